@@ -22,6 +22,12 @@ class ESP32LEDController:
         self.sock.bind((self.laptop_ip, self.laptop_port))
         self.sock.settimeout(0.1)  # Non-blocking with short timeout
         
+        # Slider throttle: mỗi key (color, brightness) gửi tối đa 1 lệnh / command_interval_ms,
+        # chỉ giữ giá trị mới nhất và luôn gửi giá trị cuối khi thả slider
+        self.command_interval_ms = 40
+        self.last_sent_at = {}  # {key: time.monotonic()}
+        self.pending_commands = {}  # {key: (func, args)}
+        
         self.setup_gui()
         
         # Start UDP listener thread
@@ -111,6 +117,29 @@ class ESP32LEDController:
         command = {"cmd": "status"}
         return self.send_command(command)
     
+    def throttle(self, key, func, *args):
+        """Gọi func(*args) ngay nếu key đã qua interval, không thì hoãn (giá trị mới ghi đè giá trị cũ)"""
+        now = time.monotonic()
+        elapsed_ms = (now - self.last_sent_at.get(key, 0.0)) * 1000
+        
+        if key not in self.pending_commands and elapsed_ms >= self.command_interval_ms:
+            self.last_sent_at[key] = now
+            func(*args)
+            return
+        
+        if key not in self.pending_commands:
+            delay = max(1, int(self.command_interval_ms - elapsed_ms))
+            self.root.after(delay, lambda: self._flush_pending(key))
+        self.pending_commands[key] = (func, args)
+    
+    def _flush_pending(self, key):
+        """Gửi giá trị mới nhất đang chờ của key"""
+        pending = self.pending_commands.pop(key, None)
+        if pending:
+            func, args = pending
+            self.last_sent_at[key] = time.monotonic()
+            func(*args)
+    
     def setup_gui(self):
         """Tạo giao diện điều khiển"""
         self.root = tk.Tk()
@@ -219,6 +248,7 @@ class ESP32LEDController:
             self.current_color = color[1]
             self.color_button.config(bg=self.current_color)
             rgb = color[0]
+            self.pending_commands.pop("color", None)  # Bỏ giá trị slider đang chờ
             self.set_color(int(rgb[0]), int(rgb[1]), int(rgb[2]))
     
     def on_rgb_change(self, val=None):
@@ -228,18 +258,19 @@ class ESP32LEDController:
         b = int(self.blue_var.get())
         self.current_color = f"#{r:02x}{g:02x}{b:02x}"
         self.color_button.config(bg=self.current_color)
-        self.set_color(r, g, b)
+        self.throttle("color", self.set_color, r, g, b)
     
     def on_brightness_change(self, val=None):
         """Xử lý thay đổi độ sáng"""
         brightness = int(self.brightness_var.get())
-        self.set_brightness(brightness)
+        self.throttle("brightness", self.set_brightness, brightness)
     
     def quick_color(self, r, g, b):
         """Đặt màu nhanh"""
         self.red_var.set(r)
         self.green_var.set(g)
         self.blue_var.set(b)
+        self.pending_commands.pop("color", None)  # Bỏ giá trị slider đang chờ
         self.set_color(r, g, b)
     
     def run(self):
@@ -251,6 +282,8 @@ class ESP32LEDController:
         try:
             self.root.mainloop()
         finally:
+            for key in list(self.pending_commands):
+                self._flush_pending(key)
             self.sock.close()
 
 if __name__ == "__main__":
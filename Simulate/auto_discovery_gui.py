@@ -10,6 +10,9 @@ import threading
 import time
 from datetime import datetime, timedelta
 from auto_discovery_manager import AutoDiscoveryManager
+from ui_update_scheduler import CoalescingUIScheduler
+from list_view_model import KeyedTreeview, KeyedListbox
+from reliable_commands import STATE_TIMEOUT
 
 class AutoDiscoveryGUI:
     """GUI cho Auto-Discovery ESP Management"""
@@ -24,6 +27,10 @@ class AutoDiscoveryGUI:
         self.auto_update_running = False
         self.discovery_running = False
         
+        # Frame-paced data display (latest packet per ESP)
+        self.ui_scheduler = CoalescingUIScheduler(
+            root, self.render_data, fps=getattr(config, 'ui_fps', 20))
+        
         # Setup callbacks
         self.manager.on_esp_discovered = self.on_esp_discovered
         self.manager.on_esp_connected = self.on_esp_connected
@@ -33,6 +40,7 @@ class AutoDiscoveryGUI:
         self.setup_window()
         self.create_widgets()
         self.start_auto_update()
+        self.ui_scheduler.start()
     
     def setup_window(self):
         """Thiết lập cửa sổ"""
@@ -149,6 +157,7 @@ class AutoDiscoveryGUI:
         # TreeView columns
         columns = ("Name", "IP", "Port", "Status", "Last Seen", "Packets")
         self.esp_tree = ttk.Treeview(tree_frame, columns=columns, show="headings", height=15)
+        self.esp_view = KeyedTreeview(self.esp_tree)
         
         # Configure columns
         column_widths = {
@@ -342,6 +351,14 @@ class AutoDiscoveryGUI:
         tk.Button(threshold_frame, text="📤 Send Threshold",
                  command=self.send_threshold,
                  bg="#4CAF50", fg="white", font=("Arial", 11)).pack(pady=5)
+        
+        tk.Button(threshold_frame, text="📢 Send to All ESPs",
+                 command=self.broadcast_threshold,
+                 bg="#FF9800", fg="white", font=("Arial", 11)).pack(pady=5)
+        
+        self.broadcast_status_label = tk.Label(threshold_frame, text="", bg="white",
+                                               font=("Arial", 9), fg="#666")
+        self.broadcast_status_label.pack()
     
     def create_config_controls(self, parent):
         """Tạo điều khiển cấu hình"""
@@ -418,6 +435,7 @@ class AutoDiscoveryGUI:
         port_section.pack(fill=tk.X, padx=10, pady=10)
         
         self.port_listbox = tk.Listbox(port_section, height=8, font=("Consolas", 9))
+        self.port_view = KeyedListbox(self.port_listbox)
         port_scrollbar = tk.Scrollbar(port_section, orient=tk.VERTICAL)
         
         self.port_listbox.config(yscrollcommand=port_scrollbar.set)
@@ -517,15 +535,13 @@ class AutoDiscoveryGUI:
             self.selected_esp_label.config(
                 text=f"🎯 {esp_name} ({esp_ip}:{esp_port}) [{status}]")
     
-    def refresh_esp_list(self):
-        """Refresh danh sách ESP"""
-        # Clear current items
-        for item in self.esp_tree.get_children():
-            self.esp_tree.delete(item)
-        
+    def refresh_esp_list(self, esps=None):
+        """Refresh danh sách ESP (chỉ cập nhật các dòng thay đổi)"""
         # Get discovered ESPs
-        esps = self.manager.get_discovered_esps()
+        if esps is None:
+            esps = self.manager.get_discovered_esps()
         
+        rows = []
         for esp in esps:
             # Calculate time since last seen
             if esp['last_heartbeat'] > 0:
@@ -549,14 +565,16 @@ class AutoDiscoveryGUI:
             # Packets info
             packets_info = f"H:{esp['heartbeat_count']} D:{esp['data_packets_received']}"
             
-            self.esp_tree.insert("", tk.END, values=(
+            rows.append((esp['ip'], (
                 esp['name'],
                 esp['ip'],
                 esp['assigned_port'],
                 status_text,
                 last_seen,
                 packets_info
-            ))
+            )))
+        
+        self.esp_view.sync(rows)
     
     def start_auto_update(self):
         """Bắt đầu auto-update"""
@@ -575,15 +593,18 @@ class AutoDiscoveryGUI:
                         if key in stats:
                             label.config(text=str(stats[key]))
                     
+                    # Snapshot ESP một lần cho cả port list và ESP list
+                    esps = self.manager.get_discovered_esps()
+                    names = {esp['ip']: esp['name'] for esp in esps}
+                    
                     # Update port assignments
-                    self.port_listbox.delete(0, tk.END)
-                    for port, esp_ip in stats.get('port_assignments', {}).items():
-                        esp_name = next((esp['name'] for esp in self.manager.get_discovered_esps() 
-                                       if esp['ip'] == esp_ip), esp_ip)
-                        self.port_listbox.insert(tk.END, f"Port {port}: {esp_name} ({esp_ip})")
+                    self.port_view.sync(
+                        (port, f"Port {port}: {names.get(esp_ip, esp_ip)} ({esp_ip})")
+                        for port, esp_ip in stats.get('port_assignments', {}).items()
+                    )
                     
                     # Update ESP list
-                    self.refresh_esp_list()
+                    self.refresh_esp_list(esps)
                     
                     # Update logs
                     self.update_log_display()
@@ -632,24 +653,31 @@ class AutoDiscoveryGUI:
         self.refresh_esp_list()
     
     def on_data_received(self, data):
-        """Callback khi nhận dữ liệu"""
-        if self.selected_esp_ip == data.get('esp_ip'):
-            # Update real-time display for selected ESP
-            timestamp = datetime.now().strftime("%H:%M:%S")
-            data_str = f"[{timestamp}] {data.get('esp_name', 'Unknown')}: "
-            
-            # Format data nicely
-            for key, value in data.items():
-                if key not in ['esp_name', 'esp_ip', 'esp_port', 'sender_ip', 'timestamp']:
-                    data_str += f"{key}={value} "
-            
-            self.data_display.insert(tk.END, data_str + "\\n")
-            self.data_display.see(tk.END)
-            
-            # Limit display length
-            lines = self.data_display.get(1.0, tk.END).split('\\n')
-            if len(lines) > 20:
-                self.data_display.delete(1.0, f"{len(lines)-20}.0")
+        """Callback khi nhận dữ liệu (thread mạng - chỉ ghi vào dirty map)"""
+        esp_ip = data.get('esp_ip')
+        if self.selected_esp_ip == esp_ip:
+            self.ui_scheduler.submit(esp_ip, data)
+    
+    def render_data(self, esp_ip, data):
+        """Thêm dòng dữ liệu mới nhất của ESP đang chọn (Tk thread, mỗi frame)"""
+        if self.selected_esp_ip != esp_ip:
+            return
+        
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        data_str = f"[{timestamp}] {data.get('esp_name', 'Unknown')}: "
+        
+        # Format data nicely
+        for key, value in data.items():
+            if key not in ['esp_name', 'esp_ip', 'esp_port', 'sender_ip', 'timestamp']:
+                data_str += f"{key}={value} "
+        
+        self.data_display.insert(tk.END, data_str + "\n")
+        self.data_display.see(tk.END)
+        
+        # Limit display length - đếm dòng qua index, không đọc lại toàn bộ text
+        line_count = int(self.data_display.index('end-1c').split('.')[0])
+        if line_count > 20:
+            self.data_display.delete(1.0, f"{line_count - 20}.0")
     
     # Control methods
     def choose_color(self):
@@ -712,8 +740,8 @@ class AutoDiscoveryGUI:
             threshold = int(self.threshold_var.get())
             command = f"THRESHOLD:{threshold}"
             
-            if self.manager.send_command_to_esp(self.selected_esp_ip, command):
-                messagebox.showinfo("Success", f"Threshold {threshold} sent successfully")
+            self.manager.send_reliable(self.selected_esp_ip, command, on_done=self._on_command_done)
+            self.add_timeline_entry(f"📤 {command} -> {self.selected_esp_ip} (waiting for confirmation)")
         except ValueError:
             messagebox.showerror("Error", "Please enter a valid number")
     
@@ -726,8 +754,51 @@ class AutoDiscoveryGUI:
         new_ip = self.resolume_ip_var.get().strip()
         command = f"RESOLUME_IP:{new_ip}"
         
-        if self.manager.send_command_to_esp(self.selected_esp_ip, command):
-            messagebox.showinfo("Success", f"Resolume IP updated to {new_ip}")
+        self.manager.send_reliable(self.selected_esp_ip, command, on_done=self._on_command_done)
+        self.add_timeline_entry(f"📤 {command} -> {self.selected_esp_ip} (waiting for confirmation)")
+    
+    def broadcast_threshold(self):
+        """Gửi threshold cho mọi ESP connected (chạy nền, chờ từng ESP xác nhận)"""
+        try:
+            threshold = int(self.threshold_var.get())
+        except ValueError:
+            messagebox.showerror("Error", "Please enter a valid number")
+            return
+        
+        operation = self.manager.broadcast_async(f"THRESHOLD:{threshold}", confirm=True)
+        self.add_timeline_entry(f"📢 THRESHOLD:{threshold} -> {operation.total} ESPs")
+        self._poll_fleet_operation(operation)
+    
+    def _poll_fleet_operation(self, operation):
+        """Cập nhật tiến độ mỗi 100 ms - Tk thread không bị chặn trong lúc broadcast"""
+        progress = operation.progress()
+        self.broadcast_status_label.config(
+            text=f"{progress['done']}/{progress['total']} done, {progress['ok']} ok, "
+                 f"{progress['failed']} failed ({progress['elapsed']:.1f}s)")
+        
+        if not operation.done:
+            self.root.after(100, lambda: self._poll_fleet_operation(operation))
+            return
+        
+        summary = operation.summary()
+        self.add_timeline_entry(f"✅ {operation.command}: {len(summary['ok'])}/{operation.total} confirmed "
+                                f"in {summary['elapsed']:.2f}s")
+        if summary['failed']:
+            self.add_timeline_entry(f"❌ No confirmation: {', '.join(sorted(summary['failed']))}")
+    
+    def _on_command_done(self, pending):
+        """Kết quả lệnh có xác nhận (thread mạng -> chuyển về Tk thread)"""
+        self.root.after(0, lambda: self._show_command_result(pending))
+    
+    def _show_command_result(self, pending):
+        if pending.confirmed:
+            self.add_timeline_entry(f"✅ {pending.command} confirmed by {pending.device} "
+                                    f"({pending.rtt * 1000:.0f} ms, {pending.attempts} attempt(s))")
+            messagebox.showinfo("Success", f"{pending.command} confirmed by {pending.device}")
+        elif pending.state == STATE_TIMEOUT:
+            self.add_timeline_entry(f"❌ {pending.command}: no confirmation from {pending.device}")
+            messagebox.showerror("Error", f"{pending.device} did not confirm {pending.command} "
+                                          f"after {pending.attempts} attempt(s)")
     
     def ping_esp(self):
         """Ping ESP"""
@@ -768,8 +839,8 @@ Statistics:
 • Heartbeat Count: {esp_data['heartbeat_count']}
 • Data Packets Received: {esp_data['data_packets_received']}
 
-Port Convention:
-• Port = 7000 + {esp_data['ip'].split('.')[-1]} = {esp_data['assigned_port']}"""
+Port Lease:
+• Port {esp_data['assigned_port']} (device id {esp_data['wire_id']}), giữ nguyên qua restart nếu bật port_lease_file"""
             
             messagebox.showinfo(f"ESP Details - {esp_data['name']}", details)
     
@@ -4,51 +4,127 @@ Auto-Discovery Port Management System
 Hệ thống tự động phát hiện ESP và cấp phát port động
 """
 
-import socket
 import threading
 import time
 import json
-from typing import Dict, List, Optional, Callable
-from dataclasses import dataclass, asdict
+from typing import Dict, List, Mapping, Optional, Callable
 from datetime import datetime
 import queue
+from udp_ingest_engine import AsyncUDPIngestEngine
+from osc_codec import is_osc_packet
+from udp_command_sender import get_shared_sender
+from telemetry_parser import parse_telemetry, TelemetryRecord
+from wire_codec import (CODEC_BIN1, CODEC_TEXT, SequenceTracker, negotiate_codec,
+                        parse_heartbeat, peek_device_id)
+from log_ring import LogRing, DEBUG, INFO, WARNING
+from ingest_metrics import IngestMetrics, DROP_PARSE_ERROR
+from discovery_protocol import AssignmentTracker, format_assignment, parse_port_ack
+from port_allocator import PortAllocator, PortExhaustedError
+from liveness import LivenessWheel
+from reliable_commands import ReliableCommandChannel
+from fleet_ops import FleetOps
+from touch_coalescer import TouchCoalescer
+from device_registry import DeviceRecord, DeviceRegistry
 
-@dataclass
-class DiscoveredESP:
-    """Thông tin ESP được phát hiện"""
-    ip: str
-    name: str = ""
-    assigned_port: int = 0
-    discovery_time: float = 0
-    last_heartbeat: float = 0
-    status: str = "Discovered"  # Discovered, Assigned, Connected, Offline
-    heartbeat_count: int = 0
-    data_packets_received: int = 0
-    
-    def to_dict(self):
-        return asdict(self)
+try:
+    from telemetry_store import TelemetryStore
+except ImportError:  # numpy chưa cài - chạy không có lịch sử telemetry
+    TelemetryStore = None
 
 class AutoDiscoveryManager:
     """Quản lý auto-discovery và dynamic port allocation"""
     
     DISCOVERY_PORT = 7000
-    PORT_BASE = 7000
     HEARTBEAT_TIMEOUT = 15.0  # 15 seconds timeout
     
-    def __init__(self, config=None):
+    def __init__(self, config=None, ingest_engine: Optional[AsyncUDPIngestEngine] = None,
+                 registry: Optional[DeviceRegistry] = None):
         self.config = config
-        self.discovered_esps: Dict[str, DiscoveredESP] = {}  # {ip: DiscoveredESP}
+        
+        # Record ESP (status: Discovered, Assigned - chờ xác nhận, Connected, Offline)
+        self.registry = registry or DeviceRegistry()
+        self.discovered_esps = self.registry  # {ip: DeviceRecord}
+        self.snapshot_max_age = 1.0 / getattr(config, 'ui_fps', 20)  # GUI đọc chung 1 snapshot/frame
         self.active_ports: Dict[int, str] = {}  # {port: esp_ip}
-        self.port_sockets: Dict[int, socket.socket] = {}  # {port: socket}
-        self.port_threads: Dict[int, threading.Thread] = {}  # {port: thread}
         
-        # Discovery socket
-        self.discovery_socket = None
-        self.discovery_thread = None
+        # Discovery port và tất cả data port dùng chung 1 event loop
+        self.ingest_engine = ingest_engine or AsyncUDPIngestEngine(name="AutoDiscovery_Ingest")
+        self._owns_engine = ingest_engine is None  # Engine truyền vào có thể đang phục vụ manager khác
+        
+        # OSC của ESP classic (/debug) cũng chạy trên ingest loop này (xem attach_osc)
+        self.osc_handler: Optional[Callable] = None
+        self.osc_port: Optional[int] = None
+        
+        # Socket gửi dùng chung (port assignment + command)
+        self.command_sender = get_shared_sender()
+        
+        # Lịch sử telemetry theo ESP (ring buffer NumPy)
+        self.telemetry_store = TelemetryStore() if TelemetryStore else None
+        
+        # Wire codec negotiation + phát hiện mất/đảo gói
+        self.preferred_codecs = tuple(getattr(config, 'wire_codecs', (CODEC_BIN1, CODEC_TEXT)))
+        self.sequence_trackers: Dict[str, SequenceTracker] = {}  # {esp_ip: tracker}
         self.running = False
         
-        # Cleanup thread
-        self.cleanup_thread = None
+        # Lease port + device id (TTL gia hạn theo heartbeat/data, lưu qua restart)
+        self.port_allocator = PortAllocator(
+            port_min=getattr(config, 'data_port_min', 7001),
+            port_max=getattr(config, 'data_port_max', 7999),
+            ttl=getattr(config, 'port_lease_ttl', 300.0),
+            lease_file=getattr(config, 'port_lease_file', None),
+            shared_port=getattr(config, 'shared_data_port', None)
+        )
+        
+        # Per-ESP ingest metrics (drop theo lý do, jitter, latency, callback time)
+        self.metrics = IngestMetrics("auto_discovery")
+        self.metrics_snapshot_interval = getattr(config, 'metrics_snapshot_interval', 5.0)
+        self.on_metrics_snapshot: Optional[Callable] = None
+        
+        # Cấp port có xác nhận + retry theo exponential backoff
+        self.assignments = AssignmentTracker(
+            base_delay=getattr(config, 'discovery_retry_base', 0.25),
+            max_attempts=getattr(config, 'discovery_max_attempts', 6)
+        )
+        
+        # Heartbeat gom theo batch trên discovery thread (không chiếm ingest loop)
+        self.heartbeat_queue = queue.SimpleQueue()
+        self.heartbeat_batch_size = getattr(config, 'discovery_batch_size', 128)
+        self.heartbeat_batches = 0
+        self.max_heartbeat_batch = 0
+        self.discovery_thread = None
+        
+        # Offline + lease TTL trên 1 timer wheel (key: esp_ip và ('lease', esp_ip))
+        self.heartbeat_timeout = getattr(config, 'heartbeat_timeout', self.HEARTBEAT_TIMEOUT)
+        self.liveness = LivenessWheel(
+            timeout=self.heartbeat_timeout,
+            tick=getattr(config, 'liveness_tick', 0.1),
+            on_expire=self._on_liveness_expired,
+            name="ESP_Liveness"
+        )
+        
+        # Lệnh cấu hình có xác nhận (THRESHOLD, RESOLUME_IP...) - reply khớp trong _process_esp_data
+        self.reliable_commands = ReliableCommandChannel(
+            self.send_command_to_esp,
+            timeout=getattr(config, 'command_timeout', 2.0),
+            retry_interval=getattr(config, 'command_retry_interval', 0.25),
+            max_attempts=getattr(config, 'command_max_attempts', 4),
+            window=getattr(config, 'command_window', 32),
+            name="ESP_Reliable_Commands"
+        )
+        
+        # Broadcast / group / rollout song song (không chặn GUI thread)
+        self.fleet = FleetOps(
+            self.send_command_to_esp,
+            lambda: [ip for ip, esp in list(self.discovered_esps.items()) if esp.status == "Connected"],
+            confirm=self.send_reliable,
+            max_concurrency=getattr(config, 'fleet_concurrency', 16),
+            log=self.add_log,
+            name="AutoDiscovery_Fleet"
+        )
+        
+        # Gộp touch theo ESP trước callback (window 0 = mỗi packet 1 callback), đổi trạng thái chạm giao ngay
+        self.touch_coalescer = TouchCoalescer(self._emit_data, getattr(config, 'touch_coalesce_window', 0.0),
+                                              name="AutoDiscovery_TouchCoalescer")
         
         # Callbacks
         self.on_esp_discovered: Optional[Callable] = None
@@ -57,8 +133,11 @@ class AutoDiscoveryManager:
         self.on_data_received: Optional[Callable] = None
         
         # Logging
-        self.log_messages = []
         self.max_logs = 500
+        self.log_messages = LogRing(self.max_logs,
+                                    level=getattr(config, 'log_level', DEBUG),
+                                    console=True,
+                                    log_file=getattr(config, 'log_file', None))
         
         print("🔍 Auto-Discovery Manager initialized")
     
@@ -69,15 +148,13 @@ class AutoDiscoveryManager:
             return False
         
         try:
-            # Setup discovery socket
-            self.discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.discovery_socket.bind(('0.0.0.0', self.DISCOVERY_PORT))
-            self.discovery_socket.settimeout(1.0)
+            # Bind discovery port vào ingest engine (có thể đã bind sẵn bởi attach_osc)
+            if not self.ingest_engine.has_port(self.DISCOVERY_PORT):
+                self.ingest_engine.add_port(self.DISCOVERY_PORT, self._on_discovery_datagram)
             
             self.running = True
             
-            # Start discovery listener thread
+            # Start discovery thread (heartbeat batch + retransmit)
             self.discovery_thread = threading.Thread(
                 target=self._discovery_loop,
                 daemon=True,
@@ -85,15 +162,13 @@ class AutoDiscoveryManager:
             )
             self.discovery_thread.start()
             
-            # Start cleanup thread
-            self.cleanup_thread = threading.Thread(
-                target=self._cleanup_loop,
-                daemon=True,
-                name="ESP_Cleanup"
-            )
-            self.cleanup_thread.start()
+            # Offline detection + lease expiry
+            self.liveness.start()
+            
+            self.metrics.start_snapshots(self.metrics_snapshot_interval, self._on_metrics_snapshot)
             
             self.add_log(f"🚀 Discovery service started on port {self.DISCOVERY_PORT}")
+            self.add_log("👂 Discovery listener started")
             return True
             
         except Exception as e:
@@ -101,105 +176,181 @@ class AutoDiscoveryManager:
             self.running = False
             return False
     
+    def _on_discovery_datagram(self, data: bytes, addr):
+        """Nhận heartbeat trên discovery port (chạy trong ingest loop) - chỉ xếp hàng"""
+        if self.osc_port == self.DISCOVERY_PORT and self.osc_handler and is_osc_packet(data):
+            self.osc_handler(data, addr)  # OSC classic dùng chung port 7000 với heartbeat
+        elif self.running:
+            self.heartbeat_queue.put((data, addr))
+    
+    def attach_osc(self, handler: Callable, port: Optional[int] = None) -> bool:
+        """Nhận OSC trên ingest loop chung - handler(data, addr), vd. OSCDispatcher.handle_datagram
+        
+        port trùng discovery port: heartbeat và OSC được tách theo byte đầu ('/' hoặc '#bundle').
+        """
+        port = port or self.DISCOVERY_PORT
+        self.osc_handler = handler
+        self.osc_port = port
+        if self.ingest_engine.has_port(port):
+            return True
+        if port == self.DISCOVERY_PORT:
+            return self.ingest_engine.add_port(port, self._on_discovery_datagram)
+        return self.ingest_engine.add_port(port, handler)
+    
     def _discovery_loop(self):
-        """Main discovery loop"""
-        self.add_log("👂 Discovery listener started")
-        
+        """Xử lý heartbeat theo batch và gửi lại PORT_ASSIGNED chưa được xác nhận"""
         while self.running:
             try:
-                data, addr = self.discovery_socket.recvfrom(1024)
-                esp_ip = addr[0]
+                deadline = self.assignments.next_deadline()
+                timeout = 0.5 if deadline is None else min(0.5, max(0.0, deadline - time.time()))
                 
-                # Parse heartbeat message
-                message = data.decode('utf-8').strip()
-                self._process_heartbeat(esp_ip, message)
+                batch = []
+                try:
+                    batch.append(self.heartbeat_queue.get(timeout=timeout))
+                    while len(batch) < self.heartbeat_batch_size:
+                        batch.append(self.heartbeat_queue.get_nowait())
+                except queue.Empty:
+                    pass
+                
+                if batch:
+                    self._process_heartbeat_batch(batch)
+                self._retransmit_assignments()
                 
-            except socket.timeout:
-                continue
             except Exception as e:
-                if self.running:
-                    self.add_log(f"❌ Discovery error: {e}")
-                break
+                self.add_log(f"❌ Discovery error: {e}")
+    
+    def _process_heartbeat_batch(self, batch: list):
+        """Gộp heartbeat trùng IP trong batch (bão heartbeat lúc cả fleet bật nguồn)"""
+        latest = {}  # {esp_ip: (message, addr, count)}
+        for data, addr in batch:
+            try:
+                message = data.decode('utf-8').strip()
+            except UnicodeDecodeError:
+                continue
+            
+            previous = latest.get(addr[0])
+            latest[addr[0]] = (message, addr, previous[2] + 1 if previous else 1)
+        
+        self.heartbeat_batches += 1
+        self.max_heartbeat_batch = max(self.max_heartbeat_batch, len(batch))
         
-        self.add_log("🔌 Discovery listener stopped")
+        for esp_ip, (message, addr, count) in latest.items():
+            port = parse_port_ack(message)
+            if port is not None:
+                self._acknowledge_assignment(esp_ip, "PORT_ACK")
+            else:
+                self._process_heartbeat(esp_ip, message, addr, count)
     
-    def _process_heartbeat(self, esp_ip: str, message: str):
+    def _process_heartbeat(self, esp_ip: str, message: str, addr=None, count: int = 1):
         """Xử lý heartbeat từ ESP"""
         current_time = time.time()
+        addr = addr or (esp_ip, 4210)
         
         try:
             # Parse heartbeat message
-            # Expected format: "HEARTBEAT:ESP_NAME" hoặc "HEARTBEAT:192.168.0.43"
+            # Expected format: "HEARTBEAT:ESP_NAME" hoặc "HEARTBEAT:ESP_NAME;CODEC=bin1,text"
+            offered_codecs = [CODEC_TEXT]
             if message.startswith("HEARTBEAT:"):
-                esp_name = message.split(":", 1)[1].strip()
+                esp_name, offered_codecs = parse_heartbeat(message)
                 if not esp_name:
                     esp_name = f"ESP_{esp_ip.split('.')[-1]}"
             else:
                 # Fallback: treat whole message as ESP name
                 esp_name = f"ESP_{esp_ip.split('.')[-1]}"
+            codec = negotiate_codec(offered_codecs, self.preferred_codecs)
             
             # Check if ESP already discovered
             if esp_ip in self.discovered_esps:
                 # Update existing ESP
                 esp_info = self.discovered_esps[esp_ip]
                 esp_info.last_heartbeat = current_time
-                esp_info.heartbeat_count += 1
+                esp_info.heartbeat_count += count
+                self._touch(esp_ip, current_time)
                 
-                # Update status if offline
-                if esp_info.status == "Offline":
-                    esp_info.status = "Connected" if esp_info.assigned_port > 0 else "Discovered"
+                # Firmware chỉ gửi heartbeat khi chưa có port -> gửi lại PORT_ASSIGNED ngay
+                if esp_info.port == 0:
+                    # Lease đã hết hạn và data port đã đóng -> cấp lại
+                    if self._assign_lease(esp_info) and self._setup_esp_data_channel(esp_info):
+                        self._send_port_assignment(esp_info, addr)
+                        if esp_info.codec != CODEC_TEXT:
+                            self._send_codec_assignment(esp_info)
+                elif esp_info.status == "Offline":
                     self.add_log(f"🔄 ESP {esp_ip} ({esp_name}) reconnected")
-                    
-                    if self.on_esp_connected:
-                        self.on_esp_connected(esp_info.to_dict())
+                    self.registry.update(esp_info, status="Assigned")
+                    self._send_port_assignment(esp_info, addr)
+                elif esp_info.status == "Assigned":
+                    if self.assignments.resend(esp_ip, addr, current_time):
+                        self._send_assignment_message(esp_info.port, addr)
+                    else:
+                        self._send_port_assignment(esp_info, addr)
+                elif esp_info.status == "Connected":
+                    # ESP khởi động lại mà data port chưa kịp timeout
+                    self._send_assignment_message(esp_info.port, addr)
+                
+                # Firmware đổi codec (vd. flash lại) -> negotiate lại
+                if codec != esp_info.codec:
+                    self.registry.update(esp_info, codec=codec)
+                    self.sequence_trackers.pop(esp_ip, None)
+                    self._send_codec_assignment(esp_info)
             else:
                 # New ESP discovered
-                assigned_port = self.calculate_port(esp_ip)
-                
-                esp_info = DiscoveredESP(
-                    ip=esp_ip,
-                    name=esp_name,
-                    assigned_port=assigned_port,
-                    discovery_time=current_time,
+                esp_info = self.registry.add(
+                    esp_ip,
+                    esp_name,
+                    registered_at=current_time,
                     last_heartbeat=current_time,
                     status="Discovered",
-                    heartbeat_count=1
+                    heartbeat_count=count,
+                    codec=codec
                 )
                 
-                self.discovered_esps[esp_ip] = esp_info
-                
-                self.add_log(f"🔍 New ESP discovered: {esp_name} ({esp_ip}) -> Port {assigned_port}")
+                assigned = self._assign_lease(esp_info)
+                self._touch(esp_ip, current_time)
+                self.add_log(f"🔍 New ESP discovered: {esp_name} ({esp_ip}) -> Port {esp_info.port}")
                 
                 # Auto-assign port và setup data channel
-                self._setup_esp_data_channel(esp_info)
+                if assigned and self._setup_esp_data_channel(esp_info):
+                    self._send_port_assignment(esp_info, addr)
+                    if codec != CODEC_TEXT:
+                        self._send_codec_assignment(esp_info)
                 
                 if self.on_esp_discovered:
-                    self.on_esp_discovered(esp_info.to_dict())
+                    self.on_esp_discovered(self.registry.view(esp_info))
         
         except Exception as e:
             self.add_log(f"❌ Heartbeat processing error from {esp_ip}: {e}")
     
-    def calculate_port(self, esp_ip: str) -> int:
-        """Tính port theo IP ESP"""
+    def calculate_port(self, esp_ip: str) -> Optional[int]:
+        """Port mà ESP sẽ được cấp (lease hiện có hoặc port trống) - không cấp thật"""
+        return self.port_allocator.peek(esp_ip)
+    
+    def _assign_lease(self, esp_info: DeviceRecord) -> bool:
+        """Lấy lease (port + device id) cho ESP - cùng IP nhận lại port cũ"""
         try:
-            last_octet = int(esp_ip.split('.')[-1])
-            port = self.PORT_BASE + last_octet
-            
-            if port < 7001 or port > 7255:
-                self.add_log(f"⚠️ Port {port} out of range for {esp_ip}")
-                return 7000 + (last_octet % 255)  # Fallback
-            
-            return port
-        except Exception as e:
-            self.add_log(f"❌ Port calculation error for {esp_ip}: {e}")
-            return 7001  # Default fallback
+            lease = self.port_allocator.allocate(esp_info.ip, esp_info.name)
+        except PortExhaustedError as e:
+            self.add_log(f"❌ {e}")
+            return False
+        
+        self.registry.set_port(esp_info, lease.port)
+        esp_info.wire_id = lease.device_id
+        return True
     
-    def _setup_esp_data_channel(self, esp_info: DiscoveredESP):
+    def _setup_esp_data_channel(self, esp_info: DeviceRecord):
         """Thiết lập kênh data cho ESP"""
         try:
-            port = esp_info.assigned_port
+            port = esp_info.port
             esp_ip = esp_info.ip
             
+            # Data port chung: bind 1 lần, phân biệt ESP theo device id / IP nguồn
+            if port == self.port_allocator.shared_port:
+                if port not in self.active_ports:
+                    self.ingest_engine.add_port(port, self._on_shared_datagram)
+                    self.active_ports[port] = "shared"
+                    self.add_log(f"👂 Shared data listener started on port {port}")
+                self.registry.update(esp_info, status="Assigned")
+                return True
+            
             # Check if port already in use
             if port in self.active_ports:
                 existing_ip = self.active_ports[port]
@@ -210,31 +361,17 @@ class AutoDiscoveryManager:
                     # Same ESP, port already setup
                     return True
             
-            # Create data socket for this ESP
-            data_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            data_socket.bind(('0.0.0.0', port))
-            data_socket.settimeout(1.0)
-            
-            # Store socket
-            self.port_sockets[port] = data_socket
-            self.active_ports[port] = esp_ip
-            
-            # Start data listener thread for this port
-            thread = threading.Thread(
-                target=self._data_listener,
-                args=(port, esp_ip),
-                daemon=True,
-                name=f"DataListener_{port}"
+            # Bind data port vào ingest engine chung
+            self.ingest_engine.add_port(
+                port,
+                lambda data, addr: self._on_data_datagram(port, esp_ip, data, addr)
             )
-            thread.start()
-            self.port_threads[port] = thread
+            self.active_ports[port] = esp_ip
             
-            # Send port assignment to ESP
-            self._send_port_assignment(esp_ip, port)
+            self.add_log(f"👂 Data listener started for {esp_ip} on port {port}")
             
-            # Update ESP status
-            esp_info.status = "Assigned"
+            # Update ESP status (PORT_ASSIGNED do caller gửi)
+            self.registry.update(esp_info, status="Assigned")
             
             self.add_log(f"🌐 Data channel setup: {esp_info.name} ({esp_ip}) on port {port}")
             return True
@@ -243,75 +380,128 @@ class AutoDiscoveryManager:
             self.add_log(f"❌ Failed to setup data channel for {esp_ip}: {e}")
             return False
     
-    def _send_port_assignment(self, esp_ip: str, port: int):
-        """Gửi thông tin port assignment về ESP"""
-        try:
-            # Send via discovery port first
-            message = f"PORT_ASSIGNMENT:{port}"
-            
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.sendto(message.encode(), (esp_ip, 4210))  # ESP listen port
-            sock.close()
-            
-            self.add_log(f"📤 Sent port assignment {port} to {esp_ip}")
+    def _send_port_assignment(self, esp_info: DeviceRecord, addr):
+        """Gửi PORT_ASSIGNED về địa chỉ nguồn của heartbeat và chờ xác nhận"""
+        self.assignments.begin(esp_info.ip, esp_info.port, addr, time.time())
+        if self._send_assignment_message(esp_info.port, addr):
+            self.add_log(f"📤 Sent port assignment {esp_info.port} to {esp_info.ip}")
+    
+    def _send_assignment_message(self, port: int, addr) -> bool:
+        if self.command_sender.send(format_assignment(port), addr):
+            return True
+        self.add_log(f"❌ Failed to send port assignment to {addr[0]}: send queue full")
+        return False
+    
+    def _retransmit_assignments(self):
+        """Gửi lại PORT_ASSIGNED đến hạn (exponential backoff)"""
+        retry, failed = self.assignments.due(time.time())
+        
+        for assignment in retry:
+            self._send_assignment_message(assignment.port, assignment.addr)
+            self.add_log("🔁 Port assignment {} -> {} (attempt {})",
+                         assignment.port, assignment.ip, assignment.attempts, level=DEBUG)
+        
+        for assignment in failed:
+            self.add_log(f"⚠️ No ACK from {assignment.ip} after {assignment.attempts} attempts, "
+                         f"waiting for next heartbeat", level=WARNING)
+    
+    def _acknowledge_assignment(self, esp_ip: str, source: str):
+        """ESP xác nhận đã nhận port (data đầu tiên hoặc PORT_ACK)"""
+        elapsed = self.assignments.acknowledge(esp_ip, time.time())
+        if elapsed is not None:
+            self.add_log("🤝 {} acknowledged port via {} after {:.0f} ms",
+                         esp_ip, source, elapsed * 1000, level=DEBUG)
             
-        except Exception as e:
-            self.add_log(f"❌ Failed to send port assignment to {esp_ip}: {e}")
+            if not self.assignments.pending and self.assignments.wave_size > 1:
+                self.add_log(f"🏁 All ESPs connected in "
+                             f"{self.assignments.time_to_all_connected():.2f}s")
+    
+    def _send_codec_assignment(self, esp_info: DeviceRecord):
+        """Báo codec đã chọn và device id cho ESP"""
+        message = f"CODEC:{esp_info.codec},ID:{esp_info.wire_id}"
+        if self.command_sender.send(message, (esp_info.ip, 4210)):
+            self.add_log(f"🤝 Codec {esp_info.codec} (id {esp_info.wire_id}) -> {esp_info.ip}")
+        else:
+            self.add_log(f"❌ Failed to send codec assignment to {esp_info.ip}")
     
-    def _data_listener(self, port: int, esp_ip: str):
-        """Data listener cho port cụ thể"""
-        socket_obj = self.port_sockets.get(port)
-        if not socket_obj:
+    def _on_shared_datagram(self, data: bytes, addr):
+        """Data port chung: frame bin1 theo device id, text theo IP nguồn"""
+        device_id = peek_device_id(data)
+        esp_ip = self.port_allocator.owner_of_device(device_id) if device_id is not None else addr[0]
+        
+        if esp_ip not in self.discovered_esps:
+            self.add_log("⚠️ Data from unknown ESP {} (device id {}) on shared port",
+                         addr[0], device_id, level=WARNING)
             return
         
-        self.add_log(f"👂 Data listener started for {esp_ip} on port {port}")
+        self._on_data_datagram(self.port_allocator.shared_port, esp_ip, data, addr)
+    
+    def _on_data_datagram(self, port: int, esp_ip: str, data: bytes, addr):
+        """Xử lý datagram trên data port (chạy trong ingest loop)"""
+        if not self.running:
+            return
         
-        while self.running and port in self.port_sockets:
-            try:
-                data, addr = socket_obj.recvfrom(4096)
-                sender_ip = addr[0]
-                
-                # Verify sender
-                if sender_ip != esp_ip:
-                    self.add_log(f"⚠️ Unexpected data from {sender_ip} on port {port} (expected {esp_ip})")
-                
-                # Update ESP status to connected
-                if esp_ip in self.discovered_esps:
-                    esp_info = self.discovered_esps[esp_ip]
-                    if esp_info.status != "Connected":
-                        esp_info.status = "Connected"
-                        self.add_log(f"✅ ESP {esp_ip} ({esp_info.name}) data connection established")
-                        
-                        if self.on_esp_connected:
-                            self.on_esp_connected(esp_info.to_dict())
-                    
-                    esp_info.data_packets_received += 1
-                
-                # Process data
-                self._process_esp_data(esp_ip, port, data, sender_ip)
+        sender_ip = addr[0]
+        arrival = time.time()
+        self.metrics.on_received(esp_ip, arrival)
+        self._touch(esp_ip, arrival)
+        
+        # Verify sender
+        if sender_ip != esp_ip:
+            self.add_log("⚠️ Unexpected data from {} on port {} (expected {})",
+                         sender_ip, port, esp_ip, level=WARNING)
+        
+        # Update ESP status to connected
+        esp_info = self.registry.get(esp_ip)
+        if esp_info is not None:
+            if esp_info.status != "Connected":
+                self.registry.update(esp_info, status="Connected")
+                self._acknowledge_assignment(esp_ip, "data")
+                self.add_log(f"✅ ESP {esp_ip} ({esp_info.name}) data connection established")
                 
-            except socket.timeout:
-                continue
-            except Exception as e:
-                if self.running:
-                    self.add_log(f"❌ Data listener error on port {port}: {e}")
-                break
+                if self.on_esp_connected:
+                    self.on_esp_connected(self.registry.view(esp_info))
+            
+            esp_info.packets_received += 1
         
-        self.add_log(f"🔌 Data listener stopped for port {port}")
+        # Process data
+        self._process_esp_data(esp_ip, port, data, sender_ip)
     
     def _process_esp_data(self, esp_ip: str, port: int, data: bytes, sender_ip: str):
         """Xử lý dữ liệu từ ESP"""
         try:
-            message = data.decode('utf-8').strip()
-            
             # Get ESP info
             esp_info = self.discovered_esps.get(esp_ip)
             if not esp_info:
                 self.add_log(f"⚠️ Data from unknown ESP: {esp_ip}")
                 return
             
-            # Parse data
-            parsed_data = self._parse_message(message)
+            # Parse trực tiếp trên bytes
+            arrival = time.time()
+            record = parse_telemetry(data)
+            
+            if record.kind == TelemetryRecord.ERROR:
+                self.metrics.on_dropped(esp_ip, DROP_PARSE_ERROR)
+            
+            if record.device_time is not None:
+                self.metrics.on_device_time(esp_ip, record.device_time, arrival)
+            
+            # Binary frame có sequence number -> đếm mất/đảo gói
+            if record.seq is not None:
+                tracker = self.sequence_trackers.get(esp_ip)
+                if tracker is None:
+                    tracker = self.sequence_trackers[esp_ip] = SequenceTracker()
+                if tracker.update(record.seq) != 'ok':
+                    esp_info.packets_lost = tracker.lost
+                    esp_info.packets_reordered = tracker.reordered
+            
+            if record.kind == TelemetryRecord.TOUCH and self.telemetry_store:
+                self.telemetry_store.append_record(esp_ip, record, arrival)
+            
+            # Reply cho lệnh đang chờ xác nhận (ACK:, "Resolume IP updated:", Threshold mới)
+            self.reliable_commands.on_record(esp_ip, record)
+            
+            parsed_data = record.to_dict()
             
             if parsed_data and self.on_data_received:
                 # Add ESP context
@@ -323,69 +513,59 @@ class AutoDiscoveryManager:
                     'timestamp': time.time()
                 })
                 
-                # Callback
-                self.on_data_received(parsed_data)
+                self.touch_coalescer.offer(esp_ip, parsed_data)
             
         except Exception as e:
             self.add_log(f"❌ Data processing error from {esp_ip}: {e}")
     
-    def _parse_message(self, message: str) -> dict:
-        """Parse message từ ESP"""
-        try:
-            data = {}
-            
-            # Handle different formats
-            if "RawTouch:" in message:
-                # Touch data: "RawTouch:1234,Threshold:2500,Value:856"
-                parts = message.split(',')
-                for part in parts:
-                    if ':' in part:
-                        key, value = part.split(':', 1)
-                        data[key.lower().replace(' ', '_')] = value.strip()
-            
-            elif message.startswith("STATUS:"):
-                # Status message
-                data['message_type'] = 'status'
-                data['status'] = message.split(':', 1)[1]
-            
-            elif message.startswith("ACK:"):
-                # Acknowledgment
-                data['message_type'] = 'acknowledgment'
-                data['ack'] = message.split(':', 1)[1]
-            
-            else:
-                # Generic message
-                data['message_type'] = 'generic'
-                data['message'] = message
-            
-            return data
-            
-        except Exception as e:
-            return {'message_type': 'error', 'error': str(e), 'raw_message': message}
+    def _emit_data(self, esp_ip: str, parsed_data: dict):
+        """Callback (từ ingest loop hoặc timer của touch coalescer)"""
+        if self.on_data_received:
+            callback_start = time.perf_counter()
+            self.on_data_received(parsed_data)
+            self.metrics.on_callback(esp_ip, time.perf_counter() - callback_start)
     
-    def _cleanup_loop(self):
-        """Cleanup offline ESPs"""
-        while self.running:
-            try:
-                current_time = time.time()
-                offline_esps = []
-                
-                for esp_ip, esp_info in self.discovered_esps.items():
-                    # Check heartbeat timeout
-                    if current_time - esp_info.last_heartbeat > self.HEARTBEAT_TIMEOUT:
-                        if esp_info.status != "Offline":
-                            esp_info.status = "Offline"
-                            offline_esps.append(esp_ip)
-                            
-                            self.add_log(f"⚠️ ESP {esp_ip} ({esp_info.name}) went offline (timeout)")
-                            
-                            if self.on_esp_disconnected:
-                                self.on_esp_disconnected(esp_info.to_dict())
-                
-                time.sleep(5)  # Check every 5 seconds
-                
-            except Exception as e:
-                self.add_log(f"❌ Cleanup error: {e}")
+    def _touch(self, esp_ip: str, now: float):
+        """Heartbeat/data từ ESP: đẩy deadline offline và gia hạn lease (O(1))"""
+        self.liveness.touch(esp_ip, now)
+        if self.port_allocator.renew(esp_ip, now) and self.port_allocator.ttl is not None:
+            self.liveness.touch(('lease', esp_ip), now, self.port_allocator.ttl)
+    
+    def _on_liveness_expired(self, key, last_seen: float):
+        """Deadline trên timer wheel đến hạn (gọi từ liveness thread)"""
+        if isinstance(key, tuple):
+            self._on_lease_expired(key[1])
+            return
+        
+        esp_info = self.discovered_esps.get(key)
+        if esp_info is None or esp_info.status == "Offline":
+            return
+        
+        self.registry.update(esp_info, status="Offline")
+        self.add_log(f"⚠️ ESP {key} ({esp_info.name}) went offline "
+                     f"(no heartbeat/data for {time.time() - last_seen:.1f}s)")
+        
+        if self.on_esp_disconnected:
+            self.on_esp_disconnected(self.registry.view(esp_info))
+    
+    def _on_lease_expired(self, esp_ip: str):
+        """Lease quá TTL: đóng data port (port vẫn giữ cho ESP tới khi dải port cạn)"""
+        esp_info = self.discovered_esps.get(esp_ip)
+        if esp_info is None or esp_info.port == 0:
+            return
+        
+        port = esp_info.port
+        self._release_data_channel(esp_info)
+        self.registry.set_port(esp_info, 0)
+        self.port_allocator.save()  # Lưu thời hạn đã gia hạn
+        self.add_log(f"⌛ Lease expired for {esp_info.name} ({esp_ip}), port {port} closed")
+    
+    def _release_data_channel(self, esp_info: DeviceRecord):
+        """Đóng data port riêng của ESP (data port chung giữ nguyên)"""
+        port = esp_info.port
+        if port in self.active_ports and port != self.port_allocator.shared_port:
+            self.ingest_engine.remove_port(port)
+            del self.active_ports[port]
     
     def send_command_to_esp(self, esp_ip: str, command: str) -> bool:
         """Gửi lệnh đến ESP qua data port"""
@@ -400,12 +580,10 @@ class AutoDiscoveryManager:
             return False
         
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            message = command.encode()
-            sock.sendto(message, (esp_ip, 4210))  # ESP command port
-            sock.close()
+            if not self.command_sender.send(command, (esp_ip, 4210)):  # ESP command port
+                raise RuntimeError("send queue full")
             
-            self.add_log(f"📤 Command sent to {esp_info.name} ({esp_ip}): {command}")
+            self.add_log("📤 Command sent to {} ({}): {}", esp_info.name, esp_ip, command, level=DEBUG)
             return True
             
         except Exception as e:
@@ -413,69 +591,106 @@ class AutoDiscoveryManager:
             return False
     
     def broadcast_command(self, command: str) -> Dict[str, bool]:
-        """Broadcast lệnh đến tất cả ESP connected"""
-        results = {}
-        
-        for esp_ip, esp_info in self.discovered_esps.items():
-            if esp_info.status == "Connected":
-                results[esp_ip] = self.send_command_to_esp(esp_ip, command)
-        
-        success_count = sum(results.values())
-        total_count = len(results)
+        """Broadcast lệnh đến tất cả ESP connected (chặn tới khi xong - GUI dùng broadcast_async)"""
+        operation = self.fleet.broadcast(command)
+        operation.wait()
+        return operation.result_map()
+    
+    def broadcast_async(self, command: str, targets=None, group: Optional[str] = None,
+                        confirm: bool = False):
+        """Gửi lệnh song song cho nhiều ESP - trả về FleetOperation ngay
         
-        self.add_log(f"📢 Broadcast: {success_count}/{total_count} successful")
-        return results
+        confirm=True: mỗi ESP chờ xác nhận qua reliable_commands.
+        """
+        return self.fleet.broadcast(command, targets=targets, group=group, confirm=confirm)
+    
+    def send_reliable(self, esp_ip: str, command: str, on_done: Optional[Callable] = None,
+                      timeout: Optional[float] = None):
+        """Gửi lệnh chờ ESP xác nhận (retry tới timeout) - trả về PendingCommand, không chặn"""
+        return self.reliable_commands.submit(esp_ip, command, timeout=timeout, on_done=on_done)
+    
+    def configure_fleet(self, command: str, esp_ips: Optional[List[str]] = None,
+                        timeout: Optional[float] = None) -> dict:
+        """Gửi lệnh cấu hình cho nhiều ESP song song và chờ xác nhận (chặn - không gọi từ GUI thread)
+        
+        Trả về {'confirmed': [ip...], 'failed': {ip: state}, 'elapsed': giây}
+        """
+        if esp_ips is None:
+            esp_ips = [ip for ip, esp in self.discovered_esps.items() if esp.status == "Connected"]
+        
+        commands = self.reliable_commands.submit_many(esp_ips, command, timeout=timeout)
+        report = ReliableCommandChannel.wait_all(commands)
+        self.add_log(f"📢 {command}: {len(report['confirmed'])}/{len(esp_ips)} confirmed "
+                     f"in {report['elapsed']:.2f}s")
+        if report['failed']:
+            self.add_log(f"⚠️ No confirmation from: {', '.join(sorted(report['failed']))}")
+        return report
     
-    def get_discovered_esps(self) -> List[dict]:
-        """Lấy danh sách ESP đã phát hiện"""
-        return [esp_info.to_dict() for esp_info in self.discovered_esps.values()]
+    def get_discovered_esps(self) -> List[Mapping]:
+        """Lấy danh sách ESP đã phát hiện (snapshot bất biến - an toàn từ thread GUI)"""
+        return list(self.registry.snapshot(self.snapshot_max_age).devices)
     
-    def get_connected_esps(self) -> List[dict]:
+    def get_connected_esps(self) -> List[Mapping]:
         """Lấy danh sách ESP đang connected"""
-        return [esp_info.to_dict() for esp_info in self.discovered_esps.values() 
-                if esp_info.status == "Connected"]
+        return [esp for esp in self.registry.snapshot(self.snapshot_max_age).devices
+                if esp.status == "Connected"]
     
     def get_statistics(self) -> dict:
-        """Lấy thống kê hệ thống"""
-        total_esps = len(self.discovered_esps)
-        connected_esps = len([esp for esp in self.discovered_esps.values() if esp.status == "Connected"])
-        offline_esps = len([esp for esp in self.discovered_esps.values() if esp.status == "Offline"])
-        
-        total_heartbeats = sum(esp.heartbeat_count for esp in self.discovered_esps.values())
-        total_data_packets = sum(esp.data_packets_received for esp in self.discovered_esps.values())
+        """Lấy thống kê hệ thống (mọi số đếm ESP từ cùng 1 snapshot)"""
+        snapshot = self.registry.snapshot(self.snapshot_max_age)
+        binary_esps = sum(1 for esp in snapshot.devices if esp.codec != CODEC_TEXT)
         
         return {
             'discovery_port': self.DISCOVERY_PORT,
-            'total_esps': total_esps,
-            'connected_esps': connected_esps,
-            'offline_esps': offline_esps,
+            'snapshot_version': snapshot.version,
+            'total_esps': snapshot.count(),
+            'connected_esps': snapshot.count("Connected"),
+            'offline_esps': snapshot.count("Offline"),
             'active_ports': len(self.active_ports),
             'port_assignments': dict(self.active_ports),
-            'total_heartbeats': total_heartbeats,
-            'total_data_packets': total_data_packets,
-            'uptime': time.time() - (min([esp.discovery_time for esp in self.discovered_esps.values()]) 
-                                   if self.discovered_esps else time.time())
+            'total_heartbeats': snapshot.total('heartbeat_count'),
+            'total_data_packets': snapshot.total('packets_received'),
+            'binary_codec_esps': binary_esps,
+            'total_packets_lost': snapshot.total('packets_lost'),
+            'assignments': self.assignments.get_stats(),
+            'port_leases': self.port_allocator.get_stats(),
+            'liveness': self.liveness.get_stats(),
+            'reliable_commands': self.reliable_commands.get_stats(),
+            'fleet': self.fleet.get_stats(),
+            'touch_coalescer': self.touch_coalescer.get_stats(),
+            'registry': self.registry.get_stats(),
+            'heartbeat_batches': self.heartbeat_batches,
+            'max_heartbeat_batch': self.max_heartbeat_batch,
+            'sender': self.command_sender.get_stats(),
+            'metrics': self.metrics.snapshot(),
+            'uptime': snapshot.taken_at - min((esp.registered_at for esp in snapshot.devices), default=snapshot.taken_at)
         }
     
+    def _on_metrics_snapshot(self, snapshot: dict):
+        """Snapshot định kỳ từ IngestMetrics"""
+        if self.on_metrics_snapshot:
+            self.on_metrics_snapshot(snapshot)
+    
     def remove_esp(self, esp_ip: str) -> bool:
         """Xóa ESP khỏi hệ thống"""
         if esp_ip not in self.discovered_esps:
             return False
         
         esp_info = self.discovered_esps[esp_ip]
-        port = esp_info.assigned_port
         
-        # Close port socket
-        if port in self.port_sockets:
-            self.port_sockets[port].close()
-            del self.port_sockets[port]
-        
-        # Remove from active ports
-        if port in self.active_ports:
-            del self.active_ports[port]
+        # Release data port, lease and liveness deadlines
+        self._release_data_channel(esp_info)
+        self.port_allocator.release(esp_ip)
+        self.liveness.remove(esp_ip)
+        self.liveness.remove(('lease', esp_ip))
+        self.reliable_commands.cancel_device(esp_ip)
+        self.fleet.remove_device(esp_ip)
+        self.touch_coalescer.discard(esp_ip)
         
         # Remove ESP
-        del self.discovered_esps[esp_ip]
+        self.registry.remove(esp_ip)
+        self.sequence_trackers.pop(esp_ip, None)
+        self.assignments.forget(esp_ip)
         
         self.add_log(f"🗑️ Removed ESP {esp_info.name} ({esp_ip})")
         return True
@@ -483,41 +698,37 @@ class AutoDiscoveryManager:
     def stop_discovery(self):
         """Dừng discovery service"""
         self.running = False
-        
-        # Close discovery socket
-        if self.discovery_socket:
-            self.discovery_socket.close()
-            self.discovery_socket = None
-        
-        # Close all data sockets
-        for socket_obj in self.port_sockets.values():
-            socket_obj.close()
-        self.port_sockets.clear()
+        self.metrics.stop_snapshots()
+        self.liveness.stop()
+        self.reliable_commands.stop()
+        
+        if self.osc_handler or not self._owns_engine:
+            # OSC vẫn nhận tiếp / engine dùng chung - chỉ đóng data port (và discovery port nếu OSC ở port khác)
+            for port in list(self.active_ports):
+                self.ingest_engine.remove_port(port)
+            if self.osc_port != self.DISCOVERY_PORT:
+                self.ingest_engine.remove_port(self.DISCOVERY_PORT)
+        else:
+            # Close discovery port and all data ports in one go
+            self.ingest_engine.stop()
         self.active_ports.clear()
+        self.assignments.clear()
+        self.port_allocator.save()
         
-        # Wait for threads
-        for thread in [self.discovery_thread, self.cleanup_thread] + list(self.port_threads.values()):
-            if thread and thread.is_alive():
-                thread.join(timeout=2)
-        
-        self.port_threads.clear()
+        # Wait for discovery thread
+        if self.discovery_thread and self.discovery_thread.is_alive():
+            self.discovery_thread.join(timeout=2)
         
+        self.touch_coalescer.stop()
         self.add_log("🛑 Discovery service stopped")
     
-    def add_log(self, message: str):
-        """Thêm log message"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        
-        self.log_messages.append(log_entry)
-        if len(self.log_messages) > self.max_logs:
-            self.log_messages.pop(0)
-        
-        print(log_entry)
+    def add_log(self, message: str, *args, level: int = INFO):
+        """Thêm log message (args được format khi đọc)"""
+        self.log_messages.log(message, *args, level=level)
     
     def get_logs(self, count: int = 50) -> List[str]:
         """Lấy logs gần nhất"""
-        return self.log_messages[-count:] if self.log_messages else []
+        return self.log_messages.get(count)
 
 # Demo và test
 if __name__ == "__main__":
@@ -542,7 +753,7 @@ if __name__ == "__main__":
         print("✅ Discovery service started")
         print("💡 Waiting for ESP heartbeats on port 7000...")
         print("📡 ESPs should send: 'HEARTBEAT:ESP_NAME' every 5 seconds")
-        print("🌐 Ports will be auto-assigned based on ESP IP")
+        print("🌐 Ports will be leased from the port allocator (7001-7999)")
         print("\\nPress Ctrl+C to stop\\n")
         
         try:
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+Benchmark Suite
+Tạo tải tái lập được cho các ingest backend (MultiESP, Port-per-ESP, Auto-Discovery):
+N cube giả lập (mỗi cube bind 1 địa chỉ 127.0.0.x), tần số và kiểu burst cấu hình được.
+Xuất JSON: throughput, latency end-to-end p50/p99/p999, drop rate, CPU / 1k packet.
+
+Latency đo được nhờ mỗi packet mang seq (raw_touch) và thời điểm gửi tính bằng µs
+(value, mod 2^31) - perf_counter là đồng hồ monotonic chung giữa các process.
+
+    python benchmark_suite.py --cubes 10 --rate 50 --duration 5 --output bench.json
+
+Scaling của sharded ingest (worker process + shared memory) theo số core:
+
+    python benchmark_suite.py --backends sharded --workers 1,2,4,8 --cubes 128 --rate 2000 --generators 4
+"""
+
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import sys
+import threading
+import time
+from typing import List, Optional
+
+from config import AppConfig
+from wire_codec import CODECS, CODEC_TEXT, CODEC_BIN1
+
+BACKENDS = ('multi_esp', 'port_per_esp', 'auto_discovery', 'sharded')
+PATTERNS = ('steady', 'burst', 'poisson')
+
+US_WRAP = 1 << 31  # value là int32
+
+
+def now_us() -> int:
+    return int(time.perf_counter() * 1_000_000) % US_WRAP
+
+
+def cube_ip(index: int) -> str:
+    """Địa chỉ loopback riêng cho mỗi cube (127.0.0.101, 127.0.0.102, ...)"""
+    return f"127.0.0.{101 + index}"
+
+
+def percentile(sorted_values: List[float], p: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))
+    return sorted_values[index]
+
+
+def _load_generator(targets, rate, pattern, burst_size, duration, codec_name,
+                    heartbeat_port, start_event, result_queue):
+    """Process tạo tải: gửi từ socket bind theo IP của từng cube"""
+    codec = CODECS[codec_name]
+    sockets = []
+    for source_ip, _ in targets:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 1024)
+        sock.bind((source_ip, 0))
+        sockets.append(sock)
+
+    sent = [0] * len(targets)
+    seqs = [0] * len(targets)
+    start_event.wait()
+    start = time.perf_counter()
+    end = start + duration
+
+    # Lịch gửi: heap (thời điểm, cube)
+    interval = 1.0 / rate
+    if pattern == 'burst':
+        interval = burst_size / rate
+    schedule = [(start + interval * index / len(targets), index) for index in range(len(targets))]
+    heapq.heapify(schedule)
+    next_heartbeat = start + 5.0
+
+    while schedule:
+        due, index = schedule[0]
+        if due >= end:
+            break
+
+        delay = due - time.perf_counter()
+        if delay > 0.0005:
+            time.sleep(delay)
+            continue
+
+        heapq.heappop(schedule)
+        sock = sockets[index]
+        target = ('127.0.0.1', targets[index][1])
+        count = burst_size if pattern == 'burst' else 1
+
+        for _ in range(count):
+            seqs[index] += 1
+            seq = seqs[index]
+            frame = codec.encode_touch(index, seq, int((due - start) * 1000), seq, index, now_us())
+            try:
+                sock.sendto(frame, target)
+                sent[index] += 1
+            except OSError:
+                pass
+
+        if pattern == 'poisson':
+            heapq.heappush(schedule, (due + random.expovariate(rate), index))
+        else:
+            heapq.heappush(schedule, (due + interval, index))
+
+        # Auto-discovery: giữ ESP không bị timeout
+        if heartbeat_port and time.perf_counter() > next_heartbeat:
+            for cube, sock in enumerate(sockets):
+                sock.sendto(f"HEARTBEAT:Bench{cube:03d}".encode(), ('127.0.0.1', heartbeat_port))
+            next_heartbeat += 5.0
+
+    for sock in sockets:
+        sock.close()
+    result_queue.put({'sent': sent, 'elapsed': time.perf_counter() - start})
+
+
+class LatencyCollector:
+    """Callback nhận dữ liệu từ backend: đo latency và đếm packet duy nhất"""
+
+    def __init__(self):
+        self.latencies_ms: List[float] = []
+        self.delivered = 0
+        self.seen = set()  # {(esp_ip, seq)}
+        self.last_delivery = None
+
+    def on_data(self, data: dict):
+        sent_us = data.get('value')
+        seq = data.get('raw_touch')
+        if not isinstance(sent_us, int) or not isinstance(seq, int):
+            return
+
+        key = (data.get('esp_ip'), seq)
+        if key in self.seen:
+            return
+        self.seen.add(key)
+
+        self.delivered += 1
+        self.latencies_ms.append(((now_us() - sent_us) % US_WRAP) / 1000.0)
+        self.last_delivery = time.perf_counter()
+
+    def on_records(self, records):
+        """Batch record từ sharded_ingest (mảng NumPy) - latency tính dạng vector"""
+        if not len(records):
+            return
+        sent_us = records['value'].astype('int64')
+        self.latencies_ms.extend((((now_us() - sent_us) % US_WRAP) / 1000.0).tolist())
+        self.delivered += len(records)
+        self.last_delivery = time.perf_counter()
+
+
+def _poll_records(backend, collector: LatencyCollector, stop_event):
+    """Thread đọc ring shared memory của sharded backend"""
+    while not stop_event.is_set():
+        collector.on_records(backend.read_records())
+        stop_event.wait(0.002)
+    collector.on_records(backend.read_records())
+
+
+def _bench_config(args):
+    config = AppConfig()
+    config.osc_port = args.port
+    config.log_level = "INFO"  # Không log từng packet khi đo
+    config.metrics_snapshot_interval = 3600
+    return config
+
+
+def _start_backend(name: str, args, collector: LatencyCollector, cube_ips: List[str], workers: int = 1):
+    """Khởi động backend, trả về (backend, targets, heartbeat_port, stop)"""
+    config = _bench_config(args)
+
+    if name == 'sharded':
+        # Đo riêng ingest + parse: record đọc theo batch từ shared memory, không callback từng packet
+        from sharded_ingest import ShardedIngest
+        backend = ShardedIngest(workers=workers, ring_capacity=1 << 18, name="Bench_Shard")
+        targets = []
+        for index, ip in enumerate(cube_ips):
+            port = args.port + 1 + index
+            backend.add_port(port, host='127.0.0.1')
+            targets.append((ip, port))
+
+        stop_event = threading.Event()
+        poller = threading.Thread(target=_poll_records, args=(backend, collector, stop_event), daemon=True)
+        poller.start()
+
+        def stop():
+            stop_event.set()
+            poller.join(timeout=2)
+            backend.stop()
+
+        return backend, targets, 0, stop
+
+    if name == 'multi_esp':
+        from multi_esp_communication import MultiESPCommunicationHandler
+        backend = MultiESPCommunicationHandler(config)
+        backend.on_data_update = collector.on_data
+        backend.start_communication()
+        return backend, [(ip, args.port) for ip in cube_ips], 0, backend.stop_communication
+
+    if name == 'port_per_esp':
+        from port_per_esp_manager import PortPerESPManager
+        backend = PortPerESPManager(config)
+        backend.on_data_received = collector.on_data
+        for index, ip in enumerate(cube_ips):
+            backend.register_esp(ip, f"Bench{index:03d}")
+        backend.start_communication()
+        targets = [(ip, backend.esp_devices[ip].port) for ip in cube_ips]
+        return backend, targets, 0, backend.stop_communication
+
+    if name == 'auto_discovery':
+        from auto_discovery_manager import AutoDiscoveryManager
+        backend = AutoDiscoveryManager(config)
+        backend.on_data_received = collector.on_data
+        backend.start_discovery()
+
+        # Handshake: heartbeat từ IP của từng cube rồi chờ được cấp port
+        codec_option = f";CODEC={args.codec}" if args.codec != CODEC_TEXT else ""
+        for index, ip in enumerate(cube_ips):
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.bind((ip, 0))
+                sock.sendto(f"HEARTBEAT:Bench{index:03d}{codec_option}".encode(),
+                            ('127.0.0.1', backend.DISCOVERY_PORT))
+
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            if all(ip in backend.discovered_esps and backend.discovered_esps[ip].port
+                   for ip in cube_ips):
+                break
+            time.sleep(0.01)
+
+        targets = [(ip, backend.discovered_esps[ip].port) for ip in cube_ips]
+        return backend, targets, backend.DISCOVERY_PORT, backend.stop_discovery
+
+    raise ValueError(f"Unknown backend: {name}")
+
+
+def _backend_drops(backend) -> dict:
+    metrics = getattr(backend, 'metrics', None)
+    if metrics:
+        return metrics.snapshot()['dropped']
+    if hasattr(backend, 'records_overrun'):
+        return {'ring_overrun': backend.records_overrun}
+    return {}
+
+
+def _worker_cpu(backend) -> float:
+    """CPU time của worker process (sharded backend)"""
+    if not hasattr(backend, 'worker_stats'):
+        return 0.0
+    return sum(stats.get('cpu_time', 0.0) for stats in backend.worker_stats())
+
+
+def run_backend(name: str, args, workers: int = 1) -> dict:
+    """Chạy 1 backend với tải đã cấu hình"""
+    cube_ips = [cube_ip(index) for index in range(args.cubes)]
+    collector = LatencyCollector()
+    backend, targets, heartbeat_port, stop = _start_backend(name, args, collector, cube_ips, workers)
+
+    try:
+        start_event = multiprocessing.Event()
+        result_queue = multiprocessing.Queue()
+        # Nhiều process tạo tải khi 1 process không đủ bão hòa backend
+        generator_count = max(1, min(args.generators, len(targets)))
+        generators = [multiprocessing.Process(
+            target=_load_generator,
+            args=(targets[index::generator_count], args.rate, args.pattern, args.burst_size, args.duration,
+                  args.codec, heartbeat_port, start_event, result_queue),
+            daemon=True
+        ) for index in range(generator_count)]
+        for generator in generators:
+            generator.start()
+        time.sleep(0.2)
+
+        cpu_start = time.process_time() + _worker_cpu(backend)
+        wall_start = time.perf_counter()
+        start_event.set()
+
+        generator_results = [result_queue.get(timeout=args.duration + 30) for _ in generators]
+        for generator in generators:
+            generator.join(timeout=5)
+
+        # Chờ backend xử lý hết packet còn lại
+        time.sleep(args.drain)
+        cpu_used = time.process_time() + _worker_cpu(backend) - cpu_start
+        wall_elapsed = (collector.last_delivery or time.perf_counter()) - wall_start
+        backend_drops = _backend_drops(backend)
+    finally:
+        stop()
+        time.sleep(0.3)  # Nhả port trước backend tiếp theo
+
+    sent = sum(sum(result['sent']) for result in generator_results)
+    generator_result = {'elapsed': max(result['elapsed'] for result in generator_results)}
+    latencies = sorted(collector.latencies_ms)
+
+    return {
+        'backend': name,
+        'workers': workers if name == 'sharded' else None,
+        'sent': sent,
+        'delivered': collector.delivered,
+        'drop_rate': (sent - collector.delivered) / sent if sent else 0.0,
+        'backend_drops': backend_drops,
+        'offered_pps': sent / generator_result['elapsed'] if generator_result['elapsed'] else 0.0,
+        'throughput_pps': collector.delivered / wall_elapsed if wall_elapsed > 0 else 0.0,
+        'latency_ms': {
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'p999': percentile(latencies, 99.9),
+            'max': latencies[-1] if latencies else None,
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+        },
+        'cpu_ms_per_1k_packets': cpu_used * 1000 / collector.delivered * 1000 if collector.delivered else None,
+    }
+
+
+def _scaling(results: List[dict]) -> List[dict]:
+    """Speedup / hiệu suất của sharded theo số worker (so với số worker nhỏ nhất)"""
+    runs = sorted((result for result in results if result['backend'] == 'sharded'),
+                  key=lambda result: result['workers'])
+    if not runs or not runs[0]['throughput_pps']:
+        return []
+    base = runs[0]
+    scaling = []
+    for result in runs:
+        speedup = result['throughput_pps'] / base['throughput_pps']
+        scaling.append({
+            'workers': result['workers'],
+            'throughput_pps': result['throughput_pps'],
+            'speedup': speedup,
+            'efficiency': speedup * base['workers'] / result['workers'],
+        })
+    return scaling
+
+
+def run_suite(args) -> dict:
+    results = []
+    for name in args.backends:
+        for workers in (args.workers if name == 'sharded' else (1,)):
+            label = f"{name} x{workers}" if name == 'sharded' else name
+            print(f"🔥 {label}: {args.cubes} cubes x {args.rate} pps ({args.pattern}, {args.codec})")
+            result = run_backend(name, args, workers)
+            latency = result['latency_ms']
+            print(f"   ✅ {result['throughput_pps']:.0f} pps, drop {result['drop_rate'] * 100:.2f}%, "
+                  f"p50 {latency['p50'] or 0:.2f} ms, p99 {latency['p99'] or 0:.2f} ms, "
+                  f"p999 {latency['p999'] or 0:.2f} ms, "
+                  f"CPU {result['cpu_ms_per_1k_packets'] or 0:.1f} ms/1k")
+            results.append(result)
+
+    scaling = _scaling(results)
+    for row in scaling:
+        print(f"📈 sharded x{row['workers']}: {row['throughput_pps']:.0f} pps, "
+              f"speedup {row['speedup']:.2f}, efficiency {row['efficiency'] * 100:.0f}%")
+
+    return {
+        'timestamp': time.time(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'params': {
+            'cubes': args.cubes,
+            'rate_per_cube': args.rate,
+            'pattern': args.pattern,
+            'burst_size': args.burst_size,
+            'duration': args.duration,
+            'codec': args.codec,
+            'generators': args.generators,
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+        'scaling': scaling,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ESP ingest benchmark suite (loopback)")
+    parser.add_argument('--backends', default=','.join(BACKENDS),
+                        type=lambda value: [name.strip() for name in value.split(',') if name.strip()],
+                        help="Comma-separated: " + ", ".join(BACKENDS))
+    parser.add_argument('--cubes', type=int, default=10, help="Số cube giả lập (tối đa 150)")
+    parser.add_argument('--rate', type=float, default=10.0, help="Packet/giây cho mỗi cube")
+    parser.add_argument('--pattern', choices=PATTERNS, default='steady')
+    parser.add_argument('--burst-size', type=int, default=10, help="Số packet mỗi burst")
+    parser.add_argument('--duration', type=float, default=5.0, help="Thời gian gửi (giây)")
+    parser.add_argument('--codec', choices=(CODEC_TEXT, CODEC_BIN1), default=CODEC_TEXT)
+    parser.add_argument('--port', type=int, default=7000, help="Port của MultiESP backend")
+    parser.add_argument('--workers', default='1',
+                        type=lambda value: [int(count) for count in value.split(',') if count.strip()],
+                        help="Sharded backend: danh sách số worker process, vd. 1,2,4")
+    parser.add_argument('--generators', type=int, default=1, help="Số process tạo tải")
+    parser.add_argument('--drain', type=float, default=1.0, help="Thời gian chờ xử lý nốt (giây)")
+    parser.add_argument('--output', help="Ghi kết quả JSON ra file (mặc định in ra stdout)")
+    args = parser.parse_args(argv)
+
+    args.cubes = max(1, min(args.cubes, 150))  # 127.0.0.101 - 127.0.0.250
+    unknown = [name for name in args.backends if name not in BACKENDS]
+    if unknown:
+        parser.error(f"Unknown backend(s): {', '.join(unknown)}")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run_suite(args)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Results saved to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Outbound Command Scheduler
+Gom lệnh gửi ESP theo (device, key): trong cửa sổ coalescing chỉ giữ giá trị mới nhất của mỗi key
+(màu LED, độ sáng, DIR...), giới hạn số lệnh/giây cho mỗi cube và luôn gửi giá trị cuối cùng.
+Kéo slider nhanh không còn bắn hàng trăm packet làm đầy event queue (10 slot) của firmware
+"""
+
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+
+class _OnceKey:
+    """Key riêng cho lệnh không gộp (mỗi lần submit 1 key mới)"""
+
+    __slots__ = ()
+
+
+class _DeviceState:
+    """Lệnh đang chờ và thời điểm gửi gần nhất của 1 device"""
+
+    __slots__ = ('pending', 'last_send', 'key_last_send', 'last_sent', 'scheduled_at')
+
+    def __init__(self):
+        self.pending: "OrderedDict[Hashable, object]" = OrderedDict()  # {key: command} theo thứ tự
+        self.last_send = 0.0
+        self.key_last_send: Dict[Hashable, float] = {}
+        self.last_sent: Dict[Hashable, object] = {}  # Giá trị đã gửi gần nhất theo key
+        self.scheduled_at: Optional[float] = None
+
+
+class CommandScheduler:
+    """Coalescing + rate cap cho lệnh gửi đi - send(device, command) chạy trên thread riêng"""
+
+    def __init__(self, send: Callable, window: float = 0.05, max_rate: float = 30.0,
+                 dedupe: bool = True, dedupe_ttl: float = 1.0, name: str = "Command_Scheduler"):
+        self.send = send
+        self.window = window  # Khoảng cách tối thiểu giữa 2 lần gửi cùng 1 key
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0  # Giữa 2 lệnh bất kỳ của 1 device
+        self.dedupe = dedupe  # Bỏ lệnh trùng giá trị đã gửi của key đó
+        # Giá trị đã gửi chỉ được coi là trạng thái của ESP trong dedupe_ttl giây
+        # (gói UDP mất / ESP reboot: gửi lại cùng màu, DIR:1... vẫn đi)
+        self.dedupe_ttl = dedupe_ttl
+        self.name = name
+
+        self.devices: Dict[Hashable, _DeviceState] = {}
+        self._heap: List[Tuple[float, int, Hashable]] = []  # (due, counter, device)
+        self._counter = 0
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.running = False
+
+        # Statistics
+        self.submitted = 0
+        self.sent = 0
+        self.coalesced = 0  # Bị giá trị mới hơn cùng key thay thế
+        self.deduplicated = 0
+        self.send_errors = 0
+
+    def start(self):
+        with self._cond:
+            if self.running:
+                return
+            self.running = True
+            self._thread = threading.Thread(target=self._run, daemon=True, name=self.name)
+            self._thread.start()
+
+    def submit(self, device: Hashable, key: Optional[Hashable], command) -> None:
+        """Đưa lệnh vào hàng đợi của device
+
+        key=None: lệnh không gộp (toggle, CONFIG...) - luôn gửi, giữ thứ tự với lệnh khác.
+        """
+        if not self.running:
+            self.start()
+
+        now = time.monotonic()
+        with self._cond:
+            self.submitted += 1
+            state = self.devices.get(device)
+            if state is None:
+                state = self.devices[device] = _DeviceState()
+
+            if key is None:
+                key = _OnceKey()
+            elif key in state.pending:
+                self.coalesced += 1
+                if not self._barrier_after(state, key):
+                    state.pending[key] = command  # Giữ vị trí cũ trong hàng đợi
+                    return
+                # Có lệnh không gộp xếp sau giá trị cũ: giá trị mới phải đi sau nó
+                del state.pending[key]
+
+            state.pending[key] = command
+            self._schedule(device, state, now)
+
+    @staticmethod
+    def _barrier_after(state: _DeviceState, key: Hashable) -> bool:
+        """Có lệnh không gộp nào đang chờ sau key không"""
+        seen = False
+        for pending_key in state.pending:
+            if seen and isinstance(pending_key, _OnceKey):
+                return True
+            seen = seen or pending_key == key
+        return False
+
+    @staticmethod
+    def _candidates(state: _DeviceState):
+        """Lệnh đang chờ có thể gửi kế tiếp: dừng ở lệnh không gộp đầu tiên - nó chỉ được gửi khi
+        đứng đầu hàng (không vượt lệnh trước), lệnh sau nó không vượt nó"""
+        for index, (key, command) in enumerate(state.pending.items()):
+            if isinstance(key, _OnceKey):
+                if index == 0:
+                    yield key, command
+                return
+            yield key, command
+
+    def _next_due(self, state: _DeviceState, now: float) -> Optional[float]:
+        """Thời điểm sớm nhất device được gửi lệnh kế tiếp"""
+        if not state.pending:
+            return None
+        key_due = min(state.key_last_send.get(key, 0.0) + self.window for key, _ in self._candidates(state))
+        return max(now, state.last_send + self.min_interval, key_due)
+
+    def _schedule(self, device: Hashable, state: _DeviceState, now: float):
+        due = self._next_due(state, now)
+        if due is None or (state.scheduled_at is not None and state.scheduled_at <= due):
+            return
+        state.scheduled_at = due
+        self._counter += 1
+        heapq.heappush(self._heap, (due, self._counter, device))
+        self._cond.notify()
+
+    def _pop_ready(self, device: Hashable, state: _DeviceState, now: float):
+        """Lấy lệnh đầu tiên (theo thứ tự) mà key đã qua cửa sổ coalescing"""
+        for key, command in self._candidates(state):
+            if now >= state.key_last_send.get(key, 0.0) + self.window:
+                del state.pending[key]
+                return key, command
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self.running and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                if not self.running:
+                    return
+
+                now = time.monotonic()
+                _, _, device = heapq.heappop(self._heap)
+                state = self.devices[device]
+                state.scheduled_at = None
+
+                item = self._pop_ready(device, state, now) if now >= state.last_send + self.min_interval else None
+                skip = False
+                if item is not None:
+                    key, command = item
+                    if (self.dedupe and state.last_sent.get(key, object()) == command
+                            and now - state.key_last_send[key] < self.dedupe_ttl):
+                        self.deduplicated += 1
+                        skip = True
+                    else:
+                        state.last_send = now
+                        if not isinstance(key, _OnceKey):
+                            state.key_last_send[key] = now
+                            state.last_sent[key] = command
+
+                self._schedule(device, state, now)
+
+            if item is not None and not skip:
+                self._send(device, item[1])
+
+    def _send(self, device: Hashable, command):
+        try:
+            if self.send(device, command) is False:
+                self.send_errors += 1
+            else:
+                self.sent += 1
+        except Exception as e:
+            self.send_errors += 1
+            print(f"Command scheduler send error to {device}: {e}")
+
+    def flush(self, device: Optional[Hashable] = None):
+        """Gửi ngay mọi lệnh đang chờ (bỏ qua rate cap) - dùng khi đóng ứng dụng"""
+        with self._cond:
+            targets = [device] if device is not None else list(self.devices)
+            batches = []
+            for target in targets:
+                state = self.devices.get(target)
+                if state and state.pending:
+                    batches.append((target, list(state.pending.values())))
+                    state.pending.clear()
+
+        for target, commands in batches:
+            for command in commands:
+                self._send(target, command)
+
+    def stop(self, flush: bool = True):
+        if flush:
+            self.flush()
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+        if self._thread and self._thread.is_alive() and threading.current_thread() is not self._thread:
+            self._thread.join(timeout=1)
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            pending = sum(len(state.pending) for state in self.devices.values())
+        return {
+            'submitted': self.submitted,
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'deduplicated': self.deduplicated,
+            'send_errors': self.send_errors,
+            'pending': pending,
+            'window_ms': self.window * 1000,
+            'max_rate': 1.0 / self.min_interval if self.min_interval else None,
+        }
+
+
+# Demo: kéo 3 slider RGB 1 giây (~60 callback/giây mỗi slider) + đổi chiều giữa chừng
+if __name__ == "__main__":
+    log: List[Tuple[float, str, object]] = []
+    scheduler = CommandScheduler(lambda device, command: log.append((time.monotonic(), device, command)),
+                                 window=0.05, max_rate=30)
+
+    start = time.monotonic()
+    for step in range(180):
+        value = step * 255 // 179
+        scheduler.submit("192.168.0.43", "color", f"{value} 0 {255 - value}")
+        if step == 90:
+            scheduler.submit("192.168.0.43", "dir", "DIR:1")
+        if step % 3 == 0:
+            scheduler.submit("192.168.0.44", "color", f"0 {value} 0")
+        time.sleep(1 / 180)
+
+    time.sleep(0.3)
+    scheduler.stop()
+
+    for device in ("192.168.0.43", "192.168.0.44"):
+        sent = [command for _, target, command in log if target == device]
+        times = [t for t, target, _ in log if target == device]
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        print(f"📤 {device}: {len(sent)} packets, min gap {min(gaps) * 1000:.1f} ms, last = {sent[-1]!r}")
+
+    assert [c for _, d, c in log if d == "192.168.0.43"][-1] == "255 0 0", "final value must be delivered"
+    assert "DIR:1" in [c for _, _, c in log]
+    print(f"📊 {scheduler.get_stats()} (elapsed {time.monotonic() - start:.2f}s)")
+
+    # Giá trị gửi sau lệnh không gộp (CONFIG) không được vượt lệnh đó
+    ordered: List[object] = []
+    scheduler = CommandScheduler(lambda device, command: ordered.append(command), window=0.05, max_rate=30)
+    for key, command in (('color', '1 1 1'), ('color', '2 2 2'), (None, 'CONFIG:1'), ('color', '3 3 3')):
+        scheduler.submit('esp', key, command)
+    time.sleep(0.3)
+    scheduler.stop()
+    assert ordered.index('CONFIG:1') < ordered.index('3 3 3') and ordered[-1] == '3 3 3', ordered
+    print(f"🔒 FIFO after CONFIG: {ordered}")
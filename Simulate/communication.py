@@ -4,20 +4,37 @@ Communication module for Cube Touch Monitor
 Xử lý tất cả giao tiếp UDP, OSC và logging
 """
 
-import socket
 import datetime
 from typing import Optional, Callable
+from udp_command_sender import get_shared_sender
+from log_ring import LogRing, DEBUG, INFO, WARNING, ERROR
+from reliable_commands import ReliableCommandChannel
+from telemetry_parser import TelemetryRecord
 
 class CommunicationHandler:
     """Xử lý giao tiếp và logging"""
     
     def __init__(self, config):
         self.config = config
-        self.log_messages = []
+        self.log_messages = LogRing(config.max_log_entries,
+                                    level=getattr(config, 'log_level', DEBUG),
+                                    log_file=getattr(config, 'log_file', None))
         self.total_packets_sent = 0
         self.total_packets_received = 0
         self.connection_status = "Disconnected"
         
+        # Socket gửi dùng chung thay cho tạo socket mỗi lệnh
+        self.command_sender = get_shared_sender()
+        
+        # Lệnh cấu hình chờ ESP xác nhận qua OSC /debug (Threshold:, "Resolume IP updated:", ACK:)
+        self.reliable_commands = ReliableCommandChannel(
+            lambda device, command: self.send_udp_command(command),
+            timeout=getattr(config, 'command_timeout', 2.0),
+            retry_interval=getattr(config, 'command_retry_interval', 0.25),
+            max_attempts=getattr(config, 'command_max_attempts', 4),
+            name="Classic_Reliable_Commands"
+        )
+        
         # Callback functions
         self.on_data_update: Optional[Callable] = None
         
@@ -28,22 +45,17 @@ class CommunicationHandler:
             'threshold': "N/A"
         }
     
-    def add_log(self, message: str):
-        """Thêm log message"""
-        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        self.log_messages.append(log_entry)
-        
-        if len(self.log_messages) > self.config.max_log_entries:
-            self.log_messages.pop(0)
+    def add_log(self, message: str, *args, level: int = INFO):
+        """Thêm log message (args được format khi đọc)"""
+        self.log_messages.log(message, *args, level=level)
     
     def get_logs(self) -> list:
         """Lấy danh sách logs"""
-        return self.log_messages.copy()
+        return self.log_messages.get()
     
     def clear_logs(self):
         """Xóa logs"""
-        self.log_messages = []
+        self.log_messages.clear()
         self.add_log("Logs cleared")
     
     def export_logs(self, filename: str = None) -> str:
@@ -58,25 +70,28 @@ class CommunicationHandler:
             self.add_log(f"Logs exported to {filename}")
             return filename
         except Exception as e:
-            self.add_log(f"Failed to export logs: {str(e)}")
+            self.add_log("Failed to export logs: {}", e, level=ERROR)
             raise
     
     def send_udp_command(self, command: str) -> bool:
         """Gửi lệnh UDP đến ESP32"""
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            message = command.encode()
-            sock.sendto(message, (self.config.esp_ip, self.config.esp_port))
-            sock.close()
+            if not self.command_sender.send(command, (self.config.esp_ip, self.config.esp_port)):
+                self.add_log("Error sending command '{}': send queue full", command, level=ERROR)
+                return False
             
             self.total_packets_sent += 1
-            self.add_log(f"Sent command: {command}")
+            self.add_log("Sent command: {}", command, level=DEBUG)
             return True
             
         except Exception as e:
-            self.add_log(f"Error sending command '{command}': {str(e)}")
+            self.add_log("Error sending command '{}': {}", command, e, level=ERROR)
             return False
     
+    def send_reliable(self, command: str, on_done: Optional[Callable] = None):
+        """Gửi lệnh chờ ESP xác nhận (retry tới timeout) - trả về PendingCommand, không chặn"""
+        return self.reliable_commands.submit('esp', command, on_done=on_done)
+    
     def handle_osc_data(self, address, *args):
         """Xử lý dữ liệu OSC từ ESP32"""
         if not args:
@@ -93,13 +108,22 @@ class CommunicationHandler:
                 self.current_state['raw_touch'] = line.replace("RawTouch:", "").strip()
             elif "Threshold:" in line:
                 self.current_state['threshold'] = line.replace("Threshold:", "").strip()
+                if self.current_state['threshold'].isdigit():
+                    self.reliable_commands.on_record('esp', TelemetryRecord(
+                        TelemetryRecord.TOUCH, threshold=int(self.current_state['threshold'])))
             elif line.strip().isdigit():
                 self.current_state['value'] = line.strip()
+            elif line.startswith("Resolume IP updated:"):
+                self.reliable_commands.on_record('esp', TelemetryRecord(
+                    TelemetryRecord.IP_UPDATE_CONFIRM, text=line.strip()))
+            elif line.startswith("ACK:"):
+                self.reliable_commands.on_record('esp', TelemetryRecord(
+                    TelemetryRecord.ACK, text=line.split(':', 1)[1].strip()))
         
         # Log dữ liệu nhận được
-        self.add_log(f"Received - RawTouch: {self.current_state['raw_touch']}, "
-                    f"Value: {self.current_state['value']}, "
-                    f"Threshold: {self.current_state['threshold']}")
+        self.add_log("Received - RawTouch: {}, Value: {}, Threshold: {}",
+                     self.current_state['raw_touch'], self.current_state['value'],
+                     self.current_state['threshold'], level=DEBUG)
         
         # Callback để cập nhật GUI
         if self.on_data_update:
@@ -122,8 +146,12 @@ class CommunicationHandler:
         self.total_packets_received = 0
         self.add_log("Statistics reset")
     
-    def update_resolume_ip(self, new_ip: str) -> bool:
-        """Cập nhật IP Resolume và gửi lệnh đến ESP32"""
+    def update_resolume_ip(self, new_ip: str, on_done: Optional[Callable] = None) -> bool:
+        """Cập nhật IP Resolume và gửi lệnh đến ESP32
+        
+        True = lệnh đã gửi; ESP không xác nhận trong timeout thì config được rollback
+        và on_done(PendingCommand) báo kết quả.
+        """
         try:
             # Kiểm tra format IP
             parts = new_ip.split('.')
@@ -134,16 +162,21 @@ class CommunicationHandler:
             old_ip = self.config.resolume_ip
             self.config.resolume_ip = new_ip
             
-            # Gửi lệnh đến ESP32
-            success = self.send_ip_config(new_ip)
+            def on_reply(pending):
+                if pending.confirmed:
+                    self.add_log(f"Resolume IP updated: {old_ip} -> {new_ip} "
+                                 f"(confirmed in {pending.rtt * 1000:.0f} ms)")
+                elif self.config.resolume_ip == new_ip:
+                    # Rollback nếu ESP không xác nhận
+                    self.config.resolume_ip = old_ip
+                    self.add_log(f"ESP did not confirm Resolume IP {new_ip} ({pending.state}), "
+                                 f"reverted to {old_ip}", level=WARNING)
+                if on_done:
+                    on_done(pending)
             
-            if success:
-                self.add_log(f"Resolume IP updated: {old_ip} -> {new_ip}")
-                return True
-            else:
-                # Rollback nếu gửi thất bại
-                self.config.resolume_ip = old_ip
-                return False
+            # Gửi lệnh đến ESP32 (chờ xác nhận)
+            self.send_ip_config(new_ip, on_done=on_reply)
+            return True
                 
         except ValueError as e:
             self.add_log(f"Invalid IP format: {new_ip}")
@@ -152,11 +185,11 @@ class CommunicationHandler:
             self.add_log(f"Error updating Resolume IP: {str(e)}")
             return False
     
-    def send_ip_config(self, ip: str) -> bool:
-        """Gửi lệnh cấu hình IP đến ESP32"""
+    def send_ip_config(self, ip: str, on_done: Optional[Callable] = None):
+        """Gửi lệnh cấu hình IP đến ESP32 - trả về PendingCommand"""
         # Format: RESOLUME_IP:192.168.0.241
         command = f"RESOLUME_IP:{ip}"
-        return self.send_udp_command(command)
+        return self.send_reliable(command, on_done=on_done)
     
     def get_current_resolume_ip(self) -> str:
         """Lấy IP Resolume hiện tại"""
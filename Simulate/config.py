@@ -38,4 +38,72 @@ class AppConfig:
         self.default_brightness = 128
         
         # Logging
-        self.max_log_entries = 100
\ No newline at end of file
+        self.max_log_entries = 100
+        self.log_level = "DEBUG"  # "INFO" để tắt log từng packet khi chạy show
+        self.log_file = None  # Đường dẫn file log (ghi ở thread nền)
+        
+        # GUI
+        self.ui_fps = 20  # Tần số vẽ lại dữ liệu realtime (FPS)
+        
+        # Wire protocol - codec ưu tiên khi ESP quảng bá trong heartbeat (text luôn là fallback)
+        self.wire_codecs = ("bin1", "text")
+        
+        # Metrics
+        self.metrics_snapshot_interval = 5.0  # Giây giữa 2 snapshot ingest metrics
+        
+        # Ingest pipeline (receive → decode → aggregate → dispatch) của Multi-ESP / Port-per-ESP:
+        # mỗi stage có queue bounded; policy khi đầy: drop_oldest | drop_newest | block (stage trước chờ,
+        # quá block_timeout thì bỏ) | coalesce_latest (mỗi ESP giữ 1 touch mới nhất, STATUS/ACK không bị gộp).
+        # 'decode': block chỉ dùng được với Multi-ESP (thread receive riêng); Port-per-ESP nhận trên
+        # ingest loop chung của mọi port nên decode block bị từ chối (ValueError)
+        self.pipeline_stages = {
+            'decode': {'maxsize': 1000, 'policy': 'drop_oldest'},
+            'aggregate': {'maxsize': 1000, 'policy': 'drop_oldest'},
+            'dispatch': {'maxsize': 500, 'policy': 'drop_oldest'},  # 'coalesce_latest' khi GUI chậm
+        }
+        
+        # Touch coalescing trước callback GUI: > 0 = mỗi ESP tối đa 1 update mỗi window (giây), giữ
+        # RawTouch/Value mới nhất + 'merged' (số packet đã gộp); chạm/thả (vượt threshold) luôn giao ngay
+        self.touch_coalesce_window = 0.0  # Vd. 0.05 (= ui_fps 20) khi ESP gửi dày
+        
+        # Auto-discovery - PORT_ASSIGNED gửi lại theo exponential backoff tới khi ESP xác nhận
+        self.discovery_retry_base = 0.25  # Giây chờ trước lần gửi lại đầu tiên (x2 mỗi lần)
+        self.discovery_max_attempts = 6
+        self.discovery_batch_size = 128  # Số heartbeat tối đa xử lý mỗi batch
+        
+        # Data port lease (PortAllocator) - ưu tiên 70XX theo octet cuối, trùng thì lấy port trống
+        self.data_port_min = 7001
+        self.data_port_max = 7999
+        self.port_lease_ttl = 300.0  # Giây không có heartbeat/data thì đóng data port
+        self.port_lease_file = None  # Đường dẫn JSON để ESP giữ port sau khi restart
+        self.shared_data_port = None  # Vd. 7500: mọi ESP gửi về 1 port, phân biệt theo device id
+        
+        # Sharded ingest (Port-per-ESP): > 0 = số worker process nhận + parse data port riêng,
+        # kết quả đọc qua shared memory (shared_data_port vẫn chạy trong process chính)
+        self.ingest_workers = 0
+        self.sharded_poll_interval = 0.005  # Giây giữa 2 lần đọc ring của worker
+        
+        # Liveness (timer wheel) - ESP offline được báo trong timeout + liveness_tick
+        self.esp_offline_timeout = 5.0  # Multi-ESP: giây không có packet
+        self.heartbeat_timeout = 15.0  # Auto-discovery: giây không có heartbeat/data
+        self.liveness_tick = 0.1
+        
+        # LED command coalescing - slider chỉ gửi giá trị mới nhất, tối đa led_max_rate lệnh/giây
+        self.led_command_window = 0.05
+        self.led_max_rate = 30.0
+        
+        # Lệnh cấu hình có xác nhận (THRESHOLD, RESOLUME_IP...) - gửi lại tới khi ESP reply
+        self.command_timeout = 2.0  # Giây chờ reply cho mỗi lệnh
+        self.command_retry_interval = 0.25  # Gửi lại sau 0.25s, nhân đôi mỗi lần
+        self.command_max_attempts = 4
+        self.command_window = 32  # Số ESP được cấu hình song song
+        
+        # Broadcast / rollout cho cả fleet trên worker pool
+        self.fleet_concurrency = 16
+        
+        # OSC relay: cube trỏ RESOLUME_IP về máy này, relay gom lệnh /composition theo frame
+        # rồi gửi bundle tới Resolume (tránh trỏ target về chính osc_port của máy này)
+        self.osc_relay_enabled = False
+        self.osc_relay_targets = None  # [(ip, port), ...]; None = resolume_ip:resolume_port
+        self.osc_relay_fps = 60.0
+        self.osc_relay_prefixes = ("/composition/",)
\ No newline at end of file
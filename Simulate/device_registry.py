@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+"""
+Device Registry
+Một nguồn dữ liệu ESP duy nhất cho MultiESP / PortPerESP / AutoDiscovery: record __slots__ gọn,
+device id là số nguyên (index trong mảng record, dùng lại khi ESP bị xóa), tra O(1) theo id, IP
+và port. GUI đọc DeviceView - Mapping chỉ đọc trỏ thẳng vào record thay vì dict copy mỗi lần gọi.
+Thread GUI đọc qua snapshot(): bản sao bất biến có version, được copy dưới lock của thao tác cấu trúc
+nên không bao giờ gặp "dictionary changed size during iteration"; đường ingest không lấy lock nào
+"""
+
+import threading
+import time
+from collections.abc import Mapping
+from typing import Callable, Dict, Iterator, List, Optional
+
+from wire_codec import CODEC_TEXT
+
+
+class DeviceRecord:
+    """Trạng thái 1 ESP (mọi manager dùng chung các field này)"""
+
+    __slots__ = ('device_id', 'ip', 'name', 'port', 'esp_port', 'status', 'registered_at',
+                 'last_seen', 'last_heartbeat', 'heartbeat_count', 'packets_received',
+                 'packets_sent', 'codec', 'wire_id', 'packets_lost', 'packets_reordered',
+                 'listening', '_view')
+
+    FIELDS = __slots__[:-1]
+
+    def __init__(self, device_id: int, ip: str, name: str = "", port: int = 0, esp_port: int = 4210,
+                 status: str = "Offline", registered_at: Optional[float] = None):
+        self.device_id = device_id
+        self.ip = ip
+        self.name = name
+        self.port = port  # Port máy tính nhận data của ESP (0 = chưa cấp)
+        self.esp_port = esp_port  # Port ESP nhận lệnh
+        self.status = status
+        self.registered_at = time.time() if registered_at is None else registered_at
+        self.last_seen: Optional[float] = None  # Packet data gần nhất
+        self.last_heartbeat = 0.0
+        self.heartbeat_count = 0
+        self.packets_received = 0
+        self.packets_sent = 0
+        self.codec = CODEC_TEXT  # Wire codec đã negotiate (text / bin1)
+        self.wire_id = 0  # Id trong header binary frame (lease của PortAllocator)
+        self.packets_lost = 0  # Theo sequence number (chỉ binary codec)
+        self.packets_reordered = 0
+        self.listening = False
+        self._view: Optional["DeviceView"] = None
+
+    # Tên field cũ của DiscoveredESP (chỉ đọc - đổi port qua DeviceRegistry.set_port)
+    assigned_port = property(lambda self: self.port)
+    data_packets_received = property(lambda self: self.packets_received)
+    discovery_time = property(lambda self: self.registered_at)
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __repr__(self):
+        return f"DeviceRecord(#{self.device_id} {self.name} {self.ip}:{self.port} {self.status})"
+
+
+class DeviceView(Mapping):
+    """View chỉ đọc của 1 record - esp['name'], esp.get('port')... không copy dữ liệu"""
+
+    __slots__ = ('_record', '_registry')
+
+    # Tên key cũ của get_discovered_esps()/to_dict() vẫn dùng được
+    ALIASES = {
+        'assigned_port': 'port',
+        'data_packets_received': 'packets_received',
+        'discovery_time': 'registered_at',
+    }
+
+    def __init__(self, record: DeviceRecord, registry: "DeviceRegistry"):
+        self._record = record
+        self._registry = registry
+
+    def __getitem__(self, key: str):
+        key = self.ALIASES.get(key, key)
+        if key in DeviceRecord.FIELDS:
+            return getattr(self._record, key)
+        computed = self._registry.computed.get(key)
+        if computed is None:
+            raise KeyError(key)
+        return computed(self._record)
+
+    def __iter__(self) -> Iterator[str]:
+        yield from DeviceRecord.FIELDS
+        yield from self.ALIASES
+        yield from self._registry.computed
+
+    def __len__(self) -> int:
+        return len(DeviceRecord.FIELDS) + len(self.ALIASES) + len(self._registry.computed)
+
+    def __repr__(self):
+        return f"DeviceView({self._record!r})"
+
+
+_FIELD_SET = frozenset(DeviceRecord.FIELDS)
+_NO_EXTRAS: Dict[str, object] = {}
+
+
+class DeviceSnapshot(Mapping):
+    """Bản sao bất biến của 1 record - đọc được cả row.status lẫn row['status']"""
+
+    __slots__ = DeviceRecord.FIELDS + ('_extras',)
+
+    def __init__(self, record: DeviceRecord, extras: Dict[str, object]):
+        for field in DeviceRecord.FIELDS:
+            object.__setattr__(self, field, getattr(record, field))
+        object.__setattr__(self, '_extras', extras)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("DeviceSnapshot is read-only")
+
+    def __getitem__(self, key: str):
+        key = DeviceView.ALIASES.get(key, key)
+        if key in _FIELD_SET:
+            return getattr(self, key)
+        return self._extras[key]
+
+    def __iter__(self) -> Iterator[str]:
+        yield from DeviceRecord.FIELDS
+        yield from DeviceView.ALIASES
+        yield from self._extras
+
+    def __len__(self) -> int:
+        return len(DeviceRecord.FIELDS) + len(DeviceView.ALIASES) + len(self._extras)
+
+    assigned_port = DeviceRecord.assigned_port
+    data_packets_received = DeviceRecord.data_packets_received
+    discovery_time = DeviceRecord.discovery_time
+
+    def __repr__(self):
+        return f"DeviceSnapshot(#{self.device_id} {self.name} {self.ip}:{self.port} {self.status})"
+
+
+class RegistrySnapshot:
+    """Trạng thái toàn bộ registry tại 1 thời điểm (bất biến, dùng chung giữa các thread đọc)"""
+
+    __slots__ = ('version', 'taken_at', 'devices', 'by_ip', 'status_counts')
+
+    def __init__(self, version: int, taken_at: float, devices: tuple):
+        self.version = version
+        self.taken_at = taken_at
+        self.devices = devices  # Tuple[DeviceSnapshot]
+        self.by_ip = {device.ip: device for device in devices}
+        counts: Dict[str, int] = {}
+        for device in devices:
+            counts[device.status] = counts.get(device.status, 0) + 1
+        self.status_counts = counts
+
+    def get(self, ip: str, default=None) -> Optional[DeviceSnapshot]:
+        return self.by_ip.get(ip, default)
+
+    def count(self, status: Optional[str] = None) -> int:
+        return len(self.devices) if status is None else self.status_counts.get(status, 0)
+
+    def total(self, field: str):
+        return sum(getattr(device, field) for device in self.devices)
+
+    def __iter__(self) -> Iterator[DeviceSnapshot]:
+        return iter(self.devices)
+
+    def __len__(self) -> int:
+        return len(self.devices)
+
+
+class DeviceRegistry:
+    """Bảng ESP dùng chung: {ip: record} + index theo device id và port
+
+    Có thể truyền cùng 1 registry cho nhiều manager để chúng chia sẻ 1 nguồn dữ liệu.
+    Thêm/xóa/đổi port/update() có lock và tăng version; counter trên đường ingest ghi thẳng vào
+    record không lock. Thread khác không duyệt by_ip/by_port trực tiếp mà đọc snapshot().
+    """
+
+    def __init__(self):
+        self._records: List[Optional[DeviceRecord]] = []  # Index = device id
+        self._free_ids: List[int] = []
+        self.by_ip: Dict[str, DeviceRecord] = {}
+        self.by_port: Dict[int, DeviceRecord] = {}
+        self.computed: Dict[str, Callable] = {}  # Key tính khi đọc view (vd. queue_size)
+        self._lock = threading.RLock()
+        self.version = 0  # Tăng mỗi lần thêm/xóa/đổi port/update()
+        self._snapshot: Optional[RegistrySnapshot] = None
+        self.snapshots_built = 0
+
+    def add(self, ip: str, name: str = "", port: int = 0, **fields) -> DeviceRecord:
+        """Thêm ESP (IP đã có thì trả về record hiện tại)"""
+        with self._lock:
+            record = self.by_ip.get(ip)
+            if record is not None:
+                return record
+
+            device_id = self._free_ids.pop() if self._free_ids else len(self._records)
+            record = DeviceRecord(device_id, ip, name or f"ESP_{ip.split('.')[-1]}")
+            for field, value in fields.items():
+                setattr(record, field, value)
+
+            if device_id == len(self._records):
+                self._records.append(record)
+            else:
+                self._records[device_id] = record
+            self.by_ip[ip] = record
+            self.set_port(record, port)
+            self.version += 1
+            return record
+
+    def remove(self, ip: str) -> Optional[DeviceRecord]:
+        with self._lock:
+            record = self.by_ip.pop(ip, None)
+            if record is None:
+                return None
+            self.set_port(record, 0)
+            self.version += 1
+            self._records[record.device_id] = None
+            self._free_ids.append(record.device_id)
+            return record
+
+    def set_port(self, record: DeviceRecord, port: int):
+        """Đổi port của record và cập nhật index theo port"""
+        with self._lock:
+            if record.port and self.by_port.get(record.port) is record:
+                del self.by_port[record.port]
+            record.port = port
+            if port and port not in self.by_port:
+                self.by_port[port] = record  # Port chung: index giữ ESP đầu tiên
+            self.version += 1
+
+    def update(self, record: DeviceRecord, **fields):
+        """Đổi nhiều field cùng lúc (status, codec...) - snapshot thấy tất cả hoặc không field nào"""
+        with self._lock:
+            for field, value in fields.items():
+                setattr(record, field, value)
+            self.version += 1
+
+    def snapshot(self, max_age: float = 0.0) -> RegistrySnapshot:
+        """Snapshot bất biến cho thread đọc (GUI, thống kê)
+        
+        Dùng lại snapshot đã publish nếu không có thay đổi cấu trúc và chưa cũ hơn max_age giây,
+        nên nhiều lời gọi trong cùng 1 vòng refresh GUI chỉ copy 1 lần.
+        """
+        snapshot = self._snapshot
+        if (snapshot is not None and snapshot.version == self.version
+                and time.time() - snapshot.taken_at <= max_age):
+            return snapshot
+
+        with self._lock:
+            version = self.version
+            records = list(self.by_ip.values())
+            extras = [{} if self.computed else _NO_EXTRAS for _ in records]
+            devices = tuple(DeviceSnapshot(record, extra) for record, extra in zip(records, extras))
+
+        # Key tính thêm (queue_size...) gọi code của manager - ngoài lock
+        for record, extra in zip(records, extras):
+            for key, func in list(self.computed.items()):
+                extra[key] = func(record)
+
+        snapshot = RegistrySnapshot(version, time.time(), devices)
+        with self._lock:
+            # 2 reader build song song có thể xong ngược thứ tự - không để snapshot cũ đè snapshot mới
+            current = self._snapshot
+            if current is None or (version, snapshot.taken_at) >= (current.version, current.taken_at):
+                self._snapshot = snapshot
+            self.snapshots_built += 1
+        return snapshot
+
+    def get(self, ip: str, default=None) -> Optional[DeviceRecord]:
+        return self.by_ip.get(ip, default)
+
+    def get_by_id(self, device_id: int) -> Optional[DeviceRecord]:
+        if 0 <= device_id < len(self._records):
+            return self._records[device_id]
+        return None
+
+    def get_by_port(self, port: int) -> Optional[DeviceRecord]:
+        return self.by_port.get(port)
+
+    def view(self, record: DeviceRecord) -> DeviceView:
+        """View chỉ đọc của record (tạo 1 lần khi GUI/callback cần)"""
+        view = record._view
+        if view is None:
+            view = record._view = DeviceView(record, self)
+        return view
+
+    def add_computed(self, key: str, func: Callable):
+        """Key phụ cho view, tính từ record lúc đọc - func(record)"""
+        self.computed[key] = func
+
+    def views(self, predicate: Optional[Callable] = None) -> List[DeviceView]:
+        """Danh sách view sống (chỉ copy tham chiếu) - GUI polling nên dùng snapshot()"""
+        records = list(self.by_ip.values())
+        if predicate is not None:
+            records = [record for record in records if predicate(record)]
+        return [record._view or self.view(record) for record in records]
+
+    def count(self, status: Optional[str] = None) -> int:
+        if status is None:
+            return len(self.by_ip)
+        return sum(1 for record in list(self.by_ip.values()) if record.status == status)
+
+    # Mapping {ip: record} như các dict esp_devices / discovered_esps trước đây
+    def __contains__(self, ip) -> bool:
+        return ip in self.by_ip
+
+    def __getitem__(self, ip: str) -> DeviceRecord:
+        return self.by_ip[ip]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self.by_ip))
+
+    def __len__(self) -> int:
+        return len(self.by_ip)
+
+    def items(self):
+        return list(self.by_ip.items())
+
+    def values(self) -> List[DeviceRecord]:
+        return list(self.by_ip.values())
+
+    def keys(self) -> List[str]:
+        return list(self.by_ip)
+
+    def get_stats(self) -> dict:
+        return {
+            'devices': len(self.by_ip),
+            'capacity': len(self._records),
+            'free_ids': len(self._free_ids),
+            'ports_indexed': len(self.by_port),
+        }
+
+
+# Benchmark: bộ nhớ/ESP và chi phí liệt kê cho GUI so với cấu trúc cũ của 3 manager
+if __name__ == "__main__":
+    import tracemalloc
+    from dataclasses import asdict, dataclass
+
+    @dataclass
+    class LegacyDiscoveredESP:
+        ip: str
+        name: str = ""
+        assigned_port: int = 0
+        discovery_time: float = 0
+        last_heartbeat: float = 0
+        status: str = "Discovered"
+        heartbeat_count: int = 0
+        data_packets_received: int = 0
+        codec: str = CODEC_TEXT
+        device_id: int = 0
+        packets_lost: int = 0
+        packets_reordered: int = 0
+
+    DEVICES = 10000
+    ips = [f"10.{i // 250}.{i % 250}.1" for i in range(DEVICES)]
+    names = [f"Cube{i}" for i in range(DEVICES)]
+    now = time.time()
+
+    def measure(build):
+        tracemalloc.start()
+        base = tracemalloc.take_snapshot()
+        result = build()
+        size = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(base, 'filename'))
+        tracemalloc.stop()
+        return result, size / DEVICES
+
+    def build_multi():
+        devices = {ip: {'name': names[i], 'ip': ip, 'registered_at': now, 'active': True}
+                   for i, ip in enumerate(ips)}
+        stats = {ip: {'packets_received': 0, 'packets_sent': 0, 'last_seen': None, 'status': 'Offline'}
+                 for ip in ips}
+        return devices, stats
+
+    def build_registry():
+        registry = DeviceRegistry()
+        for i, ip in enumerate(ips):
+            registry.add(ip, names[i], port=7001 + i, status="Discovered", registered_at=now)
+        return registry
+
+    legacy, legacy_bytes = measure(lambda: {ip: LegacyDiscoveredESP(ip=ip, name=names[i], assigned_port=7001 + i,
+                                                                   discovery_time=now)
+                                            for i, ip in enumerate(ips)})
+    _, multi_bytes = measure(build_multi)
+    registry, registry_bytes = measure(build_registry)
+
+    start = time.perf_counter()
+    for _ in range(20):
+        rows = [asdict(esp) for esp in legacy.values()]
+    legacy_list = (time.perf_counter() - start) / 20
+
+    registry.views()  # View tạo 1 lần, các lần sau chỉ copy tham chiếu
+    start = time.perf_counter()
+    for _ in range(20):
+        rows = registry.views()
+    view_list = (time.perf_counter() - start) / 20
+
+    record = registry.get(ips[42])
+    assert registry.get_by_id(record.device_id) is record and registry.get_by_port(record.port) is record
+    assert rows[42]['assigned_port'] == record.port and dict(rows[42])['name'] == "Cube42"
+    record.packets_received += 5
+    assert rows[42]['packets_received'] == 5  # View đọc thẳng record
+    removed = registry.remove(ips[42])
+    assert registry.add("192.168.0.43").device_id == removed.device_id  # id được dùng lại
+
+    print(f"🧪 {DEVICES:,} devices, state memory per device (incl. ip->state index):")
+    print(f"   MultiESP dicts {multi_bytes:.0f} B | AutoDiscovery dataclass {legacy_bytes:.0f} B | "
+          f"registry record {registry_bytes:.0f} B (+ id/port index)")
+    print(f"   list for GUI: asdict() {legacy_list * 1000:.1f} ms -> views {view_list * 1000:.2f} ms")
+    print(f"📊 {registry.get_stats()}")
+
+    # Stress: ingest + churn + update() song song với thread đọc snapshot, so với dict sửa tại chỗ
+    import random
+    import sys
+
+    DURATION = 2.0
+    sys.setswitchinterval(1e-5)  # Đổi thread dày hơn để lộ race
+
+    def run_stress(use_registry: bool) -> dict:
+        stop = threading.Event()
+        results = {'snapshots': 0, 'iteration_errors': 0, 'torn_rows': 0, 'version_regressions': 0,
+                   'rows_checked': 0}
+        registry = DeviceRegistry()
+        legacy: Dict[str, DeviceRecord] = {}
+        registry.add_computed('queue_size', lambda record: 0)
+        for i in range(500):
+            ip = f"10.1.{i // 250}.{i % 250}"
+            registry.add(ip, port=7001 + i, status="Offline")
+            legacy[ip] = DeviceRecord(i, ip, port=7001 + i)
+
+        def ingest():  # Đường nóng: counter ghi thẳng, không lock
+            while not stop.is_set():
+                for record in registry.values() if use_registry else list(legacy.values()):
+                    record.packets_received += 1
+                    record.last_seen = time.time()
+
+        def control():  # Đổi status + codec cùng lúc, thêm/xóa ESP
+            counter = 0
+            while not stop.is_set():
+                counter += 1
+                records = registry.values() if use_registry else list(legacy.values())
+                record = random.choice(records)
+                connected = record.status != "Connected"
+                status, codec = ("Connected", "bin1") if connected else ("Offline", CODEC_TEXT)
+                if use_registry:
+                    registry.update(record, status=status, codec=codec)
+                    if counter % 20 == 0:
+                        registry.add(f"10.2.{counter // 250 % 250}.{counter % 250}", status="Offline")
+                        registry.remove(random.choice(registry.keys()))
+                else:
+                    record.status = status
+                    record.codec = codec
+                    if counter % 20 == 0:
+                        legacy[f"10.2.{counter // 250 % 250}.{counter % 250}"] = DeviceRecord(0, "x")
+                        legacy.pop(random.choice(list(legacy)), None)
+
+        def reader():  # Thread GUI polling
+            last_version = -1
+            while not stop.is_set():
+                try:
+                    if use_registry:
+                        snapshot = registry.snapshot()
+                        if snapshot.version < last_version:
+                            results['version_regressions'] += 1
+                        last_version = snapshot.version
+                        rows = snapshot.devices
+                    else:
+                        rows = (esp for esp in legacy.values())  # Kiểu get_statistics() cũ
+                    for row in rows:
+                        results['rows_checked'] += 1
+                        if (row.status == "Connected") != (row.codec == "bin1"):
+                            results['torn_rows'] += 1
+                    results['snapshots'] += 1
+                except RuntimeError:
+                    results['iteration_errors'] += 1
+
+        threads = [threading.Thread(target=target, daemon=True)
+                   for target in (ingest, control, reader, reader, reader)]
+        for thread in threads:
+            thread.start()
+        time.sleep(DURATION)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    naive = run_stress(use_registry=False)
+    safe = run_stress(use_registry=True)
+    sys.setswitchinterval(0.005)
+
+    print(f"🔥 stress {DURATION:.0f}s (1 ingest + 1 control writer, 3 readers):")
+    print(f"   dict + in-place writes: {naive['iteration_errors']} 'changed size' errors, "
+          f"{naive['torn_rows']} torn rows / {naive['rows_checked']:,}")
+    print(f"   registry snapshots:     {safe['iteration_errors']} errors, {safe['torn_rows']} torn rows, "
+          f"{safe['version_regressions']} version regressions / {safe['rows_checked']:,} rows "
+          f"in {safe['snapshots']:,} snapshots")
+    assert safe['iteration_errors'] == 0 and safe['torn_rows'] == 0 and safe['version_regressions'] == 0
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Discovery Protocol
+State machine cấp port cho ESP: PORT_ASSIGNED gửi về địa chỉ nguồn của heartbeat rồi chờ
+xác nhận (datagram đầu tiên trên data port hoặc PORT_ACK), chưa có xác nhận thì gửi lại
+theo exponential backoff thay vì đợi heartbeat 5 giây kế tiếp
+"""
+
+import heapq
+import random
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from ingest_metrics import Histogram
+
+# Assignment states
+STATE_ASSIGNING = 'assigning'  # Đã gửi PORT_ASSIGNED, chờ xác nhận
+STATE_CONNECTED = 'connected'  # ESP đã xác nhận
+STATE_FAILED = 'failed'  # Hết số lần gửi - chờ heartbeat kế tiếp
+
+# Bucket (ms) cho time-to-ack: từ loopback tới vài lần retry
+ACK_BUCKETS_MS = (1, 5, 10, 50, 100, 250, 500, 1000, 2000, 5000, 10000, 30000)
+
+
+def format_assignment(port: int) -> str:
+    return f"PORT_ASSIGNED:{port}"
+
+
+def parse_port_ack(message: str) -> Optional[int]:
+    """"PORT_ACK:7043" -> 7043 (None nếu không phải ACK)"""
+    if not message.startswith("PORT_ACK:"):
+        return None
+    try:
+        return int(message[9:])
+    except ValueError:
+        return None
+
+
+class PendingAssignment:
+    """1 lần cấp port đang chờ xác nhận"""
+
+    __slots__ = ('ip', 'port', 'addr', 'attempts', 'first_sent', 'next_retry', 'state')
+
+    def __init__(self, ip: str, port: int, addr: Tuple[str, int], now: float):
+        self.ip = ip
+        self.port = port
+        self.addr = addr  # Địa chỉ nguồn của heartbeat (ESP nghe PORT_ASSIGNED trên socket này)
+        self.attempts = 0
+        self.first_sent = now
+        self.next_retry = now
+        self.state = STATE_ASSIGNING
+
+
+class AssignmentTracker:
+    """Theo dõi PORT_ASSIGNED chưa được xác nhận và lịch gửi lại (heap theo deadline)"""
+
+    def __init__(self, base_delay: float = 0.25, max_delay: float = 4.0,
+                 max_attempts: int = 6, jitter: float = 0.2):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.jitter = jitter  # Lệch ngẫu nhiên để cả fleet không retry cùng lúc
+
+        self.pending: Dict[str, PendingAssignment] = {}  # {esp_ip: PendingAssignment}
+        self._heap: List[Tuple[float, str]] = []  # (next_retry, esp_ip) - entry cũ bỏ qua khi pop
+        self._lock = threading.Lock()  # ACK đến từ ingest thread, retry chạy ở discovery thread
+
+        # Statistics
+        self.assignments = 0
+        self.retransmits = 0
+        self.acks = 0
+        self.failures = 0
+        self.time_to_ack = Histogram(ACK_BUCKETS_MS)
+        self.wave_started: Optional[float] = None  # Lần cấp đầu tiên của đợt bring-up hiện tại
+        self.wave_completed: Optional[float] = None  # Lần xác nhận cuối cùng của đợt đó
+        self.wave_size = 0
+
+    def backoff(self, attempts: int) -> float:
+        """Thời gian chờ sau lần gửi thứ attempts"""
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _schedule(self, assignment: PendingAssignment, now: float):
+        assignment.attempts += 1
+        assignment.next_retry = now + self.backoff(assignment.attempts)
+        heapq.heappush(self._heap, (assignment.next_retry, assignment.ip))
+
+    def begin(self, ip: str, port: int, addr: Tuple[str, int], now: float) -> PendingAssignment:
+        """Bắt đầu cấp port - caller gửi PORT_ASSIGNED ngay sau đó"""
+        with self._lock:
+            if not self.pending:
+                self.wave_started = now
+                self.wave_completed = None
+                self.wave_size = 0
+
+            assignment = PendingAssignment(ip, port, addr, now)
+            self.pending[ip] = assignment
+            self.assignments += 1
+            self.wave_size += 1
+            self._schedule(assignment, now)
+            return assignment
+
+    def resend(self, ip: str, addr: Tuple[str, int], now: float) -> Optional[PendingAssignment]:
+        """Heartbeat mới từ ESP đang chờ -> nó chưa nhận được, gửi lại ngay (backoff reset)"""
+        with self._lock:
+            assignment = self.pending.get(ip)
+            if assignment is None:
+                return None
+
+            assignment.addr = addr
+            assignment.attempts = 0
+            self.retransmits += 1
+            self._schedule(assignment, now)
+            return assignment
+
+    def acknowledge(self, ip: str, now: float) -> Optional[float]:
+        """ESP xác nhận - trả về time-to-ack (giây), None nếu không có gì đang chờ"""
+        with self._lock:
+            assignment = self.pending.pop(ip, None)
+            if assignment is None:
+                return None
+
+            assignment.state = STATE_CONNECTED
+            elapsed = now - assignment.first_sent
+            self.acks += 1
+            self.time_to_ack.observe(elapsed * 1000)
+
+            if not self.pending:
+                self.wave_completed = now
+            return elapsed
+
+    def due(self, now: float) -> Tuple[List[PendingAssignment], List[PendingAssignment]]:
+        """Lấy (cần gửi lại, đã hết số lần gửi) tại thời điểm now"""
+        retry = []
+        failed = []
+
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, ip = heapq.heappop(self._heap)
+                assignment = self.pending.get(ip)
+                if assignment is None or assignment.next_retry != deadline:
+                    continue  # Đã xác nhận hoặc đã được lên lịch lại
+
+                if assignment.attempts >= self.max_attempts:
+                    assignment.state = STATE_FAILED
+                    del self.pending[ip]
+                    self.failures += 1
+                    failed.append(assignment)
+                    continue
+
+                self.retransmits += 1
+                self._schedule(assignment, now)
+                retry.append(assignment)
+
+        return retry, failed
+
+    def next_deadline(self) -> Optional[float]:
+        """Deadline gần nhất (bỏ entry cũ ở đầu heap)"""
+        with self._lock:
+            while self._heap:
+                deadline, ip = self._heap[0]
+                assignment = self.pending.get(ip)
+                if assignment is not None and assignment.next_retry == deadline:
+                    return deadline
+                heapq.heappop(self._heap)
+        return None
+
+    def forget(self, ip: str):
+        with self._lock:
+            self.pending.pop(ip, None)
+
+    def clear(self):
+        with self._lock:
+            self.pending.clear()
+            self._heap.clear()
+
+    def time_to_all_connected(self) -> Optional[float]:
+        """Thời gian bring-up của đợt gần nhất (None khi còn ESP chưa xác nhận)"""
+        if self.wave_started is None or self.wave_completed is None:
+            return None
+        return self.wave_completed - self.wave_started
+
+    def get_stats(self) -> dict:
+        return {
+            'pending': len(self.pending),
+            'assignments': self.assignments,
+            'retransmits': self.retransmits,
+            'acks': self.acks,
+            'failures': self.failures,
+            'time_to_ack': self.time_to_ack.snapshot(),
+            'time_to_all_connected': self.time_to_all_connected(),
+            'wave_size': self.wave_size,
+        }
+
+
+# Demo: 80 cube, mất 30% PORT_ASSIGNED - so sánh retry với chờ heartbeat 5 giây
+if __name__ == "__main__":
+    LOSS = 0.3
+    HEARTBEAT_INTERVAL = 5.0
+    random.seed(1)
+
+    def simulate(tracker: Optional[AssignmentTracker], count: int = 80) -> float:
+        """Mô phỏng theo thời gian ảo, trả về time-to-all-connected (giây)"""
+        now = 0.0
+        connected_at = {}
+        for cube in range(count):
+            ip = f"10.0.0.{cube}"
+            boot = random.uniform(0, 0.5)
+            if tracker is None:
+                # Không retry: mỗi heartbeat cho 1 cơ hội
+                t = boot
+                while random.random() < LOSS:
+                    t += HEARTBEAT_INTERVAL
+                connected_at[ip] = t
+                continue
+
+            tracker.begin(ip, 7000 + cube, (ip, 4210), boot)
+            if random.random() >= LOSS:
+                connected_at[ip] = tracker.acknowledge(ip, boot + 0.002) + boot
+
+        while tracker is not None and tracker.pending:
+            now = tracker.next_deadline()
+            retry, _ = tracker.due(now)
+            for assignment in retry:
+                if random.random() >= LOSS:
+                    tracker.acknowledge(assignment.ip, now + 0.002)
+                    connected_at[assignment.ip] = now + 0.002
+
+        return max(connected_at.values())
+
+    print(f"🧪 80 cubes, {LOSS:.0%} assignment loss")
+    print(f"   heartbeat only : {simulate(None):.2f} s to all connected")
+    tracker = AssignmentTracker()
+    print(f"   with backoff   : {simulate(tracker):.2f} s to all connected")
+    print(f"📊 {tracker.get_stats()}")
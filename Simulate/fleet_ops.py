@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+Fleet Operations
+Gửi lệnh cho cả fleet ESP trên worker pool giới hạn concurrency thay cho vòng lặp tuần tự:
+broadcast, nhắm theo group và staged rollout (dừng khi 1 stage lỗi quá ngưỡng). Mỗi thao tác
+trả về FleetOperation (future + progress) với kết quả và thời gian từng ESP, nên GUI chỉ cần
+poll bằng root.after thay vì chặn Tk thread.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Sequence, Set
+
+# Device result states
+RESULT_OK = 'ok'  # Đã gửi (không chờ xác nhận)
+RESULT_CONFIRMED = 'confirmed'  # ESP đã xác nhận (confirm=True)
+RESULT_FAILED = 'failed'
+RESULT_ERROR = 'error'  # Exception khi gửi
+RESULT_SKIPPED = 'skipped'  # Rollout dừng trước stage của ESP này
+RESULT_CANCELLED = 'cancelled'
+
+
+class DeviceResult:
+    """Kết quả của 1 ESP trong 1 thao tác"""
+
+    __slots__ = ('device', 'ok', 'state', 'elapsed', 'error')
+
+    def __init__(self, device: Hashable, ok: bool, state: str, elapsed: float = 0.0,
+                 error: Optional[str] = None):
+        self.device = device
+        self.ok = ok
+        self.state = state
+        self.elapsed = elapsed  # Giây từ lúc worker bắt đầu gửi tới khi có kết quả
+        self.error = error
+
+    def to_dict(self) -> dict:
+        return {'ok': self.ok, 'state': self.state, 'elapsed_ms': self.elapsed * 1000, 'error': self.error}
+
+
+class FleetOperation:
+    """Future + progress của 1 thao tác trên nhiều ESP (an toàn khi đọc từ Tk thread)"""
+
+    def __init__(self, name: str, command: str, devices: Sequence[Hashable]):
+        self.name = name
+        self.command = command
+        self.devices = list(devices)
+        self.total = len(self.devices)
+        self.results: Dict[Hashable, DeviceResult] = {}
+        self.stage = 0  # Stage đang chạy (rollout)
+        self.stages = 1
+        self.halted: Optional[str] = None  # Lý do rollout dừng sớm
+        self.cancelled = False
+
+        self.started_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+        self._cond = threading.Condition()
+        self._callbacks: List[Callable] = []
+
+    def _record(self, result: DeviceResult):
+        with self._cond:
+            if result.device in self.results:
+                return
+            self.results[result.device] = result
+            finished = len(self.results) >= self.total
+            if finished:
+                self.finished_at = time.monotonic()
+            self._cond.notify_all()
+            callbacks = list(self._callbacks) if finished else []
+
+        for callback in callbacks:
+            self._run_callback(callback)
+
+    def _run_callback(self, callback: Callable):
+        try:
+            callback(self)
+        except Exception as e:
+            print(f"Fleet operation callback error ({self.name}): {e}")
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    @property
+    def ok_count(self) -> int:
+        return sum(1 for result in list(self.results.values()) if result.ok)
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def progress(self) -> dict:
+        """Tiến độ hiện tại (gọi được khi đang chạy)"""
+        results = list(self.results.values())
+        ok = sum(1 for result in results if result.ok)
+        return {
+            'done': len(results),
+            'total': self.total,
+            'ok': ok,
+            'failed': len(results) - ok,
+            'stage': self.stage,
+            'stages': self.stages,
+            'elapsed': self.elapsed,
+            'finished': self.done,
+        }
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Chờ xong - True nếu mọi ESP thành công"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.finished_at is not None, timeout)
+        return self.done and self.ok_count == self.total
+
+    def wait_for_count(self, count: int, timeout: Optional[float] = None) -> bool:
+        """Chờ tới khi có ít nhất count kết quả (rollout chờ từng stage)"""
+        with self._cond:
+            return self._cond.wait_for(lambda: len(self.results) >= count, timeout)
+
+    def add_done_callback(self, callback: Callable):
+        """callback(operation) khi xong - chạy trên worker thread (GUI dùng root.after)"""
+        with self._cond:
+            if self.finished_at is None:
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def cancel(self):
+        """ESP chưa gửi sẽ bị bỏ qua (ESP đang gửi vẫn chạy xong)"""
+        self.cancelled = True
+
+    def result_map(self) -> Dict[Hashable, bool]:
+        """{device: ok} - format cũ của broadcast_command"""
+        return {device: result.ok for device, result in list(self.results.items())}
+
+    def summary(self) -> dict:
+        results = list(self.results.values())
+        latencies = sorted(result.elapsed for result in results if result.ok)
+        return {
+            'name': self.name,
+            'command': self.command,
+            'total': self.total,
+            'ok': [result.device for result in results if result.ok],
+            'failed': {result.device: result.state for result in results if not result.ok},
+            'elapsed': self.elapsed,
+            'p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else None,
+            'max_ms': latencies[-1] * 1000 if latencies else None,
+            'halted': self.halted,
+        }
+
+
+class FleetOps:
+    """Broadcast / group / staged rollout trên worker pool giới hạn concurrency
+
+    send(device, command) -> bool: gửi 1 lệnh (thường là manager.send_command_to_esp).
+    confirm(device, command) -> PendingCommand: gửi có xác nhận (reliable_commands).
+    list_devices() -> danh sách ESP mặc định khi không chỉ định targets/group.
+    """
+
+    def __init__(self, send: Callable, list_devices: Callable, confirm: Optional[Callable] = None,
+                 max_concurrency: int = 16, log: Optional[Callable] = None, name: str = "Fleet"):
+        self.send = send
+        self.list_devices = list_devices
+        self.confirm = confirm
+        self.max_concurrency = max_concurrency
+        self.log = log
+        self.name = name
+
+        self.groups: Dict[str, Set[Hashable]] = {}  # {group: {device}}
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=name)
+        self.operations: List[FleetOperation] = []  # Thao tác gần nhất (giữ tối đa 20)
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    # Groups
+    def set_group(self, group: str, devices: Iterable[Hashable]):
+        self.groups[group] = set(devices)
+
+    def add_to_group(self, group: str, device: Hashable):
+        self.groups.setdefault(group, set()).add(device)
+
+    def remove_from_group(self, group: str, device: Hashable):
+        self.groups.get(group, set()).discard(device)
+
+    def remove_device(self, device: Hashable):
+        """ESP bị xóa khỏi hệ thống -> bỏ khỏi mọi group"""
+        for members in self.groups.values():
+            members.discard(device)
+
+    def resolve(self, targets: Optional[Iterable[Hashable]] = None,
+                group: Optional[str] = None) -> List[Hashable]:
+        """Danh sách ESP cho thao tác: targets > group > list_devices()"""
+        if targets is not None:
+            return list(dict.fromkeys(targets))
+        if group is not None:
+            if group not in self.groups:
+                raise KeyError(f"Unknown group: {group}")
+            return sorted(self.groups[group], key=str)
+        return list(self.list_devices())
+
+    # Operations
+    def _new_operation(self, kind: str, command: str, devices: List[Hashable]) -> FleetOperation:
+        with self._lock:
+            self._counter += 1
+            operation = FleetOperation(f"{kind}#{self._counter}", command, devices)
+            self.operations.append(operation)
+            del self.operations[:-20]
+
+        if self.log:
+            operation.add_done_callback(self._log_summary)
+        return operation
+
+    def _log_summary(self, operation: FleetOperation):
+        summary = operation.summary()
+        message = (f"📢 {operation.name} {operation.command}: {len(summary['ok'])}/{operation.total} ok "
+                   f"in {summary['elapsed'] * 1000:.0f} ms")
+        if summary['halted']:
+            message += f" - halted: {summary['halted']}"
+        self.log(message)
+
+    def broadcast(self, command: str, targets: Optional[Iterable[Hashable]] = None,
+                  group: Optional[str] = None, confirm: bool = False) -> FleetOperation:
+        """Gửi lệnh cho nhiều ESP song song - trả về ngay"""
+        devices = self.resolve(targets, group)
+        operation = self._new_operation("broadcast", command, devices)
+        if not devices:
+            operation.finished_at = time.monotonic()
+            return operation
+
+        for device in devices:
+            self.executor.submit(self._run_one, operation, device, command, confirm)
+        return operation
+
+    def rollout(self, command: str, stages: Sequence[float] = (1, 0.25, 1.0),
+                targets: Optional[Iterable[Hashable]] = None, group: Optional[str] = None,
+                confirm: bool = False, max_failure_ratio: float = 0.0,
+                pause: float = 0.0) -> FleetOperation:
+        """Staged rollout: stages là số ESP (int) hoặc tỉ lệ (float <= 1) cộng dồn
+
+        Stage có tỉ lệ lỗi > max_failure_ratio -> dừng, ESP còn lại được đánh dấu skipped.
+        """
+        devices = self.resolve(targets, group)
+        operation = self._new_operation("rollout", command, devices)
+
+        boundaries = []
+        for stage in stages:
+            count = int(stage) if isinstance(stage, int) else int(round(stage * len(devices)))
+            count = max(1, min(len(devices), count))
+            if not boundaries or count > boundaries[-1]:
+                boundaries.append(count)
+        if boundaries and boundaries[-1] < len(devices):
+            boundaries.append(len(devices))
+        operation.stages = len(boundaries)
+
+        if not devices:
+            operation.finished_at = time.monotonic()
+            return operation
+
+        thread = threading.Thread(target=self._run_rollout, name=f"{self.name}_Rollout",
+                                  args=(operation, boundaries, command, confirm, max_failure_ratio, pause),
+                                  daemon=True)
+        thread.start()
+        return operation
+
+    def _run_rollout(self, operation: FleetOperation, boundaries: List[int], command: str,
+                     confirm: bool, max_failure_ratio: float, pause: float):
+        start = 0
+        for index, end in enumerate(boundaries):
+            operation.stage = index + 1
+            stage_devices = operation.devices[start:end]
+            for device in stage_devices:
+                self.executor.submit(self._run_one, operation, device, command, confirm)
+            operation.wait_for_count(end)
+
+            failed = sum(1 for device in stage_devices if not operation.results[device].ok)
+            remaining = operation.devices[end:]
+            if remaining and failed > max_failure_ratio * len(stage_devices):
+                operation.halted = f"stage {index + 1}: {failed}/{len(stage_devices)} failed"
+            elif remaining and operation.cancelled:
+                operation.halted = "cancelled"
+            if operation.halted:
+                state = RESULT_CANCELLED if operation.cancelled else RESULT_SKIPPED
+                for device in remaining:
+                    operation._record(DeviceResult(device, False, state))
+                return
+
+            start = end
+            if pause and remaining:
+                time.sleep(pause)
+
+    def _run_one(self, operation: FleetOperation, device: Hashable, command: str, confirm: bool):
+        if operation.cancelled:
+            operation._record(DeviceResult(device, False, RESULT_CANCELLED))
+            return
+
+        start = time.monotonic()
+        try:
+            if confirm and self.confirm is not None:
+                pending = self.confirm(device, command)
+                ok = pending.wait()
+                state = RESULT_CONFIRMED if ok else pending.state
+            else:
+                ok = bool(self.send(device, command))
+                state = RESULT_OK if ok else RESULT_FAILED
+            result = DeviceResult(device, ok, state, time.monotonic() - start)
+        except Exception as e:
+            result = DeviceResult(device, False, RESULT_ERROR, time.monotonic() - start, str(e))
+        operation._record(result)
+
+    def get_stats(self) -> dict:
+        return {
+            'max_concurrency': self.max_concurrency,
+            'groups': {group: len(members) for group, members in self.groups.items()},
+            'operations': [dict(operation.progress(), name=operation.name)
+                           for operation in list(self.operations)[-5:]],
+        }
+
+
+# Demo: 200 cube, mỗi lệnh có xác nhận mất ~30 ms (5% không trả lời)
+if __name__ == "__main__":
+    import random
+
+    random.seed(5)
+    cubes = [f"10.0.{i // 100}.{i % 100 + 1}" for i in range(200)]
+    silent = set(random.sample(cubes, 10))
+
+    class FakePending:
+        def __init__(self, device):
+            self.state = 'timeout' if device in silent else 'confirmed'
+
+        def wait(self, timeout=None):
+            time.sleep(0.3 if self.state == 'timeout' else 0.03)
+            return self.state == 'confirmed'
+
+    fleet = FleetOps(send=lambda device, command: True, list_devices=lambda: cubes,
+                     confirm=lambda device, command: FakePending(device), max_concurrency=32)
+    fleet.set_group("stage_left", cubes[:50])
+
+    # Tuần tự (cách cũ)
+    start = time.monotonic()
+    for device in cubes:
+        FakePending(device).wait()
+    print(f"🐢 serial confirm: {time.monotonic() - start:.2f}s")
+
+    # Song song - main thread vẫn rảnh để poll progress (như root.after trong GUI)
+    operation = fleet.broadcast("THRESHOLD:3100", confirm=True)
+    polls = 0
+    while not operation.done:
+        polls += 1
+        time.sleep(0.02)
+    summary = operation.summary()
+    print(f"⚡ parallel confirm: {summary['elapsed']:.2f}s, {len(summary['ok'])}/200 ok, "
+          f"{polls} progress polls, p50 {summary['p50_ms']:.0f} ms")
+    assert set(summary['failed']) == silent
+
+    group = fleet.broadcast("LED:1", group="stage_left")
+    group.wait()
+    print(f"🎯 group stage_left: {group.ok_count}/{group.total} ok")
+
+    # Rollout: 1 canary, 25%, rồi toàn bộ - dừng nếu stage lỗi > 10%
+    healthy = [device for device in cubes if device not in silent]
+    rollout = fleet.rollout("CONFIG:1", targets=healthy, confirm=True, max_failure_ratio=0.1)
+    rollout.wait()
+    print(f"🚦 rollout healthy fleet: {rollout.progress()}")
+
+    bad = fleet.rollout("CONFIG:1", targets=sorted(silent) + healthy, stages=(2, 1.0), confirm=True)
+    bad.wait()
+    print(f"🛑 rollout with failing canaries: halted={bad.halted!r}, "
+          f"skipped {sum(1 for r in bad.results.values() if r.state == RESULT_SKIPPED)}")
+    assert bad.halted and rollout.ok_count == len(healthy)
@@ -11,6 +11,9 @@ from touch import TouchController
 import threading
 from auto_discovery_manager import AutoDiscoveryManager
 from auto_discovery_gui import AutoDiscoveryGUI
+from ui_update_scheduler import CoalescingUIScheduler
+from list_view_model import KeyedTreeview
+from reliable_commands import STATE_SUPERSEDED
 
 class CubeTouchGUI:
     """Giao diện chính của ứng dụng"""
@@ -27,11 +30,16 @@ class CubeTouchGUI:
         # GUI components
         self.admin_window = None
         
+        # Frame-paced realtime updates
+        self.ui_scheduler = CoalescingUIScheduler(
+            root, self.render_realtime_data, fps=getattr(config, 'ui_fps', 20))
+        
         # Setup callback
         self.comm_handler.on_data_update = self.update_realtime_data
         
         self.setup_window()
         self.create_widgets()
+        self.ui_scheduler.start()
     
     def setup_window(self):
         """Thiết lập cửa sổ chính"""
@@ -42,6 +50,7 @@ class CubeTouchGUI:
         
         # Center window on screen
         self.center_window()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         
         # Enable responsive scaling
         self.root.resizable(True, True)
@@ -59,6 +68,16 @@ class CubeTouchGUI:
         except:
             pass
     
+    def on_closing(self):
+        """Đóng cửa sổ: gửi nốt lệnh LED đang chờ (giá trị slider cuối) rồi thoát"""
+        try:
+            self.ui_scheduler.stop()
+            self.led_controller.stop()
+        except Exception as e:
+            print(f"⚠️ Cleanup warning: {e}")
+        finally:
+            self.root.destroy()
+    
     def create_widgets(self):
         """Tạo các widget"""
         # Main scrollable frame
@@ -680,8 +699,10 @@ class CubeTouchGUI:
             if not confirm:
                 return
             
-            # Thực hiện cập nhật
-            success = self.comm_handler.update_resolume_ip(new_ip)
+            # Thực hiện cập nhật (ESP không xác nhận -> báo lỗi và trả lại IP cũ)
+            success = self.comm_handler.update_resolume_ip(
+                new_ip, on_done=lambda pending: self.root.after(
+                    0, lambda: self._on_resolume_ip_reply(pending, old_ip)))
             
             if success:
                 # Cập nhật hiển thị
@@ -691,7 +712,7 @@ class CubeTouchGUI:
                     self.resolume_info_label.config(
                         text=f"Resolume: {new_ip}:{self.config.resolume_port}")
                 messagebox.showinfo("Thành công", 
-                                   f"Đã cập nhật IP Resolume thành: {new_ip}")
+                                   f"Đã gửi IP Resolume: {new_ip}\n(đang chờ ESP32 xác nhận)")
             else:
                 messagebox.showerror("Lỗi", 
                                    "Không thể cập nhật IP. Vui lòng kiểm tra:\n"
@@ -707,16 +728,32 @@ class CubeTouchGUI:
             self.new_ip_entry.delete(0, tk.END)
             self.new_ip_entry.insert(0, self.config.resolume_ip)
     
+    def _on_resolume_ip_reply(self, pending, old_ip):
+        """Kết quả xác nhận IP Resolume (Tk thread)"""
+        if pending.confirmed:
+            return
+        
+        self.current_ip_label.config(text=self.config.resolume_ip)
+        if hasattr(self, 'resolume_info_label'):
+            self.resolume_info_label.config(
+                text=f"Resolume: {self.config.resolume_ip}:{self.config.resolume_port}")
+        self.new_ip_entry.delete(0, tk.END)
+        self.new_ip_entry.insert(0, old_ip)
+        messagebox.showerror("Lỗi", f"ESP32 không xác nhận IP mới sau {pending.attempts} lần gửi.\n"
+                                   f"Giữ IP cũ: {old_ip}")
+    
     def send_threshold(self):
         """Gửi ngưỡng"""
         try:
             threshold_value = int(self.threshold_entry.get())
-            success = self.touch_controller.set_threshold(threshold_value)
+            success = self.touch_controller.set_threshold(
+                threshold_value,
+                on_done=lambda pending: self.root.after(0, lambda: self._on_threshold_reply(pending)))
             
             if success:
                 self.threshold_status_label.config(
-                    text=f"✅ Đã gửi ngưỡng: {threshold_value}",
-                    fg=self.config.colors['success']
+                    text=f"⏳ Đang chờ ESP32 xác nhận ngưỡng: {threshold_value}",
+                    fg=self.config.colors['warning']
                 )
             else:
                 self.threshold_status_label.config(
@@ -734,18 +771,30 @@ class CubeTouchGUI:
                 fg=self.config.colors['danger']
             )
     
+    def _on_threshold_reply(self, pending):
+        """Kết quả xác nhận ngưỡng (Tk thread)"""
+        if pending.confirmed:
+            self.threshold_status_label.config(
+                text=f"✅ ESP32 đã xác nhận {pending.command} ({pending.rtt * 1000:.0f} ms)",
+                fg=self.config.colors['success'])
+        elif pending.state != STATE_SUPERSEDED:
+            self.threshold_status_label.config(
+                text=f"❌ ESP32 không xác nhận {pending.command} sau {pending.attempts} lần gửi",
+                fg=self.config.colors['danger'])
+    
     def update_realtime_data(self, data):
-        """Cập nhật dữ liệu realtime"""
-        def update():
-            self.metric_labels['raw_touch'].config(text=str(data['raw_touch']))
-            self.metric_labels['value'].config(text=str(data['value']))
-            self.metric_labels['threshold'].config(text=str(data['threshold']))
-            
-            # Update admin window if open
-            if self.admin_window and hasattr(self.admin_window, 'update_stats'):
-                self.admin_window.update_stats()
+        """Cập nhật dữ liệu realtime (gọi từ thread mạng - chỉ ghi vào dirty map)"""
+        self.ui_scheduler.submit('classic', dict(data))
+    
+    def render_realtime_data(self, key, data):
+        """Vẽ dữ liệu realtime mới nhất (Tk thread, mỗi frame)"""
+        self.metric_labels['raw_touch'].config(text=str(data['raw_touch']))
+        self.metric_labels['value'].config(text=str(data['value']))
+        self.metric_labels['threshold'].config(text=str(data['threshold']))
         
-        self.root.after(0, update)
+        # Update admin window if open
+        if self.admin_window and hasattr(self.admin_window, 'update_stats'):
+            self.admin_window.update_stats()
     
     def open_admin_window(self):
         """Mở cửa sổ admin"""
@@ -940,8 +989,13 @@ class HybridCubeTouchGUI:
         self.classic_gui = None
         self.auto_discovery_gui = None
         
+        # Frame-paced realtime updates
+        self.ui_scheduler = CoalescingUIScheduler(
+            root, self.render_classic_realtime_data, fps=getattr(config, 'ui_fps', 20))
+        
         self.setup_window()
         self.create_widgets()
+        self.ui_scheduler.start()
     
     def setup_window(self):
         """Thiết lập cửa sổ hybrid"""
@@ -952,11 +1006,22 @@ class HybridCubeTouchGUI:
         
         # Center window
         self.center_window()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         
         # Configure grid
         self.root.grid_rowconfigure(1, weight=1)
         self.root.grid_columnconfigure(0, weight=1)
     
+    def on_closing(self):
+        """Đóng cửa sổ: gửi nốt lệnh LED đang chờ (giá trị slider cuối) rồi thoát"""
+        try:
+            self.ui_scheduler.stop()
+            self.led_controller.stop()
+        except Exception as e:
+            print(f"⚠️ Cleanup warning: {e}")
+        finally:
+            self.root.destroy()
+    
     def center_window(self):
         """Căn giữa cửa sổ"""
         self.root.update_idletasks()
@@ -1461,9 +1526,10 @@ class HybridCubeTouchGUI:
         """Cập nhật Resolume IP cho classic"""
         new_ip = self.classic_ip_entry.get().strip()
         if new_ip:
-            success = self.comm_handler.update_resolume_ip(new_ip)
+            success = self.comm_handler.update_resolume_ip(
+                new_ip, on_done=lambda pending: self.root.after(0, lambda: self._classic_command_reply(pending)))
             if success:
-                messagebox.showinfo("Thành công", f"Đã cập nhật IP Resolume: {new_ip}")
+                messagebox.showinfo("Thành công", f"Đã gửi IP Resolume: {new_ip} (chờ ESP32 xác nhận)")
             else:
                 messagebox.showerror("Lỗi", "Không thể cập nhật IP")
     
@@ -1471,21 +1537,30 @@ class HybridCubeTouchGUI:
         """Gửi threshold cho classic"""
         try:
             threshold = int(self.classic_threshold_entry.get())
-            success = self.touch_controller.set_threshold(threshold)
+            success = self.touch_controller.set_threshold(
+                threshold, on_done=lambda pending: self.root.after(0, lambda: self._classic_command_reply(pending)))
             if success:
-                messagebox.showinfo("Thành công", f"Đã gửi ngưỡng: {threshold}")
+                messagebox.showinfo("Thành công", f"Đã gửi ngưỡng: {threshold} (chờ ESP32 xác nhận)")
         except ValueError:
             messagebox.showerror("Lỗi", "Vui lòng nhập số nguyên hợp lệ")
     
+    def _classic_command_reply(self, pending):
+        """Báo lỗi khi ESP không xác nhận lệnh cấu hình (Tk thread)"""
+        if not pending.confirmed and pending.state != STATE_SUPERSEDED:
+            messagebox.showerror("Lỗi", f"ESP32 không xác nhận {pending.command} "
+                                       f"sau {pending.attempts} lần gửi")
+    
     def update_classic_realtime_data(self, data):
-        """Cập nhật dữ liệu realtime cho classic"""
+        """Cập nhật dữ liệu realtime cho classic (chỉ ghi vào dirty map)"""
+        if self.current_mode == "classic":
+            self.ui_scheduler.submit('classic', dict(data))
+    
+    def render_classic_realtime_data(self, key, data):
+        """Vẽ dữ liệu realtime mới nhất cho classic (Tk thread)"""
         if self.current_mode == "classic" and hasattr(self, 'classic_metric_labels'):
-            def update():
-                self.classic_metric_labels['raw_touch'].config(text=str(data['raw_touch']))
-                self.classic_metric_labels['value'].config(text=str(data['value']))
-                self.classic_metric_labels['threshold'].config(text=str(data['threshold']))
-            
-            self.root.after(0, update)
+            self.classic_metric_labels['raw_touch'].config(text=str(data['raw_touch']))
+            self.classic_metric_labels['value'].config(text=str(data['value']))
+            self.classic_metric_labels['threshold'].config(text=str(data['threshold']))
     
     def update_discovery_status(self):
         """Cập nhật trạng thái discovery"""
@@ -1508,6 +1583,10 @@ class EmbeddedAutoDiscoveryGUI:
         self.auto_update_running = False
         self.selected_esp_ip = None
         
+        # Frame-paced data display (latest packet per ESP)
+        self.ui_scheduler = CoalescingUIScheduler(
+            parent, self.render_data, fps=getattr(config, 'ui_fps', 20))
+        
         # Setup callbacks
         self.manager.on_esp_discovered = self.on_esp_discovered
         self.manager.on_esp_connected = self.on_esp_connected
@@ -1516,6 +1595,7 @@ class EmbeddedAutoDiscoveryGUI:
         
         self.create_interface()
         self.start_auto_update()
+        self.ui_scheduler.start()
     
     def create_interface(self):
         """Tạo giao diện embedded auto-discovery"""
@@ -1563,6 +1643,7 @@ class EmbeddedAutoDiscoveryGUI:
         
         columns = ("Name", "IP", "Port", "Status")
         self.esp_tree = ttk.Treeview(tree_frame, columns=columns, show="headings", height=15)
+        self.esp_view = KeyedTreeview(self.esp_tree)
         
         for col in columns:
             self.esp_tree.heading(col, text=col)
@@ -1690,12 +1771,9 @@ class EmbeddedAutoDiscoveryGUI:
         self.refresh_esp_list()
     
     def refresh_esp_list(self):
-        """Refresh danh sách ESP"""
-        for item in self.esp_tree.get_children():
-            self.esp_tree.delete(item)
-        
-        esps = self.manager.get_discovered_esps()
-        for esp in esps:
+        """Refresh danh sách ESP (chỉ cập nhật các dòng thay đổi)"""
+        rows = []
+        for esp in self.manager.get_discovered_esps():
             status_map = {
                 "Discovered": "🔍 Discovered",
                 "Assigned": "📡 Assigned", 
@@ -1704,12 +1782,14 @@ class EmbeddedAutoDiscoveryGUI:
             }
             status_text = status_map.get(esp['status'], esp['status'])
             
-            self.esp_tree.insert("", tk.END, values=(
+            rows.append((esp['ip'], (
                 esp['name'],
                 esp['ip'],
                 esp['assigned_port'],
                 status_text
-            ))
+            )))
+        
+        self.esp_view.sync(rows)
     
     def start_auto_update(self):
         """Bắt đầu auto-update"""
@@ -1752,16 +1832,24 @@ class EmbeddedAutoDiscoveryGUI:
         self.refresh_esp_list()
     
     def on_data_received(self, data):
-        """Callback khi nhận dữ liệu"""
-        if self.selected_esp_ip == data.get('esp_ip'):
-            from datetime import datetime
-            timestamp = datetime.now().strftime("%H:%M:%S")
-            data_str = f"[{timestamp}] {data.get('esp_name', 'Unknown')}: {data}\n"
-            
-            self.data_display.insert(tk.END, data_str)
-            self.data_display.see(tk.END)
-            
-            # Limit display length
-            lines = self.data_display.get(1.0, tk.END).split('\n')
-            if len(lines) > 15:
-                self.data_display.delete(1.0, f"{len(lines)-15}.0")
\ No newline at end of file
+        """Callback khi nhận dữ liệu (thread mạng - chỉ ghi vào dirty map)"""
+        esp_ip = data.get('esp_ip')
+        if self.selected_esp_ip == esp_ip:
+            self.ui_scheduler.submit(esp_ip, data)
+    
+    def render_data(self, esp_ip, data):
+        """Thêm dòng dữ liệu mới nhất của ESP đang chọn (Tk thread)"""
+        if self.selected_esp_ip != esp_ip:
+            return
+        
+        from datetime import datetime
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        data_str = f"[{timestamp}] {data.get('esp_name', 'Unknown')}: {data}\n"
+        
+        self.data_display.insert(tk.END, data_str)
+        self.data_display.see(tk.END)
+        
+        # Limit display length - đếm dòng qua index, không đọc lại toàn bộ text
+        line_count = int(self.data_display.index('end-1c').split('.')[0])
+        if line_count > 15:
+            self.data_display.delete(1.0, f"{line_count - 15}.0")
\ No newline at end of file
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Ingest Metrics
+Counter/histogram rẻ cho từng ESP: datagram nhận, drop theo lý do, histogram inter-arrival,
+jitter, độ trễ một chiều ước lượng (frame có timestamp), thời gian chờ queue và thời gian callback.
+Một API snapshot chung + snapshot định kỳ để tìm cube/stage nghẽn khi tải cao
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Optional
+
+# Drop reasons
+DROP_RATE_LIMIT = 'rate_limit'
+DROP_QUEUE_FULL = 'queue_full'
+DROP_PARSE_ERROR = 'parse_error'
+DROP_COALESCED = 'coalesced'  # Touch cũ bị touch mới hơn của cùng ESP thay trong pipeline
+
+# Bucket (ms) cho mọi histogram - cố định để observe chỉ là 1 bisect + 1 phép cộng
+DEFAULT_BUCKETS_MS = (0.1, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+class Histogram:
+    """Histogram bucket cố định (ms)"""
+
+    __slots__ = ('buckets', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Bucket cuối = > bucket lớn nhất
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value_ms: float):
+        self.counts[bisect_left(self.buckets, value_ms)] += 1
+        self.count += 1
+        self.total += value_ms
+        if value_ms > self.max:
+            self.max = value_ms
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Cận trên của bucket chứa percentile p (0-100)"""
+        if not self.count:
+            return None
+        target = self.count * p / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        labels = [f"<={bucket}" for bucket in self.buckets] + [f">{self.buckets[-1]}"]
+        return {
+            'count': self.count,
+            'avg_ms': self.total / self.count if self.count else 0.0,
+            'max_ms': self.max,
+            'p50_ms': self.percentile(50),
+            'p99_ms': self.percentile(99),
+            'buckets': {label: count for label, count in zip(labels, self.counts) if count},
+        }
+
+
+class ESPMetrics:
+    """Metrics của 1 ESP - counter nhận/histogram mỗi loại chỉ 1 thread ghi, không cần lock;
+    dropped được ghi từ nhiều thread (receive, ingest loop, stage worker) nên đi qua lock của IngestMetrics"""
+
+    __slots__ = ('received', 'dropped', 'last_arrival', 'last_interarrival', 'jitter_ms',
+                 'interarrival', 'latency', 'queue_wait', 'callback', 'last_device_time',
+                 'last_offset_ms', 'min_offset_ms')
+
+    def __init__(self):
+        self.received = 0
+        self.dropped: Dict[str, int] = {}  # {reason: count}
+        self.last_arrival: Optional[float] = None
+        self.last_interarrival: Optional[float] = None
+        self.jitter_ms = 0.0
+        self.interarrival = Histogram()
+        self.latency = Histogram()  # Độ trễ một chiều so với mức thấp nhất từng thấy
+        self.queue_wait = Histogram()
+        self.callback = Histogram()
+        self.last_device_time: Optional[int] = None
+        self.last_offset_ms: Optional[float] = None
+        self.min_offset_ms: Optional[float] = None
+
+    def snapshot(self, dropped: Optional[Dict[str, int]] = None) -> dict:
+        dropped = dict(self.dropped) if dropped is None else dropped
+        return {
+            'received': self.received,
+            'dropped': dropped,
+            'dropped_total': sum(dropped.values()),
+            'last_arrival': self.last_arrival,
+            'jitter_ms': self.jitter_ms,
+            'interarrival': self.interarrival.snapshot(),
+            'latency': self.latency.snapshot(),
+            'queue_wait': self.queue_wait.snapshot(),
+            'callback': self.callback.snapshot(),
+        }
+
+
+class IngestMetrics:
+    """Metrics theo ESP cho 1 manager"""
+
+    def __init__(self, name: str = "ingest"):
+        self.name = name
+        self.esps: Dict[str, ESPMetrics] = {}  # {esp_ip: ESPMetrics}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+        # Periodic snapshot
+        self.last_snapshot: Optional[dict] = None
+        self.snapshot_interval = 0.0
+        self.on_snapshot: Optional[Callable] = None
+        self._snapshot_thread: Optional[threading.Thread] = None
+        self._snapshot_stop = threading.Event()
+
+    def get(self, esp_ip: str) -> ESPMetrics:
+        """Lấy (hoặc tạo) metrics của ESP"""
+        metrics = self.esps.get(esp_ip)
+        if metrics is None:
+            with self._lock:
+                metrics = self.esps.get(esp_ip)
+                if metrics is None:
+                    metrics = self.esps[esp_ip] = ESPMetrics()
+        return metrics
+
+    def on_received(self, esp_ip: str, arrival: float, count: int = 1):
+        """Ghi nhận datagram tới (count > 1 khi nhận theo batch)"""
+        metrics = self.get(esp_ip)
+        metrics.received += count
+
+        if metrics.last_arrival is not None:
+            interarrival = (arrival - metrics.last_arrival) * 1000
+            metrics.interarrival.observe(interarrival)
+
+            # Không có timestamp từ thiết bị -> jitter theo biến thiên inter-arrival
+            if metrics.last_device_time is None and metrics.last_interarrival is not None:
+                deviation = abs(interarrival - metrics.last_interarrival)
+                metrics.jitter_ms += (deviation - metrics.jitter_ms) / 16
+            metrics.last_interarrival = interarrival
+
+        metrics.last_arrival = arrival
+
+    def on_dropped(self, esp_ip: str, reason: str, count: int = 1):
+        dropped = self.get(esp_ip).dropped
+        with self._lock:  # Gọi từ receive thread, ingest loop và các stage worker
+            dropped[reason] = dropped.get(reason, 0) + count
+
+    def on_device_time(self, esp_ip: str, device_time_ms: int, arrival: float):
+        """Frame có timestamp thiết bị: ước lượng độ trễ một chiều và jitter (RFC 3550)"""
+        metrics = self.get(esp_ip)
+        arrival_ms = arrival * 1000
+        offset = arrival_ms - device_time_ms  # = độ trễ + lệch đồng hồ (không đổi)
+
+        if metrics.min_offset_ms is None or offset < metrics.min_offset_ms:
+            metrics.min_offset_ms = offset
+        metrics.latency.observe(offset - metrics.min_offset_ms)
+
+        # Jitter = biến thiên thời gian truyền giữa 2 frame liên tiếp
+        if metrics.last_offset_ms is not None:
+            metrics.jitter_ms += (abs(offset - metrics.last_offset_ms) - metrics.jitter_ms) / 16
+        metrics.last_offset_ms = offset
+        metrics.last_device_time = device_time_ms
+
+    def on_queue_wait(self, esp_ip: str, seconds: float):
+        self.get(esp_ip).queue_wait.observe(seconds * 1000)
+
+    def on_callback(self, esp_ip: str, seconds: float):
+        self.get(esp_ip).callback.observe(seconds * 1000)
+
+    def snapshot(self) -> dict:
+        """Snapshot toàn bộ metrics (per ESP + tổng drop theo lý do)"""
+        with self._lock:
+            esps = list(self.esps.items())
+            dropped_by_esp = {esp_ip: dict(metrics.dropped) for esp_ip, metrics in esps}
+        per_esp = {esp_ip: metrics.snapshot(dropped_by_esp[esp_ip]) for esp_ip, metrics in esps}
+
+        dropped = {}
+        for esp in per_esp.values():
+            for reason, count in esp['dropped'].items():
+                dropped[reason] = dropped.get(reason, 0) + count
+
+        return {
+            'name': self.name,
+            'timestamp': time.time(),
+            'uptime': time.time() - self.started_at,
+            'total_received': sum(esp['received'] for esp in per_esp.values()),
+            'dropped': dropped,
+            'esps': per_esp,
+        }
+
+    def reset(self):
+        with self._lock:
+            self.esps.clear()
+        self.started_at = time.time()
+
+    def start_snapshots(self, interval: float = 5.0, callback: Optional[Callable] = None):
+        """Chụp snapshot định kỳ vào last_snapshot (và gọi callback nếu có)"""
+        self.snapshot_interval = interval
+        if callback is not None:
+            self.on_snapshot = callback
+        if self._snapshot_thread and self._snapshot_thread.is_alive():
+            return
+
+        self._snapshot_stop.clear()
+        self._snapshot_thread = threading.Thread(
+            target=self._snapshot_loop,
+            daemon=True,
+            name=f"Metrics_{self.name}"
+        )
+        self._snapshot_thread.start()
+
+    def stop_snapshots(self):
+        self._snapshot_stop.set()
+        thread = self._snapshot_thread
+        if thread and thread.is_alive() and threading.current_thread() is not thread:
+            thread.join(timeout=1)
+
+    def _snapshot_loop(self):
+        while not self._snapshot_stop.wait(self.snapshot_interval):
+            try:
+                self.last_snapshot = self.snapshot()
+                if self.on_snapshot:
+                    self.on_snapshot(self.last_snapshot)
+            except Exception as e:
+                print(f"Metrics snapshot error: {e}")
+
+
+# Demo: 2 cube, 1 cube bị drop và callback chậm
+if __name__ == "__main__":
+    metrics = IngestMetrics("demo")
+    now = time.time()
+
+    for i in range(1000):
+        arrival = now + i * 0.1
+        metrics.on_received("192.168.0.43", arrival)
+        metrics.on_device_time("192.168.0.43", i * 100, arrival + (0.002 if i % 10 == 0 else 0))
+        metrics.on_callback("192.168.0.43", 0.0002)
+
+        metrics.on_received("192.168.0.44", arrival + (0.03 if i % 3 == 0 else 0))
+        metrics.on_callback("192.168.0.44", 0.015)
+        if i % 7 == 0:
+            metrics.on_dropped("192.168.0.44", DROP_RATE_LIMIT)
+
+    snapshot = metrics.snapshot()
+    print(f"📊 total={snapshot['total_received']} dropped={snapshot['dropped']}")
+    for esp_ip, esp in snapshot['esps'].items():
+        print(f"  {esp_ip}: jitter {esp['jitter_ms']:.2f} ms, latency p99 {esp['latency']['p99_ms']} ms, "
+              f"callback p99 {esp['callback']['p99_ms']} ms, dropped {esp['dropped']}")
+
+    start = time.perf_counter()
+    for i in range(200000):
+        metrics.on_received("192.168.0.45", now + i * 0.001)
+    elapsed = time.perf_counter() - start
+    print(f"⚡ on_received: {200000 / elapsed:,.0f} calls/s")
@@ -4,6 +4,8 @@ LED Control module for Cube Touch Monitor
 Xử lý tất cả logic điều khiển LED
 """
 
+from command_scheduler import CommandScheduler
+
 class LEDController:
     """Điều khiển LED"""
     
@@ -18,6 +20,18 @@ class LEDController:
         self.led_enabled = True
         self.direction = 0  # 0=down, 1=up
         self.config_mode = False
+        
+        # Slider kéo nhanh: chỉ gửi giá trị mới nhất mỗi key, giới hạn lệnh/giây
+        config = getattr(comm_handler, 'config', None)
+        self.scheduler = CommandScheduler(
+            lambda device, command: self.comm_handler.send_udp_command(command),
+            window=getattr(config, 'led_command_window', 0.05),
+            max_rate=getattr(config, 'led_max_rate', 30.0),
+            name="LED_Scheduler")
+    
+    def _submit(self, key, command: str):
+        """Đưa lệnh vào scheduler - key=None: lệnh không gộp (gửi đủ, đúng thứ tự)"""
+        self.scheduler.submit('esp', key, command)
     
     def set_color(self, r: int, g: int, b: int):
         """Thiết lập màu LED"""
@@ -42,13 +56,13 @@ class LEDController:
         else:
             command = f"{adj_r} {adj_g} {adj_b}"
             
-        self.comm_handler.send_udp_command(command)
+        self._submit('color', command)
     
     def toggle_led(self):
         """Bật/tắt LED"""
         self.led_enabled = not self.led_enabled
         command = f"LED:{1 if self.led_enabled else 0}"
-        self.comm_handler.send_udp_command(command)
+        self._submit(None, command)
         return self.led_enabled
     
     def set_direction(self, direction: int):
@@ -58,14 +72,14 @@ class LEDController:
             
         self.direction = 1 if direction == 1 else 0
         command = f"DIR:{self.direction}"
-        self.comm_handler.send_udp_command(command)
+        self._submit('dir', command)
         return True
     
     def toggle_config_mode(self):
         """Bật/tắt config mode"""
         self.config_mode = not self.config_mode
         command = f"CONFIG:{1 if self.config_mode else 0}"
-        self.comm_handler.send_udp_command(command)
+        self._submit(None, command)
         return self.config_mode
     
     def send_rainbow_effect(self):
@@ -74,7 +88,7 @@ class LEDController:
             return False
             
         command = "RAINBOW:START"
-        self.comm_handler.send_udp_command(command)
+        self._submit(None, command)
         return True
     
     def send_led_test(self):
@@ -83,7 +97,7 @@ class LEDController:
             return False
             
         command = "LEDCTRL:ALL,255,255,255"
-        self.comm_handler.send_udp_command(command)
+        self._submit(None, command)
         return True
     
     def send_direct_control(self, r: int, g: int, b: int, led_index: int = -1):
@@ -96,7 +110,7 @@ class LEDController:
         else:
             command = f"LEDCTRL:ALL,{r},{g},{b}"
             
-        self.comm_handler.send_udp_command(command)
+        self._submit(('led', led_index), command)
         return True
     
     def get_state(self) -> dict:
@@ -109,4 +123,12 @@ class LEDController:
             'enabled': self.led_enabled,
             'direction': self.direction,
             'config_mode': self.config_mode
-        }
\ No newline at end of file
+        }
+    
+    def get_command_stats(self) -> dict:
+        """Thống kê coalescing/rate cap của lệnh LED"""
+        return self.scheduler.get_stats()
+    
+    def stop(self):
+        """Gửi nốt lệnh đang chờ và dừng scheduler"""
+        self.scheduler.stop(flush=True)
\ No newline at end of file
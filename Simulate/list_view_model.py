@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+List View Model
+Đồng bộ danh sách ESP lên Treeview/Listbox theo key: so sánh với những gì đang hiển thị
+và chỉ insert/update/remove các dòng thay đổi thay vì xóa hết rồi vẽ lại
+"""
+
+import tkinter as tk
+from typing import Dict, Hashable, Iterable, List, Tuple
+
+
+class KeyedListModel:
+    """Diff theo key giữa trạng thái mới và trạng thái đang hiển thị"""
+
+    def __init__(self):
+        self.rows: Dict[Hashable, tuple] = {}  # {key: values} đang hiển thị (theo thứ tự)
+
+        # Statistics
+        self.syncs = 0
+        self.total_inserted = 0
+        self.total_updated = 0
+        self.total_removed = 0
+        self.duplicates = 0  # Dòng trùng key trong 1 lần sync (đã gộp, dòng sau thắng)
+
+    def diff(self, rows: Iterable[Tuple[Hashable, tuple]]):
+        """Trả về (inserted, updated, removed) và cập nhật trạng thái hiển thị
+
+        inserted/updated: list (key, values), removed: list key. Key trùng được gộp (giá trị của dòng
+        sau, vị trí của dòng đầu) để model và widget luôn có cùng số dòng.
+        """
+        new_rows = {}
+        inserted = []
+        updated = []
+
+        for key, values in rows:
+            if key in new_rows:
+                self.duplicates += 1
+            new_rows[key] = tuple(values)
+
+        for key, values in new_rows.items():
+            old_values = self.rows.get(key)
+            if old_values is None:
+                inserted.append((key, values))
+            elif old_values != values:
+                updated.append((key, values))
+
+        removed = [key for key in self.rows if key not in new_rows]
+
+        # Giữ thứ tự hiển thị hiện tại, dòng mới nối vào cuối
+        for key in removed:
+            del self.rows[key]
+        for key, values in updated:
+            self.rows[key] = values
+        for key, values in inserted:
+            self.rows[key] = values
+
+        self.syncs += 1
+        self.total_inserted += len(inserted)
+        self.total_updated += len(updated)
+        self.total_removed += len(removed)
+        return inserted, updated, removed
+
+    def keys(self) -> List[Hashable]:
+        return list(self.rows.keys())
+
+    def clear(self):
+        self.rows.clear()
+
+    def get_stats(self) -> dict:
+        return {
+            'rows': len(self.rows),
+            'syncs': self.syncs,
+            'total_inserted': self.total_inserted,
+            'total_updated': self.total_updated,
+            'total_removed': self.total_removed,
+            'duplicates': self.duplicates,
+        }
+
+
+class KeyedTreeview(KeyedListModel):
+    """Treeview với iid = key - chỉ động vào dòng thay đổi, giữ nguyên selection"""
+
+    def __init__(self, tree):
+        super().__init__()
+        self.tree = tree
+        self._iids: Dict[Hashable, str] = {}  # {key: iid}
+
+    def sync(self, rows: Iterable[Tuple[Hashable, tuple]]) -> int:
+        """Đồng bộ Treeview, trả về số dòng thay đổi"""
+        inserted, updated, removed = self.diff(rows)
+
+        for key in removed:
+            iid = self._iids.pop(key)
+            if self.tree.exists(iid):
+                self.tree.delete(iid)
+
+        for key, values in updated:
+            self.tree.item(self._iids[key], values=values)
+
+        for key, values in inserted:
+            self._iids[key] = self.tree.insert("", tk.END, iid=str(key), values=values)
+
+        return len(inserted) + len(updated) + len(removed)
+
+    def clear(self):
+        for iid in self._iids.values():
+            if self.tree.exists(iid):
+                self.tree.delete(iid)
+        self._iids.clear()
+        super().clear()
+
+
+class KeyedListbox(KeyedListModel):
+    """Listbox đồng bộ theo key - values là tuple 1 phần tử (text)"""
+
+    def __init__(self, listbox):
+        super().__init__()
+        self.listbox = listbox
+
+    def sync(self, rows: Iterable[Tuple[Hashable, str]]) -> int:
+        """Đồng bộ Listbox từ (key, text), trả về số dòng thay đổi"""
+        # Listbox đánh index theo vị trí - lấy vị trí trước khi diff
+        positions = {key: index for index, key in enumerate(self.rows)}
+        inserted, updated, removed = self.diff((key, (text,)) for key, text in rows)
+
+        # Xóa từ cuối lên để index phía trước không bị lệch
+        for index in sorted((positions[key] for key in removed), reverse=True):
+            self.listbox.delete(index)
+
+        if updated:
+            positions = {key: index for index, key in enumerate(self.rows)}
+            for key, (text,) in updated:
+                index = positions[key]
+                self.listbox.delete(index)
+                self.listbox.insert(index, text)
+
+        for _, (text,) in inserted:
+            self.listbox.insert(tk.END, text)
+
+        return len(inserted) + len(updated) + len(removed)
+
+    def clear(self):
+        self.listbox.delete(0, tk.END)
+        super().clear()
+
+
+# Demo: đo số thao tác khi 1 ESP đổi trạng thái trong fleet 500 ESP
+if __name__ == "__main__":
+    import time
+
+    model = KeyedListModel()
+    fleet = {f"192.168.1.{i % 250}:{i}": ("Cube", "🟢 Connected", 0) for i in range(500)}
+
+    model.diff(fleet.items())
+    fleet["192.168.1.7:7"] = ("Cube", "🔴 Offline", 0)
+    del fleet["192.168.1.9:9"]
+    fleet["10.0.0.1:1"] = ("New", "🔍 Discovered", 0)
+
+    start = time.perf_counter()
+    inserted, updated, removed = model.diff(fleet.items())
+    elapsed = time.perf_counter() - start
+    print(f"🧪 inserted={len(inserted)} updated={len(updated)} removed={len(removed)} "
+          f"({elapsed * 1000:.2f} ms)")
+    print(f"📊 {model.get_stats()}")
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Liveness Tracking
+Hashed timer wheel cho deadline online/offline của ESP thay cho thread quét toàn bộ ESP mỗi
+vài giây: touch() mỗi heartbeat/packet chỉ ghi 1 deadline (O(1)), wheel chỉ xét các key
+rơi vào slot đến hạn, nên ESP offline được báo trong timeout + tick bất kể fleet lớn cỡ nào
+"""
+
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+
+class LivenessWheel:
+    """Timer wheel với deadline lười: key chỉ được xếp lại slot khi slot cũ đến hạn"""
+
+    def __init__(self, timeout: float, tick: float = 0.1, slots: int = 256,
+                 on_expire: Optional[Callable] = None, name: str = "Liveness"):
+        self.timeout = timeout
+        self.tick = tick
+        self.slots: List[Set[Hashable]] = [set() for _ in range(slots)]
+        self.on_expire = on_expire  # on_expire(key, last_seen)
+        self.name = name
+
+        self.deadlines: Dict[Hashable, float] = {}  # {key: deadline} - ghi không cần lock
+        self.timeouts: Dict[Hashable, float] = {}  # {key: timeout} khi khác timeout mặc định
+        self.scheduled: Dict[Hashable, int] = {}  # {key: tick index đang nằm trong wheel}
+        self._lock = threading.Lock()
+        self._current_tick: Optional[int] = None
+
+        self.running = False
+        self.thread: Optional[threading.Thread] = None
+
+        # Statistics
+        self.expired_total = 0
+        self.rescheduled_total = 0
+        self.max_fire_delay = 0.0  # Trễ lớn nhất giữa deadline và lúc báo offline
+
+    def _tick_of(self, deadline: float) -> int:
+        return int(deadline / self.tick) + 1  # Slot xét sau deadline
+
+    def _insert(self, key: Hashable, deadline: float):
+        """Xếp key vào slot của deadline (không sớm hơn tick kế tiếp chưa xử lý)"""
+        tick_index = self._tick_of(deadline)
+        if self._current_tick is not None and tick_index <= self._current_tick:
+            tick_index = self._current_tick + 1
+        self.scheduled[key] = tick_index
+        self.slots[tick_index % len(self.slots)].add(key)
+
+    def touch(self, key: Hashable, now: Optional[float] = None, timeout: Optional[float] = None):
+        """Key còn sống - O(1), gọi được từ mọi thread"""
+        now = time.time() if now is None else now
+        if timeout is not None:
+            self.timeouts[key] = timeout
+        self.deadlines[key] = now + self.timeouts.get(key, self.timeout)
+
+        if key not in self.scheduled:
+            with self._lock:
+                if key not in self.scheduled and key in self.deadlines:
+                    self._insert(key, self.deadlines[key])
+
+    def remove(self, key: Hashable):
+        """Ngừng theo dõi key (ESP bị xóa)"""
+        with self._lock:
+            self.deadlines.pop(key, None)
+            self.timeouts.pop(key, None)
+            tick_index = self.scheduled.pop(key, None)
+            if tick_index is not None:
+                self.slots[tick_index % len(self.slots)].discard(key)
+
+    def last_seen(self, key: Hashable) -> Optional[float]:
+        deadline = self.deadlines.get(key)
+        if deadline is None:
+            return None
+        return deadline - self.timeouts.get(key, self.timeout)
+
+    def is_alive(self, key: Hashable) -> bool:
+        return key in self.scheduled
+
+    def advance(self, now: Optional[float] = None) -> List[Tuple[Hashable, float]]:
+        """Xử lý các slot tới thời điểm now, trả về [(key, last_seen)] vừa hết hạn"""
+        now = time.time() if now is None else now
+        target_tick = int(now / self.tick)
+        expired = []
+
+        with self._lock:
+            if self._current_tick is None:
+                self._current_tick = target_tick - len(self.slots)  # Lần đầu: xét cả wheel
+
+            # Nhảy quá 1 vòng wheel thì mỗi slot chỉ cần xét 1 lần
+            start_tick = max(self._current_tick + 1, target_tick - len(self.slots) + 1)
+            self._current_tick = target_tick
+
+            for tick_index in range(start_tick, target_tick + 1):
+                slot = self.slots[tick_index % len(self.slots)]
+                if not slot:
+                    continue
+
+                for key in list(slot):
+                    if self.scheduled[key] > target_tick:
+                        continue  # Thuộc vòng wheel sau
+
+                    slot.discard(key)
+                    del self.scheduled[key]
+                    deadline = self.deadlines.get(key)
+                    if deadline is not None and deadline > now:
+                        self._insert(key, deadline)
+                        self.rescheduled_total += 1
+                        continue
+
+                    # Đọc lại sau khi bỏ khỏi wheel: touch() chen vào giữa sẽ tự xếp lại key
+                    deadline = self.deadlines.get(key)
+                    if deadline is None or key in self.scheduled:
+                        continue
+                    if deadline > now:
+                        self._insert(key, deadline)
+                        continue
+
+                    expired.append((key, deadline - self.timeouts.get(key, self.timeout)))
+                    self.max_fire_delay = max(self.max_fire_delay, now - deadline)
+
+        self.expired_total += len(expired)
+        return expired
+
+    def start(self):
+        """Thread gọi advance() mỗi tick và báo on_expire"""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True, name=self.name)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread and self.thread.is_alive() and threading.current_thread() is not self.thread:
+            self.thread.join(timeout=2)
+        self.thread = None
+
+    def _run(self):
+        next_tick = time.time()
+        while self.running:
+            next_tick += self.tick
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.time()  # Bị trễ (GC, máy bận) - không dồn tick
+
+            for key, last_seen in self.advance():
+                try:
+                    if self.on_expire:
+                        self.on_expire(key, last_seen)
+                except Exception as e:
+                    print(f"Liveness callback error for {key}: {e}")
+
+    def get_stats(self) -> dict:
+        return {
+            'tracked': len(self.deadlines),
+            'alive': len(self.scheduled),
+            'timeout': self.timeout,
+            'tick': self.tick,
+            'expired_total': self.expired_total,
+            'rescheduled_total': self.rescheduled_total,
+            'max_fire_delay_ms': self.max_fire_delay * 1000,
+        }
+
+
+# Test: 5000 ESP theo thời gian ảo - packet 20 Hz, một phần ESP tắt giữa chừng
+if __name__ == "__main__":
+    import random
+
+    DEVICES = 5000
+    TIMEOUT = 5.0
+    TICK = 0.1
+    STEP = 0.05  # Bước thời gian ảo (mỗi bước: mọi ESP còn sống gửi 1 packet)
+    random.seed(7)
+
+    wheel = LivenessWheel(TIMEOUT, TICK)
+    silent_at = {f"10.{i // 250}.{i % 250}.1": random.uniform(2, 20) if i % 10 == 0 else None
+                 for i in range(DEVICES)}
+    fired = {}
+
+    start = time.perf_counter()
+    touches = 0
+    advance_time = 0.0
+    now = 1000.0
+    for step in range(int(30 / STEP)):  # 30 giây ảo
+        now = 1000.0 + step * STEP
+        for key, silent in silent_at.items():
+            if silent is None or now - 1000.0 < silent:
+                wheel.touch(key, now)
+                touches += 1
+
+        tick_start = time.perf_counter()
+        for key, last_seen in wheel.advance(now):
+            fired[key] = (now, last_seen)
+        advance_time += time.perf_counter() - tick_start
+    elapsed = time.perf_counter() - start
+
+    expected = {key for key, silent in silent_at.items() if silent is not None and silent < 30 - TIMEOUT}
+    late = [key for key, (fire_time, last_seen) in fired.items()
+            if fire_time - last_seen > TIMEOUT + TICK + STEP + 1e-6]
+    assert set(fired) == expected, (len(fired), len(expected))
+    assert not late, late[:5]
+
+    print(f"🧪 {DEVICES} devices, {len(expected)} went silent -> {len(fired)} offline events, 0 late")
+    print(f"   detection bound: timeout {TIMEOUT}s + tick {TICK}s, "
+          f"max fire delay {wheel.max_fire_delay * 1000:.1f} ms")
+    print(f"⚡ {touches:,} touches in {elapsed - advance_time:.2f}s "
+          f"({touches / (elapsed - advance_time):,.0f}/s), advance {advance_time * 1000:.1f} ms total")
+    print(f"📊 {wheel.get_stats()}")
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Log Ring
+Logging dùng chung cho các manager: ring buffer có giới hạn, format lười (lưu template + args,
+chỉ format khi đọc), ghi console/file ở thread nền và có log level
+"""
+
+import datetime
+import queue
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR}
+
+
+def to_level(level) -> int:
+    """Chuyển 'INFO' / 20 thành số level"""
+    if isinstance(level, str):
+        return LEVEL_NAMES[level.upper()]
+    return int(level)
+
+
+def format_entry(entry: tuple) -> str:
+    """Format 1 entry (timestamp, level, template, args) thành dòng log"""
+    timestamp, _, template, args = entry
+    message = template.format(*args) if args else template
+    return f"[{datetime.datetime.fromtimestamp(timestamp).strftime('%H:%M:%S')}] {message}"
+
+
+class LogWriter:
+    """Thread nền ghi log ra console/file - thread nhận dữ liệu không bị block bởi I/O"""
+
+    def __init__(self):
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._write_loop, daemon=True, name="Log_Writer")
+        self.thread.start()
+
+    def submit(self, entry: tuple, console: bool, log_file: Optional[str]):
+        self._queue.put((entry, console, log_file))
+
+    def _write_loop(self):
+        files = {}  # {path: file}
+        while True:
+            entry, console, log_file = self._queue.get()
+            try:
+                line = format_entry(entry)
+                if console:
+                    print(line)
+                if log_file:
+                    f = files.get(log_file)
+                    if f is None:
+                        f = files[log_file] = open(log_file, 'a', encoding='utf-8')
+                    f.write(line + '\n')
+                    if self._queue.empty():
+                        f.flush()
+            except Exception:
+                pass
+
+
+_writer: Optional[LogWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_log_writer() -> LogWriter:
+    """Writer nền dùng chung"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = LogWriter()
+        return _writer
+
+
+class LogRing:
+    """Ring buffer log có giới hạn
+
+    Hành xử như list các dòng log đã format (len, lặp, index, slice, clear)
+    để code GUI cũ dùng `log_messages` vẫn chạy.
+    """
+
+    def __init__(self, max_entries: int = 1000, level=INFO, console: bool = False,
+                 console_level=INFO, log_file: Optional[str] = None):
+        # deque.append với maxlen là atomic - không cần lock ở hot path
+        self._entries: deque = deque(maxlen=max_entries)
+        self.level = to_level(level)
+        self.console = console
+        self.console_level = to_level(console_level)
+        self.log_file = log_file
+
+    @property
+    def max_entries(self) -> int:
+        return self._entries.maxlen
+
+    def log(self, template: str, *args, level: int = INFO):
+        """Ghi log - chỉ lưu template + args, format khi đọc"""
+        if level < self.level:
+            return
+
+        entry = (time.time(), level, template, args)
+        self._entries.append(entry)
+
+        if (self.console or self.log_file) and level >= self.console_level:
+            get_log_writer().submit(entry, self.console, self.log_file)
+
+    def debug(self, template: str, *args):
+        self.log(template, *args, level=DEBUG)
+
+    def info(self, template: str, *args):
+        self.log(template, *args, level=INFO)
+
+    def warning(self, template: str, *args):
+        self.log(template, *args, level=WARNING)
+
+    def error(self, template: str, *args):
+        self.log(template, *args, level=ERROR)
+
+    def set_level(self, level):
+        self.level = to_level(level)
+
+    def get(self, count: Optional[int] = None, min_level: int = DEBUG) -> list:
+        """Lấy `count` dòng gần nhất (đã format)"""
+        # list(deque) chạy trọn trong C dưới GIL - snapshot nhất quán
+        entries = list(self._entries)
+        if min_level > DEBUG:
+            entries = [entry for entry in entries if entry[1] >= min_level]
+        if count is not None:
+            entries = entries[-count:] if count > 0 else []
+        return [format_entry(entry) for entry in entries]
+
+    def clear(self):
+        self._entries.clear()
+
+    def copy(self) -> list:
+        return self.get()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self.get())
+
+    def __getitem__(self, index):
+        entries = list(self._entries)
+        if isinstance(index, slice):
+            return [format_entry(entry) for entry in entries[index]]
+        return format_entry(entries[index])
+
+    def __bool__(self):
+        return len(self._entries) > 0
@@ -6,10 +6,7 @@ Khởi tạo và chạy ứng dụng chính
 
 import sys
 import os
-import threading
 import tkinter as tk
-from pythonosc.dispatcher import Dispatcher
-from pythonosc.osc_server import BlockingOSCUDPServer
 
 # Import các module riêng
 from gui import CubeTouchGUI, HybridCubeTouchGUI
@@ -17,6 +14,8 @@ from communication import CommunicationHandler
 from config import AppConfig
 from auto_discovery_manager import AutoDiscoveryManager
 from auto_discovery_gui import AutoDiscoveryGUI
+from osc_codec import OSCDispatcher
+from osc_relay import OSCRelay
 
 class CubeTouchApp:
     def __init__(self):
@@ -27,24 +26,36 @@ class CubeTouchApp:
         self.root = None
         self.gui = None
         self.auto_gui = None
-        self.osc_thread = None
+        self.osc_dispatcher = None
+        self.osc_relay = None
         self.mode = "hybrid"  # "classic", "auto_discovery", "hybrid"
         
     def setup_osc_server(self):
-        """Thiết lập OSC server để nhận dữ liệu từ ESP32"""
-        dispatcher = Dispatcher()
-        dispatcher.map("/debug", self.comm_handler.handle_osc_data)
+        """Thiết lập OSC server để nhận dữ liệu từ ESP32 (chạy trên ingest loop của auto-discovery)"""
+        self.osc_dispatcher = OSCDispatcher()
+        self.osc_dispatcher.map("/debug", self.comm_handler.handle_osc_data)
         
-        def run_osc_server():
-            try:
-                server = BlockingOSCUDPServer(("0.0.0.0", self.config.osc_port), dispatcher)
-                self.comm_handler.add_log(f"OSC Server started on port {self.config.osc_port}")
-                server.serve_forever()
-            except Exception as e:
-                self.comm_handler.add_log(f"Error starting OSC server: {str(e)}")
+        handler = self.osc_dispatcher.handle_datagram
+        if getattr(self.config, 'osc_relay_enabled', False):
+            targets = getattr(self.config, 'osc_relay_targets', None) or [
+                (self.config.resolume_ip, self.config.resolume_port)]
+            self.osc_relay = OSCRelay(targets,
+                                      frame_rate=getattr(self.config, 'osc_relay_fps', 60.0),
+                                      prefixes=getattr(self.config, 'osc_relay_prefixes', None))
+            dispatcher = self.osc_dispatcher
+            relay = self.osc_relay
+            
+            def handler(data, addr):
+                dispatcher.handle_datagram(data, addr)
+                relay.handle_datagram(data, addr)
         
-        self.osc_thread = threading.Thread(target=run_osc_server, daemon=True)
-        self.osc_thread.start()
+        try:
+            self.auto_discovery_manager.attach_osc(handler, self.config.osc_port)
+            self.comm_handler.add_log(f"OSC Server started on port {self.config.osc_port}")
+            if self.osc_relay:
+                self.comm_handler.add_log(f"🔁 OSC relay -> {', '.join(self.osc_relay.get_stats()['targets'])}")
+        except Exception as e:
+            self.comm_handler.add_log(f"Error starting OSC server: {str(e)}")
     
     def run(self):
         """Chạy ứng dụng"""
@@ -2,14 +2,16 @@ import socket
 import tkinter as tk
 from tkinter import colorchooser, ttk, messagebox, scrolledtext
 import threading
-from pythonosc.dispatcher import Dispatcher
-from pythonosc.osc_server import BlockingOSCUDPServer
+from osc_codec import OSCDispatcher
+from udp_ingest_engine import AsyncUDPIngestEngine
 import time
 import datetime
+from ui_update_scheduler import CoalescingUIScheduler
 
 esp_ip = '192.168.0.43'  # Thay bằng đúng IP ESP32
 esp_port = 4210
 osc_port = 7000  # Port nhận OSC từ ESP32
+ui_fps = 20  # Tần số vẽ lại dữ liệu realtime
 
 current_r = 0
 current_g = 0
@@ -264,8 +266,8 @@ def update_realtime_data(address, *args):
     
     add_log(f"Received data - RawTouch: {raw_touch}, Value: {value}, Threshold: {threshold}")
     
-    # Cập nhật UI trong main thread
-    root.after(0, update_labels)
+    # Chỉ đánh dấu dirty - UI được vẽ lại theo frame trong main thread
+    ui_scheduler.submit('monitor', None)
 
 def update_labels():
     raw_touch_label.config(text=f"📱 Raw Touch: {raw_touch}")
@@ -281,17 +283,17 @@ def update_labels():
         admin_window.stats_labels['value'].config(text=f"Value: {value}")
         admin_window.stats_labels['threshold'].config(text=f"Threshold: {threshold}")
 
+osc_dispatcher = OSCDispatcher()
+osc_dispatcher.map("/debug", update_realtime_data)
+osc_engine = AsyncUDPIngestEngine(name="Monitor_OSC")
+
 def start_osc_server():
     global connection_status
-    dispatcher = Dispatcher()
-    dispatcher.map("/debug", update_realtime_data)
-    
     try:
-        server = BlockingOSCUDPServer(("0.0.0.0", osc_port), dispatcher)
+        osc_engine.add_port(osc_port, osc_dispatcher.handle_datagram)
         add_log(f"OSC Server started on port {osc_port}")
         connection_status = "Listening"
         print(f"OSC Server listening on port {osc_port}")
-        server.serve_forever()
     except Exception as e:
         add_log(f"Error starting OSC server: {str(e)}")
         print(f"Error starting OSC server: {e}")
@@ -427,6 +429,9 @@ root.geometry("600x800")
 root.configure(bg="#f0f0f0")
 root.minsize(500, 600)
 
+# Gom cập nhật realtime theo frame thay vì after(0) cho mỗi packet
+ui_scheduler = CoalescingUIScheduler(root, lambda key, state: update_labels(), fps=ui_fps)
+
 # Configure grid weights for responsive design
 root.grid_rowconfigure(0, weight=1)
 root.grid_columnconfigure(0, weight=1)
@@ -642,12 +647,12 @@ status_label = tk.Label(status_frame, text="🔗 OSC Server: Listening on port 7
                        font=("Segoe UI", 9), bg="#f0f0f0", fg="#27ae60")
 status_label.grid(row=0, column=0)
 
-# Khởi động OSC server trong thread riêng
-osc_thread = threading.Thread(target=start_osc_server, daemon=True)
-osc_thread.start()
+# Khởi động OSC server (ingest loop chạy trên thread riêng của engine)
+start_osc_server()
 
 add_log("Application started")
 add_log(f"ESP32 IP: {esp_ip}:{esp_port}")
 add_log(f"OSC Port: {osc_port}")
 
+ui_scheduler.start()
 root.mainloop()
\ No newline at end of file
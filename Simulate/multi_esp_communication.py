@@ -5,50 +5,111 @@ Xử lý giao tiếp đồng thời với nhiều ESP32 mà không bị nghẽn
 """
 
 import socket
-import datetime
 import threading
 import time
-import queue
-from typing import Optional, Callable, Dict, List
+import select
+from typing import Optional, Callable, Dict, List, Mapping
 from collections import defaultdict
+from udp_command_sender import get_shared_sender
+from log_ring import LogRing, DEBUG, INFO, WARNING, ERROR
+from telemetry_parser import parse_telemetry, TelemetryRecord
+from ingest_metrics import IngestMetrics, DROP_RATE_LIMIT, DROP_QUEUE_FULL, DROP_PARSE_ERROR, DROP_COALESCED
+from pipeline import Pipeline, stage_options, OVERFLOW
+from liveness import LivenessWheel
+from touch_coalescer import TouchCoalescer
+from fleet_ops import FleetOps
+from device_registry import DeviceRegistry
+
+try:
+    from telemetry_store import TelemetryStore
+except ImportError:  # numpy chưa cài - chạy không có lịch sử telemetry
+    TelemetryStore = None
 
 class MultiESPCommunicationHandler:
     """Xử lý giao tiếp với nhiều ESP32 đồng thời"""
     
-    def __init__(self, config):
+    def __init__(self, config, registry: Optional[DeviceRegistry] = None):
         self.config = config
-        self.log_messages = []
+        self.log_messages = LogRing(config.max_log_entries,
+                                    level=getattr(config, 'log_level', DEBUG),
+                                    console=True,
+                                    log_file=getattr(config, 'log_file', None))
         self.total_packets_sent = 0
         self.total_packets_received = 0
         self.connection_status = "Disconnected"
         
-        # Multi-ESP support
-        self.esp_devices = {}  # {esp_ip: device_info}
-        self.esp_data_queues = defaultdict(queue.Queue)  # {esp_ip: queue}
-        self.esp_statistics = defaultdict(lambda: {
-            'packets_received': 0,
-            'packets_sent': 0,
-            'last_seen': None,
-            'status': 'Offline'
-        })
+        # Multi-ESP support - trạng thái + thống kê mỗi ESP nằm trong 1 record
+        self.registry = registry or DeviceRegistry()
+        self.esp_devices = self.registry  # {esp_ip: DeviceRecord}
+        self.snapshot_max_age = 1.0 / getattr(config, 'ui_fps', 20)  # GUI đọc chung 1 snapshot/frame
         
         # Threading for parallel processing
         self.running = False
         self.receive_thread = None
-        self.process_threads = {}
         
         # UDP sockets với buffer optimization
         self.udp_socket = None
         self.setup_optimized_socket()
         
+        # Socket gửi lệnh dùng chung cho tất cả ESP
+        self.command_sender = get_shared_sender()
+        
+        # Lịch sử telemetry theo ESP (ring buffer NumPy)
+        self.telemetry_store = TelemetryStore() if TelemetryStore else None
+        
         # Callback functions
         self.on_data_update: Optional[Callable] = None
         self.on_esp_status_change: Optional[Callable] = None
         
+        # Per-ESP ingest metrics (drop theo lý do, jitter, latency, callback time)
+        self.metrics = IngestMetrics("multi_esp")
+        self.metrics_snapshot_interval = getattr(config, 'metrics_snapshot_interval', 5.0)
+        self.on_metrics_snapshot: Optional[Callable] = None
+        
+        # Receive thread → decode → aggregate → dispatch, queue bounded + overflow policy mỗi stage
+        # Item: (esp_ip, payloads | records, timestamp)
+        self.pipeline = Pipeline("MultiESP_Pipeline", key=lambda item: item[0],
+                                 on_drop=self._on_pipeline_drop, log=self.add_log)
+        self.pipeline.add_stage('decode', self._decode_stage, **stage_options(config, 'decode'))
+        self.pipeline.add_stage('aggregate', self._aggregate_stage, coalesce_if=self._is_touch_batch,
+                                **stage_options(config, 'aggregate'))
+        self.pipeline.add_stage('dispatch', self._dispatch_stage, coalesce_if=self._is_touch_batch,
+                                **stage_options(config, 'dispatch'))
+        
+        # Gộp touch theo ESP trước callback (window 0 = mỗi packet 1 callback), đổi trạng thái chạm giao ngay
+        self.touch_coalescer = TouchCoalescer(self._emit_data, getattr(config, 'touch_coalesce_window', 0.0),
+                                              name="MultiESP_TouchCoalescer")
+        
+        # Offline detection: deadline theo ESP trên timer wheel (báo trong timeout + tick)
+        self.liveness = LivenessWheel(
+            timeout=getattr(config, 'esp_offline_timeout', 5.0),
+            tick=getattr(config, 'liveness_tick', 0.1),
+            on_expire=self._on_esp_timeout,
+            name="ESP_Monitor"
+        )
+        
+        # Broadcast / group / rollout song song (không chặn GUI thread)
+        self.fleet = FleetOps(self.send_command_to_esp, lambda: list(self.esp_devices),
+                              max_concurrency=getattr(config, 'fleet_concurrency', 16),
+                              log=self.add_log, name="MultiESP_Fleet")
+        
         # Rate limiting
         self.rate_limiter = {}  # {esp_ip: last_process_time}
         self.min_process_interval = 0.01  # 10ms minimum between processes
         
+        # Batch receive: drain tất cả datagram đang chờ trong 1 lần wakeup
+        self.receive_mode = "batch"  # "batch" hoặc "single" (1 recvfrom mỗi vòng)
+        self.batch_size = 64  # Số datagram tối đa mỗi wakeup
+        self.recv_buffer_size = 4096
+        self._recv_views = [memoryview(bytearray(self.recv_buffer_size))
+                            for _ in range(self.batch_size)]
+        
+        # Batch statistics
+        self.wakeup_count = 0
+        self.batch_packets_total = 0
+        self.max_packets_per_wakeup = 0
+        self.batch_histogram = defaultdict(int)  # {packets_per_wakeup: wakeups}
+        
     def setup_optimized_socket(self):
         """Thiết lập socket với optimization cho nhiều ESP"""
         try:
@@ -75,25 +136,7 @@ class MultiESPCommunicationHandler:
             if esp_name is None:
                 esp_name = f"ESP32_{esp_ip.split('.')[-1]}"
                 
-            self.esp_devices[esp_ip] = {
-                'name': esp_name,
-                'ip': esp_ip,
-                'registered_at': datetime.datetime.now(),
-                'active': True
-            }
-            
-            # Tạo queue riêng cho ESP này
-            self.esp_data_queues[esp_ip] = queue.Queue(maxsize=1000)
-            
-            # Tạo processing thread riêng
-            thread = threading.Thread(
-                target=self._process_esp_data,
-                args=(esp_ip,),
-                daemon=True,
-                name=f"ESP_Processor_{esp_ip}"
-            )
-            thread.start()
-            self.process_threads[esp_ip] = thread
+            self.registry.add(esp_ip, esp_name, esp_port=self.config.esp_port)
             
             self.add_log(f"📡 Registered ESP32: {esp_name} ({esp_ip})")
             return True
@@ -110,6 +153,7 @@ class MultiESPCommunicationHandler:
         try:
             self.udp_socket.bind(('0.0.0.0', self.config.osc_port))
             self.running = True
+            self.pipeline.start()
             
             # Main receive thread
             self.receive_thread = threading.Thread(
@@ -119,13 +163,10 @@ class MultiESPCommunicationHandler:
             )
             self.receive_thread.start()
             
-            # Status monitor thread
-            status_thread = threading.Thread(
-                target=self._monitor_esp_status,
-                daemon=True,
-                name="ESP_Monitor"
-            )
-            status_thread.start()
+            self.metrics.start_snapshots(self.metrics_snapshot_interval, self._on_metrics_snapshot)
+            
+            # Offline detection
+            self.liveness.start()
             
             self.add_log(f"🚀 Multi-ESP communication started on port {self.config.osc_port}")
             
@@ -134,39 +175,17 @@ class MultiESPCommunicationHandler:
             
     def _receive_loop(self):
         """Main loop nhận dữ liệu UDP"""
+        if self.receive_mode == "batch":
+            self._receive_batch_loop()
+        else:
+            self._receive_single_loop()
+    
+    def _receive_single_loop(self):
+        """Nhận từng datagram - 1 recvfrom mỗi vòng lặp"""
         while self.running:
             try:
-                data, addr = self.udp_socket.recvfrom(4096)
-                esp_ip = addr[0]
-                
-                # Auto-register ESP if not known
-                if esp_ip not in self.esp_devices:
-                    self.register_esp(esp_ip)
-                
-                # Rate limiting per ESP
-                current_time = time.time()
-                if esp_ip in self.rate_limiter:
-                    if current_time - self.rate_limiter[esp_ip] < self.min_process_interval:
-                        continue  # Skip if too frequent
-                
-                self.rate_limiter[esp_ip] = current_time
-                
-                # Queue data cho ESP tương ứng
-                try:
-                    self.esp_data_queues[esp_ip].put_nowait((data, addr, current_time))
-                except queue.Full:
-                    # Queue đầy → drop oldest data
-                    try:
-                        self.esp_data_queues[esp_ip].get_nowait()
-                        self.esp_data_queues[esp_ip].put_nowait((data, addr, current_time))
-                    except queue.Empty:
-                        pass
-                
-                # Update statistics
-                self.esp_statistics[esp_ip]['packets_received'] += 1
-                self.esp_statistics[esp_ip]['last_seen'] = current_time
-                self.esp_statistics[esp_ip]['status'] = 'Online'
-                self.total_packets_received += 1
+                data, addr = self.udp_socket.recvfrom(self.recv_buffer_size)
+                self._dispatch_batch([(data, addr)], time.time())
                 
             except socket.timeout:
                 continue  # Normal timeout, continue listening
@@ -175,104 +194,172 @@ class MultiESPCommunicationHandler:
                     self.add_log(f"Receive error: {str(e)}")
                 time.sleep(0.01)
     
-    def _process_esp_data(self, esp_ip: str):
-        """Xử lý dữ liệu riêng cho từng ESP"""
-        esp_queue = self.esp_data_queues[esp_ip]
+    def _receive_batch_loop(self):
+        """Chờ socket readable rồi drain toàn bộ datagram đang chờ"""
+        self.udp_socket.setblocking(False)
         
         while self.running:
             try:
-                # Get data from queue với timeout
-                data, addr, timestamp = esp_queue.get(timeout=1.0)
+                readable, _, _ = select.select([self.udp_socket], [], [], 0.1)
+                if not readable:
+                    continue  # Normal timeout, continue listening
                 
-                # Process OSC data
-                self._handle_osc_data_from_esp(data, esp_ip, timestamp)
+                batch = self._drain_socket()
+                if batch:
+                    self._dispatch_batch(batch, time.time())
                 
-                esp_queue.task_done()
-                
-            except queue.Empty:
-                continue  # Timeout, check again
             except Exception as e:
-                self.add_log(f"ESP {esp_ip} processing error: {str(e)}")
+                if self.running:
+                    self.add_log(f"Receive error: {str(e)}")
+                time.sleep(0.01)
     
-    def _handle_osc_data_from_esp(self, data: bytes, esp_ip: str, timestamp: float):
-        """Xử lý dữ liệu OSC từ ESP cụ thể"""
-        try:
-            # Decode data
-            message = data.decode('utf-8').strip()
+    def _drain_socket(self) -> list:
+        """Đọc non-blocking vào pool buffer cho tới khi kernel buffer rỗng"""
+        batch = []
+        for view in self._recv_views:
+            try:
+                nbytes, addr = self.udp_socket.recvfrom_into(view)
+            except (BlockingIOError, InterruptedError):
+                break
             
-            # Parse data theo format
-            esp_data = self._parse_esp_message(message, esp_ip)
+            # Copy ra khỏi pool vì buffer được dùng lại ở wakeup sau
+            batch.append((bytes(view[:nbytes]), addr))
+        
+        count = len(batch)
+        self.wakeup_count += 1
+        self.batch_packets_total += count
+        self.batch_histogram[count] += 1
+        if count > self.max_packets_per_wakeup:
+            self.max_packets_per_wakeup = count
+        
+        return batch
+    
+    def _dispatch_batch(self, batch: list, current_time: float):
+        """Gom datagram theo ESP và đưa vào pipeline (1 item mỗi ESP mỗi batch)"""
+        # Group by ESP - mỗi ESP nhận 1 item cho cả batch
+        grouped = {}
+        for data, addr in batch:
+            grouped.setdefault(addr[0], []).append((data, addr))
+        
+        for esp_ip, packets in grouped.items():
+            # Auto-register ESP if not known
+            esp = self.registry.get(esp_ip)
+            if esp is None:
+                self.register_esp(esp_ip)
+                esp = self.registry[esp_ip]
             
-            if esp_data and self.on_data_update:
-                # Add ESP info to data
-                esp_data['esp_ip'] = esp_ip
-                esp_data['esp_name'] = self.esp_devices[esp_ip]['name']
-                esp_data['timestamp'] = timestamp
-                
-                # Callback to GUI
-                self.on_data_update(esp_data)
+            self.metrics.on_received(esp_ip, current_time, len(packets))
             
-        except Exception as e:
-            self.add_log(f"OSC processing error from {esp_ip}: {str(e)}")
-    
-    def _parse_esp_message(self, message: str, esp_ip: str) -> dict:
-        """Parse message từ ESP32"""
-        try:
-            # Giả sử format: "RawTouch:1234,Threshold:2500,Value:856"
-            data = {'esp_ip': esp_ip}
+            # Rate limiting per ESP - xét từng datagram như khi nhận từng recvfrom (datagram cùng batch
+            # có chung thời điểm nhận: chỉ datagram đầu qua nếu đã đủ min_process_interval)
+            payloads = []
+            for data, _ in packets:
+                last = self.rate_limiter.get(esp_ip)
+                if last is not None and current_time - last < self.min_process_interval:
+                    continue  # Skip if too frequent
+                self.rate_limiter[esp_ip] = current_time
+                payloads.append(data)
             
-            if "RawTouch:" in message:
-                parts = message.split(',')
-                for part in parts:
-                    if "RawTouch:" in part:
-                        data['raw_touch'] = part.split(':')[1].strip()
-                    elif "Threshold:" in part:
-                        data['threshold'] = part.split(':')[1].strip()
-                    elif "Value:" in part:
-                        data['value'] = part.split(':')[1].strip()
+            if len(payloads) < len(packets):
+                self.metrics.on_dropped(esp_ip, DROP_RATE_LIMIT, len(packets) - len(payloads))
+            if not payloads:
+                continue
             
-            return data
+            # Vào stage decode - overflow xử lý theo policy của stage, được đếm trong _on_pipeline_drop
+            self.pipeline.put((esp_ip, payloads, current_time))
             
-        except Exception as e:
-            self.add_log(f"Parse error from {esp_ip}: {str(e)}")
-            return None
+            # Update statistics
+            esp.packets_received += len(payloads)
+            esp.last_seen = current_time
+            if esp.status != 'Online':
+                self.registry.update(esp, status='Online')
+            self.liveness.touch(esp_ip, current_time)
+            self.total_packets_received += len(payloads)
     
-    def _monitor_esp_status(self):
-        """Monitor trạng thái kết nối của các ESP"""
-        while self.running:
-            try:
-                current_time = time.time()
-                timeout_threshold = 5.0  # 5 seconds timeout
-                
-                for esp_ip, stats in self.esp_statistics.items():
-                    if stats['last_seen']:
-                        if current_time - stats['last_seen'] > timeout_threshold:
-                            if stats['status'] != 'Offline':
-                                stats['status'] = 'Offline'
-                                if self.on_esp_status_change:
-                                    self.on_esp_status_change(esp_ip, 'Offline')
-                                self.add_log(f"⚠️ ESP {esp_ip} went offline")
-                
-                time.sleep(2)  # Check every 2 seconds
-                
-            except Exception as e:
-                self.add_log(f"Status monitor error: {str(e)}")
+    def _decode_stage(self, item):
+        """Stage decode: datagram -> TelemetryRecord (parse trực tiếp trên bytes)"""
+        esp_ip, payloads, timestamp = item
+        self.metrics.on_queue_wait(esp_ip, time.time() - timestamp)
+        
+        records = []
+        for data in payloads:
+            record = parse_telemetry(data)
+            if record.kind == TelemetryRecord.ERROR:
+                self.metrics.on_dropped(esp_ip, DROP_PARSE_ERROR)
+                self.add_log("Parse error from {}: {}", esp_ip, record.text, level=WARNING)
+                continue
+            records.append(record)
+        
+        return (esp_ip, records, timestamp) if records else None
+    
+    def _aggregate_stage(self, item):
+        """Stage aggregate: latency theo timestamp thiết bị + lịch sử telemetry"""
+        esp_ip, records, timestamp = item
+        for record in records:
+            if record.device_time is not None:
+                self.metrics.on_device_time(esp_ip, record.device_time, timestamp)
+            
+            if record.kind == TelemetryRecord.TOUCH and self.telemetry_store:
+                self.telemetry_store.append_record(esp_ip, record, timestamp)
+        
+        return item if self.on_data_update else None
+    
+    def _dispatch_stage(self, item):
+        """Stage dispatch: callback GUI"""
+        esp_ip, records, timestamp = item
+        esp = self.registry.get(esp_ip)
+        esp_name = esp.name if esp is not None else esp_ip
+        
+        for record in records:
+            # Add ESP info to data
+            esp_data = record.to_dict()
+            esp_data['esp_ip'] = esp_ip
+            esp_data['esp_name'] = esp_name
+            esp_data['timestamp'] = timestamp
+            
+            self.touch_coalescer.offer(esp_ip, esp_data)
+    
+    def _emit_data(self, esp_ip: str, esp_data: dict):
+        """Callback to GUI (từ dispatch stage hoặc timer của touch coalescer)"""
+        if self.on_data_update:
+            callback_start = time.perf_counter()
+            self.on_data_update(esp_data)
+            self.metrics.on_callback(esp_ip, time.perf_counter() - callback_start)
+    
+    @staticmethod
+    def _is_touch_batch(item) -> bool:
+        """Chỉ coalesce batch toàn touch - STATUS/ACK luôn được giao"""
+        return all(getattr(record, 'kind', None) == TelemetryRecord.TOUCH for record in item[1])
+    
+    def _on_pipeline_drop(self, stage: str, item, reason: str):
+        """Overflow / coalesce trong pipeline -> drop reason theo ESP"""
+        self.metrics.on_dropped(item[0], DROP_QUEUE_FULL if reason == OVERFLOW else DROP_COALESCED,
+                                len(item[1]))
+    
+    def _on_esp_timeout(self, esp_ip: str, last_seen: float):
+        """ESP không gửi gì trong esp_offline_timeout (gọi từ liveness thread)"""
+        esp = self.registry.get(esp_ip)
+        if esp is not None and esp.status != 'Offline':
+            self.registry.update(esp, status='Offline')
+            if self.on_esp_status_change:
+                self.on_esp_status_change(esp_ip, 'Offline')
+            self.add_log(f"⚠️ ESP {esp_ip} went offline")
     
     def send_command_to_esp(self, esp_ip: str, command: str) -> bool:
         """Gửi lệnh đến ESP cụ thể"""
         try:
-            if esp_ip not in self.esp_devices:
+            esp = self.registry.get(esp_ip)
+            if esp is None:
                 self.add_log(f"Unknown ESP: {esp_ip}")
                 return False
             
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            message = command.encode()
-            sock.sendto(message, (esp_ip, self.config.esp_port))
-            sock.close()
+            if not self.command_sender.send(command, (esp_ip, esp.esp_port)):
+                self.add_log(f"Send error to {esp_ip}: send queue full")
+                return False
             
-            self.esp_statistics[esp_ip]['packets_sent'] += 1
+            esp.packets_sent += 1
             self.total_packets_sent += 1
-            self.add_log(f"📤 Sent to {esp_ip}: {command}")
+            self.add_log("📤 Sent to {}: {}", esp_ip, command, level=DEBUG)
             return True
             
         except Exception as e:
@@ -280,54 +367,58 @@ class MultiESPCommunicationHandler:
             return False
     
     def broadcast_command(self, command: str) -> int:
-        """Gửi lệnh đến tất cả ESP"""
-        success_count = 0
-        for esp_ip in self.esp_devices:
-            if self.send_command_to_esp(esp_ip, command):
-                success_count += 1
-        return success_count
+        """Gửi lệnh đến tất cả ESP (chặn tới khi xong - GUI dùng broadcast_async)"""
+        operation = self.fleet.broadcast(command)
+        operation.wait()
+        return operation.ok_count
+    
+    def broadcast_async(self, command: str, targets=None, group: Optional[str] = None):
+        """Gửi lệnh song song cho nhiều ESP - trả về FleetOperation ngay"""
+        return self.fleet.broadcast(command, targets=targets, group=group)
     
-    def get_esp_list(self) -> List[dict]:
-        """Lấy danh sách ESP và trạng thái"""
-        esp_list = []
-        for esp_ip, device in self.esp_devices.items():
-            stats = self.esp_statistics[esp_ip]
-            esp_list.append({
-                'ip': esp_ip,
-                'name': device['name'],
-                'status': stats['status'],
-                'packets_received': stats['packets_received'],
-                'packets_sent': stats['packets_sent'],
-                'last_seen': stats['last_seen']
-            })
-        return esp_list
+    def get_esp_list(self) -> List[Mapping]:
+        """Lấy danh sách ESP và trạng thái (snapshot bất biến - an toàn từ thread GUI)"""
+        return list(self.registry.snapshot(self.snapshot_max_age).devices)
     
     def get_performance_stats(self) -> dict:
         """Lấy thống kê hiệu suất"""
+        snapshot = self.registry.snapshot(self.snapshot_max_age)
         return {
-            'total_esp_count': len(self.esp_devices),
-            'online_esp_count': sum(1 for stats in self.esp_statistics.values() 
-                                   if stats['status'] == 'Online'),
+            'snapshot_version': snapshot.version,
+            'total_esp_count': len(snapshot),
+            'online_esp_count': snapshot.count('Online'),
             'total_packets_received': self.total_packets_received,
             'total_packets_sent': self.total_packets_sent,
-            'queue_sizes': {esp_ip: q.qsize() 
-                           for esp_ip, q in self.esp_data_queues.items()}
+            'queue_sizes': self.pipeline.backlog_by_key(),
+            'pipeline': self.pipeline.get_stats(),
+            'touch_coalescer': self.touch_coalescer.get_stats(),
+            'receive_mode': self.receive_mode,
+            'wakeups': self.wakeup_count,
+            'avg_packets_per_wakeup': (self.batch_packets_total / self.wakeup_count
+                                       if self.wakeup_count else 0),
+            'max_packets_per_wakeup': self.max_packets_per_wakeup,
+            'batch_histogram': dict(self.batch_histogram),
+            'sender': self.command_sender.get_stats(),
+            'liveness': self.liveness.get_stats(),
+            'fleet': self.fleet.get_stats(),
+            'registry': self.registry.get_stats(),
+            'metrics': self.metrics.snapshot()
         }
     
-    def add_log(self, message: str):
-        """Thêm log message"""
-        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        self.log_messages.append(log_entry)
-        
-        if len(self.log_messages) > self.config.max_log_entries:
-            self.log_messages.pop(0)
-        
-        print(log_entry)  # Also print to console
+    def _on_metrics_snapshot(self, snapshot: dict):
+        """Snapshot định kỳ từ IngestMetrics"""
+        if self.on_metrics_snapshot:
+            self.on_metrics_snapshot(snapshot)
+    
+    def add_log(self, message: str, *args, level: int = INFO):
+        """Thêm log message (args được format khi đọc)"""
+        self.log_messages.log(message, *args, level=level)
     
     def stop_communication(self):
         """Dừng communication"""
         self.running = False
+        self.metrics.stop_snapshots()
+        self.liveness.stop()
         
         if self.udp_socket:
             self.udp_socket.close()
@@ -336,8 +427,7 @@ class MultiESPCommunicationHandler:
         if self.receive_thread and self.receive_thread.is_alive():
             self.receive_thread.join(timeout=2)
         
-        for thread in self.process_threads.values():
-            if thread.is_alive():
-                thread.join(timeout=1)
+        self.pipeline.stop()
+        self.touch_coalescer.stop()
         
         self.add_log("🛑 Multi-ESP communication stopped")
\ No newline at end of file
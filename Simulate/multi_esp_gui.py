@@ -5,10 +5,11 @@ Giao diện quản lý nhiều ESP32 đồng thời
 """
 
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, simpledialog
 import threading
 import time
 from multi_esp_communication import MultiESPCommunicationHandler
+from list_view_model import KeyedTreeview
 
 class MultiESPGUI:
     """GUI cho quản lý nhiều ESP32"""
@@ -75,6 +76,7 @@ class MultiESPGUI:
         # ESP TreeView
         columns = ("Name", "IP", "Status", "Packets")
         self.esp_tree = ttk.Treeview(esp_frame, columns=columns, show="headings", height=10)
+        self.esp_view = KeyedTreeview(self.esp_tree)
         
         for col in columns:
             self.esp_tree.heading(col, text=col)
@@ -347,18 +349,14 @@ class MultiESPGUI:
         self.add_log(f"ESP {esp_ip} status changed: {status}")
     
     def update_esp_list(self):
-        """Cập nhật danh sách ESP"""
-        # Clear current items
-        for item in self.esp_tree.get_children():
-            self.esp_tree.delete(item)
-        
-        # Add ESP devices
-        esp_list = self.comm_handler.get_esp_list()
-        for esp in esp_list:
-            self.esp_tree.insert("", tk.END, values=(
+        """Cập nhật danh sách ESP (chỉ cập nhật các dòng thay đổi)"""
+        self.esp_view.sync(
+            (esp['ip'], (
                 esp['name'], esp['ip'], esp['status'], 
                 f"R:{esp['packets_received']} S:{esp['packets_sent']}"
             ))
+            for esp in self.comm_handler.get_esp_list()
+        )
     
     def start_auto_update(self):
         """Bắt đầu cập nhật tự động"""
@@ -418,6 +416,28 @@ class MultiESPGUI:
         if self.selected_esp:
             self.comm_handler.send_command_to_esp(self.selected_esp, "RAINBOW:START")
     
+    def broadcast_dialog(self):
+        """Gửi 1 lệnh cho tất cả ESP (chạy nền trên fleet worker pool)"""
+        command = simpledialog.askstring("Broadcast Command", "Command for all ESP32s:", parent=self.root)
+        if not command:
+            return
+        
+        operation = self.comm_handler.broadcast_async(command.strip())
+        self.add_log(f"📢 Broadcasting '{operation.command}' to {operation.total} ESPs...")
+        self._poll_broadcast(operation)
+    
+    def _poll_broadcast(self, operation):
+        """Chờ broadcast xong bằng root.after (GUI vẫn phản hồi)"""
+        if not operation.done:
+            self.root.after(100, lambda: self._poll_broadcast(operation))
+            return
+        
+        summary = operation.summary()
+        if summary['failed']:
+            messagebox.showwarning("Broadcast",
+                                   f"{len(summary['ok'])}/{operation.total} ESPs OK\n"
+                                   f"Failed: {', '.join(sorted(summary['failed']))}")
+    
     def add_log(self, message):
         """Thêm log"""
         self.comm_handler.add_log(message)
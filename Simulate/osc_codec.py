@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+"""
+OSC Codec
+Decoder OSC 1.0 không copy thay cho pythonosc: đọc trực tiếp trên buffer của datagram bằng offset
++ struct.unpack_from (blob trả về memoryview), hỗ trợ #bundle lồng nhau, và bảng dispatch
+biên dịch sẵn theo address (bytes -> handlers) nên message không ai map không cần decode arg.
+OSCDispatcher.handle_datagram(data, addr) cắm thẳng vào AsyncUDPIngestEngine.add_port().
+"""
+
+import re
+import struct
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+BUNDLE_PREFIX = b'#bundle\x00'
+IMMEDIATE = 1  # Timetag "ngay lập tức"
+NTP_EPOCH_OFFSET = 2208988800  # Giây từ 1900-01-01 tới 1970-01-01
+
+_INT32 = struct.Struct('>i')
+_UINT64 = struct.Struct('>Q')
+_FLOAT32 = struct.Struct('>f')
+_INT64 = struct.Struct('>q')
+_FLOAT64 = struct.Struct('>d')
+
+# Tag có độ dài cố định -> ký tự struct (chuỗi tag toàn số dùng 1 lần unpack_from)
+_FIXED_TAGS = {ord('i'): 'i', ord('f'): 'f', ord('h'): 'q', ord('d'): 'd'}
+_NO_DATA_TAGS = {ord('T'): True, ord('F'): False, ord('N'): None, ord('I'): float('inf')}
+_PATTERN_CHARS = re.compile(r'[*?\[\]{}]')
+
+_MISSING = object()
+_struct_cache: Dict[bytes, Optional[struct.Struct]] = {}
+
+
+class OSCDecodeError(ValueError):
+    """Datagram không phải OSC hợp lệ"""
+
+
+def _string_end(data: bytes, offset: int, stop: int) -> int:
+    """Vị trí byte null kết thúc chuỗi OSC bắt đầu tại offset"""
+    end = data.find(b'\x00', offset, stop)
+    if end < 0:
+        raise OSCDecodeError(f"Unterminated string at offset {offset}")
+    return end
+
+
+def _fixed_struct(tags: bytes) -> Optional[struct.Struct]:
+    """Struct cho chuỗi tag chỉ gồm i/f/h/d (cache theo tag), None nếu có tag khác"""
+    cached = _struct_cache.get(tags, _MISSING)
+    if cached is not _MISSING:
+        return cached
+
+    if all(tag in _FIXED_TAGS for tag in tags):
+        cached = struct.Struct('>' + ''.join(_FIXED_TAGS[tag] for tag in tags))
+    else:
+        cached = None
+    if len(_struct_cache) < 1024:
+        _struct_cache[tags] = cached
+    return cached
+
+
+def decode_args(data: bytes, offset: int, stop: int) -> tuple:
+    """Đọc type tag + argument bắt đầu tại offset (ngay sau address)"""
+    if offset >= stop or data[offset] != 0x2C:  # ','
+        return ()  # OSC 1.0 cũ: không có type tag
+
+    tag_end = _string_end(data, offset, stop)
+    tags = data[offset + 1:tag_end]
+    offset = (tag_end + 4) & ~3
+
+    if tags == b's':  # Message /debug của ESP: 1 chuỗi
+        end = _string_end(data, offset, stop)
+        return (data[offset:end].decode('utf-8', errors='replace'),)
+
+    fixed = _fixed_struct(tags)
+    if fixed is not None:
+        if offset + fixed.size > stop:
+            raise OSCDecodeError("Truncated arguments")
+        return fixed.unpack_from(data, offset)
+
+    args = []
+    for tag in tags:
+        if tag == 0x73 or tag == 0x53:  # 's' / 'S'
+            end = _string_end(data, offset, stop)
+            args.append(data[offset:end].decode('utf-8', errors='replace'))
+            offset = (end + 4) & ~3
+        elif tag == 0x69:  # 'i'
+            args.append(_INT32.unpack_from(data, offset)[0])
+            offset += 4
+        elif tag == 0x66:  # 'f'
+            args.append(_FLOAT32.unpack_from(data, offset)[0])
+            offset += 4
+        elif tag == 0x62:  # 'b' - blob không copy
+            size = _INT32.unpack_from(data, offset)[0]
+            start = offset + 4
+            if size < 0 or start + size > stop:
+                raise OSCDecodeError("Truncated blob")
+            args.append(memoryview(data)[start:start + size])
+            offset = (start + size + 3) & ~3
+        elif tag == 0x68:  # 'h'
+            args.append(_INT64.unpack_from(data, offset)[0])
+            offset += 8
+        elif tag == 0x64:  # 'd'
+            args.append(_FLOAT64.unpack_from(data, offset)[0])
+            offset += 8
+        elif tag == 0x74:  # 't' timetag
+            args.append(_UINT64.unpack_from(data, offset)[0])
+            offset += 8
+        elif tag == 0x63:  # 'c'
+            args.append(chr(_INT32.unpack_from(data, offset)[0]))
+            offset += 4
+        elif tag == 0x72 or tag == 0x6D:  # 'r' màu RGBA / 'm' MIDI - 4 byte thô
+            args.append(bytes(data[offset:offset + 4]))
+            offset += 4
+        elif tag in _NO_DATA_TAGS:
+            args.append(_NO_DATA_TAGS[tag])
+        else:
+            raise OSCDecodeError(f"Unsupported type tag {chr(tag)!r}")
+
+        if offset > stop:
+            raise OSCDecodeError("Truncated arguments")
+    return tuple(args)
+
+
+def decode_message(data: bytes, offset: int = 0, stop: Optional[int] = None) -> Tuple[str, tuple]:
+    """1 message OSC -> (address, args)"""
+    stop = len(data) if stop is None else stop
+    end = _string_end(data, offset, stop)
+    address = data[offset:end].decode('utf-8', errors='replace')
+    return address, decode_args(data, (end + 4) & ~3, stop)
+
+
+def iter_messages(data: bytes, offset: int = 0, stop: Optional[int] = None,
+                  timetag: int = IMMEDIATE) -> Iterator[Tuple[str, tuple, int]]:
+    """Duyệt mọi message trong packet (kể cả bundle lồng nhau) -> (address, args, timetag)"""
+    stop = len(data) if stop is None else stop
+    if data.startswith(BUNDLE_PREFIX, offset):
+        if offset + 16 > stop:
+            raise OSCDecodeError("Truncated bundle header")
+        timetag = _UINT64.unpack_from(data, offset + 8)[0]
+        offset += 16
+        while offset < stop:
+            size = _INT32.unpack_from(data, offset)[0]
+            offset += 4
+            if size < 0 or offset + size > stop:
+                raise OSCDecodeError("Truncated bundle element")
+            yield from iter_messages(data, offset, offset + size, timetag)
+            offset += size
+        return
+
+    address, args = decode_message(data, offset, stop)
+    yield address, args, timetag
+
+
+def iter_message_spans(data: bytes, offset: int = 0, stop: Optional[int] = None,
+                       timetag: int = IMMEDIATE) -> Iterator[Tuple[int, int, int, int]]:
+    """Như iter_messages nhưng không decode: (start, address_end, stop, timetag) của từng message"""
+    stop = len(data) if stop is None else stop
+    if data.startswith(BUNDLE_PREFIX, offset):
+        if offset + 16 > stop:
+            raise OSCDecodeError("Truncated bundle header")
+        timetag = _UINT64.unpack_from(data, offset + 8)[0]
+        offset += 16
+        while offset < stop:
+            size = _INT32.unpack_from(data, offset)[0]
+            offset += 4
+            if size < 0 or offset + size > stop:
+                raise OSCDecodeError("Truncated bundle element")
+            yield from iter_message_spans(data, offset, offset + size, timetag)
+            offset += size
+        return
+
+    yield offset, _string_end(data, offset, stop), stop, timetag
+
+
+def timetag_to_time(timetag: int) -> Optional[float]:
+    """Timetag NTP -> Unix time (None = immediate)"""
+    if timetag == IMMEDIATE:
+        return None
+    return (timetag >> 32) - NTP_EPOCH_OFFSET + (timetag & 0xFFFFFFFF) / 2 ** 32
+
+
+def time_to_timetag(unix_time: Optional[float]) -> int:
+    if unix_time is None:
+        return IMMEDIATE
+    seconds = int(unix_time)
+    return ((seconds + NTP_EPOCH_OFFSET) << 32) | int((unix_time - seconds) * 2 ** 32)
+
+
+def _pad_string(value: bytes) -> bytes:
+    return value + b'\x00' * (4 - len(value) % 4)
+
+
+def encode_message(address: str, *args) -> bytes:
+    """address + args -> datagram OSC (tag suy từ kiểu Python)"""
+    tags = [',']
+    payload = []
+    for arg in args:
+        if arg is True:
+            tags.append('T')
+        elif arg is False:
+            tags.append('F')
+        elif arg is None:
+            tags.append('N')
+        elif isinstance(arg, int):
+            if -2 ** 31 <= arg < 2 ** 31:
+                tags.append('i')
+                payload.append(_INT32.pack(arg))
+            else:
+                tags.append('h')
+                payload.append(_INT64.pack(arg))
+        elif isinstance(arg, float):
+            tags.append('f')
+            payload.append(_FLOAT32.pack(arg))
+        elif isinstance(arg, str):
+            tags.append('s')
+            payload.append(_pad_string(arg.encode('utf-8')))
+        elif isinstance(arg, (bytes, bytearray, memoryview)):
+            blob = bytes(arg)
+            tags.append('b')
+            payload.append(_INT32.pack(len(blob)) + blob + b'\x00' * (-len(blob) % 4))
+        else:
+            raise TypeError(f"Unsupported OSC argument type: {type(arg).__name__}")
+
+    return (_pad_string(address.encode('utf-8')) + _pad_string(''.join(tags).encode('ascii'))
+            + b''.join(payload))
+
+
+def encode_bundle(elements: List[bytes], timetag: int = IMMEDIATE) -> bytes:
+    """Gói nhiều message/bundle đã encode thành 1 datagram #bundle"""
+    parts = [BUNDLE_PREFIX, _UINT64.pack(timetag)]
+    for element in elements:
+        parts.append(_INT32.pack(len(element)))
+        parts.append(element)
+    return b''.join(parts)
+
+
+def compile_address_pattern(pattern: str) -> 're.Pattern':
+    """Address pattern OSC (*, ?, [..], [!..], {a,b}) -> regex"""
+    regex = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '[':
+            close = pattern.find(']', index)
+            if close < 0:
+                regex.append(re.escape(char))
+            else:
+                body = pattern[index + 1:close]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                regex.append('[' + body.replace('\\', '\\\\') + ']')
+                index = close
+        elif char == '{':
+            close = pattern.find('}', index)
+            if close < 0:
+                regex.append(re.escape(char))
+            else:
+                options = pattern[index + 1:close].split(',')
+                regex.append('(?:' + '|'.join(re.escape(option) for option in options) + ')')
+                index = close
+        else:
+            regex.append(re.escape(char))
+        index += 1
+    return re.compile(''.join(regex) + r'\Z')
+
+
+class OSCDispatcher:
+    """Dispatch theo address với bảng biên dịch sẵn: address bytes -> (address str, handlers)
+
+    handler(address, *args) giống pythonosc Dispatcher.map.
+    """
+
+    def __init__(self, table_size: int = 4096):
+        self.exact: Dict[str, List[Callable]] = {}  # Address map trực tiếp
+        self.patterns: List[Tuple[str, 're.Pattern', List[Callable]]] = []  # Map có wildcard
+        self.default_handler: Optional[Callable] = None
+        self.table_size = table_size
+        self._table: Dict[bytes, Tuple[str, tuple]] = {}
+
+        # Statistics
+        self.packets = 0
+        self.messages = 0
+        self.bundles = 0
+        self.unmatched = 0
+        self.decode_errors = 0
+        self.handler_errors = 0
+
+    def map(self, address: str, handler: Callable):
+        if _PATTERN_CHARS.search(address):
+            for mapped, regex, handlers in self.patterns:
+                if mapped == address:
+                    handlers.append(handler)
+                    break
+            else:
+                self.patterns.append((address, compile_address_pattern(address), [handler]))
+        else:
+            self.exact.setdefault(address, []).append(handler)
+        self._table.clear()
+
+    def unmap(self, address: str, handler: Callable):
+        handlers = self.exact.get(address)
+        if handlers and handler in handlers:
+            handlers.remove(handler)
+            if not handlers:
+                del self.exact[address]
+        for mapped, regex, handlers in self.patterns:
+            if mapped == address and handler in handlers:
+                handlers.remove(handler)
+        self.patterns = [entry for entry in self.patterns if entry[2]]
+        self._table.clear()
+
+    def set_default_handler(self, handler: Optional[Callable]):
+        self.default_handler = handler
+        self._table.clear()
+
+    def _resolve(self, key: bytes) -> Tuple[str, tuple]:
+        """Tìm handlers cho address (1 lần cho mỗi address, sau đó tra bảng)"""
+        address = key.decode('utf-8', errors='replace')
+        handlers = list(self.exact.get(address, ()))
+        for mapped, regex, mapped_handlers in self.patterns:
+            if regex.match(address):
+                handlers.extend(mapped_handlers)
+
+        # Message tự mang pattern (vd. /layers/*/clear) -> khớp với các address đã map
+        if _PATTERN_CHARS.search(address):
+            regex = compile_address_pattern(address)
+            for mapped, mapped_handlers in self.exact.items():
+                if regex.match(mapped):
+                    handlers.extend(mapped_handlers)
+
+        if not handlers and self.default_handler:
+            handlers.append(self.default_handler)
+
+        entry = (address, tuple(handlers))
+        if len(self._table) < self.table_size:
+            self._table[key] = entry
+        return entry
+
+    def handle_datagram(self, data: bytes, addr=None) -> int:
+        """Handler cho ingest engine - trả về số message đã dispatch"""
+        self.packets += 1
+        try:
+            return self._dispatch(data, 0, len(data))
+        except (OSCDecodeError, struct.error):
+            self.decode_errors += 1
+            return 0
+
+    def _dispatch(self, data: bytes, offset: int, stop: int) -> int:
+        if data.startswith(BUNDLE_PREFIX, offset):
+            self.bundles += 1
+            dispatched = 0
+            offset += 16
+            while offset < stop:
+                size = _INT32.unpack_from(data, offset)[0]
+                offset += 4
+                if size < 0 or offset + size > stop:
+                    raise OSCDecodeError("Truncated bundle element")
+                dispatched += self._dispatch(data, offset, offset + size)
+                offset += size
+            return dispatched
+
+        end = data.find(b'\x00', offset, stop)
+        if end < 0:
+            raise OSCDecodeError("Unterminated address")
+        key = data[offset:end]
+        entry = self._table.get(key)
+        if entry is None:
+            entry = self._resolve(key)
+
+        self.messages += 1
+        address, handlers = entry
+        if not handlers:
+            self.unmatched += 1
+            return 0  # Không ai map -> bỏ qua, không decode argument
+
+        args = decode_args(data, (end + 4) & ~3, stop)
+        for handler in handlers:
+            try:
+                handler(address, *args)
+            except Exception as e:
+                self.handler_errors += 1
+                print(f"OSC handler error for {address}: {e}")
+        return 1
+
+    def get_stats(self) -> dict:
+        return {
+            'packets': self.packets,
+            'messages': self.messages,
+            'bundles': self.bundles,
+            'unmatched': self.unmatched,
+            'decode_errors': self.decode_errors,
+            'handler_errors': self.handler_errors,
+            'mapped_addresses': len(self.exact) + len(self.patterns),
+            'compiled_addresses': len(self._table),
+        }
+
+
+def is_osc_packet(data: bytes) -> bool:
+    """Datagram OSC (message hoặc bundle) - dùng để tách khỏi heartbeat text trên cùng port"""
+    return data[:1] == b'/' or data.startswith(BUNDLE_PREFIX)
+
+
+# Benchmark: decode + dispatch traffic ESP (/debug string) + Resolume (số, bundle)
+if __name__ == "__main__":
+    import os
+    import sys
+    import time
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "OLD"))
+
+    debug = encode_message("/debug", "RawTouch: 1823\nThreshold: 2932\n0")
+    clip = encode_message("/composition/layers/1/clips/2/connect", 1)
+    touch = encode_message("/cube/12/touch", 1823, 2932, 0.75, 1.0)
+    bundle = encode_bundle([encode_message(f"/composition/layers/{i}/clear", 1) for i in range(1, 5)])
+    packets = [debug, clip, touch, debug] * 5000
+    ROUNDS = 3
+
+    # Round trip
+    assert decode_message(debug) == ("/debug", ("RawTouch: 1823\nThreshold: 2932\n0",))
+    assert decode_message(touch)[1][:2] == (1823, 2932)
+    assert [m[0] for m in iter_messages(encode_bundle([clip, bundle], time_to_timetag(1.5e9)))] == \
+        ["/composition/layers/1/clips/2/connect"] + [f"/composition/layers/{i}/clear" for i in range(1, 5)]
+    blob = decode_message(encode_message("/blob", b"\x01\x02\x03"))[1][0]
+    assert isinstance(blob, memoryview) and bytes(blob) == b"\x01\x02\x03"
+
+    received = []
+    sink = lambda address, *args: received.append(args)
+
+    def best_of(func) -> float:
+        best = float('inf')
+        for _ in range(ROUNDS):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+        return len(packets) / best
+
+    results = {}
+
+    dispatcher = OSCDispatcher()
+    for address in ("/debug", "/composition/layers/*/clips/*/connect", "/cube/*/touch"):
+        dispatcher.map(address, sink)
+    results['osc_codec'] = best_of(lambda: [dispatcher.handle_datagram(p) for p in packets])
+
+    try:
+        from simple_osc_receiver import parse_osc_message
+        results['OLD slicing parser (no dispatch)'] = best_of(lambda: [parse_osc_message(p) for p in packets])
+    except ImportError:
+        pass
+
+    try:
+        from pythonosc.dispatcher import Dispatcher
+        osc_dispatcher = Dispatcher()
+        for address in ("/debug", "/composition/layers/*/clips/*/connect", "/cube/*/touch"):
+            osc_dispatcher.map(address, sink)
+        results['pythonosc Dispatcher'] = best_of(
+            lambda: [osc_dispatcher.call_handlers_for_packet(p, ("127.0.0.1", 0)) for p in packets])
+    except ImportError:
+        print("ℹ️ pythonosc not installed - comparing against the OLD parser only")
+
+    print(f"🧪 {len(packets):,} packets (/debug string, Resolume int, 4-arg numeric), best of {ROUNDS}")
+    for name, rate in results.items():
+        print(f"   {name:34s} {rate:>12,.0f} msg/s")
+
+    received.clear()
+    dispatcher.handle_datagram(bundle)
+    dispatcher.map("/composition/layers/*/clear", sink)
+    dispatcher.handle_datagram(bundle)
+    assert len(received) == 4, received
+    print(f"📦 bundle of 4 -> {len(received)} handler calls; 📊 {dispatcher.get_stats()}")
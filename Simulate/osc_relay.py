@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+OSC Relay tới Resolume
+Cube gửi OSC (clear/connect/playdirection...) vào relay thay vì bắn thẳng từng packet tới Resolume.
+Trong mỗi frame relay chỉ giữ giá trị mới nhất của mỗi address, /layers/N/clear bỏ các lệnh đang chờ
+của layer N, rồi gửi 1 bundle (chia theo MTU) tới mỗi Resolume host đúng nhịp render frame rate.
+Message được chuyển tiếp nguyên byte (không decode/encode lại) và đo trễ relay cho từng message.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from osc_codec import (IMMEDIATE, OSCDecodeError, encode_bundle, encode_message,
+                       iter_message_spans, timetag_to_time)
+from udp_command_sender import get_shared_sender
+
+
+class _PendingMessage:
+    """Message chờ gửi trong frame hiện tại"""
+
+    __slots__ = ('data', 'received_at', 'source')
+
+    def __init__(self, data: bytes, received_at: float, source):
+        self.data = data
+        self.received_at = received_at  # perf_counter lúc nhận bản đầu tiên (đo trễ)
+        self.source = source
+
+
+class OSCRelay:
+    """Gom OSC theo frame và fan-out bundle tới các Resolume host"""
+
+    def __init__(self, targets: Sequence[Tuple[str, int]], frame_rate: float = 60.0,
+                 max_bundle_bytes: int = 1400, prefixes: Optional[Sequence[str]] = None,
+                 reset_suffix: Optional[str] = "/clear", sender=None, name: str = "OSC_Relay"):
+        self.targets: List[Tuple[str, int]] = list(targets)
+        self.interval = 1.0 / frame_rate
+        self.max_bundle_bytes = max_bundle_bytes  # Giữ bundle dưới MTU mạng show
+        self.prefixes = tuple(prefix.encode('utf-8') for prefix in prefixes) if prefixes else None
+        self.reset_suffix = reset_suffix.encode('utf-8') if reset_suffix else None
+        self.sender = sender or get_shared_sender()
+        self.name = name
+
+        self.pending: "OrderedDict[bytes, _PendingMessage]" = OrderedDict()  # {address: message}
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.running = False
+        self.last_flush = 0.0
+
+        # Statistics
+        self.packets_in = 0
+        self.messages_in = 0
+        self.ignored = 0  # Không khớp prefixes
+        self.superseded = 0  # Bị giá trị mới hơn cùng address thay thế trong frame
+        self.cleared = 0  # Bị /layers/N/clear trong cùng frame xóa
+        self.decode_errors = 0
+        self.frames = 0
+        self.messages_out = 0
+        self.packets_out = 0
+        self.send_errors = 0
+        self.sources: Dict[str, int] = {}  # {ip nguồn: số message}
+        self.relay_latency = deque(maxlen=4096)  # Giây từ lúc nhận tới lúc gửi
+        self.source_latency = deque(maxlen=4096)  # Từ timetag của bundle nguồn (nếu có)
+
+    def start(self):
+        with self._cond:
+            if self.running:
+                return
+            self.running = True
+            self._thread = threading.Thread(target=self._run, daemon=True, name=self.name)
+            self._thread.start()
+
+    def stop(self, flush: bool = True):
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+        if self._thread and self._thread.is_alive() and threading.current_thread() is not self._thread:
+            self._thread.join(timeout=1)
+        if flush:
+            self.flush()
+
+    def add_target(self, ip: str, port: int):
+        if (ip, port) not in self.targets:
+            self.targets.append((ip, port))
+
+    def remove_target(self, ip: str, port: int):
+        if (ip, port) in self.targets:
+            self.targets.remove((ip, port))
+
+    def listen(self, engine, port: int):
+        """Nhận OSC của cube trên ingest engine chung"""
+        return engine.add_port(port, self.handle_datagram)
+
+    def handle_datagram(self, data: bytes, addr=None) -> int:
+        """Handler cho ingest engine - trả về số message được xếp vào frame"""
+        now = time.perf_counter()
+        source = addr[0] if addr else None
+        accepted = 0
+        self.packets_in += 1
+        try:
+            spans = list(iter_message_spans(data))
+        except (OSCDecodeError, ValueError):
+            self.decode_errors += 1
+            return 0
+
+        with self._cond:
+            for start, address_end, stop, timetag in spans:
+                address = data[start:address_end]
+                if self.prefixes and not address.startswith(self.prefixes):
+                    self.ignored += 1
+                    continue
+                if timetag != IMMEDIATE:
+                    self.source_latency.append(time.time() - timetag_to_time(timetag))
+                self._queue(address, data[start:stop], now, source)
+                accepted += 1
+
+            if source is not None and accepted:
+                self.sources[source] = self.sources.get(source, 0) + accepted
+        return accepted
+
+    def send(self, address: str, *args):
+        """Gửi 1 message từ Python (vd. chuyển clip) qua cùng cơ chế gom frame"""
+        with self._cond:
+            self._queue(address.encode('utf-8'), encode_message(address, *args), time.perf_counter(), None)
+
+    def _queue(self, address: bytes, message: bytes, now: float, source):
+        """Xếp message vào frame (gọi khi đã giữ lock)"""
+        if not self.running:
+            self.start()
+        self.messages_in += 1
+
+        if self.reset_suffix and address.endswith(self.reset_suffix):
+            # /composition/layers/N/clear: lệnh đang chờ của layer N không còn ý nghĩa
+            layer_prefix = address[:len(address) - len(self.reset_suffix) + 1]
+            for key in [key for key in self.pending if key.startswith(layer_prefix) and key != address]:
+                del self.pending[key]
+                self.cleared += 1
+
+        previous = self.pending.pop(address, None)
+        if previous is not None:
+            self.superseded += 1
+            now = previous.received_at  # Trễ tính từ bản đầu tiên chờ trong frame
+        self.pending[address] = _PendingMessage(message, now, source)  # Cuối hàng: giữ thứ tự ghi sau cùng
+
+        if len(self.pending) == 1:
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self.running:
+                    if self.pending:
+                        delay = self.last_flush + self.interval - time.perf_counter()
+                        if delay <= 0:
+                            break
+                        self._cond.wait(delay)
+                    else:
+                        self._cond.wait()
+                if not self.running:
+                    return
+                batch = self.pending
+                self.pending = OrderedDict()
+                self.last_flush = time.perf_counter()
+
+            self._emit(batch)
+
+    def flush(self):
+        """Gửi ngay frame đang chờ"""
+        with self._cond:
+            batch = self.pending
+            self.pending = OrderedDict()
+            self.last_flush = time.perf_counter()
+        if batch:
+            self._emit(batch)
+
+    def _pack(self, messages: List[bytes]) -> List[bytes]:
+        """Chia message thành các bundle không vượt max_bundle_bytes"""
+        packets = []
+        current: List[bytes] = []
+        size = 16  # '#bundle\0' + timetag
+        for message in messages:
+            if current and size + 4 + len(message) > self.max_bundle_bytes:
+                packets.append(current[0] if len(current) == 1 else encode_bundle(current))
+                current = []
+                size = 16
+            current.append(message)
+            size += 4 + len(message)
+        if current:
+            packets.append(current[0] if len(current) == 1 else encode_bundle(current))
+        return packets
+
+    def _emit(self, batch: "OrderedDict[bytes, _PendingMessage]"):
+        packets = self._pack([message.data for message in batch.values()])
+        for target in list(self.targets):
+            for packet in packets:
+                if self.sender.send_now(packet, target):
+                    self.packets_out += 1
+                else:
+                    self.send_errors += 1
+
+        sent_at = time.perf_counter()
+        self.frames += 1
+        self.messages_out += len(batch)
+        self.relay_latency.extend(sent_at - message.received_at for message in batch.values())
+
+    @staticmethod
+    def _percentiles(samples) -> dict:
+        if not samples:
+            return {'avg_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0}
+        ordered = sorted(samples)
+        return {
+            'avg_ms': sum(ordered) / len(ordered) * 1000,
+            'p50_ms': ordered[len(ordered) // 2] * 1000,
+            'p95_ms': ordered[int(len(ordered) * 0.95) - 1 if len(ordered) > 1 else 0] * 1000,
+            'max_ms': ordered[-1] * 1000,
+        }
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            pending = len(self.pending)
+            relay_latency = list(self.relay_latency)
+            source_latency = list(self.source_latency)
+        return {
+            'targets': [f"{ip}:{port}" for ip, port in self.targets],
+            'frame_rate': 1.0 / self.interval,
+            'packets_in': self.packets_in,
+            'messages_in': self.messages_in,
+            'ignored': self.ignored,
+            'superseded': self.superseded,
+            'cleared': self.cleared,
+            'decode_errors': self.decode_errors,
+            'pending': pending,
+            'frames': self.frames,
+            'messages_out': self.messages_out,
+            'packets_out': self.packets_out,
+            'send_errors': self.send_errors,
+            'sources': dict(self.sources),
+            'relay_latency': self._percentiles(relay_latency),
+            'source_latency': self._percentiles(source_latency) if source_latency else None,
+        }
+
+
+# Demo: 12 cube chạm liên tục, mỗi lần chạm gửi 9 packet như esp32_hybrid.cpp -> relay -> "Resolume"
+if __name__ == "__main__":
+    import random
+    from osc_codec import OSCDispatcher
+    from udp_ingest_engine import AsyncUDPIngestEngine
+
+    RESOLUME_PORT = 17000
+    CUBES = 12
+    DURATION = 2.0
+
+    final_state: Dict[str, tuple] = {}
+    dispatcher = OSCDispatcher()
+    dispatcher.set_default_handler(lambda address, *args: final_state.__setitem__(address, args))
+    resolume = AsyncUDPIngestEngine(name="Fake_Resolume")
+    resolume.add_port(RESOLUME_PORT, dispatcher.handle_datagram, host='127.0.0.1')
+
+    relay = OSCRelay([('127.0.0.1', RESOLUME_PORT)], frame_rate=60)
+
+    def touch_packets(clip: int, direction: int) -> List[bytes]:
+        packets = []
+        for layer in (1, 2, 3):
+            packets.append(encode_message(f"/composition/layers/{layer}/clear", 1))
+            packets.append(encode_message(f"/composition/layers/{layer}/clips/{clip}/connect", 1))
+            packets.append(encode_message(
+                f"/composition/layers/{layer}/clips/{clip}/transport/position/behaviour/playdirection", direction))
+        return packets
+
+    random.seed(3)
+    expected: Dict[str, tuple] = {}
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        for cube in range(CUBES):
+            if random.random() < 0.3:
+                clip, direction = random.choice((1, 2)), random.choice((1, 2))
+                for packet in touch_packets(clip, direction):
+                    relay.handle_datagram(packet, (f"192.168.0.{40 + cube}", 7000))
+                expected.update({layer: (clip, direction) for layer in (1, 2, 3)})
+        time.sleep(0.002)
+
+    relay.stop()
+    time.sleep(0.3)
+    resolume.stop()
+
+    stats = relay.get_stats()
+    for layer, (clip, direction) in expected.items():
+        address = f"/composition/layers/{layer}/clips/{clip}/transport/position/behaviour/playdirection"
+        assert final_state.get(address) == (direction,), (address, final_state.get(address))
+
+    print(f"🧪 {CUBES} cubes, {DURATION:.0f}s: {stats['packets_in']:,} packets in -> "
+          f"{stats['packets_out']:,} packets out ({stats['frames']} frames at {stats['frame_rate']:.0f} fps)")
+    print(f"   superseded {stats['superseded']:,}, cleared {stats['cleared']:,}, "
+          f"forwarded {stats['messages_out']:,}/{stats['messages_in']:,} messages")
+    latency = stats['relay_latency']
+    print(f"⏱️ relay latency avg {latency['avg_ms']:.1f} ms, p95 {latency['p95_ms']:.1f} ms, "
+          f"max {latency['max_ms']:.1f} ms; final Resolume state matches last touch ✅")
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+PCAP Replay
+Đọc pcap/pcapng theo kiểu streaming (không load cả file như rdpcap) và phát lại UDP payload
+qua loopback: đúng timing gốc, nhanh gấp N lần hoặc nhanh nhất có thể.
+Có thể đổi port đích theo quy ước 70XX (XX = octet cuối IP nguồn) và bind IP nguồn
+127.0.0.XX để receiver phân biệt từng ESP như trong show thật.
+
+    python pcap_replay.py OLD/sure.pcapng --speed 1
+    python pcap_replay.py show.pcapng --speed max --remap-70xx --bind-sources --loop 10
+
+Không cần scapy - chỉ hỗ trợ IPv4/UDP trên Ethernet, Linux SLL, raw IP, loopback (null).
+"""
+
+import argparse
+import socket
+import struct
+import time
+from typing import Callable, Dict, Iterator, Optional
+
+# Link types
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+
+PCAP_MAGIC_US = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+# pcapng block types
+BLOCK_IDB = 0x00000001
+BLOCK_PACKET = 0x00000002  # Obsolete Packet Block
+BLOCK_SPB = 0x00000003
+BLOCK_EPB = 0x00000006
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88A8)
+IPPROTO_UDP = 17
+
+
+class PcapFormatError(ValueError):
+    """File không phải pcap/pcapng hợp lệ"""
+
+
+class CapturedPacket:
+    """1 UDP datagram trong capture"""
+
+    __slots__ = ('timestamp', 'src_ip', 'dst_ip', 'src_port', 'dst_port', 'payload')
+
+    def __init__(self, timestamp: float, src_ip: str, dst_ip: str, src_port: int,
+                 dst_port: int, payload: bytes):
+        self.timestamp = timestamp
+        self.src_ip = src_ip
+        self.dst_ip = dst_ip
+        self.src_port = src_port
+        self.dst_port = dst_port
+        self.payload = payload
+
+    def __repr__(self):
+        return (f"CapturedPacket({self.timestamp:.6f} {self.src_ip}:{self.src_port} -> "
+                f"{self.dst_ip}:{self.dst_port}, {len(self.payload)} bytes)")
+
+
+def _decode_udp(linktype: int, frame: bytes, timestamp: float) -> Optional[CapturedPacket]:
+    """Bóc IPv4/UDP từ 1 frame, None nếu không phải UDP"""
+    if linktype == LINKTYPE_ETHERNET:
+        if len(frame) < 14:
+            return None
+        offset = 12
+        ethertype = struct.unpack_from('!H', frame, offset)[0]
+        while ethertype in ETHERTYPE_VLAN and len(frame) >= offset + 6:
+            offset += 4
+            ethertype = struct.unpack_from('!H', frame, offset)[0]
+        if ethertype != ETHERTYPE_IPV4:
+            return None
+        offset += 2
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if len(frame) < 16 or struct.unpack_from('!H', frame, 14)[0] != ETHERTYPE_IPV4:
+            return None
+        offset = 16
+    elif linktype == LINKTYPE_NULL:
+        if len(frame) < 4:
+            return None
+        offset = 4  # AF_INET family (byte order của máy capture)
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        offset = 0
+    else:
+        return None
+
+    if len(frame) < offset + 20 or frame[offset] >> 4 != 4:
+        return None
+
+    header_length = (frame[offset] & 0x0F) * 4
+    total_length = struct.unpack_from('!H', frame, offset + 2)[0]
+    flags_fragment = struct.unpack_from('!H', frame, offset + 6)[0]
+    if frame[offset + 9] != IPPROTO_UDP or flags_fragment & 0x3FFF:
+        return None  # Không phải UDP hoặc là fragment
+
+    src_ip = socket.inet_ntoa(frame[offset + 12:offset + 16])
+    dst_ip = socket.inet_ntoa(frame[offset + 16:offset + 20])
+
+    udp = offset + header_length
+    if len(frame) < udp + 8:
+        return None
+    src_port, dst_port, udp_length = struct.unpack_from('!HHH', frame, udp)
+
+    end = min(len(frame), offset + total_length, udp + udp_length)
+    return CapturedPacket(timestamp, src_ip, dst_ip, src_port, dst_port, frame[udp + 8:end])
+
+
+def _iter_pcap(f, magic_bytes: bytes) -> Iterator[CapturedPacket]:
+    """Đọc pcap cổ điển (µs hoặc ns)"""
+    for endian in ('<', '>'):
+        magic = struct.unpack(endian + 'I', magic_bytes)[0]
+        if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            break
+    divisor = 1e9 if magic == PCAP_MAGIC_NS else 1e6
+
+    header = f.read(20)
+    if len(header) < 20:
+        raise PcapFormatError("Truncated pcap header")
+    linktype = struct.unpack(endian + 'HHiIII', header)[5] & 0x0FFFFFFF
+
+    record = struct.Struct(endian + 'IIII')
+    while True:
+        data = f.read(record.size)
+        if len(data) < record.size:
+            return
+        seconds, fraction, captured_length, _ = record.unpack(data)
+        frame = f.read(captured_length)
+        if len(frame) < captured_length:
+            return
+
+        packet = _decode_udp(linktype, frame, seconds + fraction / divisor)
+        if packet:
+            yield packet
+
+
+def _iter_pcapng(f, first_block_type: bytes) -> Iterator[CapturedPacket]:
+    """Đọc pcapng: SHB, IDB, EPB/SPB (nhiều interface, nhiều section)"""
+    endian = '<'
+    interfaces = []  # [(linktype, ticks_per_second)]
+    block_type_bytes = first_block_type
+
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            return
+
+        if block_type_bytes == b'\x0a\x0d\x0d\x0a':
+            # Section header: byte order magic quyết định endian cho cả section
+            byte_order = header + f.read(4)
+            if struct.unpack('<I', byte_order[4:8])[0] == PCAPNG_BYTE_ORDER_MAGIC:
+                endian = '<'
+            elif struct.unpack('>I', byte_order[4:8])[0] == PCAPNG_BYTE_ORDER_MAGIC:
+                endian = '>'
+            else:
+                raise PcapFormatError("Bad pcapng byte-order magic")
+            block_length = struct.unpack(endian + 'I', header)[0]
+            f.read(block_length - 12)
+            interfaces = []
+        else:
+            block_type = struct.unpack(endian + 'I', block_type_bytes)[0]
+            block_length = struct.unpack(endian + 'I', header)[0]
+            if block_length < 12:
+                raise PcapFormatError(f"Bad pcapng block length {block_length}")
+            body = f.read(block_length - 12)
+            f.read(4)  # Trailing block length
+
+            if block_type == BLOCK_IDB:
+                linktype = struct.unpack_from(endian + 'H', body, 0)[0]
+                interfaces.append((linktype, _idb_ticks_per_second(body, endian)))
+
+            elif block_type == BLOCK_EPB:
+                interface_id, ts_high, ts_low, captured_length, _ = struct.unpack_from(
+                    endian + 'IIIII', body, 0)
+                linktype, ticks = interfaces[interface_id]
+                timestamp = ((ts_high << 32) | ts_low) / ticks
+                packet = _decode_udp(linktype, body[20:20 + captured_length], timestamp)
+                if packet:
+                    yield packet
+
+            elif block_type == BLOCK_PACKET:
+                interface_id, _, ts_high, ts_low, captured_length, _ = struct.unpack_from(
+                    endian + 'HHIIII', body, 0)
+                linktype, ticks = interfaces[interface_id]
+                timestamp = ((ts_high << 32) | ts_low) / ticks
+                packet = _decode_udp(linktype, body[20:20 + captured_length], timestamp)
+                if packet:
+                    yield packet
+
+            elif block_type == BLOCK_SPB and interfaces:
+                # Simple Packet Block không có timestamp
+                linktype, _ = interfaces[0]
+                packet = _decode_udp(linktype, body[4:], 0.0)
+                if packet:
+                    yield packet
+
+        block_type_bytes = f.read(4)
+        if len(block_type_bytes) < 4:
+            return
+
+
+def _idb_ticks_per_second(body: bytes, endian: str) -> float:
+    """Đọc option if_tsresol (mặc định µs)"""
+    offset = 8
+    while offset + 4 <= len(body):
+        code, length = struct.unpack_from(endian + 'HH', body, offset)
+        if code == 0:  # opt_endofopt
+            break
+        if code == 9 and length >= 1:  # if_tsresol
+            resolution = body[offset + 4]
+            if resolution & 0x80:
+                return float(2 ** (resolution & 0x7F))
+            return float(10 ** resolution)
+        offset += 4 + ((length + 3) & ~3)
+    return 1e6
+
+
+def iter_packets(path: str) -> Iterator[CapturedPacket]:
+    """Stream UDP packet từ file pcap hoặc pcapng"""
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+        if len(magic) < 4:
+            raise PcapFormatError("File too short")
+
+        if magic == b'\x0a\x0d\x0d\x0a':
+            yield from _iter_pcapng(f, magic)
+        elif struct.unpack('<I', magic)[0] in (PCAP_MAGIC_US, PCAP_MAGIC_NS) or \
+                struct.unpack('>I', magic)[0] in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            yield from _iter_pcap(f, magic)
+        else:
+            raise PcapFormatError(f"Unknown capture format (magic {magic.hex()})")
+
+
+def remap_70xx(packet: CapturedPacket) -> int:
+    """Port đích theo quy ước Port-per-ESP: 7000 + octet cuối IP nguồn"""
+    return 7000 + int(packet.src_ip.rsplit('.', 1)[1])
+
+
+class PcapReplayer:
+    """Phát lại packet qua UDP với timing gốc / nhanh N lần / nhanh nhất"""
+
+    def __init__(self, target_ip: str = "127.0.0.1", speed: Optional[float] = 1.0,
+                 port_map: Optional[Callable[[CapturedPacket], int]] = None,
+                 bind_sources: bool = False, src_filter: Optional[str] = None,
+                 port_filter: Optional[int] = None):
+        """speed=None: nhanh nhất có thể"""
+        self.target_ip = target_ip
+        self.speed = speed
+        self.port_map = port_map
+        self.bind_sources = bind_sources
+        self.src_filter = src_filter
+        self.port_filter = port_filter
+
+        self.sockets: Dict[str, socket.socket] = {}  # {source_ip: socket}
+
+        # Statistics
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.send_errors = 0
+        self.late_packets = 0  # Gửi trễ hơn lịch > 1 ms
+        self.max_lateness = 0.0
+        self.elapsed = 0.0
+
+    def _get_socket(self, src_ip: str) -> socket.socket:
+        # Mỗi ESP gốc -> 127.0.0.<octet cuối> để receiver nhận diện theo IP nguồn
+        key = f"127.0.0.{src_ip.rsplit('.', 1)[1]}" if self.bind_sources else ''
+        sock = self.sockets.get(key)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 1024)
+            if key:
+                sock.bind((key, 0))
+            self.sockets[key] = sock
+        return sock
+
+    def _wanted(self, packet: CapturedPacket) -> bool:
+        if self.src_filter and packet.src_ip != self.src_filter:
+            return False
+        if self.port_filter and packet.dst_port != self.port_filter:
+            return False
+        return bool(packet.payload)
+
+    def replay(self, packets, loops: int = 1) -> dict:
+        """Phát lại (packets: iterable hoặc đường dẫn file)"""
+        start = time.perf_counter()
+        offset = 0.0  # Thời gian đã phát ở các vòng trước (theo timeline capture)
+
+        for _ in range(loops):
+            source = iter_packets(packets) if isinstance(packets, str) else packets
+            first_ts = None
+            last_ts = 0.0
+
+            for packet in source:
+                if not self._wanted(packet):
+                    continue
+
+                if first_ts is None:
+                    first_ts = packet.timestamp
+                last_ts = packet.timestamp - first_ts
+
+                if self.speed:
+                    due = start + (offset + last_ts) / self.speed
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    elif -delay > 0.001:
+                        self.late_packets += 1
+                        if -delay > self.max_lateness:
+                            self.max_lateness = -delay
+
+                port = self.port_map(packet) if self.port_map else packet.dst_port
+                try:
+                    self._get_socket(packet.src_ip).sendto(packet.payload, (self.target_ip, port))
+                    self.packets_sent += 1
+                    self.bytes_sent += len(packet.payload)
+                except OSError:
+                    self.send_errors += 1
+
+            offset += last_ts
+
+        self.elapsed = time.perf_counter() - start
+        return self.get_stats()
+
+    def get_stats(self) -> dict:
+        return {
+            'packets_sent': self.packets_sent,
+            'bytes_sent': self.bytes_sent,
+            'send_errors': self.send_errors,
+            'late_packets': self.late_packets,
+            'max_lateness_ms': self.max_lateness * 1000,
+            'elapsed': self.elapsed,
+            'pps': self.packets_sent / self.elapsed if self.elapsed > 0 else 0.0,
+        }
+
+    def close(self):
+        for sock in self.sockets.values():
+            sock.close()
+        self.sockets.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay UDP traffic from pcap/pcapng")
+    parser.add_argument('capture', help="File .pcap hoặc .pcapng")
+    parser.add_argument('--target', default="127.0.0.1", help="IP đích (mặc định loopback)")
+    parser.add_argument('--speed', default="1",
+                        help="Hệ số tốc độ (1 = timing gốc, 10 = nhanh 10 lần, max = nhanh nhất)")
+    parser.add_argument('--remap-70xx', action='store_true',
+                        help="Port đích = 7000 + octet cuối IP nguồn")
+    parser.add_argument('--port', type=int, help="Gửi tất cả tới 1 port cố định")
+    parser.add_argument('--bind-sources', action='store_true',
+                        help="Gửi từ 127.0.0.<octet cuối IP nguồn>")
+    parser.add_argument('--src', help="Chỉ phát packet từ IP nguồn này")
+    parser.add_argument('--dst-port', type=int, help="Chỉ phát packet tới port đích này")
+    parser.add_argument('--loop', type=int, default=1, help="Số lần lặp lại capture")
+    parser.add_argument('--list', action='store_true', help="Chỉ in packet, không gửi")
+    args = parser.parse_args()
+
+    if args.list:
+        for index, packet in enumerate(iter_packets(args.capture), start=1):
+            print(f"{index}: {packet} {packet.payload[:48]!r}")
+        return
+
+    port_map = None
+    if args.port:
+        port_map = lambda packet: args.port
+    elif args.remap_70xx:
+        port_map = remap_70xx
+
+    speed = None if args.speed.lower() == 'max' else float(args.speed)
+    replayer = PcapReplayer(args.target, speed, port_map, args.bind_sources, args.src, args.dst_port)
+
+    print(f"▶️ Replaying {args.capture} x{args.loop} at "
+          f"{'max speed' if speed is None else f'{speed}x'} -> {args.target}")
+    try:
+        stats = replayer.replay(args.capture, loops=args.loop)
+    except KeyboardInterrupt:
+        stats = replayer.get_stats()
+        print("⏹️ Stopped by user")
+    finally:
+        replayer.close()
+
+    print(f"📊 Sent {stats['packets_sent']} packets ({stats['bytes_sent'] / 1024:.1f} KB) "
+          f"in {stats['elapsed']:.2f}s - {stats['pps']:.0f} pps, "
+          f"{stats['late_packets']} late (max {stats['max_lateness_ms']:.1f} ms), "
+          f"{stats['send_errors']} errors")
+
+
+if __name__ == "__main__":
+    main()
@@ -22,6 +22,10 @@ class ESPSimulator:
         self.packets_sent = 0
         self.send_interval = 0.1  # 100ms between packets
         
+        # IP giả (mô phỏng nhiều ESP) - trên loopback bind được 127.0.0.x
+        # nên receiver phân biệt được từng ESP theo địa chỉ nguồn
+        self.source_ip = f"127.0.0.{101 + esp_id}" if target_ip.startswith("127.") else None
+        
     def start_sending(self):
         """Bắt đầu gửi dữ liệu"""
         self.running = True
@@ -32,6 +36,12 @@ class ESPSimulator:
     def _send_loop(self):
         """Loop gửi dữ liệu"""
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.source_ip:
+            try:
+                sock.bind((self.source_ip, 0))
+            except OSError:
+                # OS chỉ có 127.0.0.1 (vd. macOS) - gửi từ địa chỉ mặc định
+                self.source_ip = None
         
         while self.running:
             try:
@@ -42,9 +52,6 @@ class ESPSimulator:
                 
                 message = f"RawTouch:{raw_touch},Threshold:{threshold},Value:{value}"
                 
-                # Gửi từ IP giả (mô phỏng nhiều ESP)
-                fake_ip = f"192.168.0.{100 + self.esp_id}"
-                
                 sock.sendto(message.encode(), (self.target_ip, self.target_port))
                 self.packets_sent += 1
                 
@@ -306,6 +313,7 @@ def run_stress_test():
     print("- Loss > 15%: System overloaded")
 
 if __name__ == "__main__":
+    # Benchmark tái lập được với JSON output: python benchmark_suite.py --help
     print("🔬 ESP32 Communication Performance Tester")
     print("="*50)
     
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+Ingest Pipeline
+Pipeline nhiều stage có giới hạn (receive → decode → aggregate → dispatch) thay cho các queue
+drop-oldest im lặng: mỗi stage có queue bounded với overflow policy riêng
+(drop_oldest, drop_newest, coalesce_latest theo ESP, block), bộ đếm overflow,
+độ sâu / high-watermark / thời gian chờ để thấy backlog đang dồn ở stage nào.
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Hashable, List, Optional
+
+# Overflow policies
+DROP_OLDEST = 'drop_oldest'  # Bỏ item cũ nhất để nhận item mới
+DROP_NEWEST = 'drop_newest'  # Từ chối item mới
+COALESCE_LATEST = 'coalesce_latest'  # Mỗi key (ESP) chỉ giữ 1 item chờ - item mới thay item cũ
+BLOCK = 'block'  # Producer chờ có chỗ (backpressure về socket), quá block_timeout thì bỏ item mới
+POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE_LATEST, BLOCK)
+
+# Lý do truyền cho on_drop
+OVERFLOW = 'overflow'
+COALESCED = 'coalesced'
+
+DEFAULT_STAGE = {'maxsize': 1000, 'policy': DROP_OLDEST}
+
+
+def stage_options(config, name: str, **defaults) -> dict:
+    """Tham số stage từ config.pipeline_stages[name] (đè lên defaults)"""
+    options = dict(DEFAULT_STAGE, **defaults)
+    options.update((getattr(config, 'pipeline_stages', None) or {}).get(name, {}))
+    return options
+
+
+class StageQueue:
+    """Queue bounded với overflow policy (nhiều producer, 1 hoặc nhiều consumer)"""
+
+    def __init__(self, name: str, maxsize: int = 1000, policy: str = DROP_OLDEST,
+                 key: Optional[Callable] = None, coalesce_if: Optional[Callable] = None,
+                 block_timeout: Optional[float] = 1.0, on_drop: Optional[Callable] = None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy} (expected one of {', '.join(POLICIES)})")
+        if policy == COALESCE_LATEST and key is None:
+            raise ValueError(f"Stage {name}: coalesce_latest needs a key function")
+
+        self.name = name
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.key = key  # item -> key (ESP) cho backlog theo ESP và coalesce
+        self.coalesce_if = coalesce_if  # item -> bool; None = mọi item có key đều coalesce được
+        self.block_timeout = block_timeout
+        self.on_drop = on_drop  # on_drop(stage name, item, reason)
+
+        self._items = deque()  # [enqueued_at, key, item] - list để coalesce thay item tại chỗ
+        self._latest: Dict[Hashable, list] = {}  # {key: entry đang chờ có thể coalesce}
+        self.depth_by_key: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self.open = True
+
+        # Statistics
+        self.offered = 0
+        self.dequeued = 0
+        self.dropped = 0  # Overflow (drop_oldest/drop_newest/block timeout)
+        self.coalesced = 0
+        self.blocked = 0  # Số lần producer phải chờ
+        self.blocked_seconds = 0.0
+        self.high_watermark = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __len__(self):
+        return len(self._items)
+
+    def _pop_entry(self) -> list:
+        """Lấy entry đầu queue (gọi khi đã giữ lock)"""
+        entry = self._items.popleft()
+        key = entry[1]
+        if key is not None:
+            if self._latest.get(key) is entry:
+                del self._latest[key]
+            remaining = self.depth_by_key[key] - 1
+            if remaining:
+                self.depth_by_key[key] = remaining
+            else:
+                del self.depth_by_key[key]
+        return entry
+
+    def put(self, item) -> bool:
+        """Đưa item vào queue theo policy - False nếu chính item này bị bỏ"""
+        now = time.perf_counter()
+        key = self.key(item) if self.key else None
+        dropped = None
+        accepted = True
+
+        with self._lock:
+            self.offered += 1
+            coalescable = (self.policy == COALESCE_LATEST and key is not None
+                           and (self.coalesce_if is None or self.coalesce_if(item)))
+
+            entry = self._latest.get(key) if coalescable else None
+            if entry is not None:
+                # Thay item đang chờ của ESP này, giữ vị trí và thời điểm vào queue
+                dropped = (entry[2], COALESCED)
+                entry[2] = item
+                self.coalesced += 1
+            else:
+                if len(self._items) >= self.maxsize:
+                    if self.policy == DROP_NEWEST:
+                        accepted = False
+                    elif self.policy == BLOCK:
+                        accepted = self._wait_not_full(now)
+                    else:  # DROP_OLDEST, COALESCE_LATEST: nhường chỗ cho item mới
+                        dropped = (self._pop_entry()[2], OVERFLOW)
+                        self.dropped += 1
+
+                if accepted:
+                    entry = [now, key, item]
+                    self._items.append(entry)
+                    if key is not None:
+                        self.depth_by_key[key] = self.depth_by_key.get(key, 0) + 1
+                        if coalescable:
+                            self._latest[key] = entry
+                    if len(self._items) > self.high_watermark:
+                        self.high_watermark = len(self._items)
+                    self._not_empty.notify()
+                else:
+                    self.dropped += 1
+                    dropped = (item, OVERFLOW)
+
+        if dropped is not None and self.on_drop:
+            self.on_drop(self.name, dropped[0], dropped[1])
+        return accepted
+
+    def _wait_not_full(self, start: float) -> bool:
+        """BLOCK: chờ consumer lấy bớt (gọi khi đã giữ lock)"""
+        self.blocked += 1
+        deadline = None if self.block_timeout is None else start + self.block_timeout
+        while len(self._items) >= self.maxsize and self.open:
+            remaining = None if deadline is None else deadline - time.perf_counter()
+            if remaining is not None and remaining <= 0:
+                break
+            self._not_full.wait(remaining)
+        self.blocked_seconds += time.perf_counter() - start
+        return len(self._items) < self.maxsize and self.open
+
+    def get_batch(self, max_items: int = 64, timeout: Optional[float] = None) -> List:
+        """Lấy tối đa max_items item (chờ tới timeout nếu queue rỗng)"""
+        with self._lock:
+            if not self._items and self.open:
+                self._not_empty.wait(timeout)
+            if not self._items:
+                return []
+
+            now = time.perf_counter()
+            batch = []
+            while self._items and len(batch) < max_items:
+                entry = self._pop_entry()
+                wait = now - entry[0]
+                self.wait_total += wait
+                if wait > self.wait_max:
+                    self.wait_max = wait
+                batch.append(entry[2])
+            self.dequeued += len(batch)
+
+            if self.policy == BLOCK:
+                self._not_full.notify_all()
+            return batch
+
+    def close(self):
+        """Đánh thức producer/consumer đang chờ"""
+        with self._lock:
+            self.open = False
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            depth = len(self._items)
+            oldest = time.perf_counter() - self._items[0][0] if depth else 0.0
+        return {
+            'policy': self.policy,
+            'maxsize': self.maxsize,
+            'depth': depth,
+            'fill': depth / self.maxsize,
+            'high_watermark': self.high_watermark,
+            'offered': self.offered,
+            'dequeued': self.dequeued,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'blocked': self.blocked,
+            'blocked_ms': self.blocked_seconds * 1000,
+            'oldest_ms': oldest * 1000,
+            'avg_wait_ms': self.wait_total / self.dequeued * 1000 if self.dequeued else 0.0,
+            'max_wait_ms': self.wait_max * 1000,
+        }
+
+
+class Stage:
+    """1 stage: queue đầu vào + handler chạy trên worker thread"""
+
+    def __init__(self, name: str, handler: Callable, queue: StageQueue, workers: int = 1,
+                 batch_size: int = 64):
+        self.name = name
+        self.handler = handler  # handler(item) -> item cho stage sau, None = dừng tại đây
+        self.queue = queue
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.threads: List[threading.Thread] = []
+
+        # Statistics
+        self.processed = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+
+
+class Pipeline:
+    """Chuỗi stage bounded - producer (receive) gọi put(), mỗi stage chạy trên thread riêng"""
+
+    def __init__(self, name: str = "Ingest_Pipeline", key: Optional[Callable] = None,
+                 on_drop: Optional[Callable] = None, log: Optional[Callable] = None,
+                 blocking_producer: bool = True):
+        self.name = name
+        # False: put() chạy trên event loop dùng chung (mọi port) - stage đầu không được dùng block
+        self.blocking_producer = blocking_producer
+        self.key = key  # item -> ESP, dùng cho backlog theo ESP và coalesce
+        self.on_drop = on_drop  # on_drop(stage name, item, reason)
+        self.log = log or print
+        self.stages: List[Stage] = []
+        self.running = False
+        self.started_at: Optional[float] = None
+
+    def add_stage(self, name: str, handler: Callable, maxsize: int = 1000, policy: str = DROP_OLDEST,
+                  coalesce_if: Optional[Callable] = None, block_timeout: Optional[float] = 1.0,
+                  workers: int = 1, batch_size: int = 64) -> Stage:
+        """Thêm stage vào cuối pipeline (item stage trước trả về đi vào queue của stage này)"""
+        if policy == BLOCK and not self.stages and not self.blocking_producer:
+            raise ValueError(f"Stage {name}: policy block would stall the shared ingest loop "
+                             f"(every port) - use drop_oldest, drop_newest or coalesce_latest")
+        queue = StageQueue(name, maxsize, policy, key=self.key, coalesce_if=coalesce_if,
+                           block_timeout=block_timeout, on_drop=self.on_drop)
+        stage = Stage(name, handler, queue, workers, batch_size)
+        self.stages.append(stage)
+        if self.running:
+            self._start_stage(len(self.stages) - 1)
+        return stage
+
+    def put(self, item) -> bool:
+        """Receive: đưa item vào stage đầu tiên"""
+        return self.stages[0].queue.put(item)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.started_at = time.perf_counter()
+        for index, stage in enumerate(self.stages):
+            stage.queue.open = True
+            self._start_stage(index)
+
+    def _start_stage(self, index: int):
+        stage = self.stages[index]
+        stage.threads = [threading.Thread(target=self._run_stage, args=(index,), daemon=True,
+                                          name=f"{self.name}_{stage.name}_{n}")
+                         for n in range(stage.workers)]
+        for thread in stage.threads:
+            thread.start()
+
+    def _run_stage(self, index: int):
+        stage = self.stages[index]
+        queue = stage.queue
+        handler = stage.handler
+
+        while self.running:
+            batch = queue.get_batch(stage.batch_size, timeout=0.5)
+            if not batch:
+                continue
+
+            next_queue = self.stages[index + 1].queue if index + 1 < len(self.stages) else None
+            start = time.perf_counter()
+            for item in batch:
+                try:
+                    output = handler(item)
+                except Exception as e:
+                    stage.errors += 1
+                    self.log(f"❌ Pipeline stage {stage.name} error: {e}")
+                    continue
+                if output is not None and next_queue is not None:
+                    next_queue.put(output)
+            stage.busy_seconds += time.perf_counter() - start
+            stage.processed += len(batch)
+
+    def stop(self):
+        self.running = False
+        for stage in self.stages:
+            stage.queue.close()
+        for stage in self.stages:
+            for thread in stage.threads:
+                if thread.is_alive() and thread is not threading.current_thread():
+                    thread.join(timeout=1)
+            stage.threads = []
+
+    def backlog(self, key) -> int:
+        """Số item của 1 ESP đang chờ trong toàn pipeline"""
+        return sum(stage.queue.depth_by_key.get(key, 0) for stage in self.stages)
+
+    def backlog_by_key(self) -> Dict[Hashable, int]:
+        totals: Dict[Hashable, int] = {}
+        for stage in self.stages:
+            for key, depth in list(stage.queue.depth_by_key.items()):
+                totals[key] = totals.get(key, 0) + depth
+        return totals
+
+    def get_stats(self) -> dict:
+        """Thống kê từng stage + stage đang nghẽn (queue đầy nhất, rồi bận nhất)"""
+        uptime = time.perf_counter() - self.started_at if self.started_at else 0.0
+        stages = {}
+        for stage in self.stages:
+            stats = stage.queue.get_stats()
+            stats.update({
+                'workers': stage.workers,
+                'processed': stage.processed,
+                'errors': stage.errors,
+                'utilization': stage.busy_seconds / (uptime * stage.workers) if uptime else 0.0,
+            })
+            stages[stage.name] = stats
+
+        bottleneck = None
+        if stages:
+            name, stats = max(stages.items(), key=lambda pair: (pair[1]['fill'], pair[1]['utilization']))
+            if stats['depth'] or stats['utilization'] > 0.8:
+                bottleneck = name
+
+        return {
+            'running': self.running,
+            'received': self.stages[0].queue.offered if self.stages else 0,
+            'dropped': sum(stats['dropped'] for stats in stages.values()),
+            'coalesced': sum(stats['coalesced'] for stats in stages.values()),
+            'bottleneck': bottleneck,
+            'stages': stages,
+        }
+
+
+# Demo: dispatch chậm (GUI) - so sánh overflow policy khi 8 ESP gửi nhanh hơn tốc độ xử lý
+if __name__ == "__main__":
+    ESPS = 8
+    PACKETS = 400  # Mỗi ESP
+
+    for policy in POLICIES:
+        delivered: Dict[int, List[int]] = {esp: [] for esp in range(ESPS)}
+        drops = {OVERFLOW: 0, COALESCED: 0}
+
+        def on_drop(stage_name, item, reason):
+            drops[reason] += 1
+
+        def slow_dispatch(item):
+            time.sleep(0.0002)  # Callback GUI chậm
+            delivered[item[0]].append(item[1])
+
+        pipeline = Pipeline(name=f"Demo_{policy}", key=lambda item: item[0], on_drop=on_drop)
+        pipeline.add_stage('decode', lambda item: (item[0], int(item[1])), maxsize=2000, policy=policy)
+        pipeline.add_stage('aggregate', lambda item: item, maxsize=2000, policy=policy)
+        pipeline.add_stage('dispatch', slow_dispatch, maxsize=64, policy=policy, block_timeout=5.0)
+        pipeline.start()
+
+        # ~20k packet/s vào, dispatch chỉ xử lý ~5k/s
+        start = time.perf_counter()
+        for seq in range(PACKETS):
+            for esp in range(ESPS):
+                pipeline.put((esp, str(seq).encode()))
+            time.sleep(0.0004)
+        while any(len(stage.queue) or stage.queue.dequeued != stage.processed for stage in pipeline.stages):
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+
+        stats = pipeline.get_stats()
+        pipeline.stop()
+
+        dispatch = stats['stages']['dispatch']
+        last_seen = [values[-1] if values else None for values in delivered.values()]
+        print(f"🧪 {policy:16s}: delivered {sum(map(len, delivered.values())):5d}/{ESPS * PACKETS}, "
+              f"overflow {drops[OVERFLOW]:4d}, coalesced {drops[COALESCED]:4d}, "
+              f"blocked {dispatch['blocked']:4d}, dispatch max wait {dispatch['max_wait_ms']:6.1f} ms, "
+              f"high watermark {dispatch['high_watermark']:3d}, last seq/ESP {set(last_seen)}, {elapsed:.2f}s")
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Port Allocator
+Cấp data port cho ESP bằng bảng lease (TTL gia hạn theo heartbeat/data) thay cho 7000 + octet cuối:
+không trùng port giữa các subnet, lưu lease ra file JSON để cube giữ port sau khi restart,
+và tùy chọn dồn nhiều cube vào 1 data port chung (phân biệt theo device id)
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class PortExhaustedError(RuntimeError):
+    """Hết port trong dải và không có lease hết hạn để thu hồi"""
+
+
+class PortLease:
+    """Lease của 1 ESP (key = IP)"""
+
+    __slots__ = ('key', 'port', 'device_id', 'name', 'granted_at', 'expires_at')
+
+    def __init__(self, key: str, port: int, device_id: int, name: str = "",
+                 granted_at: float = 0.0, expires_at: Optional[float] = None):
+        self.key = key
+        self.port = port
+        self.device_id = device_id
+        self.name = name
+        self.granted_at = granted_at
+        self.expires_at = expires_at  # None = không hết hạn (ESP đăng ký tay)
+
+    def expired(self, now: float) -> bool:
+        return self.expires_at is not None and now > self.expires_at
+
+    def to_dict(self) -> dict:
+        return {
+            'key': self.key,
+            'port': self.port,
+            'device_id': self.device_id,
+            'name': self.name,
+            'granted_at': self.granted_at,
+            'expires_at': self.expires_at,
+        }
+
+
+class PortAllocator:
+    """Bảng lease port - lease hết hạn vẫn giữ port cho ESP cũ tới khi dải port cạn"""
+
+    def __init__(self, port_min: int = 7001, port_max: int = 7999, ttl: Optional[float] = 60.0,
+                 lease_file: Optional[str] = None, shared_port: Optional[int] = None):
+        if port_min > port_max:
+            raise ValueError(f"Invalid port range {port_min}-{port_max}")
+
+        self.port_min = port_min
+        self.port_max = port_max
+        self.ttl = ttl  # None = lease không hết hạn
+        self.lease_file = lease_file
+        self.shared_port = shared_port  # Mọi ESP dùng chung 1 data port, phân biệt bằng device id
+
+        self.leases: Dict[str, PortLease] = {}  # {key: PortLease}
+        self.port_owners: Dict[int, str] = {}  # {port: key} (không dùng ở chế độ shared)
+        self.device_owners: Dict[int, str] = {}  # {device_id: key}
+        self._lock = threading.RLock()
+
+        # Statistics
+        self.granted = 0
+        self.renewed = 0
+        self.reclaimed = 0  # Lease hết hạn bị thu hồi cho ESP khác
+
+        if lease_file:
+            self.load()
+
+    def _expiry(self, now: float) -> Optional[float]:
+        return None if self.ttl is None else now + self.ttl
+
+    @staticmethod
+    def preferred_port(key: str) -> Optional[int]:
+        """Port theo quy ước cũ 7000 + octet cuối (firmware cấu hình tĩnh vẫn dùng)"""
+        try:
+            return 7000 + int(key.rsplit('.', 1)[-1])
+        except ValueError:
+            return None
+
+    def peek(self, key: str) -> Optional[int]:
+        """Port mà key sẽ nhận (không cấp) - dùng cho preview"""
+        with self._lock:
+            lease = self.leases.get(key)
+            if lease is not None:
+                return lease.port
+            if self.shared_port is not None:
+                return self.shared_port
+            return self._find_free_port(key, time.time(), reclaim=False)
+
+    def _find_free_port(self, key: str, now: float, reclaim: bool = True) -> Optional[int]:
+        preferred = self.preferred_port(key)
+        if preferred is not None and self.port_min <= preferred <= self.port_max \
+                and preferred not in self.port_owners:
+            return preferred
+
+        for port in range(self.port_min, self.port_max + 1):
+            if port not in self.port_owners:
+                return port
+
+        if not reclaim:
+            return None
+
+        # Dải port đã cạn: thu hồi lease hết hạn lâu nhất
+        expired = [lease for lease in self.leases.values() if lease.expired(now)]
+        if not expired:
+            return None
+        oldest = min(expired, key=lambda lease: lease.expires_at)
+        self._drop(oldest)
+        self.reclaimed += 1
+        return oldest.port
+
+    def _next_device_id(self) -> int:
+        device_id = 1
+        while device_id in self.device_owners:
+            device_id += 1
+        if device_id > 0xFFFF:  # device id là u16 trong header bin1
+            raise PortExhaustedError("No free device id")
+        return device_id
+
+    def allocate(self, key: str, name: str = "", now: Optional[float] = None) -> PortLease:
+        """Cấp (hoặc gia hạn) lease cho key - cùng key luôn nhận lại port cũ"""
+        now = time.time() if now is None else now
+
+        with self._lock:
+            lease = self.leases.get(key)
+            if lease is not None:
+                lease.expires_at = self._expiry(now)
+                if name:
+                    lease.name = name
+                self.renewed += 1
+                return lease
+
+            if self.shared_port is not None:
+                port = self.shared_port
+            else:
+                port = self._find_free_port(key, now)
+                if port is None:
+                    raise PortExhaustedError(
+                        f"No free port in {self.port_min}-{self.port_max} for {key}")
+
+            lease = PortLease(key, port, self._next_device_id(), name, now, self._expiry(now))
+            self.leases[key] = lease
+            if self.shared_port is None:
+                self.port_owners[port] = key
+            self.device_owners[lease.device_id] = key
+            self.granted += 1
+
+        self.save()
+        return lease
+
+    def renew(self, key: str, now: Optional[float] = None) -> bool:
+        """Gia hạn lease (heartbeat/data) - chỉ cập nhật bộ nhớ, ghi file khi save()"""
+        lease = self.leases.get(key)
+        if lease is None:
+            return False
+        lease.expires_at = self._expiry(time.time() if now is None else now)
+        return True
+
+    def release(self, key: str) -> bool:
+        """Trả port về dải (ESP bị xóa)"""
+        with self._lock:
+            lease = self.leases.get(key)
+            if lease is None:
+                return False
+            self._drop(lease)
+
+        self.save()
+        return True
+
+    def _drop(self, lease: PortLease):
+        del self.leases[lease.key]
+        if self.port_owners.get(lease.port) == lease.key:
+            del self.port_owners[lease.port]
+        if self.device_owners.get(lease.device_id) == lease.key:
+            del self.device_owners[lease.device_id]
+
+    def expired(self, now: Optional[float] = None) -> List[PortLease]:
+        """Các lease đã quá TTL (vẫn giữ port cho tới khi bị thu hồi)"""
+        now = time.time() if now is None else now
+        return [lease for lease in list(self.leases.values()) if lease.expired(now)]
+
+    def get(self, key: str) -> Optional[PortLease]:
+        return self.leases.get(key)
+
+    def owner_of_device(self, device_id: int) -> Optional[str]:
+        return self.device_owners.get(device_id)
+
+    def save(self):
+        """Ghi bảng lease ra file (atomic: ghi file tạm rồi rename)"""
+        if not self.lease_file:
+            return
+
+        with self._lock:
+            payload = {
+                'version': 1,
+                'shared_port': self.shared_port,
+                'leases': [lease.to_dict() for lease in self.leases.values()],
+            }
+
+        temp_file = self.lease_file + ".tmp"
+        try:
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(payload, f, indent=2)
+            os.replace(temp_file, self.lease_file)
+        except OSError as e:
+            print(f"⚠️ Failed to save port leases to {self.lease_file}: {e}")
+
+    def load(self) -> int:
+        """Nạp lease từ file - trả về số lease nạp được"""
+        try:
+            with open(self.lease_file, 'r', encoding='utf-8') as f:
+                payload = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Failed to load port leases from {self.lease_file}: {e}")
+            return 0
+
+        loaded = 0
+        with self._lock:
+            for item in payload.get('leases', []):
+                try:
+                    lease = PortLease(item['key'], int(item['port']), int(item['device_id']),
+                                      item.get('name', ""), item.get('granted_at', 0.0),
+                                      item.get('expires_at'))
+                except (KeyError, TypeError, ValueError):
+                    continue
+
+                # Dải port/chế độ đã đổi từ lần chạy trước -> lease cũ không còn hợp lệ
+                if self.shared_port is not None:
+                    if lease.port != self.shared_port:
+                        continue
+                elif not self.port_min <= lease.port <= self.port_max or lease.port in self.port_owners:
+                    continue
+                if lease.device_id in self.device_owners:
+                    continue
+
+                self.leases[lease.key] = lease
+                if self.shared_port is None:
+                    self.port_owners[lease.port] = lease.key
+                self.device_owners[lease.device_id] = lease.key
+                loaded += 1
+
+        return loaded
+
+    def get_stats(self) -> dict:
+        now = time.time()
+        return {
+            'leases': len(self.leases),
+            'expired': sum(1 for lease in list(self.leases.values()) if lease.expired(now)),
+            'shared_port': self.shared_port,
+            'port_range': (self.port_min, self.port_max),
+            'free_ports': 0 if self.shared_port is not None
+                          else self.port_max - self.port_min + 1 - len(self.port_owners),
+            'granted': self.granted,
+            'renewed': self.renewed,
+            'reclaimed': self.reclaimed,
+        }
+
+
+# Demo: 2 subnet trùng octet cuối, restart giữ port, fleet > 255 ESP
+if __name__ == "__main__":
+    import tempfile
+
+    lease_file = os.path.join(tempfile.gettempdir(), "port_leases_demo.json")
+    if os.path.exists(lease_file):
+        os.remove(lease_file)
+
+    allocator = PortAllocator(lease_file=lease_file)
+    for ip in ("192.168.0.45", "10.0.0.45", "192.168.1.45"):
+        lease = allocator.allocate(ip)
+        print(f"🌐 {ip:15s} -> port {lease.port}, device id {lease.device_id}")
+
+    restarted = PortAllocator(lease_file=lease_file)
+    print(f"💾 Reloaded {len(restarted.leases)} leases: 10.0.0.45 -> {restarted.allocate('10.0.0.45').port}")
+
+    fleet = PortAllocator(port_min=7001, port_max=7600, ttl=None)
+    start = time.perf_counter()
+    ports = {fleet.allocate(f"10.{i // 250}.{i % 250}.{i % 250 + 1}").port for i in range(500)}
+    elapsed = time.perf_counter() - start
+    print(f"🧪 500 ESPs over 2 subnets: {len(ports)} distinct ports ({elapsed * 1000:.1f} ms)")
+
+    shared = PortAllocator(shared_port=7500)
+    leases = [shared.allocate(f"10.0.{i // 250}.{i % 250}") for i in range(300)]
+    print(f"🔀 Shared port: {len({lease.port for lease in leases})} port, "
+          f"{len({lease.device_id for lease in leases})} device ids")
+
+    os.remove(lease_file)
@@ -10,6 +10,7 @@ import threading
 import time
 from datetime import datetime
 from port_per_esp_manager import PortPerESPManager
+from list_view_model import KeyedTreeview, KeyedListbox
 
 class PortPerESPGUI:
     """GUI quản lý ESP với port riêng biệt"""
@@ -167,6 +168,7 @@ class PortPerESPGUI:
         # ESP TreeView with detailed columns
         columns = ("Name", "IP", "Port", "Status", "Packets")
         self.esp_tree = ttk.Treeview(esp_frame, columns=columns, show="headings", height=12)
+        self.esp_view = KeyedTreeview(self.esp_tree)
         
         # Configure columns
         column_widths = {"Name": 100, "IP": 120, "Port": 60, "Status": 80, "Packets": 80}
@@ -447,6 +449,7 @@ class PortPerESPGUI:
         port_section.pack(fill=tk.X, padx=10, pady=10)
         
         self.port_listbox = tk.Listbox(port_section, height=8, font=("Consolas", 9))
+        self.port_view = KeyedListbox(self.port_listbox)
         port_scrollbar = tk.Scrollbar(port_section, orient=tk.VERTICAL)
         self.port_listbox.config(yscrollcommand=port_scrollbar.set)
         port_scrollbar.config(command=self.port_listbox.yview)
@@ -581,29 +584,21 @@ class PortPerESPGUI:
         dialog.bind('<Return>', lambda e: add_esp())
     
     def refresh_esp_list(self):
-        """Refresh ESP list"""
-        # Clear current items
-        for item in self.esp_tree.get_children():
-            self.esp_tree.delete(item)
-        
-        # Add ESP devices
-        esp_list = self.manager.get_esp_list()
-        for esp in esp_list:
-            status_color = "#27ae60" if esp['status'] == "Online" else "#e74c3c"
+        """Refresh ESP list (chỉ cập nhật các dòng thay đổi)"""
+        rows = []
+        for esp in self.manager.get_esp_list():
+            # Color code by status
+            status_text = "🟢 Online" if esp['status'] == "Online" else "🔴 Offline"
             
-            item_id = self.esp_tree.insert("", tk.END, values=(
+            rows.append((esp['ip'], (
                 esp['name'],
                 esp['ip'], 
                 esp['port'],
-                esp['status'],
+                status_text,
                 f"R:{esp['packets_received']} S:{esp['packets_sent']}"
-            ))
-            
-            # Color code by status
-            if esp['status'] == "Online":
-                self.esp_tree.set(item_id, "Status", "🟢 Online")
-            else:
-                self.esp_tree.set(item_id, "Status", "🔴 Offline")
+            )))
+        
+        self.esp_view.sync(rows)
     
     def on_esp_select(self, event):
         """Xử lý khi chọn ESP"""
@@ -660,14 +655,12 @@ ESP Send Port: 4210"""
                     self.perf_labels['total_sent'].config(text=str(stats['total_packets_sent']))
                     self.perf_labels['active_connections'].config(text=str(len(stats['active_connections'])))
                     
-                    # Update port status
-                    self.port_listbox.delete(0, tk.END)
-                    for ip, port in stats['active_connections']:
-                        self.port_listbox.insert(tk.END, f"🟢 {ip}:{port}")
-                    
-                    for port in stats['ports_in_use']:
-                        if not any(p == port for _, p in stats['active_connections']):
-                            self.port_listbox.insert(tk.END, f"🔴 Port {port} (Inactive)")
+                    # Update port status - key theo IP (shared_data_port: mọi ESP cùng 1 port)
+                    active_ips = {ip for ip, _ in stats['active_connections']}
+                    rows = [(ip, f"🟢 {ip}:{port}") for ip, port in stats['active_connections']]
+                    rows.extend((esp['ip'], f"🔴 Port {esp['port']} (Inactive, {esp['ip']})")
+                                for esp in self.manager.get_esp_list() if esp['ip'] not in active_ips)
+                    self.port_view.sync(rows)
                     
                     # Update ESP list
                     self.refresh_esp_list()
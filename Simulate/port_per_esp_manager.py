@@ -2,70 +2,123 @@
 """
 Port-Per-ESP Communication System
 Hệ thống giao tiếp với mỗi ESP32 trên port riêng biệt
-Port Convention: 70XX where XX is last 2 digits of ESP IP
-Example: ESP 192.168.0.43 -> Port 7043
+Port lấy từ PortAllocator: ưu tiên 70XX (XX = octet cuối của IP, vd. 192.168.0.43 -> 7043),
+trùng thì cấp port trống khác; tùy chọn 1 data port chung cho mọi ESP
 """
 
-import socket
-import threading
 import time
-import queue
 import re
-from typing import Dict, List, Optional, Callable
-from dataclasses import dataclass
-from datetime import datetime
+import threading
+from typing import Dict, List, Mapping, Optional, Callable
+from udp_ingest_engine import AsyncUDPIngestEngine
+from udp_command_sender import get_shared_sender
+from telemetry_parser import parse_telemetry, TelemetryRecord
+from ingest_metrics import IngestMetrics, DROP_QUEUE_FULL, DROP_PARSE_ERROR, DROP_COALESCED
+from pipeline import Pipeline, stage_options, OVERFLOW
+from log_ring import LogRing, DEBUG, INFO, WARNING
+from port_allocator import PortAllocator
+from fleet_ops import FleetOps
+from touch_coalescer import TouchCoalescer
+from device_registry import DeviceRecord, DeviceRegistry
+
+try:
+    from telemetry_store import TelemetryStore
+except ImportError:  # numpy chưa cài - chạy không có lịch sử telemetry
+    TelemetryStore = None
 
-@dataclass
-class ESPDevice:
-    """Thông tin ESP Device"""
-    name: str
-    ip: str
-    port: int  # Port máy tính lắng nghe cho ESP này
-    esp_port: int = 4210  # Port ESP gửi đến (mặc định)
-    status: str = "Offline"
-    last_seen: Optional[float] = None
-    packets_received: int = 0
-    packets_sent: int = 0
-    data_queue: Optional[queue.Queue] = None
-    socket: Optional[socket.socket] = None
-    thread: Optional[threading.Thread] = None
+try:
+    from sharded_ingest import ShardedIngest, int_to_ip, record_to_dict, MASK_DEVICE_TIME
+except ImportError:  # numpy chưa cài - chỉ có ingest 1 process
+    ShardedIngest = None
 
 class PortPerESPManager:
     """Quản lý giao tiếp với nhiều ESP thông qua port riêng biệt"""
     
-    def __init__(self, config):
+    def __init__(self, config, ingest_engine: Optional[AsyncUDPIngestEngine] = None,
+                 registry: Optional[DeviceRegistry] = None):
         self.config = config
-        self.esp_devices: Dict[str, ESPDevice] = {}  # {ip: ESPDevice}
+        self.registry = registry or DeviceRegistry()
+        self.esp_devices = self.registry  # {ip: DeviceRecord}, port = port máy tính lắng nghe
+        self.snapshot_max_age = 1.0 / getattr(config, 'ui_fps', 20)  # GUI đọc chung 1 snapshot/frame
         self.running = False
         
+        # Một event loop cho tất cả port (thay cho mỗi ESP một thread)
+        self.ingest_engine = ingest_engine or AsyncUDPIngestEngine(name="PortPerESP_Ingest")
+        self._owns_engine = ingest_engine is None  # Engine truyền vào có thể đang phục vụ manager khác
+        
+        # Tùy chọn: data port riêng chia cho nhiều worker process (parse trên nhiều core)
+        workers = getattr(config, 'ingest_workers', 0)
+        self.sharded = ShardedIngest(workers=workers, name="PortPerESP_Shard") if workers and ShardedIngest else None
+        self.sharded_slots: Dict[int, DeviceRecord] = {}  # {slot: ESP}
+        self.sharded_poll_interval = getattr(config, 'sharded_poll_interval', 0.005)
+        self._sharded_errors: Dict[int, int] = {}  # {slot: parse_errors đã báo metrics}
+        self._sharded_thread: Optional[threading.Thread] = None
+        
+        # Socket gửi lệnh dùng chung cho tất cả ESP
+        self.command_sender = get_shared_sender()
+        
+        # Cột phụ cho GUI, tính khi đọc view
+        self.registry.add_computed('queue_size', self._queue_size)
+        self.registry.add_computed(
+            'send_stats', lambda esp: self.command_sender.get_destination_stats(esp.ip, esp.esp_port))
+        
+        # Lease port (ESP đăng ký tay -> lease không hết hạn, lưu qua restart nếu có file)
+        self.port_allocator = PortAllocator(
+            port_min=getattr(config, 'data_port_min', 7001),
+            port_max=getattr(config, 'data_port_max', 7999),
+            ttl=None,
+            lease_file=getattr(config, 'port_lease_file', None),
+            shared_port=getattr(config, 'shared_data_port', None)
+        )
+        
+        # Lịch sử telemetry theo ESP (ring buffer NumPy)
+        self.telemetry_store = TelemetryStore() if TelemetryStore else None
+        
+        # Broadcast / group / rollout song song (không chặn GUI thread)
+        self.fleet = FleetOps(self.send_command_to_esp, lambda: list(self.esp_devices),
+                              max_concurrency=getattr(config, 'fleet_concurrency', 16),
+                              log=self.add_log, name="PortPerESP_Fleet")
+        
+        # Per-ESP ingest metrics (drop theo lý do, jitter, latency, callback time)
+        self.metrics = IngestMetrics("port_per_esp")
+        self.metrics_snapshot_interval = getattr(config, 'metrics_snapshot_interval', 5.0)
+        self.on_metrics_snapshot: Optional[Callable] = None
+        
+        # Ingest loop → decode → aggregate → dispatch, queue bounded + overflow policy mỗi stage
+        # Item: (esp_device, data | record, sender_ip, arrival)
+        # put() chạy trên ingest loop chung của mọi port -> decode không được block
+        self.pipeline = Pipeline("PortPerESP_Pipeline", key=lambda item: item[0].ip,
+                                 on_drop=self._on_pipeline_drop, log=self.add_log,
+                                 blocking_producer=False)
+        self.pipeline.add_stage('decode', self._decode_stage, **stage_options(config, 'decode'))
+        self.pipeline.add_stage('aggregate', self._aggregate_stage, coalesce_if=self._is_touch,
+                                **stage_options(config, 'aggregate'))
+        self.pipeline.add_stage('dispatch', self._dispatch_stage, coalesce_if=self._is_touch,
+                                **stage_options(config, 'dispatch'))
+        
+        # Gộp touch theo ESP trước callback (window 0 = mỗi packet 1 callback), đổi trạng thái chạm giao ngay
+        self.touch_coalescer = TouchCoalescer(self._emit_data, getattr(config, 'touch_coalesce_window', 0.0),
+                                              name="PortPerESP_TouchCoalescer")
+        
         # Callbacks
         self.on_data_received: Optional[Callable] = None
         self.on_esp_status_change: Optional[Callable] = None
         
         # Logging
-        self.log_messages = []
         self.max_logs = 1000
+        self.log_messages = LogRing(self.max_logs,
+                                    level=getattr(config, 'log_level', DEBUG),
+                                    console=True,
+                                    log_file=getattr(config, 'log_file', None))
         
         print("🚀 Port-Per-ESP Manager initialized")
     
-    def calculate_port(self, esp_ip: str) -> int:
-        """Tính port theo IP ESP
-        Rule: 70XX where XX = last 2 digits of IP
+    def calculate_port(self, esp_ip: str) -> Optional[int]:
+        """Port mà ESP sẽ nhận (không cấp thật)
+        Rule: 70XX where XX = last octet of IP nếu còn trống, không thì port trống đầu tiên
         Example: 192.168.0.43 -> 7043
         """
-        try:
-            # Extract last octet
-            last_octet = int(esp_ip.split('.')[-1])
-            port = 7000 + last_octet
-            
-            # Validate port range
-            if port < 7001 or port > 7255:
-                raise ValueError(f"Port {port} out of valid range")
-            
-            return port
-        except Exception as e:
-            self.add_log(f"❌ Error calculating port for {esp_ip}: {e}")
-            return 7000  # Default fallback
+        return self.port_allocator.peek(esp_ip)
     
     def register_esp(self, esp_ip: str, esp_name: str = None) -> bool:
         """Đăng ký ESP mới với port riêng"""
@@ -78,24 +131,22 @@ class PortPerESPManager:
                 self.add_log(f"⚠️ ESP {esp_ip} already registered")
                 return False
             
-            # Calculate port for this ESP
-            listen_port = self.calculate_port(esp_ip)
-            
             # Generate name if not provided
             if not esp_name:
                 esp_name = f"ESP_{esp_ip.split('.')[-1]}"
             
-            # Create ESP device
-            esp_device = ESPDevice(
-                name=esp_name,
-                ip=esp_ip,
-                port=listen_port,
-                data_queue=queue.Queue(maxsize=500)
-            )
+            # Lease port for this ESP (đăng ký lại cùng IP -> cùng port)
+            listen_port = self.port_allocator.allocate(esp_ip, esp_name).port
             
-            self.esp_devices[esp_ip] = esp_device
+            # Create ESP device
+            esp_device = self.registry.add(esp_ip, esp_name, port=listen_port)
             
             self.add_log(f"✅ Registered {esp_name} ({esp_ip}) -> Port {listen_port}")
+            
+            # Đang chạy thì lắng nghe ngay, không cần restart
+            if self.running:
+                self._start_esp_listener(esp_device)
+            
             return True
             
         except Exception as e:
@@ -110,11 +161,18 @@ class PortPerESPManager:
         
         self.running = True
         success_count = 0
+        self.metrics.start_snapshots(self.metrics_snapshot_interval, self._on_metrics_snapshot)
+        self.pipeline.start()
         
         for esp_ip, esp_device in self.esp_devices.items():
             if self._start_esp_listener(esp_device):
                 success_count += 1
         
+        if self.sharded:
+            self._sharded_thread = threading.Thread(target=self._sharded_loop, daemon=True,
+                                                    name="PortPerESP_ShardReader")
+            self._sharded_thread.start()
+        
         if success_count > 0:
             self.add_log(f"🚀 Started listening for {success_count}/{len(self.esp_devices)} ESPs")
             return True
@@ -123,27 +181,25 @@ class PortPerESPManager:
             self.add_log("❌ Failed to start any ESP listeners")
             return False
     
-    def _start_esp_listener(self, esp_device: ESPDevice) -> bool:
+    def _start_esp_listener(self, esp_device: DeviceRecord) -> bool:
         """Bắt đầu lắng nghe cho 1 ESP cụ thể"""
         try:
-            # Create UDP socket for this ESP
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.settimeout(1.0)  # 1 second timeout
-            
-            # Bind to specific port for this ESP
-            sock.bind(('0.0.0.0', esp_device.port))
-            esp_device.socket = sock
-            
-            # Create listening thread
-            thread = threading.Thread(
-                target=self._listen_for_esp,
-                args=(esp_device,),
-                daemon=True,
-                name=f"ESP_Listener_{esp_device.name}"
-            )
-            thread.start()
-            esp_device.thread = thread
+            if esp_device.port == self.port_allocator.shared_port:
+                # Data port chung: bind 1 lần, phân biệt ESP theo IP nguồn
+                if not self.ingest_engine.has_port(esp_device.port):
+                    self.ingest_engine.add_port(esp_device.port, self._on_shared_datagram)
+            elif self.sharded:
+                # Port giao cho 1 worker process, kết quả đọc lại qua shared memory
+                slot = self.sharded.add_port(esp_device.port)
+                self._sharded_errors[slot] = 0
+                self.sharded_slots[slot] = esp_device
+            else:
+                # Bind port của ESP này vào ingest engine chung
+                self.ingest_engine.add_port(
+                    esp_device.port,
+                    lambda data, addr: self._on_datagram(esp_device, data, addr)
+                )
+            esp_device.listening = True
             
             self.add_log(f"📡 Listening for {esp_device.name} on port {esp_device.port}")
             return True
@@ -152,115 +208,177 @@ class PortPerESPManager:
             self.add_log(f"❌ Failed to start listener for {esp_device.name}: {e}")
             return False
     
-    def _listen_for_esp(self, esp_device: ESPDevice):
-        """Lắng nghe dữ liệu từ ESP cụ thể"""
-        while self.running:
-            try:
-                data, addr = esp_device.socket.recvfrom(4096)
-                
-                # Verify sender IP
-                sender_ip = addr[0]
-                if sender_ip != esp_device.ip:
-                    # Log unexpected sender but continue
-                    self.add_log(f"⚠️ Unexpected sender {sender_ip} on port {esp_device.port} (expected {esp_device.ip})")
-                
-                # Update ESP status
-                esp_device.status = "Online"
-                esp_device.last_seen = time.time()
-                esp_device.packets_received += 1
-                
-                # Queue data for processing
-                try:
-                    esp_device.data_queue.put_nowait({
-                        'data': data,
-                        'sender_ip': sender_ip,
-                        'timestamp': time.time(),
-                        'esp_device': esp_device
-                    })
-                except queue.Full:
-                    # Drop oldest if queue full
-                    try:
-                        esp_device.data_queue.get_nowait()
-                        esp_device.data_queue.put_nowait({
-                            'data': data,
-                            'sender_ip': sender_ip,
-                            'timestamp': time.time(),
-                            'esp_device': esp_device
-                        })
-                    except queue.Empty:
-                        pass
-                
-                # Process data immediately
-                self._process_esp_data(esp_device, data, sender_ip)
-                
-            except socket.timeout:
-                continue  # Normal timeout, continue listening
-            except Exception as e:
-                if self.running:
-                    self.add_log(f"❌ Error listening to {esp_device.name}: {e}")
-                break
+    def _stop_esp_listener(self, esp_device: DeviceRecord):
+        """Ngừng lắng nghe cho 1 ESP"""
+        if esp_device.listening:
+            esp_device.listening = False
+            shared = esp_device.port == self.port_allocator.shared_port
+            if self.sharded and self.sharded.has_port(esp_device.port):
+                self.sharded_slots.pop(self.sharded.slot_of(esp_device.port), None)
+                self.sharded.remove_port(esp_device.port)
+            elif not shared or not any(esp.listening for esp in self.esp_devices.values()):
+                self.ingest_engine.remove_port(esp_device.port)
+            self.add_log(f"🔌 Stopped listening for {esp_device.name}")
         
-        # Cleanup
-        if esp_device.socket:
-            esp_device.socket.close()
-            esp_device.socket = None
+        self._set_status(esp_device, "Offline")
+    
+    def _set_status(self, esp_device: DeviceRecord, status: str):
+        """Cập nhật trạng thái ESP và báo callback khi thay đổi"""
+        if esp_device.status == status:
+            return
         
-        esp_device.status = "Offline"
-        self.add_log(f"🔌 Stopped listening for {esp_device.name}")
+        self.registry.update(esp_device, status=status)
+        if self.on_esp_status_change:
+            self.on_esp_status_change(esp_device.ip, status)
     
-    def _process_esp_data(self, esp_device: ESPDevice, data: bytes, sender_ip: str):
-        """Xử lý dữ liệu từ ESP"""
-        try:
-            message = data.decode('utf-8').strip()
-            
-            # Parse data according to your protocol
-            parsed_data = self._parse_message(message)
+    def _on_shared_datagram(self, data: bytes, addr):
+        """Datagram trên data port chung - tra ESP theo IP nguồn"""
+        esp_device = self.esp_devices.get(addr[0])
+        if esp_device is None or not esp_device.listening:
+            self.add_log("⚠️ Data from unregistered {} on shared port", addr[0], level=WARNING)
+            return
+        
+        self._on_datagram(esp_device, data, addr)
+    
+    def _on_datagram(self, esp_device: DeviceRecord, data: bytes, addr):
+        """Xử lý datagram từ port của ESP (chạy trong ingest loop)"""
+        # Verify sender IP
+        sender_ip = addr[0]
+        if sender_ip != esp_device.ip:
+            # Log unexpected sender but continue
+            self.add_log("⚠️ Unexpected sender {} on port {} (expected {})",
+                         sender_ip, esp_device.port, esp_device.ip, level=WARNING)
+        
+        # Update ESP status
+        arrival = time.time()
+        esp_device.last_seen = arrival
+        esp_device.packets_received += 1
+        self._set_status(esp_device, "Online")
+        self.metrics.on_received(esp_device.ip, arrival)
+        
+        # Xử lý ở các stage sau - overflow theo policy của stage, được đếm trong _on_pipeline_drop
+        self.pipeline.put((esp_device, data, sender_ip, arrival))
+    
+    def _decode_stage(self, item):
+        """Stage decode: datagram -> TelemetryRecord (parse trực tiếp trên bytes)"""
+        esp_device, data, sender_ip, arrival = item
+        self.metrics.on_queue_wait(esp_device.ip, time.time() - arrival)
+        
+        record = parse_telemetry(data)
+        if record.kind == TelemetryRecord.ERROR:
+            self.metrics.on_dropped(esp_device.ip, DROP_PARSE_ERROR)
+        
+        return esp_device, record, sender_ip, arrival
+    
+    def _aggregate_stage(self, item):
+        """Stage aggregate: latency theo timestamp thiết bị + lịch sử telemetry"""
+        esp_device, record, sender_ip, arrival = item
+        if record.device_time is not None:
+            self.metrics.on_device_time(esp_device.ip, record.device_time, arrival)
+        
+        if record.kind == TelemetryRecord.TOUCH and self.telemetry_store:
+            self.telemetry_store.append_record(esp_device.ip, record, arrival)
+        
+        return item if self.on_data_received else None
+    
+    def _dispatch_stage(self, item):
+        """Stage dispatch: callback GUI"""
+        esp_device, record, sender_ip, arrival = item
+        self._deliver(esp_device, record.to_dict(), sender_ip)
+    
+    @staticmethod
+    def _is_touch(item) -> bool:
+        """Chỉ coalesce touch - STATUS/ACK luôn được giao"""
+        return getattr(item[1], 'kind', None) == TelemetryRecord.TOUCH
+    
+    def _on_pipeline_drop(self, stage: str, item, reason: str):
+        """Overflow / coalesce trong pipeline -> drop reason theo ESP"""
+        self.metrics.on_dropped(item[0].ip, DROP_QUEUE_FULL if reason == OVERFLOW else DROP_COALESCED)
+    
+    def _deliver(self, esp_device: DeviceRecord, parsed_data: dict, sender_ip: str):
+        """Gắn context ESP và gọi callback GUI"""
+        if parsed_data and self.on_data_received:
+            # Add ESP context to data
+            parsed_data.update({
+                'esp_name': esp_device.name,
+                'esp_ip': esp_device.ip,
+                'esp_port': esp_device.port,
+                'sender_ip': sender_ip,
+                'timestamp': time.time()
+            })
             
-            if parsed_data and self.on_data_received:
-                # Add ESP context to data
-                parsed_data.update({
-                    'esp_name': esp_device.name,
-                    'esp_ip': esp_device.ip,
-                    'esp_port': esp_device.port,
-                    'sender_ip': sender_ip,
-                    'timestamp': time.time()
-                })
+            self.touch_coalescer.offer(esp_device.ip, parsed_data)
+    
+    def _emit_data(self, esp_ip: str, parsed_data: dict):
+        """Callback to GUI (từ dispatch stage/shard reader hoặc timer của touch coalescer)"""
+        if self.on_data_received:
+            callback_start = time.perf_counter()
+            self.on_data_received(parsed_data)
+            self.metrics.on_callback(esp_ip, time.perf_counter() - callback_start)
+    
+    def _sharded_loop(self):
+        """Đọc record và trạng thái mà worker process ghi vào shared memory"""
+        next_sync = 0.0
+        while self.running:
+            try:
+                records = self.sharded.read_records()
+                if len(records):
+                    self._on_sharded_records(records)
                 
-                # Callback to GUI
-                self.on_data_received(parsed_data)
+                for slot, sender_ip, kind, data, arrival in self.sharded.read_messages():
+                    esp_device = self.sharded_slots.get(slot)
+                    if esp_device is not None:
+                        self._deliver(esp_device, data, sender_ip)
+                
+                now = time.perf_counter()
+                if now >= next_sync:
+                    self._sync_sharded_state()
+                    next_sync = now + self.snapshot_max_age
+            except Exception as e:
+                if not self.running:
+                    break
+                self.add_log(f"❌ Sharded ingest read error: {e}")
             
-        except Exception as e:
-            self.add_log(f"❌ Error processing data from {esp_device.name}: {e}")
+            time.sleep(self.sharded_poll_interval)
     
-    def _parse_message(self, message: str) -> dict:
-        """Parse OSC/UDP message từ ESP"""
-        try:
-            data = {}
+    def _on_sharded_records(self, records):
+        """Batch record theo ESP: metrics + lịch sử dạng vector, callback từng record"""
+        slots = records['slot']
+        for slot in set(slots.tolist()):
+            esp_device = self.sharded_slots.get(slot)
+            if esp_device is None:  # Port vừa bị gỡ
+                continue
+            batch = records[slots == slot]
+            last = batch[-1]
             
-            # Handle different message formats
-            if "RawTouch:" in message:
-                # Touch sensor data format: "RawTouch:1234,Threshold:2500,Value:856"
-                parts = message.split(',')
-                for part in parts:
-                    if ':' in part:
-                        key, value = part.split(':', 1)
-                        data[key.lower().replace(' ', '_')] = value.strip()
+            self.metrics.on_received(esp_device.ip, float(last['timestamp']), len(batch))
+            if last['mask'] & MASK_DEVICE_TIME:
+                self.metrics.on_device_time(esp_device.ip, int(last['device_time']), float(last['timestamp']))
             
-            elif message.startswith("Resolume IP updated:"):
-                # IP update confirmation
-                data['message_type'] = 'ip_update_confirm'
-                data['message'] = message
+            if self.telemetry_store:
+                self.telemetry_store.extend(esp_device.ip, batch['timestamp'], batch['raw_touch'],
+                                            batch['value'], batch['threshold'])
             
-            else:
-                # Generic message
-                data['message_type'] = 'generic'
-                data['message'] = message
-            
-            return data
+            if self.on_data_received:
+                for row in batch:
+                    self._deliver(esp_device, record_to_dict(row), int_to_ip(row['src_ip']))
+    
+    def _sync_sharded_state(self):
+        """Chép số đếm từ bảng trạng thái của worker sang registry (mỗi frame GUI)"""
+        state = self.sharded.device_state()
+        for slot, esp_device in list(self.sharded_slots.items()):
+            row = state[slot]
+            packets = int(row['packets'])
+            if packets != esp_device.packets_received:
+                esp_device.packets_received = packets
+                esp_device.last_seen = float(row['last_seen'])
+                self._set_status(esp_device, "Online")
             
-        except Exception as e:
-            self.add_log(f"❌ Parse error: {e}")
-            return {'message_type': 'error', 'message': message}
+            parse_errors = int(row['parse_errors'])
+            reported = self._sharded_errors.get(slot, 0)
+            if parse_errors > reported:
+                self.metrics.on_dropped(esp_device.ip, DROP_PARSE_ERROR, parse_errors - reported)
+                self._sharded_errors[slot] = parse_errors
     
     def send_command_to_esp(self, esp_ip: str, command: str) -> bool:
         """Gửi lệnh đến ESP cụ thể"""
@@ -271,13 +389,12 @@ class PortPerESPManager:
         esp_device = self.esp_devices[esp_ip]
         
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            message = command.encode('utf-8')
-            sock.sendto(message, (esp_ip, esp_device.esp_port))
-            sock.close()
+            if not self.command_sender.send(command, (esp_ip, esp_device.esp_port)):
+                self.add_log(f"❌ Failed to send to {esp_device.name}: send queue full")
+                return False
             
             esp_device.packets_sent += 1
-            self.add_log(f"📤 Sent to {esp_device.name}: {command}")
+            self.add_log("📤 Sent to {}: {}", esp_device.name, command, level=DEBUG)
             return True
             
         except Exception as e:
@@ -285,47 +402,53 @@ class PortPerESPManager:
             return False
     
     def broadcast_command(self, command: str) -> Dict[str, bool]:
-        """Gửi lệnh đến tất cả ESP"""
-        results = {}
-        for esp_ip in self.esp_devices:
-            results[esp_ip] = self.send_command_to_esp(esp_ip, command)
-        
-        success_count = sum(results.values())
-        self.add_log(f"📢 Broadcast: {success_count}/{len(results)} successful")
-        return results
-    
-    def get_esp_list(self) -> List[dict]:
-        """Lấy danh sách ESP với thông tin chi tiết"""
-        esp_list = []
-        for esp_ip, esp_device in self.esp_devices.items():
-            esp_list.append({
-                'name': esp_device.name,
-                'ip': esp_ip,
-                'port': esp_device.port,
-                'status': esp_device.status,
-                'last_seen': esp_device.last_seen,
-                'packets_received': esp_device.packets_received,
-                'packets_sent': esp_device.packets_sent,
-                'queue_size': esp_device.data_queue.qsize() if esp_device.data_queue else 0
-            })
-        return esp_list
+        """Gửi lệnh đến tất cả ESP (chặn tới khi xong - GUI dùng broadcast_async)"""
+        operation = self.fleet.broadcast(command)
+        operation.wait()
+        return operation.result_map()
+    
+    def broadcast_async(self, command: str, targets=None, group: Optional[str] = None):
+        """Gửi lệnh song song cho nhiều ESP - trả về FleetOperation ngay"""
+        return self.fleet.broadcast(command, targets=targets, group=group)
+    
+    def _queue_size(self, esp_device: DeviceRecord) -> int:
+        """Số datagram của ESP đang chờ trong pipeline"""
+        return self.pipeline.backlog(esp_device.ip)
+    
+    def get_esp_list(self) -> List[Mapping]:
+        """Lấy danh sách ESP (snapshot bất biến, có queue_size/send_stats)"""
+        return list(self.registry.snapshot(self.snapshot_max_age).devices)
     
     def get_performance_stats(self) -> dict:
-        """Lấy thống kê tổng quan"""
-        total_received = sum(esp.packets_received for esp in self.esp_devices.values())
-        total_sent = sum(esp.packets_sent for esp in self.esp_devices.values())
-        online_count = sum(1 for esp in self.esp_devices.values() if esp.status == "Online")
+        """Lấy thống kê tổng quan (mọi số đếm ESP từ cùng 1 snapshot)"""
+        snapshot = self.registry.snapshot(self.snapshot_max_age)
+        online_count = snapshot.count("Online")
         
         return {
-            'total_esp_count': len(self.esp_devices),
+            'snapshot_version': snapshot.version,
+            'total_esp_count': len(snapshot),
             'online_esp_count': online_count,
-            'offline_esp_count': len(self.esp_devices) - online_count,
-            'total_packets_received': total_received,
-            'total_packets_sent': total_sent,
-            'ports_in_use': [esp.port for esp in self.esp_devices.values()],
-            'active_connections': [(esp.ip, esp.port) for esp in self.esp_devices.values() if esp.status == "Online"]
+            'offline_esp_count': len(snapshot) - online_count,
+            'total_packets_received': snapshot.total('packets_received'),
+            'total_packets_sent': snapshot.total('packets_sent'),
+            'ports_in_use': [esp.port for esp in snapshot.devices],
+            'port_leases': self.port_allocator.get_stats(),
+            'active_connections': [(esp.ip, esp.port) for esp in snapshot.devices if esp.status == "Online"],
+            'ingest': self.ingest_engine.get_stats(),
+            'pipeline': self.pipeline.get_stats(),
+            'touch_coalescer': self.touch_coalescer.get_stats(),
+            'sharded': self.sharded.get_stats() if self.sharded else None,
+            'sender': self.command_sender.get_stats(),
+            'fleet': self.fleet.get_stats(),
+            'registry': self.registry.get_stats(),
+            'metrics': self.metrics.snapshot()
         }
     
+    def _on_metrics_snapshot(self, snapshot: dict):
+        """Snapshot định kỳ từ IngestMetrics"""
+        if self.on_metrics_snapshot:
+            self.on_metrics_snapshot(snapshot)
+    
     def unregister_esp(self, esp_ip: str) -> bool:
         """Hủy đăng ký ESP"""
         if esp_ip not in self.esp_devices:
@@ -333,16 +456,14 @@ class PortPerESPManager:
         
         esp_device = self.esp_devices[esp_ip]
         
-        # Stop thread and close socket
-        if esp_device.socket:
-            esp_device.socket.close()
+        # Release port in ingest engine
+        self._stop_esp_listener(esp_device)
         
-        if esp_device.thread and esp_device.thread.is_alive():
-            # Thread will stop automatically when socket closes
-            esp_device.thread.join(timeout=2)
-        
-        # Remove from devices
-        del self.esp_devices[esp_ip]
+        # Remove from devices and free the port
+        self.registry.remove(esp_ip)
+        self.port_allocator.release(esp_ip)
+        self.fleet.remove_device(esp_ip)
+        self.touch_coalescer.discard(esp_ip)
         
         self.add_log(f"🗑️ Unregistered {esp_device.name}")
         return True
@@ -350,36 +471,32 @@ class PortPerESPManager:
     def stop_communication(self):
         """Dừng tất cả giao tiếp"""
         self.running = False
+        self.metrics.stop_snapshots()
         
-        # Close all sockets and stop threads
+        # Release all ports, then stop the event loop (chỉ khi engine do manager này tạo)
         for esp_device in self.esp_devices.values():
-            if esp_device.socket:
-                esp_device.socket.close()
-                esp_device.socket = None
-            
-            esp_device.status = "Offline"
+            self._stop_esp_listener(esp_device)
         
-        # Wait for threads to finish
-        for esp_device in self.esp_devices.values():
-            if esp_device.thread and esp_device.thread.is_alive():
-                esp_device.thread.join(timeout=2)
+        if self._owns_engine:
+            self.ingest_engine.stop()
+        self.pipeline.stop()
+        
+        if self.sharded:
+            if self._sharded_thread and self._sharded_thread.is_alive():
+                self._sharded_thread.join(timeout=1)
+            self.sharded.stop()
+            self.sharded_slots.clear()
         
+        self.touch_coalescer.stop()
         self.add_log("🛑 All communication stopped")
     
-    def add_log(self, message: str):
-        """Thêm log message"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        
-        self.log_messages.append(log_entry)
-        if len(self.log_messages) > self.max_logs:
-            self.log_messages.pop(0)
-        
-        print(log_entry)  # Also print to console
+    def add_log(self, message: str, *args, level: int = INFO):
+        """Thêm log message (args được format khi đọc)"""
+        self.log_messages.log(message, *args, level=level)
     
     def get_logs(self, count: int = 50) -> List[str]:
         """Lấy logs gần nhất"""
-        return self.log_messages[-count:] if self.log_messages else []
+        return self.log_messages.get(count)
 
 # Example usage and demo
 if __name__ == "__main__":
@@ -393,14 +510,15 @@ if __name__ == "__main__":
         "192.168.0.43",   # -> Port 7043
         "192.168.0.44",   # -> Port 7044  
         "192.168.0.100",  # -> Port 7100
-        "10.0.0.45",      # -> Port 7045
+        "192.168.0.45",   # -> Port 7045
+        "10.0.0.45",      # -> Port 7001 (7045 đã cấp cho 192.168.0.45)
     ]
     
-    print("🧪 Port Calculation Test:")
+    print("🧪 Port Lease Test:")
     print("-" * 40)
     for ip in test_ips:
-        port = manager.calculate_port(ip)
-        print(f"ESP {ip} -> Port {port}")
+        manager.register_esp(ip)
+        print(f"ESP {ip} -> Port {manager.esp_devices[ip].port}")
     
     print("\n✅ Port-Per-ESP system ready!")
     print("Each ESP will have its dedicated port for communication.")
\ No newline at end of file
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+Reliable Command Channel
+Lớp request/response cho lệnh cấu hình ESP (THRESHOLD, RESOLUME_IP, CONFIG...): mỗi lệnh chờ
+reply tương ứng từ ESP, chưa có thì gửi lại tới khi hết timeout. Nhiều ESP được cấu hình song
+song trong 1 cửa sổ pipelining (mỗi ESP 1 lệnh in-flight để reply không bị nhầm) nên đổi
+threshold cho cả fleet chỉ mất vài RTT và biết chính xác ESP nào đã xác nhận.
+
+Chỉ dùng cho lệnh idempotent (giá trị tuyệt đối) - lệnh gửi lại không được gây tác dụng phụ.
+"""
+
+import heapq
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from ingest_metrics import Histogram
+from telemetry_parser import TelemetryRecord
+
+# Command states
+STATE_QUEUED = 'queued'  # Chờ chỗ trong cửa sổ pipelining
+STATE_IN_FLIGHT = 'in_flight'  # Đã gửi, chờ reply
+STATE_CONFIRMED = 'confirmed'
+STATE_TIMEOUT = 'timeout'  # Hết thời gian/số lần gửi mà không có reply
+STATE_SUPERSEDED = 'superseded'  # Lệnh cùng loại mới hơn thay thế khi còn trong hàng đợi
+STATE_CANCELLED = 'cancelled'  # Channel dừng
+
+# Bucket (ms) cho round-trip lệnh -> reply
+REPLY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2000, 5000)
+
+
+def command_name(command: str) -> str:
+    """"THRESHOLD:2932" -> "THRESHOLD\""""
+    return command.split(':', 1)[0]
+
+
+def reply_matcher(command: str) -> Callable[[TelemetryRecord], bool]:
+    """Predicate nhận ra reply của command
+
+    - ACK:<NAME>... luôn được chấp nhận
+    - THRESHOLD:n  -> telemetry touch báo Threshold = n (PIC đã áp dụng)
+    - RESOLUME_IP:x -> "Resolume IP updated: x"
+    """
+    name, _, arg = command.partition(':')
+
+    def is_ack(record: TelemetryRecord) -> bool:
+        return record.kind == TelemetryRecord.ACK and (record.text or "").startswith(name)
+
+    if name == "THRESHOLD":
+        try:
+            value = int(arg)
+        except ValueError:
+            return is_ack
+        return lambda record: is_ack(record) or (
+            record.kind == TelemetryRecord.TOUCH and record.threshold == value)
+
+    if name == "RESOLUME_IP":
+        ip = arg.strip()
+        return lambda record: is_ack(record) or (
+            record.kind == TelemetryRecord.IP_UPDATE_CONFIRM
+            and (record.text or "").split(':', 1)[-1].strip() == ip)
+
+    return is_ack
+
+
+class PendingCommand:
+    """1 lệnh đang chờ reply - dùng như future: wait(), state, rtt"""
+
+    __slots__ = ('device', 'command', 'name', 'matcher', 'timeout', 'on_done', 'state', 'attempts',
+                 'submitted_at', 'first_sent', 'next_retry', 'deadline', 'reply', 'rtt', '_event')
+
+    def __init__(self, device: Hashable, command: str, matcher: Callable, timeout: float,
+                 on_done: Optional[Callable], now: float):
+        self.device = device
+        self.command = command
+        self.name = command_name(command)
+        self.matcher = matcher
+        self.timeout = timeout
+        self.on_done = on_done  # on_done(PendingCommand) - gọi từ thread của channel/ingest
+        self.state = STATE_QUEUED
+        self.attempts = 0
+        self.submitted_at = now
+        self.first_sent: Optional[float] = None
+        self.next_retry = 0.0
+        self.deadline = 0.0
+        self.reply: Optional[TelemetryRecord] = None
+        self.rtt: Optional[float] = None  # Giây từ lần gửi đầu tới reply
+        self._event = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._event.is_set()
+
+    @property
+    def confirmed(self) -> bool:
+        return self.state == STATE_CONFIRMED
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Chờ kết thúc - True nếu ESP đã xác nhận"""
+        self._event.wait(timeout)
+        return self.state == STATE_CONFIRMED
+
+
+class ReliableCommandChannel:
+    """Correlation lệnh/reply + retransmit + cửa sổ pipelining (send(device, command) -> bool)"""
+
+    def __init__(self, send: Callable, timeout: float = 2.0, retry_interval: float = 0.25,
+                 max_attempts: int = 4, window: int = 32, name: str = "Reliable_Commands"):
+        self.send = send
+        self.timeout = timeout  # Mặc định cho mỗi lệnh (tính từ lần gửi đầu)
+        self.retry_interval = retry_interval  # Gửi lại sau retry_interval, nhân đôi mỗi lần
+        self.max_attempts = max_attempts
+        self.window = window  # Số lệnh in-flight tối đa trên toàn channel
+        self.name = name
+
+        self.in_flight: Dict[Hashable, PendingCommand] = {}  # {device: lệnh đang chờ reply}
+        self.queues: Dict[Hashable, Deque[PendingCommand]] = {}  # {device: lệnh chờ gửi}
+        self._ready: Deque[Hashable] = deque()  # Device có lệnh chờ và chưa có lệnh in-flight
+        self._heap: List[Tuple[float, int, PendingCommand]] = []  # (next_retry, counter, cmd)
+        self._counter = 0
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.running = False
+
+        # Statistics
+        self.submitted = 0
+        self.transmits = 0
+        self.retransmits = 0
+        self.confirmed = 0
+        self.timeouts = 0
+        self.superseded = 0
+        self.send_errors = 0
+        self.rtt = Histogram(REPLY_BUCKETS_MS)
+
+    def start(self):
+        with self._cond:
+            if self.running:
+                return
+            self.running = True
+            self._thread = threading.Thread(target=self._run, daemon=True, name=self.name)
+            self._thread.start()
+
+    def submit(self, device: Hashable, command: str, timeout: Optional[float] = None,
+               matcher: Optional[Callable] = None, on_done: Optional[Callable] = None) -> PendingCommand:
+        """Gửi lệnh có xác nhận - trả về PendingCommand ngay, không chặn"""
+        if not self.running:
+            self.start()
+
+        now = time.monotonic()
+        cmd = PendingCommand(device, command, matcher or reply_matcher(command),
+                             self.timeout if timeout is None else timeout, on_done, now)
+        finished = []
+
+        with self._cond:
+            self.submitted += 1
+            queue = self.queues.get(device)
+            if queue is None:
+                queue = self.queues[device] = deque()
+
+            # Lệnh cùng loại chưa gửi -> chỉ giá trị mới nhất có ý nghĩa
+            for old in list(queue):
+                if old.name == cmd.name:
+                    queue.remove(old)
+                    old.state = STATE_SUPERSEDED
+                    self.superseded += 1
+                    finished.append(old)
+
+            queue.append(cmd)
+            if device not in self.in_flight:
+                self._ready.append(device)
+            to_send = self._pump(now)
+
+        self._transmit(to_send)
+        self._complete(finished)
+        return cmd
+
+    def submit_many(self, devices: Iterable[Hashable], command: str, **kwargs) -> List[PendingCommand]:
+        """Cùng 1 lệnh cho nhiều ESP (gửi song song trong cửa sổ pipelining)"""
+        return [self.submit(device, command, **kwargs) for device in devices]
+
+    @staticmethod
+    def wait_all(commands: List[PendingCommand], timeout: Optional[float] = None) -> dict:
+        """Chờ các lệnh kết thúc - trả về báo cáo ESP nào đã xác nhận"""
+        start = time.monotonic()
+        for cmd in commands:
+            remaining = None if timeout is None else max(0.0, timeout - (time.monotonic() - start))
+            cmd.wait(remaining)
+
+        return {
+            'confirmed': [cmd.device for cmd in commands if cmd.state == STATE_CONFIRMED],
+            'failed': {cmd.device: cmd.state for cmd in commands if cmd.state != STATE_CONFIRMED},
+            'elapsed': time.monotonic() - start,
+        }
+
+    def _pump(self, now: float) -> List[PendingCommand]:
+        """Đưa lệnh từ hàng đợi vào cửa sổ in-flight (gọi khi giữ lock)"""
+        started = []
+        while self._ready and len(self.in_flight) < self.window:
+            device = self._ready.popleft()
+            queue = self.queues.get(device)
+            if device in self.in_flight or not queue:
+                continue
+
+            cmd = queue.popleft()
+            if not queue:
+                del self.queues[device]
+
+            cmd.state = STATE_IN_FLIGHT
+            cmd.first_sent = now
+            cmd.deadline = now + cmd.timeout
+            self.in_flight[device] = cmd
+            self._schedule(cmd, now)
+            started.append(cmd)
+        return started
+
+    def _schedule(self, cmd: PendingCommand, now: float):
+        cmd.attempts += 1
+        delay = self.retry_interval * (2 ** (cmd.attempts - 1))
+        cmd.next_retry = min(cmd.deadline, now + delay)
+        self._counter += 1
+        heapq.heappush(self._heap, (cmd.next_retry, self._counter, cmd))
+        self._cond.notify()
+
+    def _finish(self, cmd: PendingCommand, state: str, now: float):
+        """Kết thúc lệnh in-flight, nhường chỗ cho lệnh kế tiếp (gọi khi giữ lock)"""
+        cmd.state = state
+        del self.in_flight[cmd.device]
+        if cmd.device in self.queues:
+            self._ready.append(cmd.device)
+
+        if state == STATE_CONFIRMED:
+            cmd.rtt = now - cmd.first_sent
+            self.confirmed += 1
+            self.rtt.observe(cmd.rtt * 1000)
+        elif state == STATE_TIMEOUT:
+            self.timeouts += 1
+
+    def on_record(self, device: Hashable, record: TelemetryRecord) -> bool:
+        """Gọi cho mỗi bản ghi nhận từ ESP - True nếu đó là reply của lệnh đang chờ"""
+        cmd = self.in_flight.get(device)
+        if cmd is None or not cmd.matcher(record):
+            return False  # Fast path: telemetry thường không cần lock
+
+        now = time.monotonic()
+        with self._cond:
+            if self.in_flight.get(device) is not cmd:
+                return False
+            cmd.reply = record
+            self._finish(cmd, STATE_CONFIRMED, now)
+            to_send = self._pump(now)
+
+        self._transmit(to_send)
+        self._complete([cmd])
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self.running and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                if not self.running:
+                    return
+
+                now = time.monotonic()
+                retry = []
+                finished = []
+                while self._heap and self._heap[0][0] <= now:
+                    due, _, cmd = heapq.heappop(self._heap)
+                    if cmd.state != STATE_IN_FLIGHT or cmd.next_retry != due:
+                        continue  # Đã có reply
+
+                    if now >= cmd.deadline or cmd.attempts >= self.max_attempts:
+                        self._finish(cmd, STATE_TIMEOUT, now)
+                        finished.append(cmd)
+                        continue
+
+                    self.retransmits += 1
+                    self._schedule(cmd, now)
+                    retry.append(cmd)
+
+                started = self._pump(now) if finished else []
+
+            self._transmit(retry + started)
+            self._complete(finished)
+
+    def _transmit(self, commands: List[PendingCommand]):
+        """Gửi ngoài lock - lỗi gửi được xử lý như mất gói (retry lo)"""
+        for cmd in commands:
+            self.transmits += 1
+            try:
+                if self.send(cmd.device, cmd.command) is False:
+                    self.send_errors += 1
+            except Exception as e:
+                self.send_errors += 1
+                print(f"Reliable command send error to {cmd.device}: {e}")
+
+    def _complete(self, commands: List[PendingCommand]):
+        for cmd in commands:
+            cmd._event.set()
+            if cmd.on_done:
+                try:
+                    cmd.on_done(cmd)
+                except Exception as e:
+                    print(f"Reliable command callback error for {cmd.device}: {e}")
+
+    def cancel_device(self, device: Hashable):
+        """Hủy mọi lệnh của ESP (ESP bị xóa)"""
+        with self._cond:
+            cancelled = list(self.queues.pop(device, ()))
+            cmd = self.in_flight.get(device)
+            if cmd is not None:
+                self._finish(cmd, STATE_CANCELLED, time.monotonic())
+                cancelled.append(cmd)
+            for cmd in cancelled:
+                cmd.state = STATE_CANCELLED
+            to_send = self._pump(time.monotonic())
+
+        self._transmit(to_send)
+        self._complete(cancelled)
+
+    def stop(self):
+        with self._cond:
+            self.running = False
+            cancelled = list(self.in_flight.values())
+            for queue in self.queues.values():
+                cancelled.extend(queue)
+            for cmd in cancelled:
+                cmd.state = STATE_CANCELLED
+            self.in_flight.clear()
+            self.queues.clear()
+            self._ready.clear()
+            self._heap.clear()
+            self._cond.notify_all()
+
+        self._complete(cancelled)
+        if self._thread and self._thread.is_alive() and threading.current_thread() is not self._thread:
+            self._thread.join(timeout=1)
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            queued = sum(len(queue) for queue in self.queues.values())
+            in_flight = len(self.in_flight)
+        return {
+            'submitted': self.submitted,
+            'in_flight': in_flight,
+            'queued': queued,
+            'window': self.window,
+            'transmits': self.transmits,
+            'retransmits': self.retransmits,
+            'confirmed': self.confirmed,
+            'timeouts': self.timeouts,
+            'superseded': self.superseded,
+            'send_errors': self.send_errors,
+            'rtt': self.rtt.snapshot(),
+        }
+
+
+# Demo: đổi threshold cho 100 cube qua link mất 15% gói (RTT ~20 ms), 5 cube không trả lời
+if __name__ == "__main__":
+    import random
+
+    LOSS = 0.15
+    RTT = 0.02
+    random.seed(3)
+    cubes = [f"192.168.1.{i}" for i in range(1, 101)]
+    dead = set(cubes[::20])
+
+    def run(channel: ReliableCommandChannel, serial: bool) -> dict:
+        def fake_send(device, command):
+            # ESP nhận lệnh -> reply sau RTT (cả lệnh lẫn reply đều có thể mất)
+            if device in dead or random.random() < LOSS or random.random() < LOSS:
+                return True
+            value = int(command.split(':')[1])
+            record = TelemetryRecord(TelemetryRecord.TOUCH, raw_touch=1800, threshold=value, value=0)
+            threading.Timer(RTT, channel.on_record, (device, record)).start()
+            return True
+
+        channel.send = fake_send
+        if serial:
+            # Cách cũ có thêm chờ: gửi từng cube và đợi reply (1 lần gửi, không retry)
+            start = time.monotonic()
+            commands = []
+            for device in cubes:
+                cmd = channel.submit(device, "THRESHOLD:3100")
+                cmd.wait()
+                commands.append(cmd)
+            report = ReliableCommandChannel.wait_all(commands)
+            report['elapsed'] = time.monotonic() - start
+        else:
+            report = ReliableCommandChannel.wait_all(channel.submit_many(cubes, "THRESHOLD:3100"))
+        channel.stop()
+        return report
+
+    for label, channel, serial in (
+            ("serial, no retry ", ReliableCommandChannel(None, timeout=0.2, max_attempts=1, window=1), True),
+            ("pipelined + retry", ReliableCommandChannel(None, timeout=2.0, retry_interval=0.1,
+                                                         max_attempts=6), False)):
+        report = run(channel, serial)
+        print(f"🧪 {label}: {len(report['confirmed'])}/100 confirmed in {report['elapsed']:.2f}s, "
+              f"failed: {sorted(report['failed'], key=lambda ip: int(ip.rsplit('.', 1)[1]))[:8]}")
+        stats = channel.get_stats()
+        print(f"   transmits {stats['transmits']}, retransmits {stats['retransmits']}, "
+              f"rtt p50 {stats['rtt']['p50_ms']} ms, p99 {stats['rtt']['p99_ms']} ms")
+
+    assert set(report['failed']) == dead, report['failed']
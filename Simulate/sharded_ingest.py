@@ -0,0 +1,563 @@
+#!/usr/bin/env python3
+"""
+Sharded Ingest
+Chế độ ingest nhiều process: mỗi worker process sở hữu một phần data port, nhận + parse
+telemetry trên core riêng rồi ghi record cố định vào ring buffer multiprocessing.shared_memory.
+Process chính (GUI) đọc record và bảng trạng thái từng ESP bằng NumPy ngay trên shared memory -
+không pickle từng packet. Message hiếm (STATUS/ACK/TOUCH_DATA có field phụ) đi qua queue.
+
+Ring (1 ring / worker, 1 writer - 1 reader):
+    header   uint64 x 8           [0] = số record đã ghi (write count)
+    records  RECORD x capacity    record thứ n nằm ở n % capacity
+Bảng trạng thái (1 dòng / slot, chỉ worker sở hữu port của slot đó ghi), seqlock theo dòng:
+    gen (lẻ = đang ghi), packets, bytes, parse_errors, last_seen,
+    raw_touch, threshold, value, touched (giá trị cuối), seq, seq_gaps
+"""
+
+import multiprocessing
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+
+from telemetry_parser import TelemetryRecord, parse_telemetry
+from telemetry_store import MISSING
+from wire_codec import FRAME_FIELDS  # Import cũng đăng ký decoder bin1
+
+# Record trong ring - little-endian, không padding (40 byte)
+RECORD = struct.Struct('<dHHIiiiiII')
+RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'), ('slot', '<u2'), ('mask', '<u2'), ('src_ip', '<u4'),
+    ('raw_touch', '<i4'), ('threshold', '<i4'), ('value', '<i4'), ('touched', '<i4'),
+    ('seq', '<u4'), ('device_time', '<u4'),
+])
+
+# mask: bit theo FRAME_FIELDS như wire_codec, thêm seq / device_time của frame bin1
+MASK_SEQ = 1 << len(FRAME_FIELDS)
+MASK_DEVICE_TIME = MASK_SEQ << 1
+
+RING_HEADER = 64
+
+# Dòng trạng thái của 1 slot (64 byte); gen ghi riêng trước/sau phần thân
+STATE_BODY = struct.Struct('<QQQdiiiiII')
+STATE_DTYPE = np.dtype([
+    ('gen', '<u8'), ('packets', '<u8'), ('bytes', '<u8'), ('parse_errors', '<u8'),
+    ('last_seen', '<f8'), ('raw_touch', '<i4'), ('threshold', '<i4'), ('value', '<i4'),
+    ('touched', '<i4'), ('seq', '<u4'), ('seq_gaps', '<u4'),
+])
+STATE_ROW = STATE_DTYPE.itemsize
+
+assert RECORD.size == RECORD_DTYPE.itemsize and 8 + STATE_BODY.size == STATE_ROW
+
+
+def ip_to_int(ip: str) -> int:
+    return int.from_bytes(socket.inet_aton(ip), 'big')
+
+
+def int_to_ip(value: int) -> str:
+    return socket.inet_ntoa(int(value).to_bytes(4, 'big'))
+
+
+def record_to_dict(row) -> dict:
+    """1 dòng RECORD_DTYPE -> dict như TelemetryRecord.to_dict()"""
+    mask = int(row['mask'])
+    data = {name: int(row[name]) for bit, name in enumerate(FRAME_FIELDS) if mask & (1 << bit)}
+    if mask & MASK_SEQ:
+        data['seq'] = int(row['seq'])
+    return data
+
+
+class _ShardWriter:
+    """Phía worker: parse datagram, ghi record vào ring và cập nhật dòng trạng thái"""
+
+    def __init__(self, ring_buf, state_buf, capacity: int, events):
+        self.ring = ring_buf
+        self.state = state_buf
+        # Write count và gen ghi bằng store uint64 căn lề (struct '<Q' ghi từng byte -> reader thấy số rách)
+        self.count = np.ndarray((1,), dtype='<u8', buffer=ring_buf)
+        self.gens = np.ndarray((len(state_buf) // STATE_ROW,), dtype='<u8', buffer=state_buf,
+                               strides=(STATE_ROW,))
+        self.capacity = capacity
+        self.events = events
+        self.write_count = 0
+        self.side_dropped = 0  # Message phụ bị bỏ vì queue đầy
+        # {slot: [gen, packets, bytes, parse_errors, last_seen, raw_touch, threshold, value, touched, seq, seq_gaps]}
+        self.rows: Dict[int, list] = {}
+        self.ip_cache: Dict[str, int] = {}
+
+    def open_slot(self, slot: int):
+        row = self.rows[slot] = [0, 0, 0, 0, 0.0, MISSING, MISSING, MISSING, MISSING, 0, 0]
+        row[0] = int(self.gens[slot]) & ~1  # Giữ gen tăng dần khi slot được dùng lại
+        self._publish(slot, row)
+
+    def close_slot(self, slot: int):
+        self.rows.pop(slot, None)
+
+    def handler(self, slot: int):
+        return lambda data, addr: self.on_datagram(slot, data, addr)
+
+    def on_datagram(self, slot: int, data: bytes, addr):
+        arrival = time.time()
+        row = self.rows.get(slot)
+        if row is None:
+            return
+        row[1] += 1
+        row[2] += len(data)
+        row[4] = arrival
+
+        try:
+            record = parse_telemetry(data)
+        except Exception:
+            record = None
+
+        if record is None or record.kind == TelemetryRecord.ERROR:
+            row[3] += 1
+        elif record.kind == TelemetryRecord.TOUCH and not record.fields:
+            self._append(slot, record, arrival, addr[0], row)
+        else:
+            # Hiếm: STATUS/ACK/IP confirm/TOUCH_DATA có LED... - không vừa record cố định
+            try:
+                self.events.put_nowait((slot, addr[0], record.kind, record.to_dict(), arrival))
+            except queue.Full:
+                self.side_dropped += 1
+
+        self._publish(slot, row)
+
+    def _append(self, slot: int, record: TelemetryRecord, arrival: float, source: str, row: list):
+        mask = 0
+        values = []
+        for bit, index, value in ((1, 5, record.raw_touch), (2, 6, record.threshold),
+                                  (4, 7, record.value), (8, 8, record.touched)):
+            if isinstance(value, int):
+                mask |= bit
+                row[index] = value
+            else:
+                value = MISSING
+            values.append(value)
+
+        seq = record.seq
+        if seq is not None:
+            mask |= MASK_SEQ
+            if row[9] and seq != (row[9] + 1) & 0xFFFFFFFF:
+                row[10] += 1
+            row[9] = seq
+        else:
+            seq = 0
+        device_time = record.device_time
+        if device_time is not None:
+            mask |= MASK_DEVICE_TIME
+        else:
+            device_time = 0
+
+        ip = self.ip_cache.get(source)
+        if ip is None:
+            ip = self.ip_cache[source] = ip_to_int(source)
+
+        index = self.write_count
+        RECORD.pack_into(self.ring, RING_HEADER + (index % self.capacity) * RECORD.size,
+                         arrival, slot, mask, ip, *values, seq, device_time)
+        self.write_count = index + 1
+        self.count[0] = index + 1  # Publish sau khi record đã ghi xong
+
+    def _publish(self, slot: int, row: list):
+        """Seqlock: gen lẻ trong lúc ghi thân dòng"""
+        row[0] += 1
+        self.gens[slot] = row[0]
+        STATE_BODY.pack_into(self.state, slot * STATE_ROW + 8, *row[1:])
+        row[0] += 1
+        self.gens[slot] = row[0]
+
+
+def _worker_main(index: int, ring, state, capacity: int, conn, events, recv_buffer_size: int):
+    """Process worker: ingest engine riêng, nhận lệnh điều khiển qua pipe"""
+    from udp_ingest_engine import AsyncUDPIngestEngine
+
+    writer = _ShardWriter(ring.buf, state.buf, capacity, events)
+    engine = AsyncUDPIngestEngine(name=f"Shard{index}_Ingest", recv_buffer_size=recv_buffer_size)
+    slots: Dict[int, int] = {}  # {port: slot}
+
+    try:
+        while True:
+            try:
+                command, *args = conn.recv()
+            except (EOFError, OSError):  # Process chính đã thoát
+                break
+            if command == 'stop':
+                break
+
+            try:
+                if command == 'add':
+                    port, slot, host = args
+                    writer.open_slot(slot)
+                    try:
+                        engine.add_port(port, writer.handler(slot), host)
+                    except Exception:
+                        writer.close_slot(slot)
+                        raise
+                    slots[port] = slot
+                    reply = True
+                elif command == 'remove':
+                    port, = args
+                    reply = engine.remove_port(port)
+                    writer.close_slot(slots.pop(port, -1))
+                elif command == 'stats':
+                    reply = {
+                        'cpu_time': time.process_time(),
+                        'records': writer.write_count,
+                        'side_dropped': writer.side_dropped,
+                        'engine': engine.get_stats(),
+                    }
+                else:
+                    raise ValueError(f"Unknown command: {command}")
+                conn.send(('ok', reply))
+            except Exception as e:
+                conn.send(('error', f"{type(e).__name__}: {e}"))
+    finally:
+        engine.stop()
+        writer.count = writer.gens = writer.ring = writer.state = None  # Nhả view trước khi close
+        ring.close()
+        state.close()
+        conn.close()
+
+
+class _WorkerHandle:
+    """Process worker nhìn từ process chính"""
+
+    __slots__ = ('index', 'process', 'conn', 'ring', 'count', 'records', 'cursor', 'ports')
+
+    def __init__(self, index: int, process, conn, ring, capacity: int):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.ring = ring
+        self.count = np.ndarray((1,), dtype='<u8', buffer=ring.buf)  # Write count của worker
+        self.records = np.ndarray((capacity,), dtype=RECORD_DTYPE, buffer=ring.buf, offset=RING_HEADER)
+        self.cursor = 0  # Số record process chính đã đọc
+        self.ports: Set[int] = set()
+
+
+class ShardedIngest:
+    """Ingest nhiều process: port chia đều cho worker, kết quả đọc từ shared memory"""
+
+    def __init__(self, workers: Optional[int] = None, ring_capacity: int = 1 << 16,
+                 max_devices: int = 1024, recv_buffer_size: int = 4 * 1024 * 1024,
+                 side_queue_size: int = 10000, name: str = "Sharded_Ingest"):
+        self.worker_count = max(1, workers or os.cpu_count() or 1)
+        self.ring_capacity = ring_capacity
+        self.max_devices = min(max_devices, 1 << 16)  # slot là uint16 trong record
+        self.recv_buffer_size = recv_buffer_size
+        self.side_queue_size = side_queue_size
+        self.name = name
+
+        self.running = False
+        self.ports: Dict[int, tuple] = {}  # {port: (worker index, slot)}
+        self.slot_ports: Dict[int, int] = {}  # {slot: port}
+        self._free_slots = deque(range(self.max_devices))  # FIFO: slot vừa trả chưa bị dùng lại ngay
+        self._workers: List[_WorkerHandle] = []
+        self._state_shm: Optional[shared_memory.SharedMemory] = None
+        self.state: Optional[np.ndarray] = None
+        self.events = None
+        self._lock = threading.RLock()  # Control plane (add/remove/stop)
+        self._read_lock = threading.Lock()  # Cursor của ring
+
+        # Statistics (process chính)
+        self.records_read = 0
+        self.records_overrun = 0  # Bị worker ghi đè trước khi kịp đọc
+        self.messages_read = 0
+        self.started_at: Optional[float] = None
+
+    def start(self) -> bool:
+        """Tạo shared memory và khởi động worker process"""
+        with self._lock:
+            if self.running:
+                return True
+
+            context = multiprocessing.get_context()
+            self.events = context.Queue(self.side_queue_size)
+            self._state_shm = shared_memory.SharedMemory(create=True, size=self.max_devices * STATE_ROW)
+            self.state = np.ndarray((self.max_devices,), dtype=STATE_DTYPE, buffer=self._state_shm.buf)
+
+            for index in range(self.worker_count):
+                ring = shared_memory.SharedMemory(
+                    create=True, size=RING_HEADER + self.ring_capacity * RECORD.size)
+                parent_conn, child_conn = context.Pipe()
+                process = context.Process(
+                    target=_worker_main,
+                    args=(index, ring, self._state_shm, self.ring_capacity, child_conn, self.events,
+                          self.recv_buffer_size),
+                    daemon=True,
+                    name=f"{self.name}_{index}"
+                )
+                process.start()
+                child_conn.close()
+                self._workers.append(_WorkerHandle(index, process, parent_conn, ring, self.ring_capacity))
+
+            self.running = True
+            self.started_at = time.time()
+            return True
+
+    def _call(self, worker: _WorkerHandle, *command, timeout: float = 5.0):
+        """Gửi lệnh tới worker và chờ reply (gọi khi đã giữ _lock)"""
+        worker.conn.send(command)
+        if not worker.conn.poll(timeout):
+            raise TimeoutError(f"Shard worker {worker.index} did not reply to {command[0]}")
+        status, reply = worker.conn.recv()
+        if status == 'error':
+            raise OSError(reply)
+        return reply
+
+    def add_port(self, port: int, host: str = '0.0.0.0') -> int:
+        """Giao port cho worker đang ít port nhất, trả về slot của port
+
+        Raise OSError nếu worker không bind được port (giống AsyncUDPIngestEngine.add_port).
+        """
+        if not self.running and not self.start():
+            raise RuntimeError("Sharded ingest failed to start")
+
+        with self._lock:
+            if port in self.ports:
+                raise OSError(f"Port {port} already registered in sharded ingest")
+            if not self._free_slots:
+                raise OSError(f"No free device slot (max_devices={self.max_devices})")
+
+            worker = min(self._workers, key=lambda handle: len(handle.ports))
+            slot = self._free_slots.popleft()
+            try:
+                self._call(worker, 'add', port, slot, host)
+            except Exception:
+                self._free_slots.appendleft(slot)
+                raise
+
+            worker.ports.add(port)
+            self.ports[port] = (worker.index, slot)
+            self.slot_ports[slot] = port
+            return slot
+
+    def remove_port(self, port: int) -> bool:
+        with self._lock:
+            entry = self.ports.pop(port, None)
+            if entry is None:
+                return False
+            index, slot = entry
+            worker = self._workers[index]
+            worker.ports.discard(port)
+            self.slot_ports.pop(slot, None)
+            try:
+                self._call(worker, 'remove', port)
+            finally:
+                self._free_slots.append(slot)
+            return True
+
+    def has_port(self, port: int) -> bool:
+        return port in self.ports
+
+    def slot_of(self, port: int) -> Optional[int]:
+        entry = self.ports.get(port)
+        return entry[1] if entry else None
+
+    def _read_ring(self, worker: _WorkerHandle) -> Optional[np.ndarray]:
+        capacity = self.ring_capacity
+        count = int(worker.count[0])
+        start = worker.cursor
+        if count == start:
+            return None
+        if count - start > capacity:
+            self.records_overrun += count - start - capacity
+            start = count - capacity
+
+        first = start % capacity
+        end = first + count - start
+        if end <= capacity:
+            chunk = worker.records[first:end].copy()
+        else:
+            chunk = np.concatenate((worker.records[first:], worker.records[:end - capacity]))
+
+        # Worker không chờ reader: bỏ các record có thể đã bị ghi đè trong lúc copy
+        valid_from = int(worker.count[0]) + 1 - capacity
+        if valid_from > start:
+            skipped = min(valid_from - start, len(chunk))
+            self.records_overrun += skipped
+            chunk = chunk[skipped:]
+
+        worker.cursor = count
+        return chunk
+
+    def read_records(self) -> np.ndarray:
+        """Record telemetry mới từ mọi worker (mảng RECORD_DTYPE, đã copy)"""
+        with self._read_lock:
+            chunks = [chunk for chunk in map(self._read_ring, self._workers) if chunk is not None and len(chunk)]
+        if not chunks:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        records = chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+        self.records_read += len(records)
+        return records
+
+    def read_messages(self, limit: int = 1000) -> List[tuple]:
+        """Message phụ không vừa record: [(slot, src_ip, kind, data dict, arrival)]"""
+        messages = []
+        while self.events is not None and len(messages) < limit:
+            try:
+                messages.append(self.events.get_nowait())
+            except (queue.Empty, OSError, ValueError):
+                break
+        self.messages_read += len(messages)
+        return messages
+
+    def device_state(self) -> np.ndarray:
+        """Copy nhất quán của bảng trạng thái (không có dòng đang ghi dở)"""
+        live = self.state
+        if live is None:
+            return np.zeros(0, dtype=STATE_DTYPE)
+
+        rows = live.copy()
+        torn = np.flatnonzero((rows['gen'] & 1).astype(bool) | (rows['gen'] != live['gen']))
+        for index in torn:
+            for _ in range(1000):
+                gen = int(live['gen'][index])
+                if not gen & 1:
+                    row = live[index].copy()
+                    if int(row['gen']) == gen == int(live['gen'][index]):
+                        rows[index] = row
+                        break
+                time.sleep(0)
+        return rows
+
+    def device_stats(self, port: int) -> Optional[dict]:
+        """Trạng thái của 1 port (MISSING -> None)"""
+        slot = self.slot_of(port)
+        if slot is None:
+            return None
+        row = self.device_state()[slot]
+        stats = {name: row[name].item() for name in STATE_DTYPE.names if name != 'gen'}
+        for name in ('raw_touch', 'threshold', 'value', 'touched'):
+            if stats[name] == MISSING:
+                stats[name] = None
+        return stats
+
+    def worker_stats(self) -> List[dict]:
+        """Hỏi từng worker (CPU time, record đã ghi) - qua pipe, không dùng ở hot path"""
+        with self._lock:
+            results = []
+            for worker in self._workers:
+                try:
+                    stats = self._call(worker, 'stats', timeout=2.0)
+                except (OSError, TimeoutError, EOFError) as e:
+                    stats = {'error': str(e)}
+                stats.update({'worker': worker.index, 'ports': len(worker.ports),
+                              'alive': worker.process.is_alive()})
+                results.append(stats)
+            return results
+
+    def get_stats(self) -> dict:
+        workers = [{
+            'worker': worker.index,
+            'alive': worker.process.is_alive(),
+            'ports': len(worker.ports),
+            'records_written': int(worker.count[0]),
+            'backlog': int(worker.count[0]) - worker.cursor,
+        } for worker in self._workers if worker.ring is not None]
+        return {
+            'running': self.running,
+            'workers': workers,
+            'port_count': len(self.ports),
+            'records_read': self.records_read,
+            'records_overrun': self.records_overrun,
+            'messages_read': self.messages_read,
+            'ring_capacity': self.ring_capacity,
+            'uptime': time.time() - self.started_at if self.started_at else 0,
+        }
+
+    def stop(self):
+        """Dừng worker và giải phóng shared memory"""
+        with self._lock:
+            if not self.running:
+                return
+            self.running = False
+
+            for worker in self._workers:
+                try:
+                    worker.conn.send(('stop',))
+                except OSError:
+                    pass
+            for worker in self._workers:
+                worker.process.join(timeout=2)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+                    worker.process.join(timeout=1)
+                worker.conn.close()
+
+            with self._read_lock:
+                for worker in self._workers:
+                    worker.count = worker.records = None  # Nhả view trước khi close
+                    worker.ring.close()
+                    worker.ring.unlink()
+                    worker.ring = None
+                self._workers = []
+
+            self.state = None
+            self._state_shm.close()
+            self._state_shm.unlink()
+            self._state_shm = None
+
+            self.events.close()
+            self.events.join_thread()
+            self.events = None
+
+            self.ports.clear()
+            self.slot_ports.clear()
+            self._free_slots = deque(range(self.max_devices))
+
+
+# Demo: 2 worker, 32 port, text + bin1 + STATUS
+if __name__ == "__main__":
+    from wire_codec import encode_frame
+
+    PORTS = list(range(17101, 17133))
+    PACKETS = 200
+
+    ingest = ShardedIngest(workers=2)
+    for port in PORTS:
+        ingest.add_port(port, host='127.0.0.1')
+    print(f"🧪 {len(PORTS)} ports on {ingest.worker_count} workers: "
+          f"{[worker['ports'] for worker in ingest.get_stats()['workers']]}")
+
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for i in range(PACKETS):
+        for n, port in enumerate(PORTS):
+            if n % 2:
+                packet = encode_frame(n, i + 1, i * 10, raw_touch=1000 + i, threshold=2500, value=i)
+            else:
+                packet = f"RawTouch:{1000 + i},Threshold:2500,Value:{i}".encode()
+            sender.sendto(packet, ('127.0.0.1', port))
+        if i % 20 == 0:
+            time.sleep(0.005)  # Không tràn socket buffer loopback
+    sender.sendto(b"STATUS:ESP_READY,Cube01", ('127.0.0.1', PORTS[0]))
+    sender.close()
+
+    received = 0
+    deadline = time.time() + 3
+    messages = []
+    while time.time() < deadline and received < PACKETS * len(PORTS):
+        received += len(ingest.read_records())
+        messages += ingest.read_messages()
+        time.sleep(0.01)
+    messages += ingest.read_messages()
+
+    state = ingest.device_state()
+    slots = [ingest.slot_of(port) for port in PORTS]
+    print(f"📥 {received:,}/{PACKETS * len(PORTS):,} records via shared memory, "
+          f"{len(messages)} side message(s): {messages[0][2:4] if messages else None}")
+    print(f"📊 packets per slot {int(state['packets'][slots].min())}-{int(state['packets'][slots].max())}, "
+          f"seq gaps {int(state['seq_gaps'][slots].sum())}, last values {sorted(set(state['value'][slots].tolist()))}")
+    print(f"📊 port {PORTS[1]}: {ingest.device_stats(PORTS[1])}")
+    for worker in ingest.worker_stats():
+        print(f"⚙️ worker {worker['worker']}: {worker['records']:,} records, "
+              f"{worker['ports']} ports, CPU {worker['cpu_time']:.2f}s")
+    ingest.stop()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Telemetry Parser
+Parse datagram từ ESP trực tiếp trên bytes/memoryview thành record có kiểu (int)
+thay cho decode + split chuỗi ở mỗi manager
+"""
+
+import re
+import time
+from typing import Callable, Dict, Optional
+
+# Fast path: layout cố định "RawTouch:1234,Threshold:2500,Value:856"
+_TOUCH_FAST = re.compile(rb'RawTouch:(-?\d+),Threshold:(-?\d+),Value:(-?\d+)\s*$')
+
+_INT_TEXT = re.compile(r'-?\d+$')
+
+# Tên field trong chuỗi text -> thuộc tính record
+_FIELD_ALIASES = {
+    'rawtouch': 'raw_touch',
+    'raw_touch': 'raw_touch',
+    'threshold': 'threshold',
+    'value': 'value',
+}
+
+
+class TelemetryRecord:
+    """Bản ghi telemetry gọn (__slots__) - số nguyên thay cho chuỗi"""
+
+    __slots__ = ('kind', 'raw_touch', 'threshold', 'value', 'touched', 'text', 'fields',
+                 'seq', 'device_id', 'device_time')
+
+    # Message kinds
+    TOUCH = 'touch'
+    STATUS = 'status'
+    ACK = 'acknowledgment'
+    IP_UPDATE_CONFIRM = 'ip_update_confirm'
+    GENERIC = 'generic'
+    ERROR = 'error'
+
+    def __init__(self, kind: str, raw_touch: Optional[int] = None, threshold: Optional[int] = None,
+                 value: Optional[int] = None, text: Optional[str] = None):
+        # Ít tham số để constructor ở fast path rẻ nhất có thể
+        self.kind = kind
+        self.raw_touch = raw_touch
+        self.threshold = threshold
+        self.value = value
+        self.touched = None
+        self.text = text
+        self.fields = None
+        # Chỉ có ở binary frame (wire_codec)
+        self.seq = None
+        self.device_id = None
+        self.device_time = None
+
+    def to_dict(self) -> dict:
+        """Chuyển sang dict cho callback GUI (giữ format cũ)"""
+        if self.kind == self.TOUCH:
+            data = {}
+            if self.raw_touch is not None:
+                data['raw_touch'] = self.raw_touch
+            if self.threshold is not None:
+                data['threshold'] = self.threshold
+            if self.value is not None:
+                data['value'] = self.value
+            if self.touched is not None:
+                data['touched'] = self.touched
+            if self.fields:
+                data.update(self.fields)
+            if self.seq is not None:
+                data['seq'] = self.seq
+            return data
+
+        if self.kind == self.STATUS:
+            return {'message_type': 'status', 'status': self.text}
+
+        if self.kind == self.ACK:
+            return {'message_type': 'acknowledgment', 'ack': self.text}
+
+        return {'message_type': self.kind, 'message': self.text}
+
+    def __repr__(self):
+        if self.kind == self.TOUCH:
+            return (f"TelemetryRecord(touch raw_touch={self.raw_touch}, "
+                    f"threshold={self.threshold}, value={self.value})")
+        return f"TelemetryRecord({self.kind} {self.text!r})"
+
+
+def _to_int_or_text(text: str):
+    text = text.strip()
+    return int(text) if _INT_TEXT.match(text) else text
+
+
+def _parse_touch_pairs(message: str) -> TelemetryRecord:
+    """Generic path cho touch data "Key:Value,..." (thứ tự tùy ý)"""
+    record = TelemetryRecord(TelemetryRecord.TOUCH)
+    for part in message.split(','):
+        if ':' not in part:
+            continue
+        key, value = part.split(':', 1)
+        key = key.strip().lower().replace(' ', '_')
+        attr = _FIELD_ALIASES.get(key)
+        if attr:
+            setattr(record, attr, _to_int_or_text(value))
+        else:
+            if record.fields is None:
+                record.fields = {}
+            record.fields[key] = _to_int_or_text(value)
+    return record
+
+
+def _parse_touch_data(message: str) -> TelemetryRecord:
+    """Parse "TOUCH_DATA,<value>,LED,r,g,b,STATUS,s,..." từ firmware"""
+    parts = message.split(',')
+    record = TelemetryRecord(TelemetryRecord.TOUCH, value=_to_int_or_text(parts[1]))
+    fields = {}
+
+    i = 2
+    while i < len(parts):
+        key = parts[i].strip()
+        if key == 'LED' and i + 3 < len(parts):
+            fields['led'] = tuple(_to_int_or_text(p) for p in parts[i + 1:i + 4])
+            i += 4
+        elif key == 'STATUS' and i + 1 < len(parts):
+            record.touched = _to_int_or_text(parts[i + 1])
+            i += 2
+        elif i + 1 < len(parts):
+            fields[key.lower()] = _to_int_or_text(parts[i + 1])
+            i += 2
+        else:
+            i += 1
+
+    record.fields = fields or None
+    return record
+
+
+# Decoder cho frame nhị phân, theo byte đầu tiên (không phải ASCII) - xem wire_codec
+_FRAME_DECODERS: Dict[int, Callable] = {}
+
+
+def register_frame_decoder(first_byte: int, decoder: Callable):
+    """Đăng ký decoder(data) -> TelemetryRecord cho frame bắt đầu bằng first_byte"""
+    if first_byte < 0x80:
+        raise ValueError("Frame magic must not be an ASCII byte (text protocol fallback)")
+    _FRAME_DECODERS[first_byte] = decoder
+
+
+def parse_telemetry(data) -> TelemetryRecord:
+    """Parse 1 datagram (bytes/bytearray/memoryview) thành TelemetryRecord"""
+    # Binary frame đã negotiate - text protocol luôn bắt đầu bằng byte ASCII
+    if _FRAME_DECODERS and data and data[0] >= 0x80:
+        decoder = _FRAME_DECODERS.get(data[0])
+        if decoder:
+            return decoder(data)
+
+    # Fast path - không decode, không split
+    match = _TOUCH_FAST.match(data)
+    if match:
+        raw_touch, threshold, value = match.groups()
+        return TelemetryRecord(TelemetryRecord.TOUCH, int(raw_touch), int(threshold), int(value))
+
+    # Generic path cho STATUS:/ACK:/IP-confirm và format khác
+    try:
+        message = bytes(data).decode('utf-8').strip()
+    except UnicodeDecodeError:
+        message = bytes(data).decode('utf-8', errors='replace').strip()
+
+    try:
+        if "RawTouch:" in message:
+            return _parse_touch_pairs(message)
+
+        if message.startswith("TOUCH_DATA,"):
+            return _parse_touch_data(message)
+
+        if message.startswith("STATUS:"):
+            return TelemetryRecord(TelemetryRecord.STATUS, text=message.split(':', 1)[1])
+
+        if message.startswith("ACK:"):
+            return TelemetryRecord(TelemetryRecord.ACK, text=message.split(':', 1)[1])
+
+        if message.startswith("Resolume IP updated:"):
+            return TelemetryRecord(TelemetryRecord.IP_UPDATE_CONFIRM, text=message)
+
+        return TelemetryRecord(TelemetryRecord.GENERIC, text=message)
+
+    except Exception:
+        return TelemetryRecord(TelemetryRecord.ERROR, text=message)
+
+
+# Micro-benchmark: parser cũ (decode + split) vs parser mới
+if __name__ == "__main__":
+    def legacy_parse(data: bytes) -> dict:
+        message = data.decode('utf-8').strip()
+        result = {}
+        if "RawTouch:" in message:
+            for part in message.split(','):
+                if ':' in part:
+                    key, value = part.split(':', 1)
+                    result[key.lower().replace(' ', '_')] = value.strip()
+        return result
+
+    def legacy_parse_typed(data: bytes) -> dict:
+        # Cùng output kiểu int như parser mới - so sánh công bằng
+        return {key: int(value) for key, value in legacy_parse(data).items()}
+
+    samples = [f"RawTouch:{1000 + i},Threshold:2932,Value:{500 + i % 700}".encode()
+               for i in range(1000)]
+    rounds = 200
+    total = len(samples) * rounds
+
+    print("🧪 Telemetry parser micro-benchmark")
+    print("-" * 40)
+
+    for name, func in (("legacy split", legacy_parse), ("legacy + int()", legacy_parse_typed),
+                       ("bytes fast path", parse_telemetry)):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for sample in samples:
+                func(sample)
+        elapsed = time.perf_counter() - start
+        print(f"{name:16s}: {total / elapsed:12,.0f} packets/s")
+
+    for sample in (b"RawTouch:1234,Threshold:2500,Value:856", b"STATUS:ESP_READY,Cube01",
+                   b"ACK:THRESHOLD", b"Resolume IP updated: 192.168.0.241",
+                   b"TOUCH_DATA,856,LED,255,0,0,STATUS,1,ESP_NAME,Cube01,MODE,AUTO"):
+        print(f"{sample.decode():60s} -> {parse_telemetry(memoryview(sample)).to_dict()}")
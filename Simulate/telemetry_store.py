@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Telemetry Store
+Lịch sử telemetry cho từng ESP trong ring buffer NumPy cấp phát trước
+(timestamp, raw_touch, value, threshold) - append O(1), truy vấn cửa sổ dạng vector
+"""
+
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+MISSING = -1  # Giá trị khi packet không có field tương ứng
+
+FIELDS = ('raw_touch', 'value', 'threshold')
+
+
+class TelemetryRingBuffer:
+    """Ring buffer kích thước cố định cho 1 ESP
+
+    Ghi (append/extend) và đọc (last/window) cùng giữ 1 lock nhỏ: reader copy các cột trong lock
+    nên không thấy mẫu ghi dở (cột rách) hay slot mới nhất đã ghi mà _index chưa tiến
+    (thứ tự cũ -> mới không còn tăng dần, searchsorted cắt sai).
+    """
+
+    def __init__(self, capacity: int = 6000):
+        self.capacity = capacity
+
+        # Columnar storage - cấp phát một lần
+        self.timestamp = np.zeros(capacity, dtype=np.float64)
+        self.raw_touch = np.full(capacity, MISSING, dtype=np.int32)
+        self.value = np.full(capacity, MISSING, dtype=np.int32)
+        self.threshold = np.full(capacity, MISSING, dtype=np.int32)
+
+        self._index = 0  # Vị trí ghi tiếp theo
+        self._count = 0
+        self.total_appended = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp: float, raw_touch: int = MISSING, value: int = MISSING,
+               threshold: int = MISSING):
+        """Thêm 1 mẫu - O(1), không cấp phát"""
+        with self._lock:
+            i = self._index
+            self.timestamp[i] = timestamp
+            self.raw_touch[i] = raw_touch
+            self.value[i] = value
+            self.threshold[i] = threshold
+
+            self._index = i + 1 if i + 1 < self.capacity else 0
+            if self._count < self.capacity:
+                self._count += 1
+            self.total_appended += 1
+
+    def extend(self, timestamps, raw_touch, value, threshold):
+        """Thêm nhiều mẫu một lần (các mảng cùng độ dài) - ghi vector, không vòng lặp Python"""
+        count = len(timestamps)
+        if not count:
+            return
+        columns = (timestamps, raw_touch, value, threshold)
+        if count > self.capacity:  # Chỉ giữ phần cuối vừa ring
+            columns = tuple(column[-self.capacity:] for column in columns)
+
+        written = len(columns[0])
+        with self._lock:
+            positions = (self._index + np.arange(written)) % self.capacity
+            self.timestamp[positions] = columns[0]
+            self.raw_touch[positions] = columns[1]
+            self.value[positions] = columns[2]
+            self.threshold[positions] = columns[3]
+
+            self._index = (self._index + written) % self.capacity
+            self._count = min(self.capacity, self._count + written)
+            self.total_appended += count
+
+    def _order(self, count: int) -> np.ndarray:
+        """Index theo thứ tự thời gian cho `count` mẫu gần nhất (gọi khi đã giữ lock)"""
+        end = self._index
+        start = end - count
+        return np.arange(start, end) % self.capacity
+
+    def last(self, n: int) -> Dict[str, np.ndarray]:
+        """Lấy n mẫu gần nhất (cũ -> mới) - bản copy"""
+        with self._lock:
+            order = self._order(min(n, self._count))
+            return {
+                'timestamp': self.timestamp[order],
+                'raw_touch': self.raw_touch[order],
+                'value': self.value[order],
+                'threshold': self.threshold[order],
+            }
+
+    def window(self, seconds: float, now: Optional[float] = None) -> Dict[str, np.ndarray]:
+        """Lấy các mẫu trong `seconds` giây gần nhất"""
+        if now is None:
+            now = time.time()
+
+        columns = self.last(self.capacity)
+        # Timestamp tăng dần theo thứ tự ghi -> tìm nhị phân
+        start = np.searchsorted(columns['timestamp'], now - seconds, side='left')
+        return {name: column[start:] for name, column in columns.items()}
+
+    def window_stats(self, seconds: float, field: str = 'value',
+                     now: Optional[float] = None) -> dict:
+        """min/max/mean và tốc độ mẫu trong cửa sổ thời gian"""
+        columns = self.window(seconds, now)
+        timestamps = columns['timestamp']
+        values = columns[field]
+        values = values[values != MISSING]
+
+        stats = {
+            'count': int(len(timestamps)),
+            'min': None,
+            'max': None,
+            'mean': None,
+            'rate': float(len(timestamps) / seconds) if seconds > 0 else 0.0,
+        }
+
+        if len(values):
+            stats['min'] = int(values.min())
+            stats['max'] = int(values.max())
+            stats['mean'] = float(values.mean())
+
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._index = 0
+            self._count = 0
+
+
+class TelemetryStore:
+    """Ring buffer telemetry theo từng ESP"""
+
+    def __init__(self, capacity: int = 6000):
+        self.capacity = capacity  # Mặc định 10 phút ở 10 Hz
+        self.buffers: Dict[str, TelemetryRingBuffer] = {}  # {esp_ip: buffer}
+        self._lock = threading.Lock()
+
+    def get_buffer(self, esp_ip: str) -> TelemetryRingBuffer:
+        """Lấy (hoặc tạo) ring buffer của ESP"""
+        buffer = self.buffers.get(esp_ip)
+        if buffer is None:
+            with self._lock:
+                buffer = self.buffers.get(esp_ip)
+                if buffer is None:
+                    buffer = TelemetryRingBuffer(self.capacity)
+                    self.buffers[esp_ip] = buffer
+        return buffer
+
+    def append(self, esp_ip: str, timestamp: float, raw_touch: int = MISSING,
+               value: int = MISSING, threshold: int = MISSING):
+        self.get_buffer(esp_ip).append(timestamp, raw_touch, value, threshold)
+
+    def append_record(self, esp_ip: str, record, timestamp: float):
+        """Thêm TelemetryRecord (field thiếu hoặc không phải số -> MISSING)"""
+        self.get_buffer(esp_ip).append(
+            timestamp,
+            record.raw_touch if isinstance(record.raw_touch, int) else MISSING,
+            record.value if isinstance(record.value, int) else MISSING,
+            record.threshold if isinstance(record.threshold, int) else MISSING
+        )
+
+    def extend(self, esp_ip: str, timestamps, raw_touch, value, threshold):
+        """Thêm batch mẫu dạng mảng (vd. record đọc từ sharded_ingest)"""
+        self.get_buffer(esp_ip).extend(timestamps, raw_touch, value, threshold)
+
+    def window(self, esp_ip: str, seconds: float) -> Dict[str, np.ndarray]:
+        buffer = self.buffers.get(esp_ip)
+        if buffer is None:
+            return {name: np.empty(0) for name in ('timestamp',) + FIELDS}
+        return buffer.window(seconds)
+
+    def window_stats(self, esp_ip: str, seconds: float, field: str = 'value') -> dict:
+        buffer = self.buffers.get(esp_ip)
+        if buffer is None:
+            return {'count': 0, 'min': None, 'max': None, 'mean': None, 'rate': 0.0}
+        return buffer.window_stats(seconds, field)
+
+    def esp_ips(self) -> List[str]:
+        return list(self.buffers.keys())
+
+    def export_csv(self, esp_ip: str, filename: str) -> int:
+        """Xuất toàn bộ lịch sử của ESP ra CSV, trả về số dòng"""
+        buffer = self.buffers.get(esp_ip)
+        if buffer is None:
+            return 0
+
+        columns = buffer.last(len(buffer))
+        table = np.column_stack([columns['timestamp']] + [columns[name] for name in FIELDS])
+        np.savetxt(filename, table, delimiter=',', fmt=['%.6f', '%d', '%d', '%d'],
+                   header='timestamp,' + ','.join(FIELDS), comments='')
+        return len(table)
+
+
+# Demo
+if __name__ == "__main__":
+    store = TelemetryStore(capacity=1000)
+    now = time.time()
+
+    for i in range(2500):
+        store.append("192.168.0.43", now - 250 + i * 0.1, 3000 + i % 50, 800 + i % 100, 2932)
+
+    buffer = store.get_buffer("192.168.0.43")
+    print(f"🧪 Stored {len(buffer)}/{buffer.total_appended} samples (capacity {buffer.capacity})")
+    print(f"📊 Last 10s value stats: {store.window_stats('192.168.0.43', 10)}")
+    print(f"📊 Last 60s raw_touch stats: {store.window_stats('192.168.0.43', 60, 'raw_touch')}")
+
+    start = time.perf_counter()
+    for i in range(100000):
+        buffer.append(now + i, 1, 2, 3)
+    elapsed = time.perf_counter() - start
+    print(f"⚡ Append rate: {100000 / elapsed:,.0f} samples/s")
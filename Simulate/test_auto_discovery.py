@@ -9,6 +9,8 @@ from auto_discovery_gui import AutoDiscoveryGUI
 import threading
 import time
 import socket
+import random
+import selectors
 
 class AutoDiscoverySystemTest:
     """Test hoàn chỉnh hệ thống Auto-Discovery"""
@@ -32,15 +34,16 @@ class AutoDiscoverySystemTest:
             print(f"🔧 Starting ESP simulator: {esp_name} ({esp_ip})")
             
             try:
-                # Create socket
+                # Create socket (bind IP riêng để manager thấy từng ESP khác nhau)
                 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.bind((esp_ip, 0))
                 sock.settimeout(1.0)
                 
                 # Computer IP (localhost for test)
                 computer_ip = "127.0.0.1"  # Localhost for testing
                 discovery_port = 7000
                 
-                # Send heartbeats every 5 seconds
+                # Giống firmware: heartbeat mỗi 5 giây cho tới khi được cấp port
                 while True:
                     try:
                         # Send heartbeat message
@@ -57,8 +60,13 @@ class AutoDiscoverySystemTest:
                                 assigned_port = int(response.split(":")[1])
                                 print(f"📡 {esp_name}: Got assigned port {assigned_port}")
                                 
+                                # Xác nhận bằng datagram đầu tiên trên data port
+                                sock.sendto(f"STATUS:ESP_READY,{esp_name},{esp_ip}".encode(),
+                                            (computer_ip, assigned_port))
+                                
                                 # Now can send data to assigned port
                                 self.send_test_data(esp_name, esp_ip, assigned_port, computer_ip)
+                                break
                         
                         except socket.timeout:
                             # No response, continue heartbeat
@@ -84,6 +92,7 @@ class AutoDiscoverySystemTest:
         def data_sender():
             try:
                 data_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                data_sock.bind((esp_ip, 0))
                 
                 # Send some test touch data
                 for i in range(5):
@@ -230,6 +239,78 @@ For example: 127.0.0.1 → Port 7001
         
         else:
             print("❌ Failed to start discovery")
+    
+    def run_fleet_test(self, count=80, loss=0.2, heartbeat_interval=5.0, timeout=60.0):
+        """Cả fleet bật nguồn cùng lúc: đo time-to-all-connected có retry và không retry"""
+        print(f"🚀 Fleet bring-up test: {count} ESPs, {loss:.0%} PORT_ASSIGNED loss")
+        
+        results = {}
+        for label, max_attempts in (("heartbeat only", 1), ("ack + backoff", 6)):
+            elapsed, stats = self._bring_up_fleet(count, loss, heartbeat_interval, timeout, max_attempts)
+            results[label] = elapsed
+            print(f"   {label:15s}: {elapsed:.2f}s to all connected "
+                  f"(retransmits {stats['retransmits']}, "
+                  f"time-to-ack p99 {stats['time_to_ack']['p99_ms']} ms)")
+        
+        return results
+    
+    def _bring_up_fleet(self, count, loss, heartbeat_interval, timeout, max_attempts):
+        """1 lần bring-up: cube giả lập chạy trên 1 thread với selector"""
+        from auto_discovery_manager import AutoDiscoveryManager
+        
+        class FleetConfig:
+            log_level = "WARNING"  # Không in log từng ESP
+            discovery_max_attempts = max_attempts
+        
+        manager = AutoDiscoveryManager(FleetConfig())
+        if not manager.start_discovery():
+            raise RuntimeError("Failed to start discovery")
+        
+        selector = selectors.DefaultSelector()
+        sockets = []
+        for index in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((f"127.0.0.{101 + index}", 0))  # Mỗi cube 1 IP loopback
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ, index)
+            sockets.append(sock)
+        
+        try:
+            start = time.time()
+            next_heartbeat = [start + random.uniform(0, 0.2) for _ in range(count)]
+            assigned = [False] * count
+            
+            while time.time() - start < timeout:
+                if len(manager.get_connected_esps()) == count:
+                    break
+                
+                now = time.time()
+                for index, sock in enumerate(sockets):
+                    if not assigned[index] and now >= next_heartbeat[index]:
+                        sock.sendto(f"HEARTBEAT:Cube{index:03d}".encode(), ("127.0.0.1", 7000))
+                        next_heartbeat[index] = now + heartbeat_interval
+                
+                for key, _ in selector.select(0.01):
+                    index = key.data
+                    data, _ = key.fileobj.recvfrom(1024)
+                    response = data.decode()
+                    if assigned[index] or not response.startswith("PORT_ASSIGNED:"):
+                        continue
+                    if random.random() < loss:
+                        continue  # Mất gói trên WiFi
+                    
+                    assigned[index] = True
+                    port = int(response.split(":")[1])
+                    key.fileobj.sendto(f"STATUS:ESP_READY,Cube{index:03d}".encode(), ("127.0.0.1", port))
+            
+            return time.time() - start, manager.assignments.get_stats()
+        
+        finally:
+            for sock in sockets:
+                selector.unregister(sock)
+                sock.close()
+            manager.stop_discovery()
+            time.sleep(0.3)  # Nhả port trước lần chạy kế tiếp
 
 def main():
     """Main function"""
@@ -237,10 +318,11 @@ def main():
     print("Choose test mode:")
     print("1. GUI Test (recommended)")
     print("2. Console Test")
-    print("3. Exit")
+    print("3. Fleet Bring-up Test (80 ESPs)")
+    print("4. Exit")
     
     try:
-        choice = input("\nEnter choice (1-3): ").strip()
+        choice = input("\nEnter choice (1-4): ").strip()
         
         test = AutoDiscoverySystemTest()
         
@@ -249,6 +331,8 @@ def main():
         elif choice == "2":
             test.run_console_test()
         elif choice == "3":
+            test.run_fleet_test()
+        elif choice == "4":
             print("👋 Goodbye!")
             return
         else:
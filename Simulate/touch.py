@@ -11,20 +11,29 @@ class TouchController:
         self.comm_handler = comm_handler
         self.current_threshold = 2932
     
-    def set_threshold(self, threshold: int) -> bool:
-        """Thiết lập ngưỡng cảm biến"""
+    def set_threshold(self, threshold: int, on_done=None) -> bool:
+        """Thiết lập ngưỡng cảm biến
+        
+        Chờ ESP báo Threshold mới (retry tới timeout); không xác nhận thì giá trị cũ được giữ lại
+        và on_done(PendingCommand) báo kết quả.
+        """
         try:
             threshold_value = int(threshold)
             if threshold_value < 100 or threshold_value > 10000:
                 return False
                 
             command = f"THRESHOLD:{threshold_value}"
-            success = self.comm_handler.send_udp_command(command)
+            previous = self.current_threshold
+            self.current_threshold = threshold_value
             
-            if success:
-                self.current_threshold = threshold_value
-                
-            return success
+            def on_reply(pending):
+                if not pending.confirmed and self.current_threshold == threshold_value:
+                    self.current_threshold = previous  # Rollback
+                if on_done:
+                    on_done(pending)
+            
+            self.comm_handler.send_reliable(command, on_done=on_reply)
+            return True
             
         except ValueError:
             return False
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Touch Coalescer
+Gộp touch telemetry theo ESP trước khi gọi callback GUI: mỗi ESP được giao tối đa 1 update mỗi window
+(giữ RawTouch/Value mới nhất, field 'merged' = số packet đã gộp vào update đó). Packet đầu tiên sau
+khoảng lặng được giao ngay; khi trạng thái chạm đổi (touched hoặc value vượt threshold) update được
+giao ngay, không chờ window. STATUS/ACK không bị gộp (giao ngay sau touch đang chờ của ESP đó).
+Số callback/giây theo số ESP thay vì theo packet rate.
+"""
+
+import heapq
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+
+def touch_state(data: dict) -> Optional[bool]:
+    """Trạng thái chạm của 1 touch dict: 'touched' (STATUS firmware) hoặc value < threshold như pic.c"""
+    touched = data.get('touched')
+    if touched is not None:
+        return bool(touched)
+    value, threshold = data.get('value'), data.get('threshold')
+    if value is None or threshold is None:
+        return None
+    return value < threshold
+
+
+class _KeyState:
+    """Touch đang chờ + trạng thái chạm đã giao của 1 ESP"""
+
+    __slots__ = ('pending', 'merged', 'touched', 'last_delivery', 'scheduled', 'outbox', 'delivering')
+
+    def __init__(self):
+        self.pending: Optional[dict] = None  # Touch mới nhất chưa giao
+        self.merged = 0  # Số packet gộp từ lần giao trước
+        self.touched: Optional[bool] = None
+        self.last_delivery = float('-inf')
+        self.scheduled = False
+        self.outbox = deque()  # Update đã chốt, chờ gọi deliver (ngoài lock)
+        self.delivering = False  # Có thread đang giao outbox của ESP này
+
+
+class TouchCoalescer:
+    """Latest-value coalescing theo ESP - deliver(key, data) chạy trên thread gọi offer hoặc thread timer
+
+    deliver luôn được gọi ngoài lock; mỗi ESP chỉ 1 thread giao outbox tại 1 thời điểm nên thứ tự theo ESP
+    được giữ và callback chậm của 1 ESP không chặn offer() của ESP khác.
+    """
+
+    def __init__(self, deliver: Callable[[Hashable, dict], None], window: float = 0.05,
+                 name: str = "Touch_Coalescer"):
+        self.deliver = deliver
+        self.window = window  # <= 0: giao từng packet như cũ
+        self.name = name
+
+        self.keys: Dict[Hashable, _KeyState] = {}
+        self._heap: List[Tuple[float, int, Hashable]] = []  # (due, counter, key)
+        self._counter = 0
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.running = False
+
+        # Statistics
+        self.offered = 0
+        self.delivered = 0
+        self.coalesced = 0  # Packet touch bị update mới hơn cùng ESP thay thế
+        self.crossings = 0  # Đổi trạng thái chạm - giao ngay
+        self.passthrough = 0  # STATUS/ACK/... không gộp
+        self.max_merged = 0
+        self.deliver_errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def start(self):
+        with self._cond:
+            if self.running or not self.enabled:
+                return
+            self.running = True
+            self._thread = threading.Thread(target=self._run, daemon=True, name=self.name)
+            self._thread.start()
+
+    def offer(self, key: Hashable, data: dict) -> bool:
+        """Đưa 1 callback dict vào coalescer - trả về True nếu được giao ngay"""
+        if not self.enabled:
+            # Tắt coalescing: gọi thẳng như trước, không lấy lock (số đếm không khóa)
+            self.offered += 1
+            if self._emit(key, data):
+                self.delivered += 1
+            else:
+                self.deliver_errors += 1
+            return True
+
+        if not self.running:
+            self.start()
+        with self._cond:
+            self.offered += 1
+            state = self.keys.get(key)
+            if state is None:
+                state = self.keys[key] = _KeyState()
+            immediate = self._accept(key, state, data)
+        if immediate:
+            self._drain(key, state)
+        return immediate
+
+    def _accept(self, key: Hashable, state: _KeyState, data: dict) -> bool:
+        """Gộp hoặc chốt update vào outbox (gọi khi đã giữ lock) - True nếu cần giao ngay"""
+        if 'message_type' in data:
+            # STATUS/ACK: touch đang chờ vào outbox trước để giữ thứ tự
+            self.passthrough += 1
+            self._flush_key(key, state, time.monotonic())
+            state.outbox.append(data)
+            return True
+
+        touched = touch_state(data)
+        crossing = touched is not None and state.touched is not None and touched != state.touched
+        if touched is not None:
+            state.touched = touched
+        state.merged += 1
+
+        now = time.monotonic()
+        if crossing or now >= state.last_delivery + self.window:
+            if crossing:
+                self.crossings += 1
+            if state.pending is not None:
+                self.coalesced += 1
+            state.pending = data
+            self._flush_key(key, state, now)
+            return True
+
+        if state.pending is not None:
+            self.coalesced += 1
+        state.pending = data
+        if not state.scheduled:
+            state.scheduled = True
+            self._counter += 1
+            heapq.heappush(self._heap, (state.last_delivery + self.window, self._counter, key))
+            self._cond.notify()
+        return False
+
+    def _flush_key(self, key: Hashable, state: _KeyState, now: float):
+        """Chốt touch đang chờ của 1 ESP vào outbox (gọi khi đã giữ lock)"""
+        data = state.pending
+        if data is None:
+            return
+        data['merged'] = state.merged
+        self.max_merged = max(self.max_merged, state.merged)
+        state.pending = None
+        state.merged = 0
+        state.last_delivery = now
+        state.outbox.append(data)
+
+    def _drain(self, key: Hashable, state: _KeyState):
+        """Gọi deliver cho outbox của 1 ESP ngoài lock (thread khác đang giao ESP này thì để nó giao tiếp)"""
+        with self._cond:
+            if state.delivering:
+                return
+            state.delivering = True
+        ok = None
+        while True:
+            with self._cond:
+                if ok is not None:
+                    if ok:
+                        self.delivered += 1
+                    else:
+                        self.deliver_errors += 1
+                if not state.outbox:
+                    state.delivering = False
+                    return
+                data = state.outbox.popleft()
+            ok = self._emit(key, data)
+
+    def _emit(self, key: Hashable, data: dict) -> bool:
+        try:
+            self.deliver(key, data)
+            return True
+        except Exception as e:
+            print(f"Touch coalescer deliver error for {key}: {e}")
+            return False
+
+    def _run(self):
+        while True:
+            ready = []
+            with self._cond:
+                while self.running and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                if not self.running:
+                    return
+
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, key = heapq.heappop(self._heap)
+                    state = self.keys.get(key)
+                    if state is None:
+                        continue
+                    state.scheduled = False
+                    due = state.last_delivery + self.window
+                    if state.pending is not None and due > now:
+                        # Entry cũ (ESP vừa giao ngay do crossing) - hẹn lại theo lần giao mới
+                        state.scheduled = True
+                        self._counter += 1
+                        heapq.heappush(self._heap, (due, self._counter, key))
+                        continue
+                    self._flush_key(key, state, now)
+                    ready.append((key, state))
+
+            for key, state in ready:
+                self._drain(key, state)
+
+    def flush(self, key: Optional[Hashable] = None):
+        """Giao ngay mọi touch đang chờ (vd. khi dừng)"""
+        with self._cond:
+            now = time.monotonic()
+            targets = [key] if key is not None else list(self.keys)
+            ready = []
+            for target in targets:
+                state = self.keys.get(target)
+                if state is not None:
+                    self._flush_key(target, state, now)
+                    ready.append((target, state))
+        for target, state in ready:
+            self._drain(target, state)
+
+    def discard(self, key: Hashable):
+        """Bỏ trạng thái của ESP đã hủy đăng ký"""
+        with self._cond:
+            self.keys.pop(key, None)
+
+    def stop(self, flush: bool = True):
+        if flush:
+            self.flush()
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+        if self._thread and self._thread.is_alive() and threading.current_thread() is not self._thread:
+            self._thread.join(timeout=1)
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            pending = sum((state.pending is not None) + len(state.outbox) for state in self.keys.values())
+            return {
+                'window_ms': self.window * 1000,
+                'offered': self.offered,
+                'delivered': self.delivered,
+                'coalesced': self.coalesced,
+                'crossings': self.crossings,
+                'passthrough': self.passthrough,
+                'max_merged': self.max_merged,
+                'deliver_errors': self.deliver_errors,
+                'pending': pending,
+                'reduction': 1.0 - self.delivered / self.offered if self.offered else 0.0,
+            }
+
+
+# Demo: 40 ESP gửi touch 500 Hz trong 2 giây, mỗi cube được chạm/thả vài lần
+if __name__ == "__main__":
+    import random
+
+    ESPS = 40
+    RATE = 500
+    DURATION = 2.0
+    THRESHOLD = 1000
+
+    random.seed(5)
+    delivered: Dict[str, List[dict]] = {}
+    sent_crossings: Dict[str, List[bool]] = {}
+    coalescer = TouchCoalescer(lambda key, data: delivered.setdefault(key, []).append(dict(data)),
+                               window=0.05)
+
+    touched = {f"192.168.0.{10 + i}": False for i in range(ESPS)}
+    last_value: Dict[str, int] = {}
+    start = time.perf_counter()
+    sent = 0
+    tick = 0
+    while time.perf_counter() - start < DURATION:
+        for esp_ip in touched:
+            if random.random() < 0.002:
+                touched[esp_ip] = not touched[esp_ip]
+                sent_crossings.setdefault(esp_ip, []).append(touched[esp_ip])
+            value = random.randint(400, 900) if touched[esp_ip] else random.randint(1100, 1600)
+            coalescer.offer(esp_ip, {'raw_touch': int(touched[esp_ip]), 'threshold': THRESHOLD,
+                                     'value': value, 'seq': tick})
+            last_value[esp_ip] = value
+            sent += 1
+        tick += 1
+        if tick % 10 == 0:
+            coalescer.offer("192.168.0.10", {'message_type': 'status', 'status': 'OK'})
+        time.sleep(max(0.0, start + tick / RATE - time.perf_counter()))
+
+    coalescer.stop()
+    stats = coalescer.get_stats()
+
+    for esp_ip, updates in delivered.items():
+        touches = [update for update in updates if 'message_type' not in update]
+        assert touches[-1]['value'] == last_value[esp_ip], esp_ip  # Giá trị cuối luôn được giao
+        seen = [False] + [touch_state(update) for update in touches]
+        flips = [state for previous, state in zip(seen, seen[1:]) if state != previous]
+        assert flips == sent_crossings.get(esp_ip, []), esp_ip  # Không mất lần chạm/thả nào
+        assert sum(update['merged'] for update in touches) == tick, esp_ip
+
+    touch_updates = stats['delivered'] - stats['passthrough']
+    print(f"🧪 {ESPS} ESPs x {tick / DURATION:.0f} Hz, {DURATION:.0f}s: {sent:,} touch packets -> "
+          f"{touch_updates:,} callbacks ({stats['reduction']:.0%} fewer, max merged {stats['max_merged']})")
+    print(f"   {stats['crossings']} touch crossings delivered immediately, "
+          f"{stats['passthrough']} STATUS passed through; last value + every crossing delivered ✅")
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Shared UDP Command Sender
+Socket gửi lệnh dùng chung (1 socket cho mỗi interface) với hàng đợi gửi non-blocking
+thay cho việc tạo/đóng socket cho mỗi lệnh
+"""
+
+import socket
+import threading
+import time
+import queue
+from typing import Dict, Optional, Tuple
+
+
+class UDPCommandSender:
+    """Gửi UDP qua socket dùng lại + thống kê theo từng đích"""
+
+    def __init__(self, max_queue: int = 10000, send_buffer_size: int = 512 * 1024):
+        self.max_queue = max_queue
+        self.send_buffer_size = send_buffer_size
+
+        self.sockets: Dict[str, socket.socket] = {}  # {bind_ip: socket}
+        self.send_queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.destinations: Dict[Tuple[str, int], dict] = {}  # {(ip, port): stats}
+
+        self.running = False
+        self.thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+        # Totals
+        self.total_sent = 0
+        self.total_errors = 0
+        self.total_rejected = 0  # Queue đầy
+
+    def get_socket(self, bind_ip: str = '0.0.0.0') -> socket.socket:
+        """Lấy (hoặc tạo) socket dùng chung cho interface"""
+        sock = self.sockets.get(bind_ip)
+        if sock is not None:
+            return sock
+
+        with self._lock:
+            sock = self.sockets.get(bind_ip)
+            if sock is None:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                if bind_ip != '0.0.0.0':
+                    sock.bind((bind_ip, 0))
+                self.sockets[bind_ip] = sock
+            return sock
+
+    def _dest_stats(self, addr: Tuple[str, int]) -> dict:
+        stats = self.destinations.get(addr)
+        if stats is None:
+            with self._lock:
+                stats = self.destinations.setdefault(addr, {
+                    'sent': 0,
+                    'errors': 0,
+                    'backlog': 0,
+                    'last_latency': 0.0,
+                    'avg_latency': 0.0,
+                    'max_latency': 0.0,
+                    'last_sent': None,
+                    'last_error': None
+                })
+        return stats
+
+    def _ensure_thread(self):
+        """Khởi động sender thread khi cần"""
+        if self.running:
+            return
+
+        with self._lock:
+            if self.running:
+                return
+            self.running = True
+            self.thread = threading.Thread(
+                target=self._send_loop,
+                daemon=True,
+                name="UDP_Sender"
+            )
+            self.thread.start()
+
+    def send(self, data, addr: Tuple[str, int], bind_ip: str = '0.0.0.0') -> bool:
+        """Đưa datagram vào hàng đợi gửi (không block)
+
+        Trả về False nếu hàng đợi đầy.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        self._ensure_thread()
+
+        stats = self._dest_stats(addr)
+        with self._lock:
+            stats['backlog'] += 1
+
+        try:
+            self.send_queue.put_nowait((data, addr, bind_ip, time.perf_counter()))
+        except queue.Full:
+            with self._lock:
+                stats['backlog'] -= 1
+            self.total_rejected += 1
+            stats['errors'] += 1
+            stats['last_error'] = "send queue full"
+            return False
+
+        return True
+
+    def send_now(self, data, addr: Tuple[str, int], bind_ip: str = '0.0.0.0') -> bool:
+        """Gửi ngay trên thread hiện tại (vẫn dùng socket chung)"""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        return self._sendto(data, addr, bind_ip, time.perf_counter(), queued=False)
+
+    def _sendto(self, data: bytes, addr: Tuple[str, int], bind_ip: str,
+                enqueued_at: float, queued: bool) -> bool:
+        stats = self._dest_stats(addr)
+        if queued:
+            with self._lock:
+                stats['backlog'] -= 1
+
+        try:
+            self.get_socket(bind_ip).sendto(data, addr)
+        except Exception as e:
+            stats['errors'] += 1
+            stats['last_error'] = str(e)
+            self.total_errors += 1
+            return False
+
+        latency = time.perf_counter() - enqueued_at
+        if stats['sent'] == 0:
+            stats['avg_latency'] = latency
+        else:
+            stats['avg_latency'] += (latency - stats['avg_latency']) * 0.1  # EWMA
+        stats['sent'] += 1
+        stats['last_latency'] = latency
+        if latency > stats['max_latency']:
+            stats['max_latency'] = latency
+        stats['last_sent'] = time.time()
+        self.total_sent += 1
+        return True
+
+    def _send_loop(self):
+        """Thread gửi datagram từ hàng đợi"""
+        while self.running:
+            try:
+                item = self.send_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            if item is None:
+                break
+
+            data, addr, bind_ip, enqueued_at = item
+            self._sendto(data, addr, bind_ip, enqueued_at, queued=True)
+
+    def flush(self, timeout: float = 1.0) -> bool:
+        """Chờ hàng đợi gửi rỗng"""
+        deadline = time.time() + timeout
+        while not self.send_queue.empty():
+            if time.time() > deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def get_destination_stats(self, ip: str, port: int) -> dict:
+        """Thống kê gửi cho 1 đích"""
+        stats = self.destinations.get((ip, port))
+        return dict(stats) if stats else {}
+
+    def get_stats(self) -> dict:
+        """Lấy thống kê tổng"""
+        return {
+            'sockets': len(self.sockets),
+            'queue_size': self.send_queue.qsize(),
+            'total_sent': self.total_sent,
+            'total_errors': self.total_errors,
+            'total_rejected': self.total_rejected,
+            'destinations': {f"{ip}:{port}": dict(stats)
+                             for (ip, port), stats in list(self.destinations.items())}
+        }
+
+    def close(self):
+        """Dừng sender thread và đóng socket"""
+        if self.running:
+            self.running = False
+            try:
+                self.send_queue.put_nowait(None)
+            except queue.Full:
+                pass
+            if self.thread and self.thread.is_alive():
+                self.thread.join(timeout=2)
+
+        with self._lock:
+            for sock in self.sockets.values():
+                sock.close()
+            self.sockets.clear()
+
+
+_shared_sender: Optional[UDPCommandSender] = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_sender() -> UDPCommandSender:
+    """Sender dùng chung cho toàn bộ ứng dụng"""
+    global _shared_sender
+    with _shared_lock:
+        if _shared_sender is None:
+            _shared_sender = UDPCommandSender()
+        return _shared_sender
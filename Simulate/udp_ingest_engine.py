@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Async UDP Ingest Engine
+Một event loop asyncio duy nhất phục vụ tất cả port UDP (discovery 7000 + data 7001-7255)
+thay cho mô hình mỗi ESP một thread recvfrom
+"""
+
+import asyncio
+import socket
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+
+class _PortProtocol(asyncio.DatagramProtocol):
+    """Protocol cho 1 port - chuyển datagram về engine"""
+
+    def __init__(self, engine, port: int):
+        self.engine = engine
+        self.port = port
+
+    def datagram_received(self, data: bytes, addr):
+        self.engine._dispatch(self.port, data, addr)
+
+    def error_received(self, exc: Exception):
+        self.engine._report_error(self.port, exc)
+
+
+class AsyncUDPIngestEngine:
+    """Nhận UDP trên nhiều port từ 1 event loop (1 thread cố định)"""
+
+    def __init__(self, name: str = "UDP_Ingest", recv_buffer_size: int = 1024 * 1024):
+        self.name = name
+        self.recv_buffer_size = recv_buffer_size
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread: Optional[threading.Thread] = None
+        self.running = False
+
+        self.transports: Dict[int, asyncio.DatagramTransport] = {}  # {port: transport}
+        self.handlers: Dict[int, Callable] = {}  # {port: handler(data, addr)}
+        self._lock = threading.Lock()
+
+        # Statistics
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.handler_errors = 0
+        self.started_at: Optional[float] = None
+
+        # Callback khi có lỗi (port, exception)
+        self.on_error: Optional[Callable] = None
+
+    def start(self) -> bool:
+        """Khởi động event loop trong thread riêng"""
+        if self.running:
+            return True
+
+        ready = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run_loop,
+            args=(ready,),
+            daemon=True,
+            name=self.name
+        )
+        self.thread.start()
+
+        if not ready.wait(timeout=2.0):
+            return False
+
+        self.running = True
+        self.started_at = time.time()
+        return True
+
+    def _run_loop(self, ready: threading.Event):
+        """Thread chạy event loop"""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        ready.set()
+
+        try:
+            self.loop.run_forever()
+        finally:
+            # Đóng transport còn lại trước khi đóng loop
+            for transport in list(self.transports.values()):
+                transport.close()
+            self.loop.run_until_complete(asyncio.sleep(0))
+            self.loop.close()
+
+    def _in_loop_thread(self) -> bool:
+        return self.thread is not None and threading.current_thread() is self.thread
+
+    def add_port(self, port: int, handler: Callable, host: str = '0.0.0.0') -> bool:
+        """Bind port và đăng ký handler(data, addr)
+
+        Raise OSError nếu không bind được port (giống socket.bind cũ).
+        Có thể gọi từ bất kỳ thread nào, kể cả từ trong handler.
+        """
+        if not self.running and not self.start():
+            raise RuntimeError("Ingest engine failed to start")
+
+        with self._lock:
+            if port in self.handlers:
+                raise OSError(f"Port {port} already registered in ingest engine")
+
+            # Bind đồng bộ để lỗi (port bận...) được báo ngay cho caller
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer_size)
+                sock.bind((host, port))
+                sock.setblocking(False)
+            except OSError:
+                sock.close()
+                raise
+
+            self.handlers[port] = handler
+
+        future = asyncio.run_coroutine_threadsafe(self._open_endpoint(port, sock), self.loop)
+
+        # Trong loop thread không thể chờ future (deadlock) - endpoint mở ở vòng lặp kế tiếp
+        if not self._in_loop_thread():
+            future.result(timeout=2.0)
+
+        return True
+
+    async def _open_endpoint(self, port: int, sock: socket.socket):
+        """Tạo datagram endpoint từ socket đã bind"""
+        transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: _PortProtocol(self, port),
+            sock=sock
+        )
+
+        # Port có thể đã bị remove trước khi endpoint kịp mở
+        if port not in self.handlers:
+            transport.close()
+            return
+
+        self.transports[port] = transport
+
+    def remove_port(self, port: int) -> bool:
+        """Ngừng nhận trên port"""
+        with self._lock:
+            if port not in self.handlers:
+                return False
+            del self.handlers[port]
+
+        transport = self.transports.pop(port, None)
+        if transport and self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(transport.close)
+
+        return True
+
+    def has_port(self, port: int) -> bool:
+        return port in self.handlers
+
+    def _dispatch(self, port: int, data: bytes, addr):
+        """Gọi handler cho datagram (chạy trong loop thread)"""
+        self.packets_received += 1
+        self.bytes_received += len(data)
+
+        handler = self.handlers.get(port)
+        if handler is None:
+            return
+
+        try:
+            handler(data, addr)
+        except Exception as e:
+            self.handler_errors += 1
+            self._report_error(port, e)
+
+    def _report_error(self, port: int, exc: Exception):
+        if self.on_error:
+            try:
+                self.on_error(port, exc)
+            except Exception:
+                pass
+
+    def stop(self):
+        """Dừng engine và đóng tất cả port"""
+        if not self.running:
+            return
+
+        self.running = False
+
+        with self._lock:
+            self.handlers.clear()
+
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+        if self.thread and self.thread.is_alive() and not self._in_loop_thread():
+            self.thread.join(timeout=2)
+
+        self.transports.clear()
+        self.loop = None
+        self.thread = None
+
+    def get_stats(self) -> dict:
+        """Lấy thống kê engine"""
+        return {
+            'running': self.running,
+            'ports': sorted(self.handlers.keys()),
+            'port_count': len(self.handlers),
+            'packets_received': self.packets_received,
+            'bytes_received': self.bytes_received,
+            'handler_errors': self.handler_errors,
+            'uptime': time.time() - self.started_at if self.started_at else 0
+        }
+
+
+# Demo: nhiều port, một thread
+if __name__ == "__main__":
+    engine = AsyncUDPIngestEngine()
+    received = []
+
+    def make_handler(port):
+        return lambda data, addr: received.append((port, data))
+
+    ports = list(range(17001, 17065))
+    for port in ports:
+        engine.add_port(port, make_handler(port), host='127.0.0.1')
+
+    print(f"🧪 Listening on {len(ports)} ports with {threading.active_count()} threads")
+
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for port in ports:
+        sender.sendto(b"RawTouch:1234,Threshold:2500,Value:856", ('127.0.0.1', port))
+    sender.close()
+
+    time.sleep(0.5)
+    print(f"📥 Received {len(received)}/{len(ports)} datagrams")
+    print(f"📊 {engine.get_stats()}")
+    engine.stop()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+UI Update Scheduler
+Gom cập nhật GUI từ telemetry tần số cao: thread mạng chỉ ghi trạng thái mới nhất
+vào dirty map, một tick root.after() theo FPS vẽ lại những key đã thay đổi
+"""
+
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+
+class CoalescingUIScheduler:
+    """Frame-paced UI updates cho Tk"""
+
+    def __init__(self, root, render: Callable, fps: float = 20.0):
+        """render(key, state) được gọi trên Tk thread cho mỗi key đã đổi"""
+        self.root = root
+        self.render = render
+        self.fps = fps
+
+        self._dirty: Dict[object, tuple] = {}  # {key: (state, received_at)}
+        self._lock = threading.Lock()
+        self._after_id = None
+        self.running = False
+
+        # Statistics
+        self.submitted = 0
+        self.painted = 0
+        self.frames = 0
+        self.last_latency = 0.0
+        self.avg_latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def interval_ms(self) -> int:
+        return max(1, int(1000 / self.fps))
+
+    def submit(self, key, state, received_at: Optional[float] = None):
+        """Ghi trạng thái mới nhất cho key (gọi được từ bất kỳ thread nào)"""
+        if received_at is None:
+            received_at = time.time()
+
+        with self._lock:
+            previous = self._dirty.get(key)
+            # Giữ thời điểm nhận của bản cũ nhất chưa vẽ để đo đúng độ trễ
+            if previous is not None:
+                received_at = min(received_at, previous[1])
+            self._dirty[key] = (state, received_at)
+            self.submitted += 1
+
+    def start(self):
+        """Bắt đầu tick (gọi trên Tk thread)"""
+        if self.running:
+            return
+        self.running = True
+        self._after_id = self.root.after(self.interval_ms, self._tick)
+
+    def stop(self):
+        self.running = False
+        if self._after_id is not None:
+            try:
+                self.root.after_cancel(self._after_id)
+            except Exception:
+                pass
+            self._after_id = None
+
+    def set_fps(self, fps: float):
+        self.fps = max(1.0, fps)
+
+    def _tick(self):
+        """Vẽ lại các key đã đổi kể từ frame trước"""
+        if not self.running:
+            return
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+
+        if dirty:
+            self.frames += 1
+            for key, (state, received_at) in dirty.items():
+                try:
+                    self.render(key, state)
+                except Exception as e:
+                    print(f"UI render error for {key}: {e}")
+                    continue
+
+                latency = time.time() - received_at
+                self.painted += 1
+                self.last_latency = latency
+                self.avg_latency += (latency - self.avg_latency) * 0.1  # EWMA
+                if latency > self.max_latency:
+                    self.max_latency = latency
+
+        try:
+            self._after_id = self.root.after(self.interval_ms, self._tick)
+        except Exception:
+            # Cửa sổ đã bị đóng
+            self.running = False
+
+    def get_stats(self) -> dict:
+        """Thống kê: số update gộp và độ trễ packet -> paint"""
+        return {
+            'fps': self.fps,
+            'frames': self.frames,
+            'submitted': self.submitted,
+            'painted': self.painted,
+            'coalesced': self.submitted - self.painted - len(self._dirty),
+            'pending': len(self._dirty),
+            'last_latency_ms': self.last_latency * 1000,
+            'avg_latency_ms': self.avg_latency * 1000,
+            'max_latency_ms': self.max_latency * 1000,
+        }
+
+
+# Demo: 8 ESP gửi 1000 packet/s, GUI vẽ 20 FPS
+if __name__ == "__main__":
+    import tkinter as tk
+
+    root = tk.Tk()
+    root.title("UI Update Scheduler Demo")
+    labels = {}
+
+    def render(esp_ip, state):
+        if esp_ip not in labels:
+            labels[esp_ip] = tk.Label(root, font=("Consolas", 10))
+            labels[esp_ip].pack(anchor="w")
+        labels[esp_ip].config(text=f"{esp_ip}: value={state['value']}")
+
+    scheduler = CoalescingUIScheduler(root, render, fps=20)
+
+    def network_thread():
+        for i in range(2000):
+            scheduler.submit(f"192.168.0.{40 + i % 8}", {'value': i})
+            time.sleep(0.001)
+
+    def report():
+        stats = scheduler.get_stats()
+        print(f"📊 {stats['submitted']} updates -> {stats['painted']} paints in {stats['frames']} frames")
+        print(f"⏱️ Packet -> paint latency: avg {stats['avg_latency_ms']:.1f} ms, "
+              f"max {stats['max_latency_ms']:.1f} ms")
+        scheduler.stop()
+        root.destroy()
+
+    scheduler.start()
+    threading.Thread(target=network_thread, daemon=True).start()
+    root.after(3000, report)
+    root.mainloop()
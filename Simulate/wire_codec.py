@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Wire Codec
+Codec cho telemetry ESP: text (mặc định, tương thích firmware cũ) và frame nhị phân "bin1"
+có header (device id, sequence, timestamp) + field int32 đóng gói.
+Codec được negotiate theo từng ESP lúc discovery, text luôn là fallback.
+
+Frame bin1 (little-endian, 14 byte header):
+    0  magic        uint8   0xFE (không phải ASCII -> phân biệt với text)
+    1  version      uint8   1
+    2  msg_type     uint8   1 = touch
+    3  field_mask   uint8   bit0 raw_touch, bit1 threshold, bit2 value, bit3 touched
+    4  device_id    uint16  id cấp lúc negotiate
+    6  seq          uint32  tăng 1 mỗi frame (wrap 2^32)
+    10 device_time  uint32  millis() trên ESP
+    14 fields       int32 x số bit trong field_mask (theo thứ tự bit)
+
+Heartbeat quảng bá codec: "HEARTBEAT:ESP_NAME;CODEC=bin1,text"
+Phản hồi của server:      "CODEC:bin1,ID:<device_id>"
+"""
+
+import random
+import socket
+import struct
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from telemetry_parser import TelemetryRecord, register_frame_decoder
+
+FRAME_MAGIC = 0xFE
+FRAME_VERSION = 1
+MSG_TOUCH = 1
+
+CODEC_TEXT = "text"
+CODEC_BIN1 = "bin1"
+
+# Thứ tự field trong frame = thứ tự bit trong field_mask
+FRAME_FIELDS = ('raw_touch', 'threshold', 'value', 'touched')
+MASK_TOUCH = 0b0111  # raw_touch + threshold + value
+
+HEADER = struct.Struct('<BBBBHII')
+HEADER_FIELD_COUNT = 7
+
+# Struct cho từng field_mask (16 tổ hợp) - tính một lần
+_MASK_LAYOUTS: Dict[int, Tuple[struct.Struct, Tuple[str, ...]]] = {}
+for _mask in range(1 << len(FRAME_FIELDS)):
+    _names = tuple(name for bit, name in enumerate(FRAME_FIELDS) if _mask & (1 << bit))
+    _MASK_LAYOUTS[_mask] = (struct.Struct('<BBBBHII' + 'i' * len(_names)), _names)
+
+# Fast path: frame touch đầy đủ
+_TOUCH_FRAME = _MASK_LAYOUTS[MASK_TOUCH][0]
+
+
+class TextCodec:
+    """Protocol text hiện tại của firmware"""
+
+    name = CODEC_TEXT
+
+    def encode_touch(self, device_id: int, seq: int, device_time: int, raw_touch: int,
+                     threshold: int, value: int, touched: Optional[int] = None) -> bytes:
+        # Text không mang device_id/seq/timestamp
+        return f"RawTouch:{raw_touch},Threshold:{threshold},Value:{value}".encode('utf-8')
+
+
+class Bin1Codec:
+    """Frame nhị phân version 1"""
+
+    name = CODEC_BIN1
+
+    def encode_touch(self, device_id: int, seq: int, device_time: int, raw_touch: int,
+                     threshold: int, value: int, touched: Optional[int] = None) -> bytes:
+        if touched is None:
+            return _TOUCH_FRAME.pack(FRAME_MAGIC, FRAME_VERSION, MSG_TOUCH, MASK_TOUCH,
+                                     device_id, seq & 0xFFFFFFFF, device_time & 0xFFFFFFFF,
+                                     raw_touch, threshold, value)
+        return encode_frame(device_id, seq, device_time, raw_touch=raw_touch,
+                            threshold=threshold, value=value, touched=touched)
+
+
+CODECS = {
+    CODEC_TEXT: TextCodec(),
+    CODEC_BIN1: Bin1Codec(),
+}
+
+
+def encode_frame(device_id: int, seq: int, device_time: int, **fields) -> bytes:
+    """Đóng gói frame touch với các field có giá trị (raw_touch/threshold/value/touched)"""
+    mask = 0
+    values = []
+    for bit, name in enumerate(FRAME_FIELDS):
+        field_value = fields.get(name)
+        if field_value is not None:
+            mask |= 1 << bit
+            values.append(int(field_value))
+
+    layout, _ = _MASK_LAYOUTS[mask]
+    return layout.pack(FRAME_MAGIC, FRAME_VERSION, MSG_TOUCH, mask, device_id,
+                       seq & 0xFFFFFFFF, device_time & 0xFFFFFFFF, *values)
+
+
+def decode_frame(data) -> TelemetryRecord:
+    """Giải mã frame bin1 (bytes/memoryview) thành TelemetryRecord"""
+    # Fast path: frame touch đầy đủ, 1 lần unpack
+    if len(data) == _TOUCH_FRAME.size:
+        (_, version, msg_type, mask, device_id, seq, device_time,
+         raw_touch, threshold, value) = _TOUCH_FRAME.unpack_from(data)
+        if version == FRAME_VERSION and msg_type == MSG_TOUCH and mask == MASK_TOUCH:
+            record = TelemetryRecord(TelemetryRecord.TOUCH, raw_touch, threshold, value)
+            record.seq = seq
+            record.device_id = device_id
+            record.device_time = device_time
+            return record
+
+    if len(data) < HEADER.size:
+        return TelemetryRecord(TelemetryRecord.ERROR, text=f"Truncated frame ({len(data)} bytes)")
+
+    _, version, msg_type, mask, device_id, seq, device_time = HEADER.unpack_from(data)
+    if version != FRAME_VERSION:
+        return TelemetryRecord(TelemetryRecord.ERROR, text=f"Unsupported frame version {version}")
+    if msg_type != MSG_TOUCH:
+        return TelemetryRecord(TelemetryRecord.ERROR, text=f"Unknown frame type {msg_type}")
+
+    layout, names = _MASK_LAYOUTS[mask & 0x0F]
+    if len(data) < layout.size:
+        return TelemetryRecord(TelemetryRecord.ERROR, text=f"Truncated frame ({len(data)} bytes)")
+
+    values = layout.unpack_from(data)[HEADER_FIELD_COUNT:]
+    record = TelemetryRecord(TelemetryRecord.TOUCH)
+    for name, field_value in zip(names, values):
+        setattr(record, name, field_value)
+    record.seq = seq
+    record.device_id = device_id
+    record.device_time = device_time
+    return record
+
+
+register_frame_decoder(FRAME_MAGIC, decode_frame)
+
+
+def peek_device_id(data) -> Optional[int]:
+    """Device id trong header bin1 (None nếu không phải frame bin1) - để demux data port chung"""
+    if len(data) < HEADER.size or data[0] != FRAME_MAGIC:
+        return None
+    return data[4] | (data[5] << 8)
+
+
+def parse_heartbeat(message: str) -> Tuple[str, List[str]]:
+    """Tách "HEARTBEAT:NAME;CODEC=bin1,text" thành (name, [codec...])
+
+    Firmware cũ không quảng bá codec -> ["text"].
+    """
+    body = message.split(':', 1)[1] if ':' in message else message
+    name, _, options = body.partition(';')
+
+    codecs = []
+    for option in options.split(';'):
+        key, _, value = option.partition('=')
+        if key.strip().upper() == 'CODEC':
+            codecs = [codec.strip().lower() for codec in value.split(',') if codec.strip()]
+
+    return name.strip(), codecs or [CODEC_TEXT]
+
+
+def negotiate_codec(offered: List[str], preferred: Tuple[str, ...] = (CODEC_BIN1, CODEC_TEXT)) -> str:
+    """Chọn codec đầu tiên trong preferred mà ESP hỗ trợ, mặc định text"""
+    for codec in preferred:
+        if codec in offered and codec in CODECS:
+            return codec
+    return CODEC_TEXT
+
+
+class SequenceTracker:
+    """Phát hiện mất gói / đảo thứ tự / trùng gói từ sequence number"""
+
+    WINDOW = 256  # Số seq gần nhất được nhớ để phát hiện trùng
+
+    def __init__(self):
+        self.highest: Optional[int] = None
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self._recent = deque(maxlen=self.WINDOW)
+        self._recent_set = set()
+
+    def _remember(self, seq: int):
+        if len(self._recent) == self._recent.maxlen:
+            self._recent_set.discard(self._recent[0])
+        self._recent.append(seq)
+        self._recent_set.add(seq)
+
+    def update(self, seq: int) -> str:
+        """Ghi nhận seq, trả về 'ok' | 'gap' | 'reordered' | 'duplicate'"""
+        if seq in self._recent_set:
+            self.duplicates += 1
+            return 'duplicate'
+
+        self._remember(seq)
+        self.received += 1
+
+        if self.highest is None:
+            self.highest = seq
+            return 'ok'
+
+        delta = (seq - self.highest) & 0xFFFFFFFF
+        if delta == 1:
+            self.highest = seq
+            return 'ok'
+
+        if delta < 0x80000000:
+            # Nhảy tới trước - các seq ở giữa tạm tính là mất
+            self.lost += delta - 1
+            self.highest = seq
+            return 'gap'
+
+        # Seq cũ hơn highest - tới muộn, không còn tính là mất
+        self.reordered += 1
+        if self.lost > 0:
+            self.lost -= 1
+        return 'reordered'
+
+    def get_stats(self) -> dict:
+        expected = self.received + self.lost
+        return {
+            'received': self.received,
+            'lost': self.lost,
+            'reordered': self.reordered,
+            'duplicates': self.duplicates,
+            'loss_rate': self.lost / expected if expected else 0.0,
+            'last_seq': self.highest,
+        }
+
+
+class SimulatedCube:
+    """ESP giả lập gửi telemetry bằng codec bất kỳ - có thể giả lập mất/đảo gói"""
+
+    def __init__(self, name: str, target: Tuple[str, int], codec: str = CODEC_BIN1,
+                 device_id: int = 1, drop_rate: float = 0.0, reorder_rate: float = 0.0,
+                 bind_ip: Optional[str] = None):
+        self.name = name
+        self.target = target
+        self.codec = CODECS[codec]
+        self.device_id = device_id
+        self.drop_rate = drop_rate
+        self.reorder_rate = reorder_rate
+
+        self.seq = 0
+        self.sent = 0
+        self.dropped = 0
+        self._held: Optional[bytes] = None  # Frame giữ lại để gửi sau (đảo thứ tự)
+        self._start = time.time()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if bind_ip:
+            self.sock.bind((bind_ip, 0))
+
+    def heartbeat(self) -> bytes:
+        """Heartbeat có quảng bá codec"""
+        return f"HEARTBEAT:{self.name};CODEC={self.codec.name}".encode('utf-8')
+
+    def make_touch(self, raw_touch: int, threshold: int, value: int) -> bytes:
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        device_time = int((time.time() - self._start) * 1000)
+        return self.codec.encode_touch(self.device_id, self.seq, device_time,
+                                       raw_touch, threshold, value)
+
+    def send_touch(self, raw_touch: int, threshold: int, value: int):
+        frame = self.make_touch(raw_touch, threshold, value)
+
+        if self.drop_rate and random.random() < self.drop_rate:
+            self.dropped += 1
+            return
+
+        if self._held is None and self.reorder_rate and random.random() < self.reorder_rate:
+            self._held = frame
+            return
+
+        self.sock.sendto(frame, self.target)
+        self.sent += 1
+        if self._held is not None:
+            self.sock.sendto(self._held, self.target)
+            self.sent += 1
+            self._held = None
+
+    def close(self):
+        self.sock.close()
+
+
+# Demo: kích thước, tốc độ parse và phát hiện mất/đảo gói qua loopback
+if __name__ == "__main__":
+    from telemetry_parser import parse_telemetry
+
+    text_frame = CODECS[CODEC_TEXT].encode_touch(0, 0, 0, 1234, 2500, 856)
+    bin_frame = CODECS[CODEC_BIN1].encode_touch(7, 42, 123456, 1234, 2500, 856)
+    print(f"📦 text: {len(text_frame)} bytes, bin1: {len(bin_frame)} bytes")
+    print(f"🔁 round trip: {parse_telemetry(bin_frame).to_dict()}")
+    print(f"🤝 negotiate: {parse_heartbeat('HEARTBEAT:Cube01;CODEC=bin1,text')} -> "
+          f"{negotiate_codec(parse_heartbeat('HEARTBEAT:Cube01;CODEC=bin1,text')[1])}, "
+          f"legacy -> {negotiate_codec(parse_heartbeat('HEARTBEAT:Cube01')[1])}")
+
+    rounds = 200000
+    for name, frame in (("text", text_frame), ("bin1", bin_frame)):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            parse_telemetry(frame)
+        elapsed = time.perf_counter() - start
+        print(f"⚡ {name}: {rounds / elapsed:12,.0f} packets/s")
+
+    # Loopback: 2000 frame, 2% mất, 2% đảo thứ tự
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(0.5)
+
+    cube = SimulatedCube("Cube01", receiver.getsockname(), drop_rate=0.02, reorder_rate=0.02)
+    for i in range(2000):
+        cube.send_touch(3000 + i % 50, 2932, i % 700)
+
+    tracker = SequenceTracker()
+    try:
+        while True:
+            record = parse_telemetry(receiver.recv(64))
+            tracker.update(record.seq)
+    except socket.timeout:
+        pass
+
+    print(f"🧪 sent={cube.sent} dropped={cube.dropped} -> {tracker.get_stats()}")
+    cube.close()
+    receiver.close()